@@ -2,11 +2,12 @@
 # draft 4.1 - simplified
 import streamlit as st
 import pandas as pd
+import plotly.graph_objects as go
 import sys
 import os
+import time
 import traceback
 from datetime import date, datetime, timedelta
-from io import BytesIO
 from github_settings import get_settings_manager, get_plan_adjustment_manager
 from multon_excel_parser import parse_multon_excel_to_df, preview_multon_plan
 from optima_rs_parser import parse_optima_rs_excel, preview_optima_rs_mapping
@@ -14,6 +15,26 @@ from multibrand_excel_parser import parse_multibrand_excel, preview_multibrand_p
 from github_settings import get_multibrand_plan_manager
 from region_coefficients_parser import parse_region_coefficients_excel, preview_region_coefficients
 from github_settings import get_region_coefficient_manager
+from compute_core import (
+    calculate_plan_fact, run_pipeline, normalize_source_frame,
+    normalize_stage_weights, period_signature, PIPELINE_STAGES,
+    preview_plan_adjustments, adjustment_summary, replan_stage_weights
+)
+from visit_calculator import load_plan_sources_from_managers
+from diagnostics import Diagnostics
+from snapshot_store import (
+    SnapshotStore, input_fingerprints, settings_fingerprint, snapshot_key, snapshot_calc_params
+)
+from job_runner import job_manager, JOB_DONE, JOB_ERROR
+from result_cache import result_cache
+from tracer import Tracer
+from profiler import Profiler, CAPTURE_MODES, list_profiles, compare_profiles, state_memory
+from frame_store import FrameDict, frame_store
+from rollup_cube import RollupCube
+from export_service import (
+    excel_download_button, frame_download_button, bundle_download_button, export_service,
+    EXPORT_FORMATS, FORMAT_LABELS
+)
 
 # Инициализация временных корректировок
 if 'temp_adjustments' not in st.session_state:
@@ -29,13 +50,7 @@ def load_excel(file_obj, file_key):
         df = pd.read_excel(file_obj, dtype=str)
         
         # Сжимаем пробелы во всех строковых колонках
-        for col in df.columns:
-            if df[col].dtype == 'object':  # строковые колонки
-                df[col] = df[col].astype(str).str.strip()
-                # Заменяем пустые строки и 'nan' на пустую строку
-                df[col] = df[col].replace(['nan', 'None', 'null', ''], '')
-        
-        return df
+        return normalize_source_frame(df)
     except Exception as e:
         st.error(f"Ошибка загрузки файла {file_key}: {e}")
         return None
@@ -84,13 +99,36 @@ DEFAULT_STATE = {
     'plan_calc_params': None,
     'data_calculated': False,
     'last_calculation_hash': None,
-    'last_files_hash': None
+    'last_files_hash': None,
+    'input_fingerprints': None,
+    'loaded_snapshot': None,
+    'calc_job_id': None,
+    'trace_key': None,
+    'last_trace': None,
+    'profile_capture': None,
+    'profile_memory': False,
+    'export_format': 'xlsx',
+    'last_profile': None,
+    'plan_sources_status': None
 }
 
+# Словари с большими таблицами: таблицы выгружаются на диск (frame_store)
+SPILLED_STATE = ('uploaded_files', 'cleaned_data', 'visit_report')
+
 for key, default_value in DEFAULT_STATE.items():
     if key not in st.session_state:
         st.session_state[key] = default_value
 
+
+def session_frames(values=None):
+    """Словарь таблиц сессии с выгрузкой больших DataFrame на диск"""
+    return FrameDict(frame_store, values=values)
+
+
+for key in SPILLED_STATE:
+    if not isinstance(st.session_state[key], FrameDict):
+        st.session_state[key] = session_frames(st.session_state[key])
+
 # Вспомогательные функции
 
 def deduplicate_by_priority(df, priority_sources):
@@ -121,9 +159,282 @@ def deduplicate_by_priority(df, priority_sources):
     
     return df
     
+def without_prodata(df):
+    """Полевые проекты для выгрузки: без ПроДата (Мониторинги)"""
+    if 'Источник' in df.columns:
+        return df[df['Источник'] != 'Мониторинги']
+    return df
+
+
+def render_calculation_downloads():
+    """Выгрузки промежуточных таблиц последнего расчета (в формате из сайдбара)"""
+    tables = [
+        ('base_data', "📥 Скачать base_data (иерархия)", "download_base_data"),
+        ('plan_result', "📥 Скачать plan_result", "download_plan_result"),
+        ('fact_result', "📥 Скачать fact_result", "download_fact_result"),
+        ('calculated_data', "📥 Скачать calculated_data (итог)", "download_calculated_data")
+    ]
+    for name, label, key in tables:
+        df = st.session_state.visit_report.get(name)
+        if df is not None and not df.empty:
+            frame_download_button(
+                df, name, label,
+                file_stem=f"{name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
+                fmt=st.session_state.export_format,
+                key=key
+            )
+
+
+def report_frames():
+    """Все таблицы отчета для архива: {имя файла: DataFrame}"""
+    field_projects = st.session_state.cleaned_data.get('полевые_проекты')
+    return {
+        'base_data': st.session_state.visit_report.get('base_data'),
+        'plan_result': st.session_state.visit_report.get('plan_result'),
+        'fact_result': st.session_state.visit_report.get('fact_result'),
+        'calculated_data': st.session_state.visit_report.get('calculated_data'),
+        'полевые_проекты': without_prodata(field_projects) if field_projects is not None else None,
+        'динамика_факта': st.session_state.get('dynamics_report')
+    }
+
+
+def current_tracer():
+    """Трассировщик по ключу из отладочной панели (None - трассировка выключена)"""
+    trace_key = st.session_state.get('trace_key')
+    if not trace_key:
+        return None
+    return Tracer(**trace_key)
+
+
+def new_profiler():
+    """Профилировщик расчета (полный профиль и режим памяти - если выбраны в сайдбаре)"""
+    return Profiler(
+        capture=st.session_state.get('profile_capture'),
+        memory=st.session_state.get('profile_memory', False)
+    )
+
+
+def cached_result(cached, rows=None):
+    """Результат из общего кэша с собственным профилем (расчет не выполнялся)"""
+    profiler = Profiler()
+    profiler.cache_hit('Общий кэш расчетов', rows)
+    return dict(cached, profile=profiler)
+
+
+def save_profile(profiler):
+    """Сохраняет профиль расчета для сравнения запусков (ошибка записи не мешает расчету)"""
+    try:
+        profiler.save()
+    except OSError:
+        pass
+
+
+def result_fingerprints(excluded_df, included_df, plan_sources):
+    """Отпечатки входных файлов и настроек/корректировок (ключ общего кэша и снимков)"""
+    fingerprints = st.session_state.get('input_fingerprints')
+    if not fingerprints:
+        fingerprints = input_fingerprints(st.session_state.uploaded_files)
+        st.session_state.input_fingerprints = fingerprints
+    fingerprints = dict(fingerprints)
+    fingerprints['настройки'] = settings_fingerprint(excluded_df, included_df, plan_sources)
+    return fingerprints
+
+
+def save_result_snapshot(excluded_df, included_df, plan_sources):
+    """Сохраняет результат расчета в снимок (ошибка записи не прерывает расчет)"""
+    try:
+        fingerprints = result_fingerprints(excluded_df, included_df, plan_sources)
+        cube = st.session_state.visit_report.get('rollup_cube')
+        
+        frames = {
+            'base_data': st.session_state.visit_report.get('base_data'),
+            'calculated_data': st.session_state.visit_report.get('calculated_data'),
+            'полевые_проекты': st.session_state.cleaned_data.get('полевые_проекты'),
+            'prodata_processed': st.session_state.cleaned_data.get('prodata_processed'),
+            'rollup_cube': cube.to_frame() if cube is not None else None
+        }
+        SnapshotStore().save(frames, fingerprints, st.session_state.plan_calc_params)
+    except Exception as e:
+        st.warning(f"⚠️ Снимок результата не сохранен: {str(e)}")
+
+
+def open_latest_snapshot():
+    """Открывает последний снимок: отчеты строятся без загрузки файлов и расчета"""
+    frames, meta = SnapshotStore().load_latest()
+    if meta is None:
+        return False
+    
+    calculated_data = frames.get('calculated_data', pd.DataFrame())
+    # Снимки без куба (сохраненные раньше) - куб строится по итоговой таблице
+    if 'rollup_cube' in frames:
+        cube = RollupCube.from_frame(frames['rollup_cube'])
+    else:
+        cube = RollupCube(calculated_data) if not calculated_data.empty else None
+    st.session_state.visit_report = session_frames({
+        'base_data': frames.get('base_data', pd.DataFrame()),
+        'calculated_data': calculated_data,
+        'rollup_cube': cube,
+        'timestamp': meta.get('created_at')
+    })
+    st.session_state.cleaned_data = session_frames({
+        name: frames[name] for name in ('полевые_проекты', 'prodata_processed') if name in frames
+    })
+    st.session_state.loaded_snapshot = meta
+    st.session_state.data_calculated = True
+    return True
+
+
+def apply_settings_and_calculate(sources, settings_manager=None, plan_sources=None):
+    """
+    Применение настроек проектов и расчет план/факт по очищенным источникам
+    (compute_core.calculate_plan_fact) с сохранением результата в session_state
+    """
+    # Загружаем настройки
+    if settings_manager is None:
+        settings_manager = get_settings_manager()
+    
+    excluded_df = settings_manager.get_excluded_projects()
+    included_df = settings_manager.get_included_projects()
+    
+    loaded_sources = set(st.session_state.uploaded_files.keys())
+    if plan_sources is None:
+        plan_sources = load_plan_sources_from_managers(loaded_sources)
+    
+    # Такой расчет уже выполнялся (в любой сессии) - берем готовый результат.
+    # При трассировке считаем заново: журнал пишется только во время расчета
+    tracer = current_tracer()
+    if tracer is None:
+        fingerprints = result_fingerprints(excluded_df, included_df, plan_sources)
+        cached = result_cache.get(snapshot_key(fingerprints, st.session_state.plan_calc_params))
+        if cached is not None:
+            return use_pipeline_result(cached_result(cached), excluded_df, included_df, plan_sources)
+    
+    # Очищенные источники взяты из кэша сессии
+    profiler = new_profiler()
+    profiler.cache_hit('Очистка источников', len(sources['field_df']))
+    profiler.start_capture()
+    try:
+        # Расчет пишет в обычный словарь, на диск выгружается только итог
+        result = calculate_plan_fact(
+            sources, st.session_state.plan_calc_params, excluded_df, included_df, plan_sources,
+            loaded_sources=loaded_sources,
+            cleaned_data={},
+            diagnostics=Diagnostics(),
+            profiler=profiler,
+            tracer=tracer
+        )
+    finally:
+        profiler.stop_capture()
+    save_profile(profiler)
+    st.session_state.cleaned_data.update(result['cleaned_data'])
+    return publish_calculation_result(result, excluded_df, included_df, plan_sources)
+
+
+def use_pipeline_result(result, excluded_df, included_df, plan_sources):
+    """
+    Результат полного расчета (run_pipeline) → session_state.
+    Таблицы общие с кэшем, поэтому копируются только словари сессии.
+    """
+    st.session_state.cleaned_data = session_frames(result['cleaned_data'])
+    # Кэш очищенных источников для быстрого пересчета по настройкам
+    st.session_state.cleaned_data['подготовленные_источники'] = result['sources']
+    return publish_calculation_result(result, excluded_df, included_df, plan_sources)
+
+
+def publish_calculation_result(result, excluded_df, included_df, plan_sources):
+    """Сохраняет результат расчета в session_state, снимок и выводит выгрузки"""
+    st.session_state.visit_report.update(result['visit_report'])
+    # Промежуточные таблицы - для выгрузки по запросу (render_calculation_downloads)
+    st.session_state.visit_report['plan_result'] = result['plan_result']
+    st.session_state.visit_report['fact_result'] = result['fact_result']
+    # План до корректировок - для предпросмотра корректировок без пересчета
+    st.session_state.visit_report['plan_unadjusted'] = result.get('plan_unadjusted')
+    # Геометрия этапов и корректировки расчета - для пересчета при движении весов этапов
+    st.session_state.visit_report['stage_geometry'] = result.get('stage_geometry')
+    st.session_state.visit_report['plan_adjustments'] = result.get('plan_adjustments')
+    if result.get('stage_geometry') is not None:
+        st.session_state.visit_report['report_coefficients'] = result['stage_geometry'].coefficients
+    # Таблица динамики строится вкладкой отчетов заново
+    st.session_state.dynamics_report = None
+    st.session_state.last_trace = result.get('trace')
+    st.session_state.last_profile = result.get('profile')
+    st.session_state.plan_sources_status = result.get('plan_sources_status')
+    # Режим памяти: какие ключи сессии держат больше всего (попадает в JSON профиля)
+    if st.session_state.last_profile is not None and st.session_state.last_profile.memory:
+        st.session_state.last_profile.record_state(st.session_state)
+        save_profile(st.session_state.last_profile)
+    if result['not_found_projects'] is not None:
+        st.session_state.not_found_projects = result['not_found_projects']
+    
+    result['diagnostics'].render()
+    
+    # Снимок результата: отчеты можно открыть позже без загрузки и расчета
+    st.session_state.loaded_snapshot = None
+    save_result_snapshot(excluded_df, included_df, plan_sources)
+    
+    # Выводим предупреждение о ненайденных проектах
+    if 'not_found_projects' in st.session_state and not st.session_state.not_found_projects.empty:
+        st.warning("⚠️ Следующие проекты не найдены в загруженных данных:")
+        st.dataframe(st.session_state.not_found_projects, width='stretch')
+        st.info("💡 Проверьте: возможно, визиты по этим проектам не были загружены, или указан неверный портал.")
+        
+    st.session_state.processing_complete = True
+    st.session_state.data_calculated = 'calculated_data' in result['visit_report']
+    return True
+
+
+def replan_for_stage_weights(calc_params):
+    """
+    Веса этапов изменились после расчета (период тот же) - план на дату и отчет
+    пересчитываются по геометрии этапов без полного расчета. Возвращает время в мс или None.
+    """
+    report = st.session_state.visit_report
+    geometry = report.get('stage_geometry')
+    if geometry is None or report.get('fact_result') is None or not geometry.same_period(calc_params):
+        return None
+    if list(calc_params['coefficients']) == list(report.get('report_coefficients', geometry.coefficients)):
+        return None
+
+    started = time.perf_counter()
+    plan_unadjusted, plan_result, calculated_data = replan_stage_weights(
+        report['fact_result'], report['plan_unadjusted'], geometry,
+        report.get('plan_adjustments') or {}, calc_params
+    )
+    report['plan_unadjusted'] = plan_unadjusted
+    report['plan_result'] = plan_result
+    report['calculated_data'] = calculated_data
+    report['rollup_cube'] = RollupCube(calculated_data)
+    report['report_coefficients'] = list(calc_params['coefficients'])
+    st.session_state.dynamics_report = None
+    return (time.perf_counter() - started) * 1000
+
+
+def _calculation_job(uploaded_files, calc_params, excluded_df, included_df, plan_sources,
+                     cache_key=None, tracer=None, profiler=None, progress=None):
+    """Полный расчет в рабочем потоке (без обращений к streamlit)"""
+    profiler = profiler or Profiler()
+    # Полный профиль снимается в рабочем потоке - там идет расчет
+    profiler.start_capture()
+    try:
+        result = run_pipeline(
+            uploaded_files, calc_params, excluded_df, included_df, plan_sources,
+            progress=progress, tracer=tracer, profiler=profiler
+        )
+    finally:
+        profiler.stop_capture()
+    save_profile(profiler)
+    if result is not None and cache_key is not None:
+        result_cache.put(cache_key, result)
+    return result
+
+
 def process_all_data(settings_manager=None, force_recalc=False):
     
-    """Полная обработка данных и расчет план/факт"""
+    """
+    Полная обработка данных и расчет план/факт.
+    Расчет запускается фоновой задачей, результат забирает collect_calculation_job()
+    при следующем перезапуске скрипта.
+    """
 
     # Проверяем, изменились ли загруженные файлы
     current_files_hash = hash(frozenset(st.session_state.uploaded_files.keys()))
@@ -135,694 +446,257 @@ def process_all_data(settings_manager=None, force_recalc=False):
     if not force_recalc and st.session_state.get('data_calculated', False):
         return True
     
-    # Загрузка, очистка    
+    # Настройки и плановые справочники читаются здесь: менеджеры GitHub работают через streamlit
     try:
-        import time
-        start_total = time.time()
-        start = start_total
-
-        if 'debug_times' not in st.session_state:
-            st.session_state.debug_times = []
-        st.session_state.debug_times = []
-        
-        # Проверяем наличие Сервизория (всегда обязательна)
-        if 'сервизория' not in st.session_state.uploaded_files:
-            return False
-        
-        # Проверяем наличие ХОТЯ БЫ одного источника визитов
-        has_visits_source = (
-            'портал' in st.session_state.uploaded_files or
-            'cxway' in st.session_state.uploaded_files or
-            'easymerch' in st.session_state.uploaded_files or
-            'optima' in st.session_state.uploaded_files
-        )
-        
-        if not has_visits_source:
-            return False
-        
-        # Получаем данные
-        google_raw = st.session_state.uploaded_files['сервизория']
-        
-        # ОЧИСТКА ПРОЕКТОВ (GOOGLE)
-        google_cleaned = data_cleaner.clean_google(google_raw)
-        if google_cleaned is None:
-            google_cleaned = google_raw
-        st.session_state.cleaned_data['сервизория'] = google_cleaned
-        st.session_state.cleaned_data['сервизория_original'] = google_raw.copy()
-        
-        # Добавление признака полевой проект
-        google_with_field = data_cleaner.update_field_projects_flag(st.session_state.cleaned_data['сервизория'])
-        st.session_state.cleaned_data['сервизория'] = google_with_field
-        st.session_state.debug_times.append(f"[DEBUG] Очистка: {time.time() - start:.2f} сек")
-        start = time.time()
-        
-
-        # ОБРАБОТКА ПОРТАЛА (CHECKER) - ЕСЛИ ЗАГРУЖЕН
-        if 'портал' in st.session_state.uploaded_files:
-            portal_raw = st.session_state.uploaded_files['портал']
-            portal_cleaned = data_cleaner.clean_array(portal_raw)
-            if portal_cleaned is None:
-                portal_cleaned = portal_raw
-            st.session_state.cleaned_data['портал'] = portal_cleaned
-            
-            enriched_result = data_cleaner.enrich_array_with_project_codes(
-                st.session_state.cleaned_data['портал'],
-                st.session_state.cleaned_data['сервизория']  # ← ТЕПЕРЬ СУЩЕСТВУЕТ!
-            )
-            
-            if enriched_result:
-                enriched_array, discrepancy_df, stats = enriched_result
-                st.session_state.cleaned_data['портал'] = enriched_array
-        else:
-            st.session_state.cleaned_data['портал'] = pd.DataFrame()
-
-        
-        # ОБОГАЩЕНИЕ ДАННЫХ (ОПТИМИЗИРОВАННО)
-        
-        # Добавляем поле 'Полевой' и 'ПО' (только если есть портал)
-        if 'портал' in st.session_state.cleaned_data and not st.session_state.cleaned_data['портал'].empty:
-            array_with_field = data_cleaner.add_field_flag_to_array(st.session_state.cleaned_data['портал'])
-            array_with_portal = data_cleaner.add_portal_to_array(array_with_field, google_with_field)
-            array_with_portal = data_cleaner.remove_cxway_from_portal(array_with_portal, google_with_field)
-            st.session_state.cleaned_data['портал_с_полем'] = array_with_portal
-        else:
-            st.session_state.cleaned_data['портал_с_полем'] = pd.DataFrame()
-        
-        # Разделение на полевые/неполевые (только если есть портал_с_полем)
-        if not st.session_state.cleaned_data['портал_с_полем'].empty:
-            field_df, non_field_df = data_cleaner.split_array_by_field_flag(
-                st.session_state.cleaned_data['портал_с_полем']
-            )
-        else:
-            field_df = pd.DataFrame()
-            non_field_df = pd.DataFrame()
-        
-        # Загружаем настройки
         if settings_manager is None:
             settings_manager = get_settings_manager()
-        
         excluded_df = settings_manager.get_excluded_projects()
         included_df = settings_manager.get_included_projects()
-        
-        # ============================================
-        # ВЕКТОРИЗОВАННОЕ ПРИМЕНЕНИЕ НАСТРОЕК
-        # ============================================
-        
-        # Применяем исключенные проекты (делаем их неполевыми)
-        if not excluded_df.empty and field_df is not None and not field_df.empty:
-            # Создаем временные ключи для быстрого поиска
-            field_df['_temp_key'] = (
-                field_df['Имя клиента'].astype(str) + '|' + 
-                field_df['Название проекта'].astype(str) + '|' + 
-                field_df['Код анкеты'].astype(str)
-            )
-            excluded_df['_temp_key'] = (
-                excluded_df['Название проекта'].astype(str) + '|' + 
-                excluded_df['Волна'].astype(str) + '|' + 
-                excluded_df['Код проекта'].astype(str)
-            )
-            
-            # Одна операция вместо цикла
-            mask = field_df['_temp_key'].isin(excluded_df['_temp_key'])
-            field_df.loc[mask, 'Полевой'] = 0
-            
-            # Удаляем временные колонки
-            field_df = field_df.drop('_temp_key', axis=1)
-            # excluded_df не сохраняем, не нужно удалять
-        
-        # Применяем добавленные проекты (делаем их полевыми)
-        if not included_df.empty and non_field_df is not None and not non_field_df.empty:
-            # Создаем временные ключи
-            non_field_df['_temp_key'] = (
-                non_field_df['Имя клиента'].astype(str) + '|' + 
-                non_field_df['Название проекта'].astype(str) + '|' + 
-                non_field_df['Код анкеты'].astype(str)
-            )
-            included_df['_temp_key'] = (
-                included_df['Название проекта'].astype(str) + '|' + 
-                included_df['Волна'].astype(str) + '|' + 
-                included_df['Код проекта'].astype(str)
+        plan_sources = load_plan_sources_from_managers(set(st.session_state.uploaded_files.keys()))
+        
+        # Предыдущая задача этой сессии больше не нужна
+        if st.session_state.calc_job_id:
+            job_manager.cancel(st.session_state.calc_job_id)
+        
+        st.session_state.input_fingerprints = None
+        fingerprints = result_fingerprints(excluded_df, included_df, plan_sources)
+        cache_key = snapshot_key(fingerprints, st.session_state.plan_calc_params)
+        
+        # Те же файлы и настройки уже считались (в любой сессии) - расчет не нужен.
+        # При трассировке считаем заново: журнал пишется только во время расчета
+        tracer = current_tracer()
+        cached = result_cache.get(cache_key) if tracer is None else None
+        if cached is not None:
+            calculated_data = cached['visit_report'].get('calculated_data')
+            use_pipeline_result(
+                cached_result(cached, len(calculated_data) if calculated_data is not None else None),
+                excluded_df, included_df, plan_sources
             )
-            
-            # Одна операция вместо цикла
-            mask = non_field_df['_temp_key'].isin(included_df['_temp_key'])
-            non_field_df.loc[mask, 'Полевой'] = 1
-            
-            # Удаляем временные колонки
-            non_field_df = non_field_df.drop('_temp_key', axis=1)
-        
-        # Объединяем все проекты в один датасет
-        # Проверяем, есть ли данные из портала
-        if not field_df.empty or not non_field_df.empty:
-            all_projects = pd.concat([field_df, non_field_df], ignore_index=True)
-        else:
-            # Если портала нет — создаем пустой DataFrame с нужными колонками
-            all_projects = pd.DataFrame(columns=[
-                'Код анкеты', 'Имя клиента', 'Название проекта', 
-                'ЗОД', 'АСС', 'ЭМ', 'Регион short', 'Регион', 'ПО', 
-                'Полевой', 'Статус', 'Дата визита', 'Оплата факт', 'Источник'
-            ])
-        st.session_state.cleaned_data['all_projects'] = all_projects
-        
-        # Создаем датасеты из портала (если есть данные)
-        if not all_projects.empty and 'Полевой' in all_projects.columns:
-            field_df = all_projects[all_projects['Полевой'] == 1].copy()
-            non_field_df = all_projects[all_projects['Полевой'] == 0].copy()
-            st.session_state.cleaned_data['полевые_проекты'] = all_projects[all_projects['Полевой'] == 1].copy()
-            st.session_state.cleaned_data['неполевые_проекты'] = all_projects[all_projects['Полевой'] == 0].copy()
-        else:
-            field_df = pd.DataFrame()
-            non_field_df = pd.DataFrame()
-            st.session_state.cleaned_data['полевые_проекты'] = pd.DataFrame()
-            st.session_state.cleaned_data['неполевые_проекты'] = pd.DataFrame()
-    
-        
-        # ============================================
-        # ВЕКТОРИЗОВАННОЕ ДОБАВЛЕНИЕ ЗОД
-        # ============================================
-        
-        # Добавление ЗОД из встроенного справочника (векторизовано)
-        if field_df is not None and not field_df.empty:
-            # Получаем ЗОД через словарь (быстрее чем apply)
-            field_df_with_zod = data_cleaner.add_zod_from_hierarchy(field_df)
-            
-            # Создаем словарь для быстрого обновления
-            if not field_df_with_zod.empty:
-                # Создаем временный ключ для поиска
-                all_projects['_temp_key'] = (
-                    all_projects['Имя клиента'].astype(str) + '|' + 
-                    all_projects['Название проекта'].astype(str) + '|' + 
-                    all_projects['Код анкеты'].astype(str)
-                )
-                
-                # Создаем маппинг ЗОД по ключу
-                zod_mapping = {}
-                for _, row in field_df_with_zod.iterrows():
-                    key = (
-                        str(row['Имя клиента']) + '|' + 
-                        str(row['Название проекта']) + '|' + 
-                        str(row['Код анкеты'])
-                    )
-                    zod_mapping[key] = row['ЗОД']
-                
-                # Обновляем ЗОД одним проходом
-                mask = all_projects['_temp_key'].isin(zod_mapping.keys())
-                all_projects.loc[mask, 'ЗОД'] = all_projects.loc[mask, '_temp_key'].map(zod_mapping)
-                
-                # Удаляем временную колонку
-                all_projects = all_projects.drop('_temp_key', axis=1)
-        
-        # ============================================
-        # ОБРАБОТКА ДОПОЛНИТЕЛЬНЫХ ИСТОЧНИКОВ
-        # ============================================
-        
-        # Обработка Easymerch (если есть)
-        easymerch_processed = None
-        easymerch_raw = st.session_state.uploaded_files.get('easymerch')
-        if easymerch_raw is not None:
-            easymerch_processed = data_cleaner.clean_easymerch(easymerch_raw, google_with_field)
-            if easymerch_processed is not None and not easymerch_processed.empty:
-                st.session_state.cleaned_data['easymerch_processed'] = easymerch_processed
-        
-        # Обработка Optima (если есть)
-        optima_processed = None
-        optima_raw = st.session_state.uploaded_files.get('optima')
-        if optima_raw is not None:
-            try:
-                optima_processed = data_cleaner.clean_optima(optima_raw, google_with_field)
-                if optima_processed is not None and not optima_processed.empty:
-                    st.session_state.cleaned_data['optima_processed'] = optima_processed
-            except Exception as e:
-                st.warning(f"⚠️ Ошибка при обработке Optima: {e}")
-
-        # Обработка ПроДата (Мониторинги)
-        prodata_processed = None
-        prodata_raw = st.session_state.uploaded_files.get('prodata')
-        if prodata_raw is not None:
-            try:
-                prodata_processed = data_cleaner.clean_prodata(prodata_raw, google_with_field)
-                if prodata_processed is not None and not prodata_processed.empty:
-                    st.session_state.cleaned_data['prodata_processed'] = prodata_processed
-            except Exception as e:
-                st.warning(f"⚠️ Ошибка при обработке ПроДата: {e}")
-
-        # Обработка БДР (плановая оплата) - опционально
-        bdr_processed = None
-        bdr_raw = st.session_state.uploaded_files.get('bdr')
-        if bdr_raw is not None:
-            bdr_processed = data_cleaner.clean_bdr(bdr_raw)
-            if bdr_processed is not None and not bdr_processed.empty:
-                st.session_state.cleaned_data['bdr_processed'] = bdr_processed
+            st.session_state.show_messages = True
+            return True
+        
+        # Одинаковый расчет, уже идущий в другой сессии, не запускается повторно
+        st.session_state.calc_job_id = job_manager.submit(
+            _calculation_job,
+            dict(st.session_state.uploaded_files),
+            dict(st.session_state.plan_calc_params),
+            excluded_df, included_df, plan_sources,
+            cache_key=cache_key,
+            tracer=tracer,
+            profiler=new_profiler(),
+            total_stages=len(PIPELINE_STAGES),
+            key=cache_key if tracer is None else None,
+            context={'excluded_df': excluded_df, 'included_df': included_df, 'plan_sources': plan_sources}
+        )
+        return True
         
-        # Обработка CXWAY (если есть)
-        cxway_processed = None
-        cxway_raw = st.session_state.uploaded_files.get('cxway')
-        if cxway_raw is not None:
-            cxway_processed = data_cleaner.clean_cxway(cxway_raw, None, google_with_field)
-            
-            # Разделяем CXWAY на полевые и неполевые
-            if cxway_processed is not None and not cxway_processed.empty:
-                cxway_field = cxway_processed[cxway_processed['Полевой'] == 1]
-                cxway_non_field = cxway_processed[cxway_processed['Полевой'] == 0]
-                
-                # Неполевые добавляем в неполевые проекты сразу
-                if not cxway_non_field.empty:
-                    st.session_state.cleaned_data['неполевые_проекты'] = pd.concat([
-                        st.session_state.cleaned_data['неполевые_проекты'],
-                        cxway_non_field
-                    ], ignore_index=True)
-
+    except Exception as e:
+        st.session_state.last_error = {
+            'step': 'Общая обработка',
+            'error': str(e),
+            'traceback': traceback.format_exc()
+        }
+        return False
 
-        # ============================================
-        # УДАЛЕНИЕ ДУБЛЕЙ ПО ПРИОРИТЕТУ ИЗ GOOGLE (ВЕКТОРИЗИРОВАННО)
-        # ============================================
-        
-        if cxway_processed is not None and not cxway_processed.empty and field_df is not None and not field_df.empty:
-            # Ключи проектов
-            cxway_keys = (
-                cxway_processed['Код анкеты'].astype(str).str.strip() + '|' +
-                cxway_processed['Название проекта'].astype(str).str.strip()
-            )
-            portal_keys = (
-                field_df['Код анкеты'].astype(str).str.strip() + '|' +
-                field_df['Название проекта'].astype(str).str.strip()
-            )
-            
-            # Какие проекты в Google отмечены как Чеккер
-            checker_keys = set()
-            if google_with_field is not None and not google_with_field.empty:
-                google_code_col = data_cleaner._find_column(google_with_field, ['Код проекта RU00.000.00.01SVZ24', 'Код проекта'])
-                google_portal_col = data_cleaner._find_column(google_with_field, ['Портал на котором идет проект (для работы полевой команды)', 'ПО'])
-                google_wave_col = data_cleaner._find_column(google_with_field, ['Название волны на Чекере/ином ПО', 'Волна'])
-                
-                if google_code_col and google_portal_col:
-                    for _, row in google_with_field.iterrows():
-                        code = str(row.get(google_code_col, '')).strip()
-                        wave = str(row.get(google_wave_col, '')).strip() if google_wave_col else ''
-                        portal = str(row.get(google_portal_col, '')).strip()
-                        if code and portal == 'Чеккер':
-                            checker_keys.add(f"{code}|{wave}")
-            
-            # Находим пересекающиеся проекты
-            common_mask = cxway_keys.isin(portal_keys)
-            common_keys = cxway_keys[common_mask].unique()
-            
-            # Разделяем на два множества
-            remove_from_cxway = [k for k in common_keys if k in checker_keys]
-            remove_from_portal = [k for k in common_keys if k not in checker_keys]
-            
-            # Векторизированное удаление из CXWAY
-            if remove_from_cxway:
-                cxway_processed = cxway_processed[~cxway_keys.isin(remove_from_cxway)]
-            
-            # Векторизированное удаление из портала
-            if remove_from_portal:
-                field_df = field_df[~portal_keys.isin(remove_from_portal)]
-                # Обновляем field_df_with_zod для слияния
-                if not field_df.empty:
-                    field_df_with_zod = data_cleaner.add_zod_from_hierarchy(field_df)
-                else:
-                    field_df_with_zod = pd.DataFrame()
-                    
-            
-        
-        # ============================================
-        # ФИНАЛЬНОЕ ОБЪЕДИНЕНИЕ ВСЕХ ИСТОЧНИКОВ
-        # ============================================
-        
-        sources_for_merge = []
-        
-        if field_df is not None and not field_df.empty:
-            sources_for_merge.append(field_df_with_zod)
-            
-        if cxway_processed is not None and not cxway_processed.empty:
-            cxway_field_only = cxway_processed[cxway_processed['Полевой'] == 1].copy()
-            if not cxway_field_only.empty:
-                sources_for_merge.append(cxway_field_only)
-        
-        if easymerch_processed is not None and not easymerch_processed.empty:
-            sources_for_merge.append(easymerch_processed)
-            
-        if optima_processed is not None and not optima_processed.empty:
-            sources_for_merge.append(optima_processed)
-        
-        if prodata_processed is not None and not prodata_processed.empty:
-            st.session_state.cleaned_data['prodata_processed'] = prodata_processed
-        
-        if sources_for_merge:
-            all_field_projects = pd.concat(sources_for_merge, ignore_index=True)
-            st.session_state.cleaned_data['полевые_проекты'] = all_field_projects
-        else:
-            st.session_state.cleaned_data['полевые_проекты'] = pd.DataFrame()
-
-        # ============================================
-        # ДОБАВЛЯЕМ ЗОД ДЛЯ ВСЕХ ПОЛЕВЫХ ПРОЕКТОВ
-        # ============================================
-        if not st.session_state.cleaned_data['полевые_проекты'].empty:
-            all_field_projects_with_zod = data_cleaner.add_zod_from_hierarchy(
-                st.session_state.cleaned_data['полевые_проекты']
-            )
-            st.session_state.cleaned_data['полевые_проекты'] = all_field_projects_with_zod
-        
-        # Добавляем ЗОД для неполевых проектов
-        if not st.session_state.cleaned_data['неполевые_проекты'].empty:
-            non_field_with_zod = data_cleaner.add_zod_from_hierarchy(
-                st.session_state.cleaned_data['неполевые_проекты']
-            )
-            st.session_state.cleaned_data['неполевые_проекты'] = non_field_with_zod
 
-        # ============================================
-        # ПРИМЕНЕНИЕ НАСТРОЕК ДЛЯ CXWAY/EASYMERCH/OPTIMA
-        # ============================================
-        
-        # 1. Обрабатываем excluded_df (исключаем проекты из расчета)
-        if not excluded_df.empty and not all_field_projects.empty:
-            excluded_df['_key'] = (
-                excluded_df['Название проекта'].astype(str).str.strip() + '|' +
-                excluded_df['Волна'].astype(str).str.strip() + '|' +
-                excluded_df['Код проекта'].astype(str).str.strip()
-            )
-            
-            all_field_projects['_key'] = (
-                all_field_projects['Имя клиента'].astype(str).str.strip() + '|' +
-                all_field_projects['Название проекта'].astype(str).str.strip() + '|' +
-                all_field_projects['Код анкеты'].astype(str).str.strip()
-            )
-            
-            all_field_projects = all_field_projects[~all_field_projects['_key'].isin(excluded_df['_key'])]
-            all_field_projects = all_field_projects.drop('_key', axis=1)
-            excluded_df = excluded_df.drop('_key', axis=1)
-            
-            st.session_state.cleaned_data['полевые_проекты'] = all_field_projects
-        
-        # 2. Обрабатываем included_df (добавляем проекты в расчет)
-        if not included_df.empty:
-            included_df['_key'] = (
-                included_df['Название проекта'].astype(str).str.strip() + '|' +
-                included_df['Волна'].astype(str).str.strip() + '|' +
-                included_df['Код проекта'].astype(str).str.strip()
-            )
-            
-            # Создаем ключи в all_field_projects
-            if not all_field_projects.empty:
-                all_field_projects['_key'] = (
-                    all_field_projects['Имя клиента'].astype(str).str.strip() + '|' +
-                    all_field_projects['Название проекта'].astype(str).str.strip() + '|' +
-                    all_field_projects['Код анкеты'].astype(str).str.strip()
-                )
-                existing_keys = set(all_field_projects['_key'])
-            else:
-                existing_keys = set()
-            
-            # Находим проекты, которых еще нет
-            new_projects = included_df[~included_df['_key'].isin(existing_keys)].copy()
-            
-            if not new_projects.empty:
-                all_source_rows = []
-                not_found_projects = []
-                new_keys = set(new_projects['_key'])
-                
-                # Создаем ключи в источниках
-                if 'cxway_processed' in locals() and cxway_processed is not None and not cxway_processed.empty:
-                    if '_key' not in cxway_processed.columns:
-                        cxway_processed['_key'] = (
-                            cxway_processed['Имя клиента'].astype(str).str.strip() + '|' +
-                            cxway_processed['Название проекта'].astype(str).str.strip() + '|' +
-                            cxway_processed['Код анкеты'].astype(str).str.strip()
-                        )
-                
-                if 'optima_processed' in locals() and optima_processed is not None and not optima_processed.empty:
-                    if '_key' not in optima_processed.columns:
-                        optima_processed['_key'] = (
-                            optima_processed['Имя клиента'].astype(str).str.strip() + '|' +
-                            optima_processed['Название проекта'].astype(str).str.strip() + '|' +
-                            optima_processed['Код анкеты'].astype(str).str.strip()
-                        )
-                
-                if 'easymerch_processed' in locals() and easymerch_processed is not None and not easymerch_processed.empty:
-                    if '_key' not in easymerch_processed.columns:
-                        easymerch_processed['_key'] = (
-                            easymerch_processed['Имя клиента'].astype(str).str.strip() + '|' +
-                            easymerch_processed['Название проекта'].astype(str).str.strip() + '|' +
-                            easymerch_processed['Код анкеты'].astype(str).str.strip()
-                        )
-                
-                # Портал
-                portal_df = None
-                if 'портал_с_полем' in st.session_state.cleaned_data:
-                    portal_df = st.session_state.cleaned_data['портал_с_полем'].copy()
-                    if portal_df is not None and not portal_df.empty and '_key' not in portal_df.columns:
-                        portal_df['_key'] = (
-                            portal_df['Имя клиента'].astype(str).str.strip() + '|' +
-                            portal_df['Название проекта'].astype(str).str.strip() + '|' +
-                            portal_df['Код анкеты'].astype(str).str.strip()
-                        )
-                
-                # Поиск в CXWAY
-                if 'cxway_processed' in locals() and cxway_processed is not None and not cxway_processed.empty:
-                    matches = cxway_processed[cxway_processed['_key'].isin(new_keys)].copy()
-                    if not matches.empty:
-                        matches['Полевой'] = 1
-                        matches['Источник'] = 'CXWAY (добавлен вручную)'
-                        all_source_rows.append(matches)
-                        new_keys -= set(matches['_key'])
-                
-                # Поиск в портале
-                if new_keys and portal_df is not None and not portal_df.empty:
-                    matches = portal_df[portal_df['_key'].isin(new_keys)].copy()
-                    if not matches.empty:
-                        matches['Полевой'] = 1
-                        matches['Источник'] = 'Портал (добавлен вручную)'
-                        all_source_rows.append(matches)
-                        new_keys -= set(matches['_key'])
-                
-                # Поиск в Optima
-                if new_keys and 'optima_processed' in locals() and optima_processed is not None and not optima_processed.empty:
-                    matches = optima_processed[optima_processed['_key'].isin(new_keys)].copy()
-                    if not matches.empty:
-                        matches['Полевой'] = 1
-                        matches['Источник'] = 'Optima (добавлен вручную)'
-                        all_source_rows.append(matches)
-                        new_keys -= set(matches['_key'])
-                
-                # Поиск в Easymerch
-                if new_keys and 'easymerch_processed' in locals() and easymerch_processed is not None and not easymerch_processed.empty:
-                    matches = easymerch_processed[easymerch_processed['_key'].isin(new_keys)].copy()
-                    if not matches.empty:
-                        matches['Полевой'] = 1
-                        matches['Источник'] = 'Easymerch (добавлен вручную)'
-                        all_source_rows.append(matches)
-                        new_keys -= set(matches['_key'])
-                
-                # Проекты не найдены
-                if new_keys:
-                    not_found_df = new_projects[new_projects['_key'].isin(new_keys)]
-                    for _, row in not_found_df.iterrows():
-                        not_found_projects.append({
-                            'Клиент': row['Название проекта'],
-                            'Волна': row['Волна'],
-                            'Код проекта': row['Код проекта'],
-                            'ПО': row.get('ПО', ''),
-                            'Проверенные источники': 'CXWAY, Портал, Optima, Easymerch'
-                        })
-                
-                # Добавляем найденные строки
-                if all_source_rows:
-                    new_df = pd.concat(all_source_rows, ignore_index=True)
-                    if all_field_projects.empty:
-                        all_field_projects = new_df
-                    else:
-                        all_field_projects = pd.concat([all_field_projects, new_df], ignore_index=True)
-                
-                # Сохраняем список ненайденных проектов
-                if not_found_projects:
-                    st.session_state.not_found_projects = pd.DataFrame(not_found_projects)
-                else:
-                    st.session_state.not_found_projects = pd.DataFrame()
-                
-                # Удаляем временные колонки
-                if '_key' in all_field_projects.columns:
-                    all_field_projects = all_field_projects.drop('_key', axis=1)
-            
-            # Удаляем временные колонки
-            included_df = included_df.drop('_key', axis=1)
-            
-            # Сохраняем обновленные полевые проекты
-            st.session_state.cleaned_data['полевые_проекты'] = all_field_projects
-            
+def collect_calculation_job():
+    """
+    Забирает результат фоновой задачи расчета, если она завершилась.
+    Вызывается при каждом перезапуске скрипта.
+    """
+    job_id = st.session_state.calc_job_id
+    if not job_id:
+        return
+    
+    job = job_manager.get(job_id)
+    if job is None:
+        st.session_state.calc_job_id = None
+        st.warning("⚠️ Фоновый расчет не найден (возможно, сервер перезапускался). Запустите расчет заново.")
+        return
+    if not job.finished:
+        return
+    
+    job_manager.release(job_id)
+    st.session_state.calc_job_id = None
+    
+    if job.status == JOB_DONE:
+        result = job.result
+        if result is None:
+            st.error("❌ Нужны файл Сервизории и хотя бы один источник визитов")
+            return
+        
+        use_pipeline_result(
+            result, job.context['excluded_df'], job.context['included_df'], job.context['plan_sources']
+        )
+        st.session_state.show_messages = True
     
-
-        all_projects_export = pd.concat([
-            st.session_state.cleaned_data['полевые_проекты'],
-            st.session_state.cleaned_data['неполевые_проекты']
-        ], ignore_index=True)
-        st.session_state.cleaned_data['all_projects'] = all_projects_export
+    elif job.status == JOB_ERROR:
+        st.session_state.last_error = {
+            'step': 'Общая обработка',
+            'error': job.error,
+            'traceback': job.traceback
+        }
+        st.error(f"❌ Ошибка при расчете: {job.error}")
+        with st.expander("📋 Полный traceback (для разработчика)"):
+            st.code(job.traceback, language="python")
     
+    else:
+        st.info("⏹️ Расчет отменен")
 
-        
-        # Создание иерархии
-        import time as tm
-        start_hier = tm.time()
-        # st.write(f"🔍 НАЧАЛО ИЕРАРХИИ: {tm.time() - start_total:.2f} сек от старта")
-        
-        # ✅ ДИАГНОСТИКА ПЕРЕД ИЕРАРХИЕЙ
-        st.write(f"📊 ПОЛЕВЫЕ_ПРОЕКТЫ ПЕРЕД ИЕРАРХИЕЙ:")
-        st.write(f"  строк: {len(st.session_state.cleaned_data['полевые_проекты'])}")
-        if not st.session_state.cleaned_data['полевые_проекты'].empty:
-            if 'Источник' in st.session_state.cleaned_data['полевые_проекты'].columns:
-                st.write(f"  Источники: {st.session_state.cleaned_data['полевые_проекты']['Источник'].unique()}")
-            if 'Полевой' in st.session_state.cleaned_data['полевые_проекты'].columns:
-                st.write(f"  Полевой == 1: {(st.session_state.cleaned_data['полевые_проекты']['Полевой'] == 1).sum()}")
-        st.write("---")
-        
-        base_data = visit_calculator.extract_hierarchical_data(
-            st.session_state.cleaned_data['полевые_проекты'],
-            st.session_state.cleaned_data['сервизория'],
-            st.session_state.cleaned_data.get('сервизория_original')
+
+def render_debug_panel():
+    """Отладочная панель: состояние расчета и журнал трассировки"""
+    with st.expander("🐞 Отладка"):
+        calculated_data = st.session_state.visit_report.get('calculated_data')
+        st.write(f"data_calculated: {st.session_state.get('data_calculated', False)}")
+        st.write(f"visit_report: {list(st.session_state.visit_report.keys())}")
+        if calculated_data is not None:
+            st.write(f"calculated_data: {len(calculated_data)} строк, колонки: {list(calculated_data.columns)}")
+        
+        # Где лежат таблицы сессии: на диске (Arrow) или в памяти
+        store_stats = frame_store.stats()
+        st.write(
+            f"Хранилище таблиц: в памяти {store_stats['resident_frames']} таблиц, "
+            f"{store_stats['resident_bytes'] / 1024 / 1024:.0f} из {store_stats['max_resident_bytes'] / 1024 / 1024:.0f} МБ, "
+            f"чтений с диска: {store_stats['loads']}, из памяти: {store_stats['hits']}"
         )
+        for key in SPILLED_STATE:
+            st.write(f"{key}: {st.session_state[key].describe()}")
+        
+        # Плановые справочники последнего расчета: устаревшие и отсутствующие
+        sources_status = st.session_state.get('plan_sources_status')
+        if sources_status is not None:
+            st.write("**Плановые справочники:**")
+            st.dataframe(sources_status, width='stretch', hide_index=True)
+        
+        # Память: таблицы этапов последнего расчета и крупные ключи сессии
+        profile = st.session_state.get('last_profile')
+        if profile is not None and profile.has_memory:
+            st.write("**Таблицы на входе/выходе этапов (memory_usage deep):**")
+            st.dataframe(profile.memory_frame(), width='stretch', hide_index=True)
+        if st.button("🧮 Посчитать память сессии", key="count_state_memory"):
+            st.dataframe(state_memory(st.session_state), width='stretch', hide_index=True)
+        elif profile is not None and profile.state_memory:
+            st.write("**Память session_state после расчета:**")
+            st.dataframe(pd.DataFrame(profile.state_memory), width='stretch', hide_index=True)
+        else:
+            st.caption("Память по этапам пишется в режиме памяти (сайдбар → Профилирование).")
         
-        # ========== ВЫГРУЗКА base_data ==========
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            base_data.to_excel(writer, sheet_name='base_data', index=False)
+        trace = st.session_state.get('last_trace')
+        if trace is None:
+            st.caption("Трассировка выключена. Включите ее в сайдбаре и пересчитайте.")
+        elif not trace.events:
+            st.warning(f"Трассировка {trace.key_label}: событий нет")
+        else:
+            st.write(f"**Трассировка {trace.key_label}:** {len(trace.events)} событий")
+            st.dataframe(trace.to_frame(), width='stretch', hide_index=True)
+
+
+def render_profile_panel():
+    """Профиль последнего расчета: таблица этапов, flame-диаграмма и сравнение с прошлыми запусками"""
+    profile = st.session_state.get('last_profile')
+    if profile is None or not profile.records:
+        return
+    
+    with st.expander(f"⏱️ Время выполнения: {profile.total_wall:.2f} сек", expanded=st.session_state.get('show_messages', False)):
+        # Таблица сортируется кликом по заголовку колонки
+        st.dataframe(profile.to_frame(), width='stretch', hide_index=True)
+        
+        flame = profile.to_flame_frame()
+        fig = go.Figure(go.Icicle(
+            ids=flame['id'],
+            labels=flame['label'],
+            parents=flame['parent'],
+            values=flame['wall'],
+            branchvalues='total',
+            tiling=dict(orientation='v', flip='y'),
+            hovertemplate='%{id}<br>%{value:.3f} сек<extra></extra>'
+        ))
+        fig.update_layout(height=350, margin=dict(t=10, l=10, r=10, b=10))
+        st.plotly_chart(fig, width='stretch')
+        
+        # Сравнение с сохраненным профилем прошлого запуска
+        saved = [path for path in list_profiles() if path != profile.saved_path]
+        if saved:
+            baseline_path = st.selectbox(
+                "Сравнить с запуском",
+                [None] + saved,
+                format_func=lambda path: "не сравнивать" if path is None else os.path.basename(path),
+                key="profile_baseline"
+            )
+            if baseline_path:
+                try:
+                    comparison = compare_profiles(profile, Profiler.load(baseline_path))
+                    st.dataframe(comparison, width='stretch', hide_index=True)
+                except Exception as e:
+                    st.warning(f"⚠️ Не удалось прочитать профиль {os.path.basename(baseline_path)}: {e}")
         
         st.download_button(
-            label="📥 Скачать base_data (иерархия)",
-            data=output.getvalue(),
-            file_name=f"base_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            key="download_base_data"
+            label="📥 Скачать профиль (JSON)",
+            data=profile.to_json(),
+            file_name=f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
+            mime="application/json",
+            key="download_profile"
         )
-        # ===========================================
-
-        # st.write(f"🔍 КОНЕЦ ИЕРАРХИИ: {tm.time() - start_hier:.2f} сек (время выполнения)")
-        # st.write(f"🔍 ВСЕГО СТРОК В ИЕРАРХИИ: {len(base_data)}")
-        
-        st.session_state.visit_report['base_data'] = base_data
-        st.session_state.visit_report['timestamp'] = datetime.now().isoformat()
-
-        st.session_state.debug_times.append(f"[DEBUG] Иерархия: {time.time() - start:.2f} сек")
-        start = time.time()
-
-        # ========== ДИАГНОСТИКА ПЕРЕД РАСЧЕТОМ ==========
-        st.write("### 🔍 ДИАГНОСТИКА В process_all_data")
-        st.write(f"1. plan_calc_params: {st.session_state.plan_calc_params is not None}")
-        if st.session_state.plan_calc_params:
-            st.write(f"   - start_date: {st.session_state.plan_calc_params.get('start_date')}")
-            st.write(f"   - end_date: {st.session_state.plan_calc_params.get('end_date')}")
-        st.write(f"2. base_data: {base_data is not None}")
-        if base_data is not None:
-            st.write(f"   - empty: {base_data.empty}")
-            st.write(f"   - len: {len(base_data)}")
-        st.markdown("---")
-        # ==============================================
         
+        if profile.capture_text and st.checkbox(f"Показать полный профиль ({profile.capture})", key="show_capture"):
+            st.code(profile.capture_text)
 
-        # Расчет план/факт
-        if st.session_state.plan_calc_params and not base_data.empty:
-            params = st.session_state.plan_calc_params
-            source_df = st.session_state.cleaned_data['полевые_проекты']
-            
-            plan_result = visit_calculator.calculate_hierarchical_plan_on_date(
-                base_data, source_df, params, 
-                google_df=st.session_state.cleaned_data['сервизория'],
-                optima_df=st.session_state.cleaned_data.get('optima_processed')
-            )
-            
-            # === ДОБАВЛЕНИЕ ПЛАНОВОЙ ОПЛАТЫ ===
-            if plan_result is not None and not plan_result.empty:
-                bdr_df = st.session_state.cleaned_data.get('bdr_processed')
-                if bdr_df is not None and not bdr_df.empty:
-                    region_coeff_manager = get_region_coefficient_manager()
-                    region_coeffs = region_coeff_manager.load_coefficients()
-                    plan_result = visit_calculator.add_plan_payment(plan_result, bdr_df, region_coeffs)
-
-            # ✅ ВЫГРУЗКА: plan_result
-            if plan_result is not None and not plan_result.empty:
-                output = BytesIO()
-                with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                    plan_result.to_excel(writer, sheet_name='plan_result', index=False)
-                st.download_button(
-                    label="📥 Скачать plan_result",
-                    data=output.getvalue(),
-                    file_name=f"plan_result_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                    key="download_plan_result"
-                )
-            else:
-                st.warning("⚠️ plan_result ПУСТОЙ!")
-            # ===================================
 
-            
-            st.session_state.debug_times.append(f"[DEBUG] План: {time.time() - start:.2f} сек")
-            start = time.time()
-            
-            if plan_result is not None and not plan_result.empty:
-                fact_result = visit_calculator.calculate_hierarchical_fact_on_date(
-                    plan_result, source_df, params, status_filter='completed'
-                )
-                
-                # ✅ ВЫГРУЗКА: fact_result
-                if fact_result is not None and not fact_result.empty:
-                    output = BytesIO()
-                    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                        fact_result.to_excel(writer, sheet_name='fact_result', index=False)
-                    st.download_button(
-                        label="📥 Скачать fact_result",
-                        data=output.getvalue(),
-                        file_name=f"fact_result_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        key="download_fact_result"
-                    )
-                else:
-                    st.warning("⚠️ fact_result ПУСТОЙ!")
+@st.fragment(run_every=1)
+def calculation_job_panel():
+    """Прогресс фоновой задачи расчета с кнопкой отмены (обновляется раз в секунду)"""
+    job_id = st.session_state.calc_job_id
+    job = job_manager.get(job_id) if job_id else None
+    
+    # Задача завершилась - полный перезапуск, чтобы забрать результат
+    if job is None or job.finished:
+        st.rerun()
+    
+    state = job.progress.snapshot()
+    if state['stage_number'] == 0:
+        st.info("⏳ Расчет в очереди...")
+    else:
+        st.info(f"⏳ Идет расчет: **{state['stage']}** (этап {state['stage_number']} из {state['total_stages']})")
+    
+    st.progress(state['fraction'] or 0.0)
+    
+    if state['rows'] is not None and state['rows_done'] is not None:
+        rows_text = f"строк: {state['rows_done']:,} из {state['rows']:,}"
+    elif state['rows'] is not None:
+        rows_text = f"строк: {state['rows']:,}"
+    else:
+        rows_text = ""
+    st.caption(
+        f"Прошло {state['elapsed']:.0f} сек (этап {state['stage_elapsed']:.0f} сек)"
+        + (f", {rows_text}" if rows_text else "")
+    )
+    
+    if st.button("⏹️ Отменить расчет", key="cancel_calc_job"):
+        # Если тот же расчет ждут другие сессии - он продолжится для них
+        job_manager.cancel(job_id)
+        st.session_state.calc_job_id = None
+        st.toast("⏹️ Расчет отменен")
+        st.rerun()
 
 
-                # Факт по порученным
-                assigned_result = visit_calculator.calculate_hierarchical_fact_on_date(
-                    plan_result, source_df, params, status_filter='assigned'
-                )
-                
-                # Объединяем результаты
-                for col in assigned_result.columns:
-                    if col not in fact_result.columns:
-                        fact_result[col] = assigned_result[col]
-
-                # Факт по не порученным
-                not_assigned_result = visit_calculator.calculate_hierarchical_fact_on_date(
-                    plan_result, source_df, params, status_filter='not_assigned'
-                )
-                
-                # Объединяем результаты
-                for col in not_assigned_result.columns:
-                    if col not in fact_result.columns:
-                        fact_result[col] = not_assigned_result[col]
-                
-                st.session_state.debug_times.append(f"[DEBUG] Факт: {time.time() - start:.2f} сек")
-                start = time.time()
-                
-                final_result = visit_calculator._calculate_metrics(
-                    fact_result, params, plan_result
-                )
-                
-                st.session_state.visit_report['calculated_data'] = final_result
-                
-                st.session_state.debug_times.append(f"[DEBUG] Метрики: {time.time() - start:.2f} сек")
-                
-        st.session_state.debug_times.append(f"[DEBUG] ВСЕГО: {time.time() - start_total:.2f} сек")
-                
-        # Выводим предупреждение о ненайденных проектах
-        if 'not_found_projects' in st.session_state and not st.session_state.not_found_projects.empty:
-            st.warning("⚠️ Следующие проекты не найдены в загруженных данных:")
-            st.dataframe(st.session_state.not_found_projects, width='stretch')
-            st.info("💡 Проверьте: возможно, визиты по этим проектам не были загружены, или указан неверный портал.")
-            
-        st.session_state.processing_complete = True
-        return True
-        
+def recalculate_with_settings(settings_manager=None):
+    """
+    Быстрый пересчет после изменения настроек проектов:
+    источники берутся из кэша, заново выполняются только применение настроек,
+    иерархия, план, факт и метрики.
+    Если кэша нет или сменился период - запускается полная обработка (фоновая задача).
+    """
+    sources = st.session_state.cleaned_data.get('подготовленные_источники')
+    if sources is None or sources.get('период') != period_signature(st.session_state.plan_calc_params):
+        return process_all_data(settings_manager, force_recalc=True)
+    
+    try:
+        return apply_settings_and_calculate(sources, settings_manager)
+    
     except Exception as e:
         st.session_state.last_error = {
-            'step': 'Общая обработка',
+            'step': 'Пересчет по настройкам',
             'error': str(e),
             'traceback': traceback.format_exc()
         }
@@ -844,6 +718,82 @@ with st.sidebar:
         st.success("✅ Все данные и кэш очищены")
         st.rerun()
         
+    st.markdown("---")
+    st.subheader("📂 Снимки расчета")
+    
+    if st.button("📂 Открыть последний снимок", width='stretch'):
+        try:
+            if open_latest_snapshot():
+                st.success("✅ Снимок загружен")
+            else:
+                st.info("Сохраненных снимков пока нет")
+        except Exception as e:
+            st.error(f"❌ Ошибка загрузки снимка: {str(e)}")
+    
+    if st.session_state.loaded_snapshot:
+        snapshot_meta = st.session_state.loaded_snapshot
+        st.caption(
+            f"Снимок от {snapshot_meta['created_at'][:16].replace('T', ' ')}, "
+            f"период {snapshot_meta['start_date']} — {snapshot_meta['end_date']}"
+        )
+    
+    with st.expander("🐞 Трассировка расчета"):
+        st.caption("Журнал решений расчета плана для одного ключа. Пустые регион/ASM - любые.")
+        trace_project = st.text_input("Код проекта", key="trace_project")
+        trace_region = st.text_input("Регион (short)", key="trace_region")
+        trace_asm = st.text_input("ASM", key="trace_asm")
+        if st.checkbox("Включить трассировку", key="trace_enabled") and trace_project.strip():
+            st.session_state.trace_key = {'project': trace_project, 'region': trace_region, 'asm': trace_asm}
+        else:
+            st.session_state.trace_key = None
+    
+    with st.expander("⏱️ Профилирование"):
+        st.caption("Полный профиль следующего расчета (cProfile или pyinstrument) - показывается под временем выполнения.")
+        st.session_state.profile_capture = st.selectbox(
+            "Полный профиль запуска",
+            [None] + list(CAPTURE_MODES),
+            format_func=lambda mode: "выключен" if mode is None else mode,
+            key="profile_capture_mode"
+        )
+        st.session_state.profile_memory = st.checkbox(
+            "Режим памяти (tracemalloc, размер таблиц по этапам)",
+            key="profile_memory_mode",
+            help="Пик памяти Python, RSS и memory_usage(deep=True) таблиц каждого этапа. Расчет заметно медленнее."
+        )
+    
+    with st.expander("📥 Выгрузки"):
+        st.session_state.export_format = st.selectbox(
+            "Формат выгрузки таблиц",
+            list(EXPORT_FORMATS),
+            format_func=lambda fmt: FORMAT_LABELS[fmt],
+            key="export_format_choice"
+        )
+        if st.session_state.visit_report.get('calculated_data') is not None:
+            bundle_download_button(
+                report_frames,
+                st.session_state.export_format,
+                file_stem=f"отчеты_{datetime.now().strftime('%Y%m%d_%H%M')}",
+                key="download_report_bundle",
+                width='stretch'
+            )
+        export_stats = export_service.stats()
+        st.caption(
+            f"Готовых файлов: {export_stats['files']}, "
+            f"{export_stats['bytes_held'] / 1024 / 1024:.0f} из {export_stats['max_bytes'] / 1024 / 1024:.0f} МБ, "
+            f"сформировано: {export_stats['builds']}, из кэша: {export_stats['hits']}"
+        )
+    
+    with st.expander("🧠 Общий кэш расчетов"):
+        cache_stats = result_cache.stats()
+        st.caption(
+            f"Записей: {cache_stats['entries']}, "
+            f"память: {cache_stats['bytes_held'] / 1024 / 1024:.0f} из {cache_stats['max_bytes'] / 1024 / 1024:.0f} МБ"
+        )
+        st.caption(
+            f"Попадания: {cache_stats['hits']} из {cache_stats['hits'] + cache_stats['misses']} "
+            f"({cache_stats['hit_rate']:.0%}), вытеснено: {cache_stats['evictions']}"
+        )
+    
     st.markdown("---")
     st.subheader("📅 Параметры расчета")
     
@@ -881,29 +831,37 @@ with st.sidebar:
         )
         stage_weights.append(weight)
     
-    total_weight = sum(stage_weights)
-    if total_weight > 0:
-        coefficients = [w/total_weight for w in stage_weights]
-    else:
-        coefficients = [0.25, 0.25, 0.25, 0.25]
+    coefficients = normalize_stage_weights(stage_weights)
     
     st.session_state.plan_calc_params = {
         'start_date': start_date,
         'end_date': end_date,
         'coefficients': coefficients
     }
+    
+    # Отчет уже посчитан за этот период - новые веса применяются сразу
+    replan_ms = replan_for_stage_weights(st.session_state.plan_calc_params)
+    if replan_ms is not None:
+        st.caption(f"⚡ План на дату пересчитан по новым весам этапов: {replan_ms:.0f} мс")
 
 # ==============================================
 # ОСНОВНОЙ ИНТЕРФЕЙС
 # ==============================================
+# Прогресс фонового расчета - над вкладками, чтобы был виден на любой из них
+running_job = job_manager.get(st.session_state.calc_job_id) if st.session_state.calc_job_id else None
+if running_job is not None and not running_job.finished:
+    calculation_job_panel()
+
 tab1, tab2, tab3 = st.tabs(["📤 Загрузка данных", "📈 Отчеты", "⚙️ Настройки проектов"])
 
 with tab1:
+    # Результат фонового расчета (если задача завершилась)
+    collect_calculation_job()
+    
     # Показываем сообщения о расчете после перезагрузки
+    render_profile_panel()
+    render_calculation_downloads()
     if 'show_messages' in st.session_state and st.session_state.show_messages:
-        st.write("### ⏱️ Время выполнения:")
-        for msg in st.session_state.calculation_messages:
-            st.write(msg)
         st.success("✅ Расчет завершен!")
         st.session_state.show_messages = False
         
@@ -1020,8 +978,8 @@ with tab1:
                     prodata_df = load_excel(prodata_file_obj, "prodata") if prodata_file_obj else None
                     
                     # ✅ ОЧИЩАЕМ uploaded_files ПЕРЕД СОХРАНЕНИЕМ
-                    st.session_state.uploaded_files = {}
-                    st.session_state.cleaned_data = {} 
+                    st.session_state.uploaded_files = session_frames()
+                    st.session_state.cleaned_data = session_frames()
                     
                     # 2. СОХРАНЯЕМ В SESSION_STATE.uploaded_files
                     if portal_df is not None:
@@ -1051,12 +1009,9 @@ with tab1:
                     
                     success = process_all_data(settings_manager, force_recalc=True)
                     
-                    if success:         
-                        # Сохраняем сообщения в память
-                        st.session_state.calculation_messages = st.session_state.debug_times.copy()
-                        st.session_state.show_messages = True 
-                        st.session_state.data_calculated = True
-                        # st.rerun()
+                    if success:
+                        # Расчет идет в фоне - перезапуск покажет прогресс
+                        st.rerun()
                     else:
                         st.error("❌ Ошибка при расчете")
                         # ========== ОТЛАДКА ==========
@@ -1094,32 +1049,7 @@ with tab1:
             
 with tab2:
     st.title("📈 Отчеты по полевым визитам")
-    # ========== ДИАГНОСТИКА ==========
-    st.write("### 🔍 Диагностика перед отчетами")
-    
-    # 1. Проверяем data_calculated
-    st.write(f"1. data_calculated: {st.session_state.get('data_calculated', False)}")
-    
-    # 2. Проверяем visit_report
-    st.write(f"2. visit_report keys: {list(st.session_state.visit_report.keys()) if 'visit_report' in st.session_state else 'НЕТ visit_report'}")
-    
-    # 3. Проверяем calculated_data
-    if 'calculated_data' in st.session_state.visit_report:
-        calculated_data = st.session_state.visit_report['calculated_data']
-        st.write(f"3. calculated_data существует: {calculated_data is not None}")
-        if calculated_data is not None:
-            st.write(f"   - Тип: {type(calculated_data)}")
-            st.write(f"   - Пустой: {calculated_data.empty if hasattr(calculated_data, 'empty') else 'N/A'}")
-            st.write(f"   - Размер: {len(calculated_data) if hasattr(calculated_data, '__len__') else 'N/A'}")
-            if hasattr(calculated_data, 'columns'):
-                st.write(f"   - Колонки: {list(calculated_data.columns)}")
-        else:
-            st.write("   ❌ calculated_data = None")
-    else:
-        st.write("❌ calculated_data НЕТ в visit_report")
-    
-    st.markdown("---")
-    # ========== КОНЕЦ ДИАГНОСТИКИ ==========
+    render_debug_panel()
     
 
     if not st.session_state.get('data_calculated', False):
@@ -1131,19 +1061,20 @@ with tab2:
         # Проверяем, есть ли данные для отчета
         if 'calculated_data' in st.session_state.visit_report and st.session_state.visit_report['calculated_data'] is not None:
             calculated_data = st.session_state.visit_report['calculated_data']
+            rollup_cube = st.session_state.visit_report.get('rollup_cube')
             
             with tab_projects:
-                dataviz.create_planfact_tab(calculated_data, None)
+                dataviz.create_planfact_tab(calculated_data, None, rollup_cube)
                 
                 prodata_df = st.session_state.cleaned_data.get('prodata_processed')
                 if prodata_df is not None and not prodata_df.empty:
                     dataviz.create_prodata_table(prodata_df)
             
             with tab_regions:
-                dataviz.create_region_tab(calculated_data, None)
+                dataviz.create_region_tab(calculated_data, None, rollup_cube)
             
             with tab_dsm:
-                dataviz.create_dsm_tab(calculated_data, None)
+                dataviz.create_dsm_tab(calculated_data, None, rollup_cube)
             
             with tab_dynamics:
                 visits_for_dynamics = st.session_state.cleaned_data.get('полевые_проекты')
@@ -1156,10 +1087,16 @@ with tab2:
                     if 'RS' not in visits_for_dynamics.columns and 'ЭМ' in visits_for_dynamics.columns:
                         visits_for_dynamics = visits_for_dynamics.rename(columns={'ЭМ': 'RS'})
                     
+                    # Для снимка - период и коэффициенты, с которыми он был рассчитан
+                    if st.session_state.loaded_snapshot:
+                        dynamics_params = snapshot_calc_params(st.session_state.loaded_snapshot)
+                    else:
+                        dynamics_params = st.session_state.plan_calc_params
+                    
                     dataviz.create_dynamics_tab(
                         calculated_data,
                         visits_for_dynamics,
-                        st.session_state.plan_calc_params
+                        dynamics_params
                     )
                 else:
                     st.warning("⚠️ Нет данных для динамики")
@@ -1177,20 +1114,20 @@ if st.session_state.cleaned_data.get('полевые_проекты') is not Non
     field_projects_df = st.session_state.cleaned_data['полевые_проекты']
     
     
-    # Исключаем ПроДата из выгрузки
-    if 'Источник' in field_projects_df.columns:
-        field_projects_df = field_projects_df[field_projects_df['Источник'] != 'Мониторинги']
-    
-    if not field_projects_df.empty:
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            field_projects_df.to_excel(writer, sheet_name='Полевые_проекты', index=False)
-        
-        st.download_button(
+    # Исключаем ПроДата из выгрузки (фильтр - только при формировании файла)
+    has_export_rows = (
+        (field_projects_df['Источник'] != 'Мониторинги').any()
+        if 'Источник' in field_projects_df.columns else not field_projects_df.empty
+    )
+    if has_export_rows:
+        frame_download_button(
+            field_projects_df, 'Полевые_проекты',
             label="📥 Скачать все полевые проекты",
-            data=output.getvalue(),
-            file_name=f"полевые_проекты_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            file_stem=f"полевые_проекты_{datetime.now().strftime('%Y%m%d_%H%M')}",
+            fmt=st.session_state.export_format,
+            key="download_field_projects",
+            layout='без Мониторингов',
+            prepare=without_prodata,
             type="primary",
             width='stretch'
         )
@@ -1585,16 +1522,11 @@ with tab3:
                 if not problematic_projects.empty:
                     st.dataframe(problematic_projects, width='stretch')
                     
-                    excel_buffer = BytesIO()
-                    with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
-                        problematic_projects.to_excel(writer, sheet_name='Проблемные_проекты', index=False)
-                    excel_buffer.seek(0)
-                    
-                    st.download_button(
+                    excel_download_button(
+                        problematic_projects, 'Проблемные_проекты',
                         label="⬇️ Скачать проблемные проекты",
-                        data=excel_buffer,
                         file_name="проблемные_проекты.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                        key="download_problematic_projects",
                         type="secondary",
                         width='stretch'
                     )
@@ -1616,9 +1548,8 @@ with tab3:
         if st.button("🔄 Пересчитать", type="secondary", width='stretch'):
             with st.spinner("🔄 Пересчет с учетом настроек..."):
                 st.session_state.data_calculated = False
-                success = process_all_data(manager, force_recalc=True)
+                success = recalculate_with_settings(manager)
                 if success:
-                    st.session_state.data_calculated = True
                     st.success("✅ Пересчет завершен!")
                     st.rerun()
                 else:
@@ -1825,6 +1756,84 @@ with tab3:
                         })
                         st.dataframe(temp_df[['Проект', 'Волна', 'Код', 'Значение']], width='stretch', hide_index=True)
             
+            # ========== ПРЕДПРОСМОТР КОРРЕКТИРОВОК (БЕЗ ПЕРЕСЧЕТА) ==========
+            with st.expander("⚡ Предпросмотр корректировок", expanded=False):
+                visit_report = st.session_state.visit_report
+                plan_unadjusted = visit_report.get('plan_unadjusted')
+                fact_result = visit_report.get('fact_result')
+                current_df = visit_report.get('calculated_data')
+                if plan_unadjusted is None or fact_result is None or current_df is None:
+                    st.info("⏳ Предпросмотр доступен после расчета (для открытого снимка - после пересчета)")
+                else:
+                    st.caption("Введите корректировки для нескольких проектов: план, факт и %ПФ пересчитываются "
+                               "сразу, к сохраненным и временным корректировкам добавляются введенные")
+                    preview_input = unique_projects.rename(columns={
+                        'Имя клиента': 'Название проекта',
+                        'Название проекта': 'Волна',
+                        'Код анкеты': 'Код проекта'
+                    }).reset_index(drop=True)
+                    preview_input['Корректировка'] = 0
+                    edited = st.data_editor(
+                        preview_input,
+                        disabled=['Название проекта', 'Волна', 'Код проекта'],
+                        hide_index=True,
+                        width='stretch',
+                        key="adjustment_preview_editor"
+                    )
+                    edited = edited[edited['Корректировка'] != 0]
+
+                    # Сохраненные + временные + введенные: {клиент|волна|код: сумма}
+                    preview_adjustments = {f"{n}|{w}|{c}": value for (n, w, c), value in all_adjustments.items()}
+                    for _, row in edited.iterrows():
+                        key = f"{row['Название проекта']}|{row['Волна']}|{row['Код проекта']}"
+                        preview_adjustments[key] = preview_adjustments.get(key, 0) + row['Корректировка']
+
+                    started = time.perf_counter()
+                    preview_df = preview_plan_adjustments(
+                        fact_result, plan_unadjusted, preview_adjustments, st.session_state.plan_calc_params
+                    )
+                    elapsed = time.perf_counter() - started
+
+                    if preview_df is not None:
+                        col1, col2, col3 = st.columns(3)
+                        for col, name in ((col1, 'План проекта, шт.'), (col2, 'План на дату, шт.')):
+                            before, after = current_df[name].sum(), preview_df[name].sum()
+                            col.metric(name, f"{after:,.0f}", f"{after - before:+,.0f}")
+                        fact = preview_df['Факт на дату, шт.'].sum()
+                        before_kpi = current_df['Факт на дату, шт.'].sum() / max(current_df['План на дату, шт.'].sum(), 1) * 100
+                        after_kpi = fact / max(preview_df['План на дату, шт.'].sum(), 1) * 100
+                        col3.metric('%ПФ на дату', f"{after_kpi:.1f}%", f"{after_kpi - before_kpi:+.1f}")
+                        st.caption(f"⏱️ Пересчет предпросмотра: {elapsed * 1000:.0f} мс, строк {len(preview_df)}")
+
+                        summary = adjustment_summary(current_df, preview_df)
+                        if summary.empty:
+                            st.info("✅ План не меняется относительно текущего отчета")
+                        else:
+                            st.dataframe(summary, width='stretch', hide_index=True)
+
+                        if st.button("💾 Сохранить и применить к отчету", key="save_preview_adjustments_btn"):
+                            pending = st.session_state.temp_adjustments + [{
+                                'project_name': row['Название проекта'],
+                                'wave_name': row['Волна'],
+                                'project_code': row['Код проекта'],
+                                'adjustment_value': row['Корректировка']
+                            } for _, row in edited.iterrows()]
+                            for adj in pending:
+                                plan_adj_manager.add_adjustment(
+                                    adj['project_name'],
+                                    adj['wave_name'],
+                                    adj['project_code'],
+                                    adj['adjustment_value']
+                                )
+                            st.session_state.temp_adjustments = []
+                            st.session_state.pop('cached_saved_adjustments', None)
+                            # Отчет = предпросмотр: план и факт уже посчитаны, пересчет не нужен
+                            visit_report['calculated_data'] = preview_df
+                            visit_report['rollup_cube'] = RollupCube(preview_df)
+                            visit_report['plan_adjustments'] = preview_adjustments
+                            st.session_state.dynamics_report = None
+                            st.success(f"✅ Сохранено корректировок: {len(pending)}, отчет обновлен")
+
             # ========== КНОПКИ ДЛЯ КОРРЕКТИРОВОК ==========
             st.markdown("---")
             col1, col2, col3 = st.columns([1, 1, 1])
@@ -1848,9 +1857,8 @@ with tab3:
                     with st.spinner("🔄 Пересчет план/факта с учетом корректировок..."):
                         try:
                             st.session_state.data_calculated = False
-                            success = process_all_data(manager, force_recalc=True)
+                            success = recalculate_with_settings(manager)
                             if success:
-                                st.session_state.data_calculated = True
                                 st.success("✅ Пересчет завершен!")
                                 st.rerun()
                             else:
@@ -1879,7 +1887,6 @@ with tab3:
     st.caption("Загрузите Excel-файл с распределением плана по регионам и RS")
     
     # Инициализируем менеджер
-    from multon_excel_parser import parse_multon_excel_to_df, preview_multon_plan
     from github_settings import get_multon_plan_manager
     
     multon_manager = get_multon_plan_manager()
@@ -1955,9 +1962,6 @@ with tab3:
     st.caption("📌 Формат: две вкладки 'Дилеры_май' и 'Пронто_май'. Колонки: Обозначение, Регион полный, АСС, ЭМ, Дилеры/Пронто")
     
     # Инициализируем менеджер
-    from multibrand_excel_parser import parse_multibrand_excel, preview_multibrand_plan
-    from github_settings import get_multibrand_plan_manager
-    
     multibrand_manager = get_multibrand_plan_manager()
     
     # Текущее распределение
@@ -2031,7 +2035,6 @@ with tab3:
     st.caption("Загрузите Excel-файл с распределением сотрудников (RS) по регионам и клиентам (Москва/СПб)")
     
     # Инициализируем менеджер
-    from optima_rs_parser import parse_optima_rs_excel, preview_optima_rs_mapping
     from github_settings import get_optima_rs_manager
     
     optima_rs_manager = get_optima_rs_manager()
@@ -2106,8 +2109,6 @@ with tab3:
     st.caption("📌 Формат: первая строка — коды регионов (AA, AD...), вторая строка — коэффициенты (100%, 95%...)")
     
     # Инициализируем менеджер
-    from github_settings import get_region_coefficient_manager
-    from region_coefficients_parser import parse_region_coefficients_excel, preview_region_coefficients
     from data_cleaner import REGION_MAPPING
     
     region_coeff_manager = get_region_coefficient_manager()
@@ -2201,3 +2202,63 @@ with tab3:
                         st.rerun()
                     else:
                         st.error(msg)
+
+    # ============================================
+    # БЛОК: ПРОИЗВОДСТВЕННЫЙ КАЛЕНДАРЬ
+    # ============================================
+    
+    st.markdown("---")
+    st.subheader("📅 Производственный календарь")
+    st.caption("Рабочие дни для коэффициента месяца: будни пн-пт минус праздники плюс рабочие выходные (переносы)")
+    
+    from business_calendar import get_calendar, load_calendar_settings, save_calendar_settings
+    
+    calendar_settings = load_calendar_settings()
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        st.markdown("**🎉 Праздники (нерабочие будни)**")
+        holidays_df = st.data_editor(
+            pd.DataFrame({'Дата': pd.to_datetime(calendar_settings['holidays'])}),
+            column_config={'Дата': st.column_config.DateColumn('Дата', format="DD.MM.YYYY")},
+            num_rows="dynamic",
+            hide_index=True,
+            use_container_width=True,
+            key="calendar_holidays_editor"
+        )
+    with col2:
+        st.markdown("**🛠️ Рабочие выходные (переносы)**")
+        workdays_df = st.data_editor(
+            pd.DataFrame({'Дата': pd.to_datetime(calendar_settings['workdays'])}),
+            column_config={'Дата': st.column_config.DateColumn('Дата', format="DD.MM.YYYY")},
+            num_rows="dynamic",
+            hide_index=True,
+            use_container_width=True,
+            key="calendar_workdays_editor"
+        )
+    
+    edited_calendar = {
+        'holidays': [str(pd.Timestamp(day).date()) for day in holidays_df['Дата'].dropna()],
+        'workdays': [str(pd.Timestamp(day).date()) for day in workdays_df['Дата'].dropna()]
+    }
+    
+    # Рабочие дни по месяцам расчетного года с учетом правок (до сохранения)
+    with st.expander("📊 Рабочие дни по месяцам", expanded=False):
+        year = (st.session_state.get('plan_calc_params') or {}).get('start_date', date.today()).year
+        month_starts = pd.date_range(f"{year}-01-01", periods=12, freq='MS')
+        st.dataframe(pd.DataFrame({
+            'Месяц': month_starts.strftime('%m.%Y'),
+            'Рабочих дней': get_calendar(edited_calendar).count(
+                month_starts.to_numpy(), (month_starts + pd.offsets.MonthEnd(1)).to_numpy()
+            )
+        }), use_container_width=True, hide_index=True)
+    
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col2:
+        if st.button("💾 Сохранить календарь", type="primary", use_container_width=True, key="save_production_calendar"):
+            success, msg = save_calendar_settings(edited_calendar)
+            if success:
+                st.success(msg)
+                st.info("🔄 Пересчитайте отчет, чтобы применить календарь")
+            else:
+                st.error(msg)
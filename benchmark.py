@@ -0,0 +1,381 @@
+# benchmark.py
+# draft 4.1 - simplified
+"""
+Бенчмарк этапов расчета план/факт на синтетических данных (synthetic_data.py).
+Каждый публичный этап (загрузка файлов, очистка источников, иерархия, план,
+факт, метрики, фокус, динамика и агрегации вкладок) измеряется отдельно
+на нескольких масштабах, результат сохраняется в JSON. Сравнение двух
+запусков отмечает этапы, которые замедлились больше порога.
+
+    python benchmark.py run --scales 50000 200000 1000000
+    python benchmark.py compare data/benchmarks/bench_A.json data/benchmarks/bench_B.json --threshold 10
+
+Наборы данных генерируются один раз и хранятся в BENCHMARK_DIR/datasets.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+
+from config import config
+from compute_core import (
+    SETTINGS_FILES, read_source_file, load_settings_from_folder,
+    normalize_stage_weights, prepare_sources, calculate_plan_fact
+)
+from data_cleaner import DataCleaner
+from profiler import Profiler
+from visit_calculator import VisitCalculator
+from visit_cube import VisitCube
+from synthetic_data import (
+    SYNTHETIC_FORMATS, SOURCE_FILE_NAMES, EXCEL_MAX_ROWS, generate_dataset, write_dataset, source_counts
+)
+
+try:
+    from dataviz import dataviz
+except ImportError:  # без streamlit агрегации вкладок не измеряются
+    dataviz = None
+
+DEFAULT_SCALES = [50000, 200000, 1000000]
+
+# Фиксированный период: результаты разных дней сравнимы между собой
+DEFAULT_START = date(2026, 7, 1)
+DEFAULT_END = date(2026, 7, 15)
+DEFAULT_WEIGHTS = [0.8, 1.2, 1.0, 0.9]
+
+# Изменение меньше этого (сек) не считается регрессией (шум измерения)
+MIN_DELTA_SECONDS = 0.05
+
+
+# ============================================
+# НАБОРЫ ДАННЫХ
+# ============================================
+
+def ensure_dataset(visits, fmt, seed, start, end):
+    """Папка синтетического набора (генерируется, если еще нет)"""
+    path = os.path.join(
+        config.BENCHMARK_DIR, 'datasets',
+        f"{visits}_{fmt}_{seed}_{start:%Y%m%d}_{end:%Y%m%d}"
+    )
+    # Справочники пишутся последними: их наличие - признак полного набора
+    marker = os.path.join(path, 'settings', SETTINGS_FILES['projects_settings'])
+    if not os.path.exists(marker):
+        print(f"🧪 Генерация набора: {visits:,} визитов ({fmt})")
+        frames, settings = generate_dataset(visits, start, end, seed)
+        write_dataset(path, frames, settings, fmt)
+    return path
+
+
+def load_dataset(path, fmt):
+    """Исходные файлы набора как при загрузке в приложении: {источник: DataFrame}"""
+    uploaded_files = {}
+    for source, file_name in SOURCE_FILE_NAMES.items():
+        file_path = os.path.join(path, f"{file_name}.{fmt}")
+        if os.path.exists(file_path):
+            uploaded_files[source] = read_source_file(file_path)
+    return uploaded_files
+
+
+# ============================================
+# ИЗМЕРЕНИЕ ЭТАПОВ
+# ============================================
+
+def _rows(result):
+    """Строк в результате этапа (DataFrame или первый элемент кортежа)"""
+    if isinstance(result, tuple) and result:
+        result = result[0]
+    return len(result) if isinstance(result, pd.DataFrame) else None
+
+
+def measure(profiler, name, func, rows_in=None, repeat=1):
+    """Выполняет этап repeat раз под профилировщиком, возвращает результат последнего запуска"""
+    result = None
+    for _ in range(repeat):
+        with profiler.stage(name, rows_in=rows_in) as stage:
+            result = func()
+            stage.rows(_rows(result))
+    return result
+
+
+def _stage_summary(profiler):
+    """Лучшее время этапов верхнего уровня: {этап: wall, cpu, строки, память}"""
+    stages = {}
+    for record in profiler.sorted_records():
+        if record['depth'] != 0:
+            continue
+        best = stages.get(record['name'])
+        if best is None or record['wall'] < best['wall']:
+            stages[record['name']] = {
+                'wall': record['wall'],
+                'cpu': record['cpu'],
+                'rows_in': record['rows_in'],
+                'rows_out': record['rows_out'],
+                'mem_delta_mb': record['mem_delta_mb']
+            }
+    return stages
+
+
+def run_scale(visits, fmt='xlsx', seed=42, start=DEFAULT_START, end=DEFAULT_END, repeat=1):
+    """
+    Все этапы на одном масштабе. Входы этапов берутся из одного прогона
+    пайплайна (не измеряется), затем каждый этап запускается отдельно.
+    Возвращает {'stages': {этап: метрики}, 'records': записи профиля}.
+    """
+    path = ensure_dataset(visits, fmt, seed, start, end)
+    calc_params = {
+        'start_date': start,
+        'end_date': end,
+        'coefficients': normalize_stage_weights(DEFAULT_WEIGHTS)
+    }
+    excluded_df, included_df, plan_sources = load_settings_from_folder(os.path.join(path, 'settings'))
+
+    profiler = Profiler()
+    load_name = 'load_excel' if fmt == 'xlsx' else f"load_{fmt}"
+    uploaded_files = measure(profiler, load_name, lambda: load_dataset(path, fmt), visits, repeat)
+    loaded_sources = set(uploaded_files)
+
+    # Входы этапов: один полный прогон без профиля
+    cleaned_data = {}
+    sources = prepare_sources(
+        uploaded_files, calc_params, plan_sources, cleaned_data=cleaned_data, profiler=Profiler(enabled=False)
+    )
+    result = calculate_plan_fact(
+        sources, calc_params, excluded_df, included_df, plan_sources, loaded_sources=loaded_sources,
+        cleaned_data=cleaned_data, profiler=Profiler(enabled=False)
+    )
+    data_cleaner = DataCleaner()
+    # Вложенные шаги калькулятора пишутся в профиль бенчмарка
+    visit_calculator = VisitCalculator(profiler=profiler)
+
+    google = sources['google']
+    visits_df = cleaned_data['полевые_проекты']
+    base_data = result['visit_report'].get('base_data')
+    plan_result = result['plan_result']
+    fact_result = result['fact_result']
+    calculated_data = result['visit_report'].get('calculated_data')
+
+    # === ОЧИСТКА ИСТОЧНИКОВ ===
+    measure(profiler, 'clean_google', lambda: data_cleaner.clean_google(uploaded_files['сервизория'], calc_params),
+            len(uploaded_files['сервизория']), repeat)
+    if 'портал' in uploaded_files:
+        measure(profiler, 'clean_array', lambda: data_cleaner.clean_array(uploaded_files['портал'], calc_params),
+                len(uploaded_files['портал']), repeat)
+        portal_with_field = data_cleaner.add_field_flag_to_array(cleaned_data['портал'])
+        measure(profiler, 'add_portal_to_array', lambda: data_cleaner.add_portal_to_array(portal_with_field, google),
+                len(portal_with_field), repeat)
+    if 'cxway' in uploaded_files:
+        measure(profiler, 'clean_cxway',
+                lambda: data_cleaner.clean_cxway(uploaded_files['cxway'], None, google, calc_params),
+                len(uploaded_files['cxway']), repeat)
+    if 'easymerch' in uploaded_files:
+        measure(profiler, 'clean_easymerch', lambda: data_cleaner.clean_easymerch(uploaded_files['easymerch'], google),
+                len(uploaded_files['easymerch']), repeat)
+    if 'optima' in uploaded_files:
+        measure(profiler, 'clean_optima',
+                lambda: data_cleaner.clean_optima(uploaded_files['optima'], google, plan_sources.get('optima_rs')),
+                len(uploaded_files['optima']), repeat)
+    if 'prodata' in uploaded_files:
+        measure(profiler, 'clean_prodata', lambda: data_cleaner.clean_prodata(uploaded_files['prodata'], google),
+                len(uploaded_files['prodata']), repeat)
+    if 'bdr' in uploaded_files:
+        measure(profiler, 'clean_bdr', lambda: data_cleaner.clean_bdr(uploaded_files['bdr']),
+                len(uploaded_files['bdr']), repeat)
+
+    # === РАСЧЕТ ===
+    measure(profiler, 'extract_hierarchical_data', lambda: visit_calculator.extract_hierarchical_data(
+        visits_df, google, cleaned_data.get('сервизория_original'), calc_params=calc_params
+    ), len(visits_df), repeat)
+
+    measure(profiler, 'VisitCube', lambda: VisitCube(visits_df, calc_params), len(visits_df), repeat)
+
+    if base_data is not None and not base_data.empty:
+        measure(profiler, 'calculate_hierarchical_plan_on_date', lambda: visit_calculator.calculate_hierarchical_plan_on_date(
+            base_data, visits_df, calc_params, google_df=google, optima_df=cleaned_data.get('optima_processed'),
+            plan_sources=plan_sources, loaded_sources=loaded_sources
+        ), len(base_data), repeat)
+
+    if plan_result is not None and not plan_result.empty:
+        measure(profiler, 'calculate_hierarchical_fact_on_date', lambda: visit_calculator.calculate_hierarchical_fact_on_date(
+            plan_result, visits_df, calc_params, status_filter='completed'
+        ), len(visits_df), repeat)
+
+    if fact_result is not None and not fact_result.empty:
+        measure(profiler, '_calculate_metrics', lambda: visit_calculator._calculate_metrics(
+            fact_result, calc_params, plan_result
+        ), len(fact_result), repeat)
+
+    measure(profiler, 'calculate_dynamics_fact', lambda: visit_calculator.calculate_dynamics_fact(
+        visits_df, calc_params, ['АСС', 'Имя клиента']
+    ), len(visits_df), repeat)
+
+    # === АГРЕГАЦИИ ВКЛАДОК ===
+    if dataviz is not None and calculated_data is not None and not calculated_data.empty:
+        measure(profiler, 'calculate_focus', lambda: dataviz.calculate_focus(calculated_data, aggregation_level='wave'),
+                len(calculated_data), repeat)
+
+        tab_data = calculated_data.rename(columns={'ЗОД': 'DSM', 'АСС': 'ASM', 'ЭМ': 'RS'})
+        region_col = 'Регион short' if 'Регион short' in tab_data.columns and 'Регион' not in tab_data.columns else 'Регион'
+        measure(profiler, '_compute_base_planfact_aggregations',
+                lambda: dataviz._compute_base_planfact_aggregations(tab_data, region_col), len(tab_data), repeat)
+        measure(profiler, '_compute_base_region_aggregations',
+                lambda: dataviz._compute_base_region_aggregations(tab_data, region_col), len(tab_data), repeat)
+        measure(profiler, '_compute_base_dsm_aggregations',
+                lambda: dataviz._compute_base_dsm_aggregations(tab_data, region_col), len(tab_data), repeat)
+        asm_selected = sorted(tab_data['ASM'].dropna().unique())[:3] if 'ASM' in tab_data.columns else []
+        measure(profiler, '_apply_planfact_filters', lambda: dataviz._apply_planfact_filters(
+            tab_data, [], 'Включить', asm_selected, 'Включить', [], 'Включить', [], 'Включить', region_col
+        ), len(tab_data), repeat)
+
+    return {'stages': _stage_summary(profiler), 'records': profiler.sorted_records()}
+
+
+def run_benchmark(scales, fmt='xlsx', seed=42, start=DEFAULT_START, end=DEFAULT_END, repeat=1):
+    """Бенчмарк на нескольких масштабах: словарь для JSON"""
+    results = {
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'format': fmt,
+        'seed': seed,
+        'period': [start.isoformat(), end.isoformat()],
+        'repeat': repeat,
+        'environment': {
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'platform': platform.platform()
+        },
+        'scales': {}
+    }
+    for visits in scales:
+        print(f"⏱️ Масштаб: {visits:,} визитов")
+        scale_result = run_scale(visits, fmt, seed, start, end, repeat)
+        results['scales'][str(visits)] = scale_result
+        for name, stage in scale_result['stages'].items():
+            print(f"   {name}: {stage['wall']:.3f} сек")
+    return results
+
+
+def save_results(results, path=None):
+    """Сохраняет результаты в JSON (по умолчанию BENCHMARK_DIR/bench_<время>.json)"""
+    if path is None:
+        os.makedirs(config.BENCHMARK_DIR, exist_ok=True)
+        stamp = results['started_at'].replace(':', '').replace('-', '')
+        path = os.path.join(config.BENCHMARK_DIR, f"bench_{stamp}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2, default=str)
+    return path
+
+
+# ============================================
+# СРАВНЕНИЕ
+# ============================================
+
+def compare_results(baseline, current, threshold=10.0, min_seconds=MIN_DELTA_SECONDS):
+    """
+    Сравнение двух запусков по масштабам и этапам.
+    Статус 'регрессия' - этап медленнее больше чем на threshold % (и больше min_seconds),
+    'ускорение' - быстрее на столько же.
+    """
+    rows = []
+    scales = sorted(set(baseline['scales']) | set(current['scales']), key=int)
+    for scale in scales:
+        before_stages = baseline['scales'].get(scale, {}).get('stages', {})
+        now_stages = current['scales'].get(scale, {}).get('stages', {})
+        names = list(now_stages) + [name for name in before_stages if name not in now_stages]
+        for name in names:
+            before = before_stages.get(name, {}).get('wall')
+            now = now_stages.get(name, {}).get('wall')
+            delta = now - before if now is not None and before is not None else None
+            percent = delta / before * 100 if delta is not None and before else None
+
+            status = ''
+            if percent is not None and abs(delta) >= min_seconds:
+                if percent > threshold:
+                    status = 'регрессия'
+                elif percent < -threshold:
+                    status = 'ускорение'
+            elif before is None:
+                status = 'новый этап'
+            elif now is None:
+                status = 'нет в запуске'
+
+            rows.append({
+                'Визитов': int(scale),
+                'Этап': name,
+                'Было, сек': round(before, 3) if before is not None else None,
+                'Стало, сек': round(now, 3) if now is not None else None,
+                'Разница, %': round(percent, 1) if percent is not None else None,
+                'Статус': status
+            })
+    return pd.DataFrame(rows, columns=['Визитов', 'Этап', 'Было, сек', 'Стало, сек', 'Разница, %', 'Статус'])
+
+
+def _load_results(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+# ============================================
+# CLI
+# ============================================
+
+def _parse_date(value):
+    return date.fromisoformat(value)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Бенчмарк этапов расчета план/факт")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help="Измерить этапы на синтетических данных")
+    run.add_argument('--scales', nargs='+', type=int, default=DEFAULT_SCALES, help="Масштабы (визитов)")
+    run.add_argument('--format', choices=SYNTHETIC_FORMATS, default='xlsx',
+                     help="Формат файлов источников (xlsx - этап load_excel)")
+    run.add_argument('--seed', type=int, default=42, help="Seed синтетических данных")
+    run.add_argument('--start', type=_parse_date, default=DEFAULT_START, help="Начало периода (YYYY-MM-DD)")
+    run.add_argument('--end', type=_parse_date, default=DEFAULT_END, help="Конец периода (YYYY-MM-DD)")
+    run.add_argument('--repeat', type=int, default=1, help="Повторов каждого этапа (берется лучшее время)")
+    run.add_argument('--output', default=None, help="Файл результатов (по умолчанию BENCHMARK_DIR)")
+
+    compare = commands.add_parser('compare', help="Сравнить два запуска")
+    compare.add_argument('baseline', help="JSON базового запуска")
+    compare.add_argument('current', help="JSON нового запуска")
+    compare.add_argument('--threshold', type=float, default=10.0, help="Порог регрессии, %%")
+    compare.add_argument('--min-seconds', type=float, default=MIN_DELTA_SECONDS,
+                         help="Минимальная разница (сек), меньше - шум")
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        if args.end < args.start or args.start.month != args.end.month:
+            parser.error("Период должен быть в пределах одного месяца")
+        if args.format == 'xlsx':
+            too_large = [visits for visits in args.scales if max(source_counts(visits).values()) > EXCEL_MAX_ROWS]
+            if too_large:
+                parser.error(f"Масштабы {too_large} не помещаются в xlsx - используйте --format csv или parquet")
+        results = run_benchmark(args.scales, args.format, args.seed, args.start, args.end, max(1, args.repeat))
+        print(f"💾 Результаты: {save_results(results, args.output)}")
+        return 0
+
+    comparison = compare_results(
+        _load_results(args.baseline), _load_results(args.current), args.threshold, args.min_seconds
+    )
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(comparison.to_string(index=False))
+    regressions = comparison[comparison['Статус'] == 'регрессия']
+    if not regressions.empty:
+        print(f"⚠️ Регрессий: {len(regressions)} (порог {args.threshold}%)")
+        return 1
+    print("✅ Регрессий нет")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
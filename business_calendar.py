@@ -0,0 +1,206 @@
+# business_calendar.py
+# draft 4.1 - simplified
+"""
+Производственный календарь: рабочие дни с учетом праздников и переносов.
+Праздники (нерабочие будни) и рабочие выходные задаются в локальном
+JSON (config.CALENDAR_FILE, редактируется во вкладке настроек):
+
+    {"last_updated": "...", "holidays": ["2026-01-01", ...], "workdays": ["2025-11-01", ...]}
+
+Рабочие дни считаются префиксными суммами по годам календаря: диапазон
+[start, end] - разность двух накопленных сумм, O(1) на диапазон и сразу
+для массивов дат. За пределами годов календаря - обычные будни (пн-пт).
+
+Сверка с np.busday_count: python business_calendar.py [--file календарь.json]
+"""
+import argparse
+import json
+import sys
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from config import config
+
+CALENDAR_KEYS = ('holidays', 'workdays')
+ONE_DAY = np.timedelta64(1, 'D')
+
+# Построенные календари по набору дат (см. get_calendar)
+_calendars = {}
+
+
+def to_days(values):
+    """Даты (скаляр или массив: date, Timestamp, datetime64, строки) → datetime64[D], пустые - NaT"""
+    if isinstance(values, np.ndarray) and np.issubdtype(values.dtype, np.datetime64):
+        return values.astype('datetime64[D]')
+    if np.ndim(values) == 0:
+        if pd.isna(values):
+            return np.datetime64('NaT', 'D')
+        return pd.Timestamp(values).to_datetime64().astype('datetime64[D]')
+    flat = pd.to_datetime(pd.Series(np.ravel(np.asarray(values, dtype=object))), errors='coerce')
+    return flat.to_numpy(dtype='datetime64[ns]').astype('datetime64[D]').reshape(np.shape(values))
+
+
+def _date_list(values):
+    """Список дат из настроек → отсортированные уникальные datetime64[D] (пустые и ошибки пропускаются)"""
+    days = to_days(list(values or []))
+    return np.unique(days[~np.isnat(days)])
+
+
+class BusinessCalendar:
+    """Рабочие дни: будни пн-пт минус праздники плюс рабочие выходные"""
+
+    def __init__(self, holidays=(), workdays=()):
+        self.holidays = _date_list(holidays)
+        self.workdays = _date_list(workdays)
+        listed = np.concatenate([self.holidays, self.workdays])
+        if len(listed):
+            first_year = listed.min().astype('datetime64[Y]')
+            last_year = listed.max().astype('datetime64[Y]')
+        else:
+            first_year = last_year = np.datetime64('today', 'Y')
+        # Накопленные рабочие дни от начала первого года календаря: prefix[i] - в [origin, origin + i)
+        self.origin = first_year.astype('datetime64[D]')
+        self.stop = (last_year + 1).astype('datetime64[D]')
+        days = np.arange(self.origin, self.stop)
+        working = np.is_busday(days)
+        working[np.isin(days, self.holidays)] = False
+        working[np.isin(days, self.workdays)] = True
+        self.prefix = np.concatenate([[0], np.cumsum(working)])
+
+    @classmethod
+    def from_settings(cls, settings):
+        settings = settings or {}
+        return cls(settings.get('holidays', []), settings.get('workdays', []))
+
+    def to_settings(self):
+        return {key: [str(day) for day in getattr(self, key)] for key in CALENDAR_KEYS}
+
+    def _cumulative(self, days):
+        """Рабочих дней в [origin, day) (для дней раньше origin - со знаком минус)"""
+        offset = np.clip((days - self.origin).astype('int64'), 0, len(self.prefix) - 1)
+        before = -np.busday_count(np.minimum(days, self.origin), self.origin)
+        after = np.busday_count(self.stop, np.maximum(days, self.stop))
+        return self.prefix[offset] + before + after
+
+    def count(self, start, end):
+        """
+        Рабочие дни в [start, end] включительно. start/end - даты или массивы дат
+        (приводятся друг к другу по правилам NumPy); start > end или пустая дата → 0.
+        """
+        start_days, end_days = np.broadcast_arrays(to_days(start), to_days(end))
+        valid = ~np.isnat(start_days) & ~np.isnat(end_days) & (start_days <= end_days)
+        safe_start = np.where(valid, start_days, self.origin)
+        safe_end = np.where(valid, end_days, self.origin)
+        counts = np.where(valid, self._cumulative(safe_end + ONE_DAY) - self._cumulative(safe_start), 0)
+        return counts if np.ndim(counts) else int(counts)
+
+    def is_working(self, dates):
+        """Рабочий ли день (скаляр или массив)"""
+        days = to_days(dates)
+        return self.count(days, days) > 0
+
+
+# ============================================
+# ФАЙЛ КАЛЕНДАРЯ
+# ============================================
+
+def calendar_settings(data):
+    """Содержимое файла календаря → {'holidays': [...], 'workdays': [...]} (без служебных полей)"""
+    data = data or {}
+    return {key: [str(day) for day in data.get(key, [])] for key in CALENDAR_KEYS}
+
+
+def load_calendar_settings(path=None):
+    """Настройки календаря из JSON (нет файла или ошибка чтения - пустой календарь: только пн-пт)"""
+    path = path or config.CALENDAR_FILE
+    try:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        data = {}
+    return calendar_settings(data)
+
+
+def save_calendar_settings(settings, path=None):
+    """Сохраняет праздники и рабочие выходные в JSON. Возвращает (успех, сообщение)"""
+    path = path or config.CALENDAR_FILE
+    calendar = BusinessCalendar.from_settings(settings)
+    data = {'last_updated': datetime.now().isoformat(), **calendar.to_settings()}
+    try:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+    except OSError as e:
+        return False, f"❌ Ошибка: {e}"
+    _calendars.clear()
+    return True, f"✅ Сохранено: праздников {len(calendar.holidays)}, рабочих выходных {len(calendar.workdays)}"
+
+
+def get_calendar(settings=None):
+    """
+    Календарь по настройкам (None - из файла config.CALENDAR_FILE).
+    Построенные календари переиспользуются, пока не меняются даты.
+    """
+    if settings is None:
+        settings = load_calendar_settings()
+    key = tuple(tuple(sorted(str(day) for day in settings.get(name, []))) for name in CALENDAR_KEYS)
+    if key not in _calendars:
+        _calendars[key] = BusinessCalendar.from_settings(settings)
+    return _calendars[key]
+
+
+# ============================================
+# ПРОВЕРКА
+# ============================================
+
+def reference_count(calendar, start, end):
+    """Рабочие дни в [start, end] через np.busday_count (эталон для BusinessCalendar.count)"""
+    start_days, end_days = np.broadcast_arrays(to_days(start), to_days(end))
+    counts = np.busday_count(start_days, end_days + ONE_DAY, holidays=calendar.holidays)
+    # Рабочие выходные: дни, которые busday_count не считает рабочими
+    extra = calendar.workdays[~np.is_busday(calendar.workdays, holidays=calendar.holidays)]
+    counts = counts + ((extra >= start_days[..., None]) & (extra <= end_days[..., None])).sum(axis=-1)
+    return np.where(start_days <= end_days, counts, 0)
+
+
+def check_calendar(calendar, margin_days=400, max_length=40):
+    """
+    Сверка count() с reference_count на всех диапазонах длиной 0..max_length,
+    начинающихся в [origin - margin_days, stop + margin_days] (до, внутри и после
+    годов календаря, с началом в любой день недели).
+    Возвращает таблицу расхождений 'Начало', 'Конец', 'count', 'Эталон' (пустая - совпадают).
+    """
+    starts = np.arange(calendar.origin - margin_days, calendar.stop + margin_days)
+    start_days = np.repeat(starts, max_length + 1)
+    end_days = start_days + np.tile(np.arange(max_length + 1), len(starts)).astype('timedelta64[D]')
+    actual = calendar.count(start_days, end_days)
+    expected = reference_count(calendar, start_days, end_days)
+    differ = actual != expected
+    return pd.DataFrame({
+        'Начало': start_days[differ], 'Конец': end_days[differ], 'count': actual[differ], 'Эталон': expected[differ]
+    })
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Сверка производственного календаря с np.busday_count")
+    parser.add_argument('--file', default=None, help="JSON календаря (по умолчанию config.CALENDAR_FILE)")
+    args = parser.parse_args(argv)
+
+    calendars = {
+        'пустой (только пн-пт)': BusinessCalendar(),
+        'из файла': BusinessCalendar.from_settings(load_calendar_settings(args.file)),
+    }
+    failed = False
+    for name, calendar in calendars.items():
+        mismatches = check_calendar(calendar)
+        if mismatches.empty:
+            print(f"✅ Календарь {name}: count() совпадает с np.busday_count")
+        else:
+            failed = True
+            print(mismatches.head(20).to_string(index=False))
+            print(f"❌ Календарь {name}: расхождений {len(mismatches)}")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
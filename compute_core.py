@@ -0,0 +1,1263 @@
+# utils/compute_core.py
+# draft 4.1 - simplified
+"""
+Вычислительное ядро план/факт без зависимости от streamlit.
+Все параметры передаются явно, диагностика возвращается объектом Diagnostics.
+Используется приложением (app.py) и пакетным запуском (run_batch.py).
+"""
+import json
+import os
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from data_cleaner import DataCleaner, SURROGATE_DATE
+from visit_calculator import VisitCalculator, load_plan_sources_from_managers
+from diagnostics import Diagnostics
+from tracer import NULL_TRACER
+from profiler import Profiler
+from business_calendar import calendar_settings, load_calendar_settings
+from plan_registry import PlanSourceRegistry, DATED_SOURCES
+from visit_cube import VisitCube
+from plan_engine import ADJUSTED_COLUMNS, StageGeometry, apply_plan_adjustments, compare_plans, project_keys
+from rollup_cube import RollupCube
+
+# Имена файлов настроек (совпадают с файлами в GitHub-репозитории настроек)
+SETTINGS_FILES = {
+    'projects_settings': 'projects_settings.json',
+    'adjustments': 'plan_adjustments.json',
+    'multon_plan': 'multon_plan.json',
+    'multibrand_plan': 'multibrand_plan.json',
+    'optima_rs': 'optima_rs_distribution.json',
+    'region_coefficients': 'region_coefficients.json',
+    'production_calendar': 'production_calendar.json'
+}
+
+# Ключевые слова в именах файлов источников (порядок важен: первое совпадение)
+SOURCE_FILE_KEYWORDS = [
+    ('сервизория', ['сервизория', 'servizoria', 'проекты', 'projects']),
+    ('портал', ['портал', 'массив', 'portal', 'checker', 'array']),
+    ('cxway', ['cxway']),
+    ('easymerch', ['easymerch']),
+    ('optima', ['optima', 'оптима']),
+    ('prodata', ['prodata', 'продата']),
+    ('bdr', ['bdr', 'бдр'])
+]
+
+SOURCE_FILE_EXTENSIONS = ('.xlsx', '.xls', '.csv', '.parquet')
+
+PROJECT_SETTINGS_COLUMNS = ['Название проекта', 'Волна', 'Код проекта', 'ПО', 'ФИО ОМ']
+
+# Этапы полного расчета (для индикатора прогресса фоновой задачи)
+PIPELINE_STAGES = [
+    'Очистка Сервизории', 'Очистка портала', 'Easymerch', 'Optima', 'ПроДата', 'БДР', 'CXWAY',
+    'Применение настроек', 'Иерархия', 'План', 'Факт', 'Метрики'
+]
+
+
+# ============================================
+# ПАРАМЕТРЫ
+# ============================================
+
+def normalize_stage_weights(stage_weights):
+    """Веса этапов → коэффициенты (сумма = 1)"""
+    total_weight = sum(stage_weights)
+    if total_weight > 0:
+        return [w / total_weight for w in stage_weights]
+    return [0.25, 0.25, 0.25, 0.25]
+
+
+def period_signature(calc_params):
+    """Сигнатура периода расчета (очистка источников зависит от дат периода)"""
+    calc_params = calc_params or {}
+    return (str(calc_params.get('start_date')), str(calc_params.get('end_date')))
+
+
+def _report_progress(progress, stage, rows=None):
+    """Сообщает этап расчета трекеру фоновой задачи (там же проверяется отмена)"""
+    if progress is not None:
+        progress.stage(stage, rows)
+
+
+def _next_step(progress, profiler, step, name, rows=None):
+    """Закрывает предыдущий шаг профиля и открывает следующий (с отметкой прогресса)"""
+    if step is not None:
+        profiler.end(step)
+    _report_progress(progress, name, rows)
+    return profiler.begin(name, rows_in=rows)
+
+
+# Очиститель и калькулятор создаются на каждый расчет (DataCleaner(diagnostics),
+# VisitCalculator(diagnostics, profiler, tracer)): расчеты идут одновременно
+# в фоновых задачах и в основном потоке, и общие экземпляры смешали бы их
+# диагностику, профиль, трассировку и производственный календарь.
+
+def _run_diagnostics(diagnostics):
+    """Сборщик сообщений очистки и расчета (None - новый)"""
+    return diagnostics if diagnostics is not None else Diagnostics()
+
+
+def _run_profiler(profiler):
+    """Профилировщик этапов расчета (None - новый)"""
+    return profiler if profiler is not None else Profiler()
+
+
+def _run_tracer(tracer):
+    """Трассировка ключа (None - выключена)"""
+    return tracer if tracer is not None else NULL_TRACER
+
+
+# ============================================
+# ЗАГРУЗКА ИСХОДНЫХ ФАЙЛОВ
+# ============================================
+
+def normalize_source_frame(df):
+    """Сжимает пробелы во всех строковых колонках и убирает 'nan'/'None'"""
+    for col in df.columns:
+        if df[col].dtype == 'object':  # строковые колонки
+            df[col] = df[col].astype(str).str.strip()
+            # Заменяем пустые строки и 'nan' на пустую строку
+            df[col] = df[col].replace(['nan', 'None', 'null', ''], '')
+    return df
+
+
+def read_source_file(path):
+    """Читает файл источника (xlsx/xls/csv/parquet) как строки"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.csv':
+        df = pd.read_csv(path, dtype=str, encoding='utf-8-sig', sep=None, engine='python')
+    elif ext == '.parquet':
+        df = pd.read_parquet(path).astype(str)
+    else:
+        df = pd.read_excel(path, dtype=str)
+    return normalize_source_frame(df)
+
+
+def detect_source_name(file_name):
+    """Определяет источник по имени файла (None - файл не распознан)"""
+    name = os.path.splitext(os.path.basename(file_name))[0].lower()
+    for source_name, keywords in SOURCE_FILE_KEYWORDS:
+        if any(keyword in name for keyword in keywords):
+            return source_name
+    return None
+
+
+def load_source_folder(folder):
+    """
+    Загружает все распознанные файлы источников из папки.
+    Возвращает ({источник: DataFrame}, [нераспознанные файлы])
+    """
+    uploaded_files = {}
+    skipped = []
+    for file_name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, file_name)
+        if not os.path.isfile(path) or not file_name.lower().endswith(SOURCE_FILE_EXTENSIONS):
+            continue
+        source_name = detect_source_name(file_name)
+        if source_name is None or source_name in uploaded_files:
+            skipped.append(file_name)
+            continue
+        uploaded_files[source_name] = read_source_file(path)
+    return uploaded_files, skipped
+
+
+def _read_json(folder, key):
+    path = os.path.join(folder, SETTINGS_FILES[key])
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _projects_to_dataframe(projects_list):
+    """Список проектов из projects_settings.json → DataFrame настроек"""
+    if not projects_list:
+        return pd.DataFrame(columns=PROJECT_SETTINGS_COLUMNS)
+    df = pd.DataFrame(projects_list).rename(columns={
+        'project_name': 'Название проекта',
+        'wave_name': 'Волна',
+        'project_code': 'Код проекта',
+        'portal': 'ПО',
+        'fio_om': 'ФИО ОМ'
+    })
+    for col in PROJECT_SETTINGS_COLUMNS:
+        if col not in df.columns:
+            df[col] = ''
+    return df[PROJECT_SETTINGS_COLUMNS]
+
+
+def load_settings_from_folder(folder):
+    """
+    Загружает настройки из локальных JSON (копия файлов GitHub-репозитория настроек).
+    Возвращает (excluded_df, included_df, plan_sources)
+    """
+    return settings_to_sources({key: _read_json(folder, key) for key in SETTINGS_FILES})
+
+
+def settings_to_sources(settings):
+    """
+    Содержимое JSON-файлов настроек {ключ SETTINGS_FILES: dict} → (excluded_df, included_df, plan_sources).
+    Отсутствующий ключ - пустые настройки.
+    """
+    def read(key):
+        return settings.get(key) or {}
+    
+    projects = read('projects_settings')
+    excluded_df = _projects_to_dataframe(projects.get('excluded_projects', []))
+    included_df = _projects_to_dataframe(projects.get('included_projects', []))
+    
+    multibrand = read('multibrand_plan')
+    optima_rs = read('optima_rs')
+    # Нет файла календаря в настройках - локальный производственный календарь
+    production_calendar = settings.get('production_calendar')
+    plan_sources = {
+        'adjustments': read('adjustments').get('adjustments', []),
+        'multon_plan': pd.DataFrame(read('multon_plan').get('data', [])),
+        'multibrand_plan': (
+            pd.DataFrame(multibrand.get('dilers', [])),
+            pd.DataFrame(multibrand.get('pronto', []))
+        ),
+        'optima_rs': (
+            optima_rs.get('region_mapping', {}),
+            optima_rs.get('moscow_mapping', {}),
+            optima_rs.get('spb_mapping', {})
+        ),
+        'region_coefficients': read('region_coefficients').get('coefficients', {}),
+        'production_calendar': calendar_settings(production_calendar) if production_calendar else load_calendar_settings(),
+        # Даты обновления файлов (устаревшие помесячные планы - plan_registry)
+        'updated': {key: read(key).get('last_updated') or read(key).get('updated_at') for key in DATED_SOURCES}
+    }
+    return excluded_df, included_df, plan_sources
+
+
+# ============================================
+# ОЧИСТКА ИСТОЧНИКОВ
+# ============================================
+
+def prepare_sources(uploaded_files, calc_params, plan_sources=None, cleaned_data=None,
+                    diagnostics=None, profiler=None, progress=None):
+    """
+    Очистка и сверка всех источников визитов.
+    Не зависит от настроек проектов (исключенные/добавленные),
+    поэтому результат кэшируется и переиспользуется при пересчете.
+    
+    uploaded_files - {имя источника: DataFrame}, calc_params - период и коэффициенты,
+    cleaned_data - словарь для промежуточных таблиц (заполняется по ходу очистки),
+    progress - трекер фоновой задачи (job_runner.ProgressTracker) или None,
+    profiler - профилировщик этапов (profiler.Profiler), по умолчанию новый.
+    Возвращает словарь подготовленных источников или None, если данных недостаточно.
+    """
+    if cleaned_data is None:
+        cleaned_data = {}
+    profiler = _run_profiler(profiler)
+    diagnostics = _run_diagnostics(diagnostics)
+    data_cleaner = DataCleaner(diagnostics)
+    rs_distribution = (plan_sources or {}).get('optima_rs')
+    
+    # Проверяем наличие Сервизория (всегда обязательна)
+    if 'сервизория' not in uploaded_files:
+        return None
+    
+    # Проверяем наличие ХОТЯ БЫ одного источника визитов
+    has_visits_source = (
+        'портал' in uploaded_files or
+        'cxway' in uploaded_files or
+        'easymerch' in uploaded_files or
+        'optima' in uploaded_files
+    )
+    
+    if not has_visits_source:
+        return None
+    
+    # Получаем данные
+    google_raw = uploaded_files['сервизория']
+    sources_stage = profiler.begin('Очистка источников', rows_in=sum(
+        len(df) for df in uploaded_files.values() if df is not None
+    ))
+    sources_stage.frames_in(uploaded_files)
+    
+    # ОЧИСТКА ПРОЕКТОВ (GOOGLE)
+    step = _next_step(progress, profiler, None, 'Очистка Сервизории', len(google_raw))
+    google_cleaned = data_cleaner.clean_google(google_raw, calc_params)
+    if google_cleaned is None:
+        google_cleaned = google_raw
+    cleaned_data['сервизория'] = google_cleaned
+    cleaned_data['сервизория_original'] = google_raw.copy()
+    
+    # Добавление признака полевой проект
+    google_with_field = data_cleaner.update_field_projects_flag(cleaned_data['сервизория'])
+    cleaned_data['сервизория'] = google_with_field
+    step.rows(len(google_with_field))
+    step.frames_in({'сервизория': google_raw})
+    step.frames_out({'сервизория': google_with_field})
+    
+
+    # ОБРАБОТКА ПОРТАЛА (CHECKER) - ЕСЛИ ЗАГРУЖЕН
+    if 'портал' in uploaded_files:
+        portal_raw = uploaded_files['портал']
+        step = _next_step(progress, profiler, step, 'Очистка портала', len(portal_raw))
+        portal_cleaned = data_cleaner.clean_array(portal_raw, calc_params)
+        if portal_cleaned is None:
+            portal_cleaned = portal_raw
+        cleaned_data['портал'] = portal_cleaned
+        
+        enriched_result = data_cleaner.enrich_array_with_project_codes(
+            cleaned_data['портал'],
+            cleaned_data['сервизория']  # ← ТЕПЕРЬ СУЩЕСТВУЕТ!
+        )
+        
+        if enriched_result:
+            enriched_array, discrepancy_df, stats = enriched_result
+            cleaned_data['портал'] = enriched_array
+    else:
+        cleaned_data['портал'] = pd.DataFrame()
+
+    
+    # ОБОГАЩЕНИЕ ДАННЫХ (ОПТИМИЗИРОВАННО)
+    
+    # Добавляем поле 'Полевой' и 'ПО' (только если есть портал)
+    if 'портал' in cleaned_data and not cleaned_data['портал'].empty:
+        array_with_field = data_cleaner.add_field_flag_to_array(cleaned_data['портал'])
+        array_with_portal = data_cleaner.add_portal_to_array(array_with_field, google_with_field)
+        array_with_portal = data_cleaner.remove_cxway_from_portal(array_with_portal, google_with_field)
+        cleaned_data['портал_с_полем'] = array_with_portal
+    else:
+        cleaned_data['портал_с_полем'] = pd.DataFrame()
+    
+    # Разделение на полевые/неполевые (только если есть портал_с_полем)
+    if not cleaned_data['портал_с_полем'].empty:
+        field_df, non_field_df = data_cleaner.split_array_by_field_flag(
+            cleaned_data['портал_с_полем']
+        )
+        step.frames_in({'портал': uploaded_files['портал']})
+        step.frames_out({'портал_с_полем': cleaned_data['портал_с_полем'], 'field_df': field_df, 'non_field_df': non_field_df})
+    else:
+        field_df = pd.DataFrame()
+        non_field_df = pd.DataFrame()
+    
+    # ============================================
+    # ОБРАБОТКА ДОПОЛНИТЕЛЬНЫХ ИСТОЧНИКОВ
+    # ============================================
+    
+    # Обработка Easymerch (если есть)
+    easymerch_processed = None
+    easymerch_raw = uploaded_files.get('easymerch')
+    if easymerch_raw is not None:
+        step = _next_step(progress, profiler, step, 'Easymerch', len(easymerch_raw))
+        easymerch_processed = data_cleaner.clean_easymerch(easymerch_raw, google_with_field)
+        step.frames_in({'easymerch': easymerch_raw})
+        step.frames_out({'easymerch_processed': easymerch_processed})
+        if easymerch_processed is not None and not easymerch_processed.empty:
+            cleaned_data['easymerch_processed'] = easymerch_processed
+    
+    # Обработка Optima (если есть)
+    optima_processed = None
+    optima_raw = uploaded_files.get('optima')
+    if optima_raw is not None:
+        step = _next_step(progress, profiler, step, 'Optima', len(optima_raw))
+        try:
+            optima_processed = data_cleaner.clean_optima(optima_raw, google_with_field, rs_distribution)
+            step.frames_in({'optima': optima_raw})
+            step.frames_out({'optima_processed': optima_processed})
+            if optima_processed is not None and not optima_processed.empty:
+                cleaned_data['optima_processed'] = optima_processed
+        except Exception as e:
+            diagnostics.warning(f"⚠️ Ошибка при обработке Optima: {e}")
+
+    # Обработка ПроДата (Мониторинги)
+    prodata_processed = None
+    prodata_raw = uploaded_files.get('prodata')
+    if prodata_raw is not None:
+        step = _next_step(progress, profiler, step, 'ПроДата', len(prodata_raw))
+        try:
+            prodata_processed = data_cleaner.clean_prodata(prodata_raw, google_with_field)
+            step.frames_in({'prodata': prodata_raw})
+            step.frames_out({'prodata_processed': prodata_processed})
+            if prodata_processed is not None and not prodata_processed.empty:
+                cleaned_data['prodata_processed'] = prodata_processed
+        except Exception as e:
+            diagnostics.warning(f"⚠️ Ошибка при обработке ПроДата: {e}")
+
+    # Обработка БДР (плановая оплата) - опционально
+    bdr_processed = None
+    bdr_raw = uploaded_files.get('bdr')
+    if bdr_raw is not None:
+        step = _next_step(progress, profiler, step, 'БДР', len(bdr_raw))
+        bdr_processed = data_cleaner.clean_bdr(bdr_raw)
+        step.frames_in({'bdr': bdr_raw})
+        step.frames_out({'bdr_processed': bdr_processed})
+        if bdr_processed is not None and not bdr_processed.empty:
+            cleaned_data['bdr_processed'] = bdr_processed
+    
+    # Обработка CXWAY (если есть)
+    cxway_processed = None
+    cxway_raw = uploaded_files.get('cxway')
+    if cxway_raw is not None:
+        step = _next_step(progress, profiler, step, 'CXWAY', len(cxway_raw))
+        cxway_processed = data_cleaner.clean_cxway(cxway_raw, None, google_with_field, calc_params)
+        step.frames_in({'cxway': cxway_raw})
+        step.frames_out({'cxway_processed': cxway_processed})
+    
+    # Какие проекты в Google отмечены как Чеккер (для удаления дублей CXWAY/портал)
+    checker_keys = set()
+    if google_with_field is not None and not google_with_field.empty:
+        google_code_col = data_cleaner._find_column(google_with_field, ['Код проекта RU00.000.00.01SVZ24', 'Код проекта'])
+        google_portal_col = data_cleaner._find_column(google_with_field, ['Портал на котором идет проект (для работы полевой команды)', 'ПО'])
+        google_wave_col = data_cleaner._find_column(google_with_field, ['Название волны на Чекере/ином ПО', 'Волна'])
+        
+        if google_code_col and google_portal_col:
+            codes = google_with_field[google_code_col].astype(str).str.strip()
+            waves = google_with_field[google_wave_col].astype(str).str.strip() if google_wave_col else ''
+            portals = google_with_field[google_portal_col].astype(str).str.strip()
+            mask = (codes != '') & (portals == 'Чеккер')
+            checker_keys = set((codes + '|' + waves)[mask])
+    
+    profiler.end(sources_stage, rows_out=sum(
+        len(df) for df in (field_df, non_field_df, cxway_processed, easymerch_processed, optima_processed)
+        if df is not None
+    ))
+    
+    return {
+        'период': period_signature(calc_params),
+        'google': google_with_field,
+        'сервизория_original': cleaned_data['сервизория_original'],
+        'портал_с_полем': cleaned_data['портал_с_полем'],
+        'field_df': field_df,
+        'non_field_df': non_field_df,
+        'cxway_processed': cxway_processed,
+        'easymerch_processed': easymerch_processed,
+        'optima_processed': optima_processed,
+        'prodata_processed': prodata_processed,
+        'bdr_processed': bdr_processed,
+        'checker_keys': checker_keys
+    }
+
+
+# ============================================
+# НАСТРОЙКИ И РАСЧЕТ ПЛАН/ФАКТ
+# ============================================
+
+def _copy_or_none(df):
+    """Копия DataFrame (кэш источников не должен меняться при пересчете)"""
+    return df.copy() if df is not None else None
+
+
+# Источники строк для вручную добавленных проектов - в порядке приоритета
+INCLUDED_SOURCE_PRIORITY = ('CXWAY', 'Портал', 'Optima', 'Easymerch')
+
+INCLUDED_REPORT_COLUMNS = ['Клиент', 'Волна', 'Код проекта', 'ПО', 'Источник']
+
+
+def project_key(client, wave, code):
+    """Ключ проекта Клиент|Волна|Код (без пробелов по краям)"""
+    return (
+        client.astype(str).str.strip() + '|' +
+        wave.astype(str).str.strip() + '|' +
+        code.astype(str).str.strip()
+    )
+
+
+def build_included_index(candidate_sources, codes=None):
+    """
+    Единый индекс строк-кандидатов для вручную добавленных проектов.
+    candidate_sources - {источник: DataFrame визитов}; для каждого ключа проекта
+    остаются строки только самого приоритетного источника (INCLUDED_SOURCE_PRIORITY).
+    codes - коды добавленных проектов: ключи строятся только для строк с этими кодами.
+    Возвращает DataFrame с индексом _key и колонкой _source.
+    """
+    parts = []
+    for priority, source in enumerate(INCLUDED_SOURCE_PRIORITY):
+        df = candidate_sources.get(source)
+        if df is None or df.empty:
+            continue
+        if codes is not None:
+            df = df[df['Код анкеты'].astype(str).str.strip().isin(codes)]
+            if df.empty:
+                continue
+        keys = project_key(df['Имя клиента'], df['Название проекта'], df['Код анкеты'])
+        parts.append(df.assign(_source=source, _priority=priority).set_index(pd.Index(keys.values, name='_key')))
+    
+    if not parts:
+        return pd.DataFrame(columns=['_source', '_priority'], index=pd.Index([], name='_key'))
+    
+    candidates = pd.concat(parts)
+    best_priority = candidates.groupby(level='_key')['_priority'].transform('min')
+    return candidates[candidates['_priority'] == best_priority]
+
+
+def resolve_included_projects(candidates, keys):
+    """
+    Строки для добавленных проектов одним поиском по индексу.
+    Возвращает (строки с Полевой = 1 и Источник '<источник> (добавлен вручную)',
+    {ключ: источник}).
+    """
+    found = candidates[candidates.index.isin(keys)]
+    if found.empty:
+        return pd.DataFrame(), {}
+    source_by_key = found['_source'].groupby(level='_key').first().to_dict()
+    rows = found.reset_index(drop=True)
+    rows['Полевой'] = 1
+    rows['Источник'] = rows['_source'] + ' (добавлен вручную)'
+    return rows.drop(columns=['_source', '_priority']), source_by_key
+
+
+def calculate_plan_fact(sources, calc_params, excluded_df=None, included_df=None, plan_sources=None,
+                        loaded_sources=None, cleaned_data=None, diagnostics=None, profiler=None,
+                        progress=None, tracer=None):
+    """
+    Применение настроек проектов и расчет иерархии, плана, факта и метрик
+    по уже очищенным источникам из prepare_sources().
+    
+    excluded_df / included_df - исключенные и добавленные проекты
+    (колонки Название проекта, Волна, Код проекта, ПО, ФИО ОМ).
+    tracer - трассировка ключа (tracer.Tracer), по умолчанию выключена,
+    profiler - профилировщик этапов (profiler.Profiler), по умолчанию новый.
+    Возвращает словарь: visit_report, plan_result, fact_result, not_found_projects,
+    plan_unadjusted (план до корректировок - для preview_plan_adjustments),
+    stage_geometry и plan_adjustments (для replan_stage_weights), included_projects (источник каждого добавленного вручную проекта),
+    plan_sources_status (состояние плановых справочников), profile, trace.
+    """
+    if cleaned_data is None:
+        cleaned_data = {}
+    diagnostics = _run_diagnostics(diagnostics)
+    profiler = _run_profiler(profiler)
+    tracer = _run_tracer(tracer)
+    data_cleaner = DataCleaner(diagnostics)
+    visit_calculator = VisitCalculator(diagnostics, profiler, tracer)
+    if plan_sources is None:
+        plan_sources = load_plan_sources_from_managers(loaded_sources)
+    # Индексы справочников - один раз на расчет
+    plan_registry = PlanSourceRegistry(plan_sources, calc_params, loaded_sources)
+    for problem in plan_registry.problems():
+        diagnostics.warning(f"⚠️ Справочник {problem}")
+    visit_report = {}
+    not_found_projects = None
+    plan_result = None
+    plan_unadjusted = None
+    stage_geometry = None
+    fact_result = None
+    
+    google_with_field = sources['google']
+    field_df = _copy_or_none(sources['field_df'])
+    non_field_df = _copy_or_none(sources['non_field_df'])
+    cxway_processed = _copy_or_none(sources['cxway_processed'])
+    easymerch_processed = _copy_or_none(sources['easymerch_processed'])
+    optima_processed = _copy_or_none(sources['optima_processed'])
+    prodata_processed = sources['prodata_processed']
+    checker_keys = sources['checker_keys']
+    
+    # Очищенные таблицы, которые читает расчет
+    cleaned_data['сервизория'] = google_with_field
+    cleaned_data['сервизория_original'] = sources['сервизория_original']
+    cleaned_data['портал_с_полем'] = sources['портал_с_полем']
+    for key in ('easymerch_processed', 'optima_processed', 'prodata_processed', 'bdr_processed'):
+        if sources.get(key) is not None and not sources[key].empty:
+            cleaned_data[key] = sources[key]
+    
+    step = _next_step(progress, profiler, None, 'Применение настроек', sum(
+        len(df) for df in (field_df, non_field_df, cxway_processed, easymerch_processed, optima_processed)
+        if df is not None
+    ))
+    
+    # Настройки проектов (копии - ниже в них добавляются служебные ключи)
+    excluded_df = excluded_df.copy() if excluded_df is not None else pd.DataFrame()
+    included_df = included_df.copy() if included_df is not None else pd.DataFrame()
+    
+    # ============================================
+    # ВЕКТОРИЗОВАННОЕ ПРИМЕНЕНИЕ НАСТРОЕК
+    # ============================================
+    
+    # Применяем исключенные проекты (делаем их неполевыми)
+    if not excluded_df.empty and field_df is not None and not field_df.empty:
+        # Создаем временные ключи для быстрого поиска
+        field_df['_temp_key'] = (
+            field_df['Имя клиента'].astype(str) + '|' + 
+            field_df['Название проекта'].astype(str) + '|' + 
+            field_df['Код анкеты'].astype(str)
+        )
+        excluded_df['_temp_key'] = (
+            excluded_df['Название проекта'].astype(str) + '|' + 
+            excluded_df['Волна'].astype(str) + '|' + 
+            excluded_df['Код проекта'].astype(str)
+        )
+        
+        # Одна операция вместо цикла
+        mask = field_df['_temp_key'].isin(excluded_df['_temp_key'])
+        field_df.loc[mask, 'Полевой'] = 0
+        
+        # Удаляем временные колонки
+        field_df = field_df.drop('_temp_key', axis=1)
+        # excluded_df не сохраняем, не нужно удалять
+    
+    # Применяем добавленные проекты (делаем их полевыми)
+    if not included_df.empty and non_field_df is not None and not non_field_df.empty:
+        # Создаем временные ключи
+        non_field_df['_temp_key'] = (
+            non_field_df['Имя клиента'].astype(str) + '|' + 
+            non_field_df['Название проекта'].astype(str) + '|' + 
+            non_field_df['Код анкеты'].astype(str)
+        )
+        included_df['_temp_key'] = (
+            included_df['Название проекта'].astype(str) + '|' + 
+            included_df['Волна'].astype(str) + '|' + 
+            included_df['Код проекта'].astype(str)
+        )
+        
+        # Одна операция вместо цикла
+        mask = non_field_df['_temp_key'].isin(included_df['_temp_key'])
+        non_field_df.loc[mask, 'Полевой'] = 1
+        
+        # Удаляем временные колонки
+        non_field_df = non_field_df.drop('_temp_key', axis=1)
+    
+    # Объединяем все проекты в один датасет
+    # Проверяем, есть ли данные из портала
+    if not field_df.empty or not non_field_df.empty:
+        all_projects = pd.concat([field_df, non_field_df], ignore_index=True)
+    else:
+        # Если портала нет — создаем пустой DataFrame с нужными колонками
+        all_projects = pd.DataFrame(columns=[
+            'Код анкеты', 'Имя клиента', 'Название проекта', 
+            'ЗОД', 'АСС', 'ЭМ', 'Регион short', 'Регион', 'ПО', 
+            'Полевой', 'Статус', 'Дата визита', 'Оплата факт', 'Источник'
+        ])
+    cleaned_data['all_projects'] = all_projects
+    
+    # Создаем датасеты из портала (если есть данные)
+    if not all_projects.empty and 'Полевой' in all_projects.columns:
+        field_df = all_projects[all_projects['Полевой'] == 1].copy()
+        non_field_df = all_projects[all_projects['Полевой'] == 0].copy()
+        cleaned_data['полевые_проекты'] = all_projects[all_projects['Полевой'] == 1].copy()
+        cleaned_data['неполевые_проекты'] = all_projects[all_projects['Полевой'] == 0].copy()
+    else:
+        field_df = pd.DataFrame()
+        non_field_df = pd.DataFrame()
+        cleaned_data['полевые_проекты'] = pd.DataFrame()
+        cleaned_data['неполевые_проекты'] = pd.DataFrame()
+
+    
+    # ============================================
+    # ВЕКТОРИЗОВАННОЕ ДОБАВЛЕНИЕ ЗОД
+    # ============================================
+    
+    # Добавление ЗОД из встроенного справочника (векторизовано)
+    if field_df is not None and not field_df.empty:
+        # Получаем ЗОД через словарь (быстрее чем apply)
+        field_df_with_zod = data_cleaner.add_zod_from_hierarchy(field_df)
+        
+        # Создаем словарь для быстрого обновления
+        if not field_df_with_zod.empty:
+            # Создаем временный ключ для поиска
+            all_projects['_temp_key'] = (
+                all_projects['Имя клиента'].astype(str) + '|' + 
+                all_projects['Название проекта'].astype(str) + '|' + 
+                all_projects['Код анкеты'].astype(str)
+            )
+            
+            # Создаем маппинг ЗОД по ключу
+            zod_mapping = {}
+            for _, row in field_df_with_zod.iterrows():
+                key = (
+                    str(row['Имя клиента']) + '|' + 
+                    str(row['Название проекта']) + '|' + 
+                    str(row['Код анкеты'])
+                )
+                zod_mapping[key] = row['ЗОД']
+            
+            # Обновляем ЗОД одним проходом
+            mask = all_projects['_temp_key'].isin(zod_mapping.keys())
+            all_projects.loc[mask, 'ЗОД'] = all_projects.loc[mask, '_temp_key'].map(zod_mapping)
+            
+            # Удаляем временную колонку
+            all_projects = all_projects.drop('_temp_key', axis=1)
+    
+    # Неполевые CXWAY добавляем в неполевые проекты сразу
+    if cxway_processed is not None and not cxway_processed.empty:
+        cxway_non_field = cxway_processed[cxway_processed['Полевой'] == 0]
+        if not cxway_non_field.empty:
+            cleaned_data['неполевые_проекты'] = pd.concat([
+                cleaned_data['неполевые_проекты'],
+                cxway_non_field
+            ], ignore_index=True)
+
+
+    # ============================================
+    # УДАЛЕНИЕ ДУБЛЕЙ ПО ПРИОРИТЕТУ ИЗ GOOGLE (ВЕКТОРИЗИРОВАННО)
+    # ============================================
+    
+    if cxway_processed is not None and not cxway_processed.empty and field_df is not None and not field_df.empty:
+        # Ключи проектов
+        cxway_keys = (
+            cxway_processed['Код анкеты'].astype(str).str.strip() + '|' +
+            cxway_processed['Название проекта'].astype(str).str.strip()
+        )
+        portal_keys = (
+            field_df['Код анкеты'].astype(str).str.strip() + '|' +
+            field_df['Название проекта'].astype(str).str.strip()
+        )
+        
+        # Находим пересекающиеся проекты
+        common_mask = cxway_keys.isin(portal_keys)
+        common_keys = cxway_keys[common_mask].unique()
+        
+        # Разделяем на два множества
+        remove_from_cxway = [k for k in common_keys if k in checker_keys]
+        remove_from_portal = [k for k in common_keys if k not in checker_keys]
+        
+        # Векторизированное удаление из CXWAY
+        if remove_from_cxway:
+            cxway_processed = cxway_processed[~cxway_keys.isin(remove_from_cxway)]
+        
+        # Векторизированное удаление из портала
+        if remove_from_portal:
+            field_df = field_df[~portal_keys.isin(remove_from_portal)]
+            # Обновляем field_df_with_zod для слияния
+            if not field_df.empty:
+                field_df_with_zod = data_cleaner.add_zod_from_hierarchy(field_df)
+            else:
+                field_df_with_zod = pd.DataFrame()
+                
+        
+    
+    # ============================================
+    # ФИНАЛЬНОЕ ОБЪЕДИНЕНИЕ ВСЕХ ИСТОЧНИКОВ
+    # ============================================
+    
+    sources_for_merge = []
+    
+    if field_df is not None and not field_df.empty:
+        sources_for_merge.append(field_df_with_zod)
+        
+    if cxway_processed is not None and not cxway_processed.empty:
+        cxway_field_only = cxway_processed[cxway_processed['Полевой'] == 1].copy()
+        if not cxway_field_only.empty:
+            sources_for_merge.append(cxway_field_only)
+    
+    if easymerch_processed is not None and not easymerch_processed.empty:
+        sources_for_merge.append(easymerch_processed)
+        
+    if optima_processed is not None and not optima_processed.empty:
+        sources_for_merge.append(optima_processed)
+    
+    if prodata_processed is not None and not prodata_processed.empty:
+        cleaned_data['prodata_processed'] = prodata_processed
+    
+    if sources_for_merge:
+        all_field_projects = pd.concat(sources_for_merge, ignore_index=True)
+    else:
+        all_field_projects = pd.DataFrame()
+    cleaned_data['полевые_проекты'] = all_field_projects
+
+    # ============================================
+    # ДОБАВЛЯЕМ ЗОД ДЛЯ ВСЕХ ПОЛЕВЫХ ПРОЕКТОВ
+    # ============================================
+    if not cleaned_data['полевые_проекты'].empty:
+        all_field_projects_with_zod = data_cleaner.add_zod_from_hierarchy(
+            cleaned_data['полевые_проекты']
+        )
+        cleaned_data['полевые_проекты'] = all_field_projects_with_zod
+    
+    # Добавляем ЗОД для неполевых проектов
+    if not cleaned_data['неполевые_проекты'].empty:
+        non_field_with_zod = data_cleaner.add_zod_from_hierarchy(
+            cleaned_data['неполевые_проекты']
+        )
+        cleaned_data['неполевые_проекты'] = non_field_with_zod
+
+    # ============================================
+    # ПРИМЕНЕНИЕ НАСТРОЕК ДЛЯ CXWAY/EASYMERCH/OPTIMA
+    # ============================================
+    
+    # 1. Обрабатываем excluded_df (исключаем проекты из расчета)
+    if not excluded_df.empty and not all_field_projects.empty:
+        excluded_df['_key'] = (
+            excluded_df['Название проекта'].astype(str).str.strip() + '|' +
+            excluded_df['Волна'].astype(str).str.strip() + '|' +
+            excluded_df['Код проекта'].astype(str).str.strip()
+        )
+        
+        all_field_projects['_key'] = (
+            all_field_projects['Имя клиента'].astype(str).str.strip() + '|' +
+            all_field_projects['Название проекта'].astype(str).str.strip() + '|' +
+            all_field_projects['Код анкеты'].astype(str).str.strip()
+        )
+        
+        all_field_projects = all_field_projects[~all_field_projects['_key'].isin(excluded_df['_key'])]
+        all_field_projects = all_field_projects.drop('_key', axis=1)
+        excluded_df = excluded_df.drop('_key', axis=1)
+        
+        cleaned_data['полевые_проекты'] = all_field_projects
+    
+    # 2. Обрабатываем included_df (добавляем проекты в расчет)
+    included_projects = pd.DataFrame(columns=INCLUDED_REPORT_COLUMNS)
+    if not included_df.empty:
+        included_df['_key'] = project_key(
+            included_df['Название проекта'], included_df['Волна'], included_df['Код проекта']
+        )
+        
+        # Ключи проектов, которые уже есть в расчете
+        if not all_field_projects.empty:
+            existing_keys = set(project_key(
+                all_field_projects['Имя клиента'], all_field_projects['Название проекта'], all_field_projects['Код анкеты']
+            ))
+        else:
+            existing_keys = set()
+        
+        # Находим проекты, которых еще нет
+        new_projects = included_df[~included_df['_key'].isin(existing_keys)]
+        
+        if not new_projects.empty:
+            # Один индекс строк-кандидатов по всем источникам (по приоритету источника)
+            candidates = build_included_index({
+                'CXWAY': cxway_processed,
+                'Портал': cleaned_data.get('портал_с_полем'),
+                'Optima': optima_processed,
+                'Easymerch': easymerch_processed
+            }, codes=set(new_projects['Код проекта'].astype(str).str.strip()))
+            found_rows, source_by_key = resolve_included_projects(candidates, set(new_projects['_key']))
+            
+            # Добавляем найденные строки
+            if not found_rows.empty:
+                if all_field_projects.empty:
+                    all_field_projects = found_rows
+                else:
+                    all_field_projects = pd.concat([all_field_projects, found_rows], ignore_index=True)
+            
+            # Откуда взят каждый добавленный проект / какие не найдены
+            included_projects = pd.DataFrame({
+                'Клиент': new_projects['Название проекта'].values,
+                'Волна': new_projects['Волна'].values,
+                'Код проекта': new_projects['Код проекта'].values,
+                'ПО': new_projects['ПО'].values if 'ПО' in new_projects.columns else '',
+                'Источник': new_projects['_key'].map(source_by_key).values
+            }, columns=INCLUDED_REPORT_COLUMNS)
+            
+            not_found = included_projects[included_projects['Источник'].isna()]
+            not_found_projects = not_found.drop(columns='Источник').assign(
+                **{'Проверенные источники': ', '.join(INCLUDED_SOURCE_PRIORITY)}
+            ).reset_index(drop=True)
+            found = included_projects[included_projects['Источник'].notna()]
+            if not found.empty:
+                diagnostics.info(
+                    f"➕ Добавлено вручную проектов: {len(found)} из {len(included_projects)}"
+                )
+                diagnostics.dataframe(found.reset_index(drop=True))
+        
+        # Сохраняем обновленные полевые проекты
+        cleaned_data['полевые_проекты'] = all_field_projects
+        
+
+
+    all_projects_export = pd.concat([
+        cleaned_data['полевые_проекты'],
+        cleaned_data['неполевые_проекты']
+    ], ignore_index=True)
+    cleaned_data['all_projects'] = all_projects_export
+
+
+    
+    # Создание иерархии
+    field_projects = cleaned_data['полевые_проекты']
+    tracer.summary('Источники', 'полевые проекты перед иерархией', lambda: {
+        'строк': len(field_projects),
+        'источники': sorted(field_projects['Источник'].astype(str).unique()) if 'Источник' in field_projects.columns else [],
+        'Полевой == 1': int((field_projects['Полевой'] == 1).sum()) if 'Полевой' in field_projects.columns else 0
+    })
+    
+    step = _next_step(progress, profiler, step, 'Иерархия', len(cleaned_data['полевые_проекты']))
+    base_data = visit_calculator.extract_hierarchical_data(
+        cleaned_data['полевые_проекты'],
+        cleaned_data['сервизория'],
+        cleaned_data.get('сервизория_original'),
+        calc_params=calc_params
+    )
+    
+    visit_report['base_data'] = base_data
+    visit_report['timestamp'] = datetime.now().isoformat()
+    step.rows(len(base_data) if base_data is not None else None)
+    step.frames_in({'полевые_проекты': field_projects, 'сервизория': cleaned_data['сервизория']})
+    step.frames_out({'base_data': base_data})
+
+    tracer.summary('Иерархия', 'готова', lambda: {
+        'период': f"{calc_params.get('start_date')} — {calc_params.get('end_date')}" if calc_params else None,
+        'строк': len(base_data) if base_data is not None else None
+    })
+    
+
+    # Расчет план/факт
+    if calc_params and not base_data.empty:
+        params = calc_params
+        source_df = cleaned_data['полевые_проекты']
+        
+        step = _next_step(progress, profiler, step, 'План', len(base_data))
+        # Куб визитов - один на план и все варианты факта
+        cube_step = profiler.begin('Куб визитов', rows_in=len(source_df))
+        visit_cube = VisitCube(source_df, params)
+        profiler.end(cube_step, rows_out=len(visit_cube))
+        plan_unadjusted = visit_calculator.calculate_hierarchical_plan_on_date(
+            base_data, source_df, params, 
+            google_df=cleaned_data['сервизория'],
+            optima_df=cleaned_data.get('optima_processed'),
+            plan_sources=plan_sources,
+            loaded_sources=loaded_sources,
+            progress=progress,
+            plan_registry=plan_registry,
+            visit_cube=visit_cube,
+            adjust=False
+        )
+        
+        # === ДОБАВЛЕНИЕ ПЛАНОВОЙ ОПЛАТЫ ===
+        if plan_unadjusted is not None and not plan_unadjusted.empty:
+            bdr_df = cleaned_data.get('bdr_processed')
+            if bdr_df is not None and not bdr_df.empty:
+                plan_unadjusted = visit_calculator.add_plan_payment(
+                    plan_unadjusted, bdr_df, plan_registry.region_coefficients
+                )
+
+        # Геометрия этапов - пересчет плана на дату при изменении весов этапов
+        if plan_unadjusted is not None and not plan_unadjusted.empty:
+            geometry_step = profiler.begin('Геометрия этапов', rows_in=len(plan_unadjusted))
+            stage_geometry = StageGeometry(plan_unadjusted, params, visit_cube)
+            profiler.end(geometry_step, rows_out=len(stage_geometry))
+
+        # === КОРРЕКТИРОВКИ ПЛАНА ===
+        # План без корректировок сохраняется: новые корректировки применяются к нему без пересчета
+        adjust_step = profiler.begin('Корректировки', rows_in=len(plan_unadjusted) if plan_unadjusted is not None else 0)
+        plan_result = apply_plan_adjustments(plan_unadjusted, plan_registry.adjustments, diagnostics)
+        profiler.end(adjust_step, rows_out=len(plan_result) if plan_result is not None else 0)
+
+        if plan_result is None or plan_result.empty:
+            diagnostics.warning("⚠️ plan_result ПУСТОЙ!")
+        step.rows(len(plan_result) if plan_result is not None else 0)
+        step.frames_in({'base_data': base_data, 'полевые_проекты': source_df})
+        step.frames_out({'plan_result': plan_result})
+        
+        if plan_result is not None and not plan_result.empty:
+            step = _next_step(progress, profiler, step, 'Факт', len(source_df))
+            status_step = profiler.begin('Выполненные', rows_in=len(source_df))
+            fact_result = visit_calculator.calculate_hierarchical_fact_on_date(
+                plan_result, source_df, params, status_filter='completed', visit_cube=visit_cube
+            )
+            
+            if fact_result is None or fact_result.empty:
+                diagnostics.warning("⚠️ fact_result ПУСТОЙ!")
+            profiler.end(status_step, rows_out=len(fact_result) if fact_result is not None else 0)
+
+
+            # Факт по порученным
+            status_step = profiler.begin('Порученные', rows_in=len(source_df))
+            assigned_result = visit_calculator.calculate_hierarchical_fact_on_date(
+                plan_result, source_df, params, status_filter='assigned', visit_cube=visit_cube
+            )
+            
+            # Объединяем результаты
+            for col in assigned_result.columns:
+                if col not in fact_result.columns:
+                    fact_result[col] = assigned_result[col]
+            profiler.end(status_step, rows_out=len(assigned_result))
+
+            # Факт по не порученным
+            status_step = profiler.begin('Не порученные', rows_in=len(source_df))
+            not_assigned_result = visit_calculator.calculate_hierarchical_fact_on_date(
+                plan_result, source_df, params, status_filter='not_assigned', visit_cube=visit_cube
+            )
+            
+            # Объединяем результаты
+            for col in not_assigned_result.columns:
+                if col not in fact_result.columns:
+                    fact_result[col] = not_assigned_result[col]
+            profiler.end(status_step, rows_out=len(not_assigned_result))
+            step.rows(len(fact_result))
+            step.frames_in({'plan_result': plan_result, 'полевые_проекты': source_df})
+            step.frames_out({'fact_result': fact_result})
+            
+            step = _next_step(progress, profiler, step, 'Метрики', len(fact_result))
+            final_result = visit_calculator._calculate_metrics(
+                fact_result, params, plan_result
+            )
+            
+            visit_report['calculated_data'] = final_result
+            # Куб сводных таблиц отчетов - один раз на расчет
+            cube_step = profiler.begin('OLAP-куб', rows_in=len(final_result))
+            visit_report['rollup_cube'] = RollupCube(final_result)
+            profiler.end(cube_step, rows_out=sum(len(cuboid) for cuboid in visit_report['rollup_cube'].cuboids.values()))
+            step.rows(len(final_result) if final_result is not None else 0)
+            step.frames_in({'fact_result': fact_result})
+            step.frames_out({'calculated_data': final_result})
+            
+    profiler.end(step)
+            
+    return {
+        'visit_report': visit_report,
+        'plan_result': plan_result,
+        'fact_result': fact_result,
+        'plan_unadjusted': plan_unadjusted,
+        'stage_geometry': stage_geometry,
+        'plan_adjustments': plan_registry.adjustments,
+        'not_found_projects': not_found_projects,
+        'included_projects': included_projects,
+        'plan_sources_status': plan_registry.status_frame(),
+        'cleaned_data': cleaned_data,
+        'profile': profiler,
+        'diagnostics': diagnostics,
+        'trace': tracer if tracer.enabled else None
+    }
+
+
+# ============================================
+# ПРЕДПРОСМОТР КОРРЕКТИРОВОК
+# ============================================
+
+# Итоги проекта до/после корректировок
+ADJUSTMENT_SUMMARY_COLUMNS = ['План проекта, шт.', 'План на дату, шт.', 'Факт на дату, шт.']
+
+
+def preview_plan_adjustments(fact_result, plan_unadjusted, adjustments, calc_params, diagnostics=None):
+    """
+    Итоговая таблица (как calculated_data) с другими корректировками без пересчета плана и факта:
+    колонки ADJUSTED_COLUMNS берутся из плана без корректировок (plan_unadjusted того же расчета),
+    корректируются и пересчитываются метрики. adjustments - {клиент|волна|код: сумма}.
+    """
+    if fact_result is None or fact_result.empty or plan_unadjusted is None:
+        return None
+    base = fact_result.copy()
+    for col in ADJUSTED_COLUMNS:
+        if col in base.columns and col in plan_unadjusted.columns:
+            base[col] = plan_unadjusted[col]
+    adjusted = apply_plan_adjustments(base, adjustments, diagnostics)
+    return VisitCalculator(diagnostics)._calculate_metrics(adjusted, calc_params, adjusted)
+
+
+def replan_stage_weights(fact_result, plan_unadjusted, stage_geometry, adjustments, calc_params):
+    """
+    Отчет для новых весов этапов (calc_params['coefficients']) без полного расчета:
+    план на дату строк - по геометрии этапов расчета (plan_engine.StageGeometry),
+    затем корректировки и метрики. Период calc_params должен совпадать с периодом расчета.
+    Возвращает (план до корректировок, план, calculated_data).
+    """
+    plan_unadjusted = plan_unadjusted.copy()
+    plan_on_date, daily_plan = stage_geometry.plan_on_date(calc_params['coefficients'])
+    plan_unadjusted['План на дату, шт.'] = plan_on_date
+    plan_unadjusted['Дневной план RS, шт.'] = daily_plan
+    plan_result = apply_plan_adjustments(plan_unadjusted, adjustments)
+    calculated_data = preview_plan_adjustments(fact_result, plan_unadjusted, adjustments, calc_params)
+    return plan_unadjusted, plan_result, calculated_data
+
+
+def adjustment_summary(current_df, preview_df, keys=None):
+    """
+    Сравнение итогов по проектам 'клиент|волна|код': текущий отчет и предпросмотр.
+    keys - только эти проекты (None - все, где план изменился).
+    """
+    totals = {}
+    for label, df in (('сейчас', current_df), ('предпросмотр', preview_df)):
+        grouped = df.groupby(project_keys(df), sort=False)[ADJUSTMENT_SUMMARY_COLUMNS].sum()
+        grouped['%ПФ на дату'] = (grouped['Факт на дату, шт.'] /
+                                  grouped['План на дату, шт.'].where(grouped['План на дату, шт.'] > 0) * 100).round(1)
+        totals[label] = grouped
+    summary = pd.concat(totals, axis=1).fillna(0)
+    summary.columns = [f"{col} ({label})" for label, col in summary.columns]
+    if keys is None:
+        changed = (summary['План проекта, шт. (сейчас)'] - summary['План проекта, шт. (предпросмотр)']).abs() > 1e-9
+        summary = summary[changed]
+    else:
+        summary = summary.reindex([key for key in keys if key in summary.index])
+    return summary.rename_axis('Проект').reset_index()
+
+
+# ============================================
+# ПОЛНЫЙ РАСЧЕТ
+# ============================================
+
+def run_pipeline(uploaded_files, calc_params, excluded_df=None, included_df=None, plan_sources=None,
+                 diagnostics=None, progress=None, tracer=None, profiler=None):
+    """
+    Полный расчет: очистка источников → настройки → иерархия → план → факт → метрики.
+    Возвращает словарь результата calculate_plan_fact() с добавленными sources
+    или None, если не хватает обязательных файлов.
+    """
+    diagnostics = _run_diagnostics(diagnostics)
+    profiler = _run_profiler(profiler)
+    loaded_sources = set(uploaded_files.keys())
+    if plan_sources is None:
+        plan_sources = load_plan_sources_from_managers(loaded_sources)
+    
+    cleaned_data = {}
+    sources = prepare_sources(
+        uploaded_files, calc_params, plan_sources,
+        cleaned_data=cleaned_data, diagnostics=diagnostics, profiler=profiler, progress=progress
+    )
+    if sources is None:
+        return None
+    
+    result = calculate_plan_fact(
+        sources, calc_params, excluded_df, included_df, plan_sources,
+        loaded_sources=loaded_sources, cleaned_data=cleaned_data,
+        diagnostics=diagnostics, profiler=profiler, progress=progress, tracer=tracer
+    )
+    result['sources'] = sources
+    return result
+
+
+# ============================================
+# МНОГОПЕРИОДНЫЙ РАСЧЕТ
+# ============================================
+
+# Источники, из которых очистка удаляет визиты раньше начала периода
+PERIOD_CUTOFF_SOURCES = ('портал_с_полем', 'field_df', 'non_field_df', 'cxway_processed')
+
+
+def split_periods(start_date, end_date, freq='month'):
+    """
+    Делит диапазон дат на периоды расчета: 'month' - по месяцам, 'week' - по неделям
+    (пн-вс). Периоды не выходят за границу месяца - как и в сайдбаре.
+    Возвращает список (начало, конец).
+    """
+    periods = []
+    current = start_date
+    while current <= end_date:
+        month_end = (pd.Timestamp(current) + pd.offsets.MonthEnd(0)).date()
+        if freq == 'week':
+            period_end = current + timedelta(days=6 - current.weekday())
+            period_end = min(period_end, month_end, end_date)
+        else:
+            period_end = min(month_end, end_date)
+        periods.append((current, period_end))
+        current = period_end + timedelta(days=1)
+    return periods
+
+
+def period_label(calc_params):
+    """Подпись периода в индексе многопериодного результата"""
+    return f"{calc_params['start_date']} — {calc_params['end_date']}"
+
+
+def _restrict_sources_to_period(sources, calc_params):
+    """
+    Копия подготовленных источников без визитов раньше начала периода.
+    Повторяет фильтр дат очистки, поэтому источники, очищенные один раз
+    с самой ранней датой месяца, подходят для любого периода этого месяца.
+    Визиты без даты (пустые или с заглушкой SURROGATE_DATE) остаются, как и при очистке.
+    """
+    first_day = pd.Timestamp(calc_params['start_date'])
+    restricted = dict(sources)
+    for key in PERIOD_CUTOFF_SOURCES:
+        df = sources.get(key)
+        if df is None or df.empty or 'Дата визита' not in df.columns:
+            continue
+        visit_dates = pd.to_datetime(df['Дата визита'], errors='coerce')
+        restricted[key] = df[visit_dates.isna() | (visit_dates == SURROGATE_DATE) | (visit_dates >= first_day)]
+    restricted['период'] = period_signature(calc_params)
+    return restricted
+
+
+def calculate_periods(uploaded_files, periods, coefficients, excluded_df=None, included_df=None,
+                      plan_sources=None, diagnostics=None, profiler=None):
+    """
+    План/факт сразу для списка периодов [(начало, конец), ...].
+    
+    Очистка источников выполняется один раз на месяц (она зависит только от месяца
+    и начала периода), справочники плана загружаются один раз на весь расчет;
+    по периодам считаются только иерархия, план, факт и метрики. Они пересчитываются
+    calculate_plan_fact для каждого периода: визиты до начала периода отбрасываются,
+    поэтому визиты по ключу плана, доли RS и состав иерархии у периодов свои.
+    Совпадение с обычным расчетом каждого периода - check_period_parity.
+    
+    Возвращает словарь:
+        calculated_data - итог всех периодов с уровнем индекса 'Период'
+                          (срез одного периода: result.loc[period_label(params)]),
+        results - {подпись периода: результат calculate_plan_fact()},
+        profile - профиль этапов (по месяцам и периодам).
+    Периоды без данных пропускаются.
+    """
+    diagnostics = _run_diagnostics(diagnostics)
+    profiler = _run_profiler(profiler)
+    loaded_sources = set(uploaded_files.keys())
+    if plan_sources is None:
+        plan_sources = load_plan_sources_from_managers(loaded_sources)
+    
+    # Группируем периоды по месяцу
+    periods_by_month = {}
+    for start_date, end_date in periods:
+        periods_by_month.setdefault((start_date.year, start_date.month), []).append((start_date, end_date))
+    
+    results = {}
+    frames = []
+    for month_key in sorted(periods_by_month):
+        month_periods = sorted(periods_by_month[month_key])
+        month_stage = profiler.begin(f"Месяц {month_key[1]:02d}.{month_key[0]}")
+        
+        # Источники очищаются с самым ранним началом и концом месяца
+        month_params = {
+            'start_date': month_periods[0][0],
+            'end_date': max(end_date for _, end_date in month_periods),
+            'coefficients': coefficients
+        }
+        month_sources = prepare_sources(
+            uploaded_files, month_params, plan_sources,
+            cleaned_data={}, diagnostics=diagnostics, profiler=profiler
+        )
+        if month_sources is None:
+            return None
+        
+        for start_date, end_date in month_periods:
+            calc_params = {'start_date': start_date, 'end_date': end_date, 'coefficients': coefficients}
+            label = period_label(calc_params)
+            period_stage = profiler.begin(f"Период {label}")
+            result = calculate_plan_fact(
+                _restrict_sources_to_period(month_sources, calc_params), calc_params,
+                excluded_df, included_df, plan_sources,
+                loaded_sources=loaded_sources, cleaned_data={}, diagnostics=diagnostics,
+                profiler=profiler
+            )
+            results[label] = result
+            profiler.end(period_stage)
+            
+            calculated_data = result['visit_report'].get('calculated_data')
+            if calculated_data is not None and not calculated_data.empty:
+                frames.append((label, calculated_data))
+        profiler.end(month_stage)
+    
+    if frames:
+        calculated_data = pd.concat(
+            [df for _, df in frames], keys=[label for label, _ in frames], names=['Период']
+        )
+    else:
+        calculated_data = pd.DataFrame()
+    
+    return {
+        'calculated_data': calculated_data,
+        'results': results,
+        'profile': profiler,
+        'diagnostics': diagnostics
+    }
+
+
+def _calculated_data(result):
+    data = None if result is None else result['visit_report'].get('calculated_data')
+    return pd.DataFrame() if data is None else data
+
+
+def check_period_parity(uploaded_files, periods, coefficients, excluded_df=None, included_df=None,
+                        plan_sources=None, tolerance=1e-9):
+    """
+    Сверка пакетного расчета с обычным: periods считаются одним calculate_periods,
+    затем каждый период - отдельным run_pipeline.
+    Возвращает таблицу расхождений calculated_data ('Период', 'Строка', 'Колонка',
+    'Обычный расчет', 'Пакетный расчет'), пустая - результаты совпадают.
+    """
+    loaded_sources = set(uploaded_files.keys())
+    if plan_sources is None:
+        plan_sources = load_plan_sources_from_managers(loaded_sources)
+    batch = calculate_periods(uploaded_files, periods, coefficients, excluded_df, included_df, plan_sources)
+    batch_results = {} if batch is None else batch['results']
+    
+    mismatches = {}
+    for start_date, end_date in periods:
+        calc_params = {'start_date': start_date, 'end_date': end_date, 'coefficients': coefficients}
+        label = period_label(calc_params)
+        single = run_pipeline(uploaded_files, calc_params, excluded_df, included_df, plan_sources)
+        mismatches[label] = compare_plans(
+            _calculated_data(single), _calculated_data(batch_results.get(label)), tolerance
+        ).rename(columns={'Построчно': 'Обычный расчет', 'Колоночно': 'Пакетный расчет'})
+    return pd.concat(mismatches, names=['Период']).reset_index(level='Период').reset_index(drop=True)
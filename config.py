@@ -1,8 +1,42 @@
 # config.py
 # Теперь конфигурация простая, так как файлы загружаются через интерфейс
+import os
 
 class Config:
     DEBUG = True
     CACHE_TTL = 3600
+    
+    # Снимки результатов расчета (Parquet)
+    SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', './data/snapshots/')
+    SNAPSHOT_KEEP = int(os.getenv('SNAPSHOT_KEEP', 30))
+    
+    # Фоновые задачи расчета
+    JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+    JOB_TTL = int(os.getenv('JOB_TTL', 3600))
+    
+    # Общий для сессий кэш результатов расчета (МБ)
+    RESULT_CACHE_MB = int(os.getenv('RESULT_CACHE_MB', 1024))
+    
+    # Профили этапов расчета (JSON для сравнения запусков)
+    PROFILE_DIR = os.getenv('PROFILE_DIR', './data/profiles/')
+    PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', 50))
+    
+    # Промежуточные таблицы сессий на диске (Arrow IPC)
+    FRAME_STORE_DIR = os.getenv('FRAME_STORE_DIR', './data/frames/')
+    FRAME_STORE_MB = int(os.getenv('FRAME_STORE_MB', 512))
+    FRAME_SPILL_MIN_KB = int(os.getenv('FRAME_SPILL_MIN_KB', 1024))
+    FRAME_STORE_TTL = int(os.getenv('FRAME_STORE_TTL', 86400))
+    
+    # Кэш готовых Excel-выгрузок (МБ)
+    EXPORT_CACHE_MB = int(os.getenv('EXPORT_CACHE_MB', 256))
+    
+    # Расчет плана: 'vectorized' (колоночный plan_engine) или 'legacy' (построчный цикл)
+    PLAN_ENGINE = os.getenv('PLAN_ENGINE', 'vectorized')
+    
+    # Производственный календарь (праздники и переносы рабочих дней, JSON)
+    CALENDAR_FILE = os.getenv('CALENDAR_FILE', './production_calendar.json')
+    
+    # Бенчмарк этапов: наборы синтетических данных и результаты запусков
+    BENCHMARK_DIR = os.getenv('BENCHMARK_DIR', './data/benchmarks/')
 
 config = Config()
@@ -3,8 +3,21 @@
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
-import streamlit as st
 import io
+from diagnostics import Diagnostics
+
+try:
+    import streamlit as st
+except ImportError:  # headless-режим (CLI, воркер) без streamlit
+    st = None
+
+
+def _cache_data(func):
+    """st.cache_data в приложении, без кэша в headless-режиме"""
+    return st.cache_data(func) if st is not None else func
+
+# Дата-заглушка для пустых дат визита (строки с ней не отбрасываются фильтром периода)
+SURROGATE_DATE = pd.Timestamp('1900-01-01')
 
 # Встроенный справочник {АСС: ЗОД}
 ZOD_MAPPING = {
@@ -55,7 +68,7 @@ REGION_MAPPING = {
 # Обратный словарь {название: код}
 REGION_NAME_TO_CODE = {v: k for k, v in REGION_MAPPING.items()}
 
-@st.cache_data
+@_cache_data
 def _enrich_array_with_project_codes_cached(array_df, projects_df):
     """Кэшируемая версия обогащения кодами проектов"""
     
@@ -142,6 +155,10 @@ def _enrich_array_with_project_codes_cached(array_df, projects_df):
 
 class DataCleaner:
     
+    def __init__(self, diag=None):
+        # Диагностика текущей очистки (выводится в UI или пишется в лог CLI)
+        self.diag = diag if diag is not None else Diagnostics()
+    
     def is_non_unique_code(self, code):
         """Проверяет, является ли код неуникальным (Мультикод, Пилот, Семпл и т.д.)"""
         if pd.isna(code):
@@ -153,7 +170,7 @@ class DataCleaner:
     def _log_samples(self, df, stage_name):
         """Вспомогательная функция для отладки семплов"""
         if df is None or df.empty:
-            st.write(f"🔍 {stage_name}: 0 семплов (DataFrame пуст)")
+            self.diag.write(f"🔍 {stage_name}: 0 семплов (DataFrame пуст)")
             return
         
         # Проверяем, есть ли колонка с кодом
@@ -163,18 +180,18 @@ class DataCleaner:
         elif 'Project Code' in df.columns:
             code_col = 'Project Code'
         else:
-            st.write(f"🔍 {stage_name}: нет колонки с кодом, пропускаем")
+            self.diag.write(f"🔍 {stage_name}: нет колонки с кодом, пропускаем")
             return
         
         sample_mask = df[code_col].astype(str).str.contains('семпл', case=False, na=False)
         sample_df = df[sample_mask]
         sample_count = len(sample_df)
         
-        st.write(f"🔍 {stage_name}: {sample_count} семплов")
+        self.diag.write(f"🔍 {stage_name}: {sample_count} семплов")
         
         if sample_count > 0:
             sample_codes = sample_df[code_col].unique()
-            st.write(f"   Коды: {list(sample_codes)}")
+            self.diag.write(f"   Коды: {list(sample_codes)}")
 
     def _find_column(self, df, possible_names):
         """Находит колонку по возможным названиям"""
@@ -183,9 +200,10 @@ class DataCleaner:
                 return name
         return None
     
-    def clean_google(self, df):
+    def clean_google(self, df, calc_params=None):
         """
         Шаги 1-7: Очистка Гугл таблицы (Проекты Сервизория)
+        calc_params - период расчета (нужен для шага 6)
         """
         if df is None or df.empty:
             return None
@@ -253,8 +271,8 @@ class DataCleaner:
                     pass
         
         # === ШАГ 6: Исправить даты по бизнес-правилам ===
-        if 'plan_calc_params' in st.session_state:
-            end_period = st.session_state['plan_calc_params']['end_date']
+        if calc_params:
+            end_period = calc_params['end_date']
             first_day = pd.Timestamp(year=end_period.year, month=end_period.month, day=1)
             last_day = first_day + pd.offsets.MonthEnd(1)
             
@@ -290,7 +308,7 @@ class DataCleaner:
         
         return df_clean
 
-    def clean_array(self, df):
+    def clean_array(self, df, calc_params=None):
         """Очистка файла Массив"""
         if df is None or df.empty:
             return None
@@ -305,8 +323,8 @@ class DataCleaner:
         # Удалить строки где Дата визита < первый день месяца
         date_col = self._find_column(df_clean, ['Дата визита', 'Date of Visit'])
         if date_col:
-            if 'plan_calc_params' in st.session_state:
-                first_day = pd.Timestamp(st.session_state['plan_calc_params']['start_date'])
+            if calc_params:
+                first_day = pd.Timestamp(calc_params['start_date'])
             else:
                 today = datetime.now()
                 first_day = pd.Timestamp(year=today.year, month=today.month, day=1)
@@ -329,8 +347,6 @@ class DataCleaner:
         existing_date_cols = [col for col in DATE_COLUMNS if col in df_clean.columns]
         
         if existing_date_cols:
-            SURROGATE_DATE = pd.Timestamp('1900-01-01')
-            
             for col in existing_date_cols:
                 try:
                     df_clean[col] = pd.to_datetime(df_clean[col], errors='coerce')
@@ -371,9 +387,9 @@ class DataCleaner:
                     df_clean[col].astype(str).str.replace(',', '.'),
                     errors='coerce'
                 ).fillna(0)
-            st.info(f"✅ Найдено колонок с оплатой: {len(payment_cols)}. Суммируем.")
+            self.diag.info(f"✅ Найдено колонок с оплатой: {len(payment_cols)}. Суммируем.")
         else:
-            st.warning("⚠️ В файле Массив не найдены колонки 'Total sum for payment'. Оплата факт = 0")
+            self.diag.warning("⚠️ В файле Массив не найдены колонки 'Total sum for payment'. Оплата факт = 0")
             df_clean['Оплата факт'] = 0
             
         return df_clean
@@ -903,7 +919,7 @@ class DataCleaner:
         
         return df_result
     
-    def clean_cxway(self, df, hierarchy_df, google_df):
+    def clean_cxway(self, df, hierarchy_df, google_df, calc_params=None):
         """Очистка файла CXWAY и приведение к структуре полевых проектов"""
         if df is None or df.empty:
             return pd.DataFrame()
@@ -922,8 +938,8 @@ class DataCleaner:
         date_col = self._find_column(df_clean, ['Date of Visit', 'Дата визита', 'Visit Date'])
         if date_col:
             first_day = None
-            if 'plan_calc_params' in st.session_state:
-                first_day = pd.Timestamp(st.session_state['plan_calc_params']['start_date'])
+            if calc_params:
+                first_day = pd.Timestamp(calc_params['start_date'])
             else:
                 today = datetime.now()
                 first_day = pd.Timestamp(year=today.year, month=today.month, day=1)
@@ -1142,7 +1158,7 @@ class DataCleaner:
         
         # Проверка: найдены ли колонки с оплатой
         if not payment_col and not extra_payment_col:
-            st.warning("⚠️ В файле CXWAY не найдены колонки 'Оплата' и 'Доп. оплата'. Оплата факт = 0")
+            self.diag.warning("⚠️ В файле CXWAY не найдены колонки 'Оплата' и 'Доп. оплата'. Оплата факт = 0")
         
         # Векторизованный расчет оплаты для CXWAY (быстро)
         result['Оплата факт'] = 0
@@ -1306,17 +1322,21 @@ class DataCleaner:
         
         return result
 
-    def clean_optima(self, df, google_df):
+    def clean_optima(self, df, google_df, rs_distribution=None):
         """
         Очистка файла Optima и приведение к структуре полевых проектов
+        rs_distribution - (region_mapping, moscow_mapping, spb_mapping),
+        если не передано - загружается через менеджер GitHub
         """
         if df is None or df.empty:
             return pd.DataFrame()
 
         # Загружаем распределение RS для Optima
-        from github_settings import get_optima_rs_manager
-        optima_rs_manager = get_optima_rs_manager()
-        region_mapping, moscow_mapping, spb_mapping = optima_rs_manager.load_distribution()
+        if rs_distribution is None:
+            from github_settings import get_optima_rs_manager
+            optima_rs_manager = get_optima_rs_manager()
+            rs_distribution = optima_rs_manager.load_distribution()
+        region_mapping, moscow_mapping, spb_mapping = rs_distribution
         
         has_distribution = bool(region_mapping or moscow_mapping or spb_mapping)
         
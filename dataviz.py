@@ -4,8 +4,9 @@ import pandas as pd
 import numpy as np
 import streamlit as st
 from datetime import datetime
-from io import BytesIO
 from visit_calculator import visit_calculator
+from export_service import excel_download_button, frame_download_button
+from rollup_cube import RollupCube, wave_focus
 
 class DataVisualizer:
 
@@ -344,7 +345,7 @@ class DataVisualizer:
         
     #     return project_agg
     
-    def create_planfact_tab(self, data, hierarchy_df=None):
+    def create_planfact_tab(self, data, hierarchy_df=None, cube=None):
         """Создает вкладку ПланФакт на дату с фильтрами в форме"""
         if data is None or data.empty:
             st.warning("⚠️ Нет данных для отчета")
@@ -376,6 +377,12 @@ class DataVisualizer:
         
         base_data = st.session_state.planfact_base_data
         
+        # Куб отчетов из расчета; без него - строится по данным вкладки (один раз на данные)
+        if cube is None:
+            if 'cube' not in base_data:
+                base_data['cube'] = RollupCube(base_data['raw_data'])
+            cube = base_data['cube']
+        
         # ============================================
         # 2. ФИЛЬТРЫ В ФОРМЕ (без rerun при выборе)
         # ============================================
@@ -545,45 +552,8 @@ class DataVisualizer:
         if show_po and 'ПО' in display_data.columns:
             group_cols.append('ПО')
 
-        # Рассчитываем фокус на уровне волны ДО агрегации
-        display_data = self.calculate_focus(display_data, aggregation_level='wave')
-        
-        # Агрегируем для отображения
-        agg_columns = {
-            'План проекта, шт.': 'sum',
-            'План на дату, шт.': 'sum',
-            'Факт проекта, шт.': 'sum',
-            'Факт на дату, шт.': 'sum',
-            'Длительность': 'first',
-            'Дата старта': 'first',
-            'Дата финиша': 'first',
-            'Дата старта_гугл': 'first',
-            'Дата финиша_гугл': 'first',
-            'Коэффициент месяца': 'first',
-            'Метод подбора дат': 'first',
-            'Дней до конца проекта': 'first',
-            'Прогноз, шт.': 'sum',
-            'Утилизация тайминга, %': 'first',
-            'Ср. план на день для 100% плана': 'sum',
-            'Фокус': 'first',
-            'Оплата план': 'sum',
-            'plan_payment_per_visit': 'first',
-            'Оплата факт': 'sum',
-            'Оплата_поручено': 'sum',
-            'Факт проекта_поручено, шт.': 'sum',
-            'Факт проекта_не_поручено, шт.': 'sum',
-            'Оплата план средн., руб.': 'first',
-            'Оплата факт средн., руб.': 'first',
-            'Оплата план-факт средн., руб.': 'first',
-            'Оплата факт/план средн., %': 'first',
-            'Оплата средн. в динамике, руб.': 'first',
-            'Оплата средн. прогноз, руб.': 'first',
-        }
-        
-        existing_agg = {k: v for k, v in agg_columns.items() if k in display_data.columns}
-
-        # ВСЕГДА группируем (даже если group_cols == ['Клиент'])
-        project_data = display_data.groupby(group_cols).agg(existing_agg).reset_index()
+        # Сводная таблица - срез куба отчетов (после фильтров - по отфильтрованным строкам)
+        project_data = cube.slice(group_cols, data=st.session_state.planfact_filtered_data)
 
         # === ПЕРЕСЧЕТ ОПЛАТА ПЛАН СРЕДН. ПОСЛЕ АГРЕГАЦИИ ===
         if 'Оплата план' in project_data.columns and 'План проекта, шт.' in project_data.columns:
@@ -878,17 +848,12 @@ class DataVisualizer:
                 project_data = project_data.drop(col, axis=1)
                 
         # Кнопка скачивания
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            project_data.to_excel(writer, sheet_name='План_факт_проекты', index=False)
-        
-        st.download_button(
+        excel_download_button(
+            project_data, 'План_факт_проекты',
             label="⬇️ Скачать Excel",
-            data=output.getvalue(),
             file_name=f"план_факт_проекты_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            type="primary",
-            use_container_width=True
+            key="download_planfact",
+            type="primary", use_container_width=True
         )
         
         # Кнопка скачивания краткого отчета
@@ -921,18 +886,12 @@ class DataVisualizer:
         existing_brief_cols = [col for col in brief_cols if col in project_data.columns]
         brief_report = project_data[existing_brief_cols].copy()
         
-        output_brief = BytesIO()
-        with pd.ExcelWriter(output_brief, engine='openpyxl') as writer:
-            brief_report.to_excel(writer, sheet_name='Краткий_отчет', index=False)
-        
-        st.download_button(
+        excel_download_button(
+            brief_report, 'Краткий_отчет',
             label="📊 Скачать краткий отчет",
-            data=output_brief.getvalue(),
             file_name=f"краткий_отчет_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            type="secondary",
-            use_container_width=True,
-            key="download_brief_planfact" 
+            key="download_brief_planfact",
+            type="secondary", use_container_width=True
         )
 
     def create_region_summary(self, df):
@@ -1014,7 +973,7 @@ class DataVisualizer:
         region_agg = region_agg.sort_values('Регион')
         return region_agg
         
-    def create_region_tab(self, data, hierarchy_df=None):
+    def create_region_tab(self, data, hierarchy_df=None, cube=None):
         """Создает вкладку Регионы с фильтрами в форме"""
         if data is None or data.empty:
             st.warning("⚠️ Нет данных для отчета")
@@ -1044,6 +1003,12 @@ class DataVisualizer:
         
         base_data = st.session_state.region_base_data
         
+        # Куб отчетов из расчета; без него - строится по данным вкладки (один раз на данные)
+        if cube is None:
+            if 'cube' not in base_data:
+                base_data['cube'] = RollupCube(base_data['raw_data'])
+            cube = base_data['cube']
+        
         # ============================================
         # 2. ФИЛЬТРЫ В ФОРМЕ
         # ============================================
@@ -1204,44 +1169,8 @@ class DataVisualizer:
         if show_po and 'ПО' in display_data.columns:
             group_cols.append('ПО')
 
-        display_data = self.calculate_focus(display_data, aggregation_level='wave')
-        # Агрегируем для отображения
-        agg_columns = {
-            'План проекта, шт.': 'sum',
-            'План на дату, шт.': 'sum',
-            'Факт проекта, шт.': 'sum',
-            'Факт на дату, шт.': 'sum',
-            'Длительность': 'first',
-            'Дата старта': 'first',
-            'Дата финиша': 'first',
-            'Дата старта_гугл': 'first',
-            'Дата финиша_гугл': 'first',
-            'Коэффициент месяца': 'first',
-            'Метод подбора дат': 'first',
-            'Дней до конца проекта': 'first',
-            'Прогноз, шт.': 'sum',
-            'Утилизация тайминга, %': 'first',
-            'Ср. план на день для 100% плана': 'sum',
-            'Фокус': 'first',
-            'Оплата план': 'sum',
-            'plan_payment_per_visit': 'first',
-            'Оплата факт': 'sum',
-            'Оплата_поручено': 'sum',
-            'Факт проекта_поручено, шт.': 'sum',
-            'Факт проекта_не_поручено, шт.': 'sum',
-            # НОВЫЕ КОЛОНКИ
-            'Оплата план средн., руб.': 'first',
-            'Оплата факт средн., руб.': 'first',
-            'Оплата план-факт средн., руб.': 'first',
-            'Оплата факт/план средн., %': 'first',
-            'Оплата средн. в динамике, руб.': 'first',
-            'Оплата средн. прогноз, руб.': 'first',
-        }
-        
-        existing_agg = {k: v for k, v in agg_columns.items() if k in display_data.columns}
-        
-        # ВСЕГДА группируем
-        region_data = display_data.groupby(group_cols).agg(existing_agg).reset_index()
+        # Сводная таблица - срез куба отчетов (после фильтров - по отфильтрованным строкам)
+        region_data = cube.slice(group_cols, data=st.session_state.region_filtered_data)
         
         # === ПЕРЕСЧЕТ ОПЛАТА ПЛАН СРЕДН. ПОСЛЕ АГРЕГАЦИИ ===
         if 'Оплата план' in region_data.columns and 'План проекта, шт.' in region_data.columns:
@@ -1558,17 +1487,12 @@ class DataVisualizer:
                 region_data = region_data.drop(col, axis=1)
         
         # Кнопка скачивания
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            region_data.to_excel(writer, sheet_name='Регионы', index=False)
-        
-        st.download_button(
+        excel_download_button(
+            region_data, 'Регионы',
             label="⬇️ Скачать Excel",
-            data=output.getvalue(),
             file_name=f"регионы_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            type="primary",
-            use_container_width=True
+            key="download_region",
+            type="primary", use_container_width=True
         )
 
         # Кнопка скачивания краткого отчета
@@ -1601,21 +1525,15 @@ class DataVisualizer:
         existing_brief_cols = [col for col in brief_cols if col in region_data.columns]
         brief_report = region_data[existing_brief_cols].copy()
         
-        output_brief = BytesIO()
-        with pd.ExcelWriter(output_brief, engine='openpyxl') as writer:
-            brief_report.to_excel(writer, sheet_name='Краткий_отчет', index=False)
-        
-        st.download_button(
+        excel_download_button(
+            brief_report, 'Краткий_отчет',
             label="📊 Скачать краткий отчет",
-            data=output_brief.getvalue(),
             file_name=f"краткий_отчет_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            type="secondary",
-            use_container_width=True,
-            key="download_brief_region"
+            key="download_brief_region",
+            type="secondary", use_container_width=True
         )
     
-    def create_dsm_tab(self, data, hierarchy_df=None):
+    def create_dsm_tab(self, data, hierarchy_df=None, cube=None):
         """Создает вкладку DSM с фильтрами в форме"""
         if data is None or data.empty:
             st.warning("⚠️ Нет данных для отчета")
@@ -1644,6 +1562,12 @@ class DataVisualizer:
             st.session_state.dsm_filtered_data = None
         
         base_data = st.session_state.dsm_base_data
+        
+        # Куб отчетов из расчета; без него - строится по данным вкладки (один раз на данные)
+        if cube is None:
+            if 'cube' not in base_data:
+                base_data['cube'] = RollupCube(base_data['raw_data'])
+            cube = base_data['cube']
         all_dsm = base_data['all_dsm']
         
         # ============================================
@@ -1812,44 +1736,8 @@ class DataVisualizer:
         if show_po and 'ПО' in display_data.columns:
             group_cols.append('ПО')
         
-        display_data = self.calculate_focus(display_data, aggregation_level='wave')
-        
-        # Агрегируем для отображения
-        agg_columns = {
-            'План проекта, шт.': 'sum',
-            'План на дату, шт.': 'sum',
-            'Факт проекта, шт.': 'sum',
-            'Факт на дату, шт.': 'sum',
-            'Длительность': 'first',
-            'Дата старта': 'first',
-            'Дата финиша': 'first',
-            'Дата старта_гугл': 'first',
-            'Дата финиша_гугл': 'first',
-            'Коэффициент месяца': 'first',
-            'Метод подбора дат': 'first',
-            'Дней до конца проекта': 'first',
-            'Прогноз, шт.': 'sum',
-            'Утилизация тайминга, %': 'first',
-            'Ср. план на день для 100% плана': 'sum',
-            'Фокус': 'first',
-            'Оплата план': 'sum',
-            'plan_payment_per_visit': 'first',
-            'Оплата факт': 'sum',
-            'Оплата_поручено': 'sum',
-            'Факт проекта_поручено, шт.': 'sum',
-            'Факт проекта_не_поручено, шт.': 'sum',
-            'Оплата план средн., руб.': 'first',
-            'Оплата факт средн., руб.': 'first',
-            'Оплата план-факт средн., руб.': 'first',
-            'Оплата факт/план средн., %': 'first',
-            'Оплата средн. в динамике, руб.': 'first',
-            'Оплата средн. прогноз, руб.': 'first',
-        }
-        
-        existing_agg = {k: v for k, v in agg_columns.items() if k in display_data.columns}
-
-        # ВСЕГДА группируем
-        dsm_data = display_data.groupby(group_cols).agg(existing_agg).reset_index()
+        # Сводная таблица - срез куба отчетов (после фильтров - по отфильтрованным строкам)
+        dsm_data = cube.slice(group_cols, data=st.session_state.dsm_filtered_data)
         
         # === ПЕРЕСЧЕТ ОПЛАТА ПЛАН СРЕДН. ПОСЛЕ АГРЕГАЦИИ ===
         if 'Оплата план' in dsm_data.columns and 'План проекта, шт.' in dsm_data.columns:
@@ -2164,17 +2052,12 @@ class DataVisualizer:
                 dsm_data = dsm_data.drop(col, axis=1)
         
         # Кнопка скачивания
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            dsm_data.to_excel(writer, sheet_name='DSM', index=False)
-        
-        st.download_button(
+        excel_download_button(
+            dsm_data, 'DSM',
             label="⬇️ Скачать Excel",
-            data=output.getvalue(),
             file_name=f"dsm_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            type="primary",
-            use_container_width=True
+            key="download_dsm",
+            type="primary", use_container_width=True
         )
 
         # Кнопка скачивания краткого отчета
@@ -2207,18 +2090,12 @@ class DataVisualizer:
         existing_brief_cols = [col for col in brief_cols if col in dsm_data.columns]
         brief_report = dsm_data[existing_brief_cols].copy()
         
-        output_brief = BytesIO()
-        with pd.ExcelWriter(output_brief, engine='openpyxl') as writer:
-            brief_report.to_excel(writer, sheet_name='Краткий_отчет', index=False)
-        
-        st.download_button(
+        excel_download_button(
+            brief_report, 'Краткий_отчет',
             label="📊 Скачать краткий отчет",
-            data=output_brief.getvalue(),
             file_name=f"краткий_отчет_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            type="secondary",
-            use_container_width=True,
-            key="download_brief_dsm"
+            key="download_brief_dsm",
+            type="secondary", use_container_width=True
         )
     def create_prodata_table(self, prodata_df):
         """
@@ -2256,17 +2133,12 @@ class DataVisualizer:
             )
             
             # Кнопка скачивания для развернутой таблицы
-            output = BytesIO()
-            with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                table_df.to_excel(writer, sheet_name='ПроДата_детально', index=False)
-            
-            st.download_button(
+            excel_download_button(
+                table_df, 'ПроДата_детально',
                 label="⬇️ Скачать ПроДата (детально)",
-                data=output.getvalue(),
                 file_name=f"prodata_detailed_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                type="secondary",
-                use_container_width=True
+                key="download_prodata_detailed",
+                type="secondary", use_container_width=True
             )
         else:
             # Свернутая таблица - группируем по клиенту (суммируем все типы мониторинга)
@@ -2288,17 +2160,12 @@ class DataVisualizer:
             )
             
             # Кнопка скачивания для свернутой таблицы
-            output = BytesIO()
-            with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                prodata_agg.to_excel(writer, sheet_name='ПроДата', index=False)
-            
-            st.download_button(
+            excel_download_button(
+                prodata_agg, 'ПроДата',
                 label="⬇️ Скачать ПроДата",
-                data=output.getvalue(),
                 file_name=f"prodata_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                type="secondary",
-                use_container_width=True
+                key="download_prodata",
+                type="secondary", use_container_width=True
             )
     def create_dynamics_tab(self, data, visits_df, calc_params):
         """
@@ -2461,18 +2328,15 @@ class DataVisualizer:
         
         st.dataframe(result_df, use_container_width=True, hide_index=True)
         
-        # Скачивание
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            result_df.to_excel(writer, sheet_name='Динамика_факта', index=False)
-        
-        st.download_button(
-            label="⬇️ Скачать Excel",
-            data=output.getvalue(),
-            file_name=f"динамика_факта_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            type="primary",
-            use_container_width=True
+        # Скачивание (формат - из сайдбара); таблица нужна и для архива отчетов
+        st.session_state.dynamics_report = result_df
+        frame_download_button(
+            result_df, 'Динамика_факта',
+            label="⬇️ Скачать",
+            file_stem=f"динамика_факта_{datetime.now().strftime('%Y%m%d_%H%M')}",
+            fmt=st.session_state.get('export_format', 'xlsx'),
+            key="download_dynamics",
+            type="primary", use_container_width=True
         )
     
     def calculate_focus(self, df, aggregation_level='auto'):
@@ -2495,20 +2359,7 @@ class DataVisualizer:
         
         if is_wave_level or aggregation_level == 'wave':
             # === УРОВЕНЬ ВОЛНЫ: рассчитываем фокус ===
-            wave_focus = {}
-            
-            for (project, client, wave), group in df.groupby(['Проект', 'Клиент', 'Волна']):
-                plan_total = group['План проекта, шт.'].sum()
-                fact_total = group['Факт проекта, шт.'].sum()
-                plan_vs_fact = (fact_total / plan_total * 100) if plan_total > 0 else 0
-                
-                timing_col = 'Утилизация тайминга, %'
-                timing = group[timing_col].iloc[0] if timing_col in group.columns and len(group) > 0 else 0
-                
-                is_focus = (plan_vs_fact < 80) and (timing > 80) and (timing < 100)
-                wave_focus[(project, client, wave)] = 'Да' if is_focus else 'Нет'
-            
-            df['Фокус'] = df.apply(lambda row: wave_focus.get((row['Проект'], row['Клиент'], row['Волна']), 'Нет'), axis=1)
+            df['Фокус'] = wave_focus(df)
             
         else:
             # === АГРЕГИРОВАННЫЙ УРОВЕНЬ: наследуем фокус (если есть колонка Фокус) ===
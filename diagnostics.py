@@ -0,0 +1,77 @@
+# utils/diagnostics.py
+# draft 4.1 - simplified
+import pandas as pd
+
+
+class Diagnostics:
+    """
+    Сборщик диагностических сообщений расчета.
+    Повторяет нужное подмножество API streamlit (write/info/warning/...),
+    поэтому вычислительное ядро не зависит от UI: в приложении сообщения
+    выводятся через render(), в CLI - печатаются через to_text().
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def _add(self, level, *args):
+        self.records.append((level, args))
+
+    # === API в стиле streamlit ===
+
+    def write(self, *args):
+        self._add('write', *args)
+
+    def markdown(self, text):
+        self._add('markdown', text)
+
+    def info(self, text):
+        self._add('info', text)
+
+    def success(self, text):
+        self._add('success', text)
+
+    def warning(self, text):
+        self._add('warning', text)
+
+    def error(self, text):
+        self._add('error', text)
+
+    def dataframe(self, df):
+        self._add('dataframe', df)
+
+    # === ВЫВОД ===
+
+    @property
+    def warnings(self):
+        """Только предупреждения и ошибки"""
+        return [args for level, args in self.records if level in ('warning', 'error')]
+
+    def extend(self, other):
+        """Добавляет сообщения другого сборщика"""
+        if other is not None:
+            self.records.extend(other.records)
+
+    def clear(self):
+        self.records = []
+
+    def render(self):
+        """Выводит сообщения в streamlit (только из UI)"""
+        import streamlit as st
+
+        for level, args in self.records:
+            getattr(st, level)(*args)
+
+    def to_text(self):
+        """Текстовое представление для логов CLI"""
+        lines = []
+        for level, args in self.records:
+            parts = []
+            for arg in args:
+                if isinstance(arg, pd.DataFrame):
+                    parts.append(arg.to_string(max_rows=10))
+                else:
+                    parts.append(str(arg))
+            prefix = '' if level in ('write', 'markdown', 'dataframe') else f"[{level.upper()}] "
+            lines.append(prefix + ' '.join(parts))
+        return '\n'.join(lines)
@@ -0,0 +1,303 @@
+# export_service.py
+# draft 4.1 - simplified
+"""
+Выгрузки отчетов по запросу: Excel, Parquet, CSV (UTF-8 с BOM) и Arrow.
+Файл формируется только когда пользователь его запросил, байты кэшируются
+по (отпечаток таблицы, раскладка листа, формат), поэтому перезапуски скрипта
+и повторные скачивания не пересобирают файл. Книга Excel пишется построчно
+(xlsxwriter constant_memory или openpyxl write_only), CSV - частями,
+поэтому память не растет с размером таблицы.
+Архив отчетов (ZIP) собирается на диске по одной таблице.
+
+Таблицы выгрузки не изменяются на месте после показа кнопки
+(отпечаток запоминается для объекта DataFrame).
+"""
+import io
+import os
+import tempfile
+import threading
+import weakref
+import zipfile
+from collections import OrderedDict
+from io import BytesIO
+
+import streamlit as st
+
+from config import config
+from snapshot_store import frame_fingerprint
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# Форматы выгрузки: формат → (расширение, MIME, сжимать в ZIP)
+EXPORT_FORMATS = {
+    'xlsx': ('.xlsx', XLSX_MIME, False),
+    'parquet': ('.parquet', "application/vnd.apache.parquet", False),
+    'csv': ('.csv', "text/csv", True),
+    'arrow': ('.arrow', "application/vnd.apache.arrow.file", True)
+}
+
+FORMAT_LABELS = {
+    'xlsx': 'Excel (.xlsx)',
+    'parquet': 'Parquet',
+    'csv': 'CSV (UTF-8 с BOM)',
+    'arrow': 'Arrow (Feather)'
+}
+
+# Строк на один шаг преобразования значений (память на шаг, а не на всю таблицу)
+ROWS_PER_CHUNK = 5000
+
+
+def _iter_rows(df):
+    """Строки таблицы как списки значений Python (пропуски → пустые ячейки)"""
+    for start in range(0, len(df), ROWS_PER_CHUNK):
+        chunk = df.iloc[start:start + ROWS_PER_CHUNK].astype(object)
+        yield from chunk.where(chunk.notna(), None).values.tolist()
+
+
+def write_xlsx(df, sheet_name):
+    """Книга Excel с одним листом (без индекса) - построчная запись, возвращает байты"""
+    output = BytesIO()
+    sheet_name = str(sheet_name)[:31]
+    header = [str(col) for col in df.columns]
+
+    if xlsxwriter is not None:
+        workbook = xlsxwriter.Workbook(output, {
+            'constant_memory': True,
+            'remove_timezone': True,
+            'default_date_format': 'dd.mm.yyyy'
+        })
+        worksheet = workbook.add_worksheet(sheet_name)
+        worksheet.write_row(0, 0, header)
+        for row_number, values in enumerate(_iter_rows(df), start=1):
+            worksheet.write_row(row_number, 0, values)
+        workbook.close()
+    else:
+        from openpyxl import Workbook
+        workbook = Workbook(write_only=True)
+        worksheet = workbook.create_sheet(sheet_name)
+        worksheet.append(header)
+        for values in _iter_rows(df):
+            worksheet.append(values)
+        workbook.save(output)
+
+    return output.getvalue()
+
+
+def _arrow_table(df):
+    """Таблица Arrow без индекса; смешанные типы в текстовых колонках приводятся к строкам"""
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowException, TypeError, ValueError):
+        df = df.copy()
+        for col in df.columns:
+            if df[col].dtype == 'object':
+                df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def write_csv(df, stream):
+    """CSV в UTF-8 с BOM (открывается в Excel без выбора кодировки), запись частями"""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    for start in range(0, max(len(df), 1), ROWS_PER_CHUNK):
+        df.iloc[start:start + ROWS_PER_CHUNK].to_csv(text, index=False, header=start == 0)
+    text.flush()
+    text.detach()
+
+
+def write_frame(df, fmt, sheet_name='data'):
+    """Файл выгрузки таблицы в формате fmt, возвращает байты"""
+    if fmt == 'xlsx':
+        return write_xlsx(df, sheet_name)
+    output = BytesIO()
+    if fmt == 'csv':
+        write_csv(df, output)
+    elif fmt == 'parquet':
+        pq.write_table(_arrow_table(df), output, compression='zstd')
+    elif fmt == 'arrow':
+        table = _arrow_table(df)
+        with pa.ipc.new_file(output, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+    return output.getvalue()
+
+
+def write_bundle(frames, fmt, path):
+    """
+    ZIP-архив таблиц отчета {имя файла без расширения: DataFrame} в формате fmt.
+    Таблицы пишутся в архив на диске по одной - в памяти не больше одного файла.
+    """
+    extension, _, compress = EXPORT_FORMATS[fmt]
+    compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    written = []
+    with zipfile.ZipFile(path, 'w') as bundle:
+        for name, df in frames.items():
+            if df is None or df.empty:
+                continue
+            if fmt == 'csv':
+                info = zipfile.ZipInfo(name + extension)
+                info.compress_type = compress_type
+                with bundle.open(info, 'w', force_zip64=True) as entry:
+                    write_csv(df, entry)
+            else:
+                bundle.writestr(name + extension, write_frame(df, fmt, name), compress_type=compress_type)
+            written.append(name)
+    return written
+
+
+class ExportService:
+    """Готовые xlsx-файлы в LRU-кэше с ограничением по памяти (общий для сессий)"""
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes if max_bytes is not None else config.EXPORT_CACHE_MB * 1024 * 1024
+        self._files = OrderedDict()
+        self._fingerprints = {}
+        self._lock = threading.Lock()
+        self.bytes_held = 0
+        self.builds = 0
+        self.hits = 0
+
+    def _fingerprint(self, df):
+        """Отпечаток таблицы (считается один раз на объект DataFrame, пока он жив)"""
+        frame_id = id(df)
+        entry = self._fingerprints.get(frame_id)
+        if entry is not None and entry[0]() is df:
+            return entry[1]
+        fingerprint = frame_fingerprint(df)
+        self._fingerprints[frame_id] = (
+            weakref.ref(df, lambda _, frame_id=frame_id: self._fingerprints.pop(frame_id, None)),
+            fingerprint
+        )
+        return fingerprint
+
+    def cache_key(self, df, sheet_name, layout=None, fmt='xlsx'):
+        return (self._fingerprint(df), str(sheet_name), tuple(map(str, df.columns)), layout, fmt)
+
+    def get(self, df, sheet_name, layout=None, fmt='xlsx'):
+        """Готовый файл из кэша (None - еще не формировался)"""
+        key = self.cache_key(df, sheet_name, layout, fmt)
+        with self._lock:
+            data = self._files.get(key)
+            if data is not None:
+                self._files.move_to_end(key)
+                self.hits += 1
+            return data
+
+    def file_bytes(self, df, sheet_name, layout=None, prepare=None, fmt='xlsx'):
+        """
+        Файл выгрузки таблицы: из кэша или формируется сейчас.
+        prepare - преобразование таблицы перед записью (учитывается через layout).
+        """
+        data = self.get(df, sheet_name, layout, fmt)
+        if data is not None:
+            return data
+
+        key = self.cache_key(df, sheet_name, layout, fmt)
+        data = write_frame(prepare(df) if prepare is not None else df, fmt, sheet_name)
+        with self._lock:
+            self.builds += 1
+            if len(data) <= self.max_bytes:
+                if key in self._files:
+                    self.bytes_held -= len(self._files.pop(key))
+                while self._files and self.bytes_held + len(data) > self.max_bytes:
+                    _, evicted = self._files.popitem(last=False)
+                    self.bytes_held -= len(evicted)
+                self._files[key] = data
+                self.bytes_held += len(data)
+        return data
+
+    def stats(self):
+        with self._lock:
+            return {
+                'files': len(self._files),
+                'bytes_held': self.bytes_held,
+                'max_bytes': self.max_bytes,
+                'builds': self.builds,
+                'hits': self.hits
+            }
+
+
+# Глобальный экземпляр на процесс (одинаковые выгрузки разных сессий формируются один раз)
+export_service = ExportService()
+
+
+def frame_download_button(df, sheet_name, label, file_stem, fmt='xlsx', key=None, layout=None, prepare=None,
+                          **button_kwargs):
+    """
+    Кнопка скачивания таблицы без скрытой сериализации на каждом перезапуске:
+    если файл уже сформирован - сразу download_button, иначе кнопка
+    «сформировать», по нажатию файл формируется и появляется download_button.
+    file_stem - имя файла без расширения (расширение - по формату fmt),
+    button_kwargs (type, width, use_container_width) - для обеих кнопок.
+    """
+    extension, mime, _ = EXPORT_FORMATS[fmt]
+    key = key or f"export_{sheet_name}_{label}"
+    key = f"{key}_{fmt}" if fmt != 'xlsx' else key
+    data = export_service.get(df, sheet_name, layout, fmt)
+    if data is None:
+        if not st.button(f"⚙️ {label}: сформировать файл", key=f"{key}_prepare", **button_kwargs):
+            return
+        with st.spinner(f"Формирование {FORMAT_LABELS[fmt]}..."):
+            data = export_service.file_bytes(df, sheet_name, layout, prepare, fmt)
+
+    st.download_button(
+        label=label,
+        data=data,
+        file_name=file_stem + extension,
+        mime=mime,
+        key=key,
+        **button_kwargs
+    )
+
+
+def excel_download_button(df, sheet_name, label, file_name, key=None, layout=None, prepare=None,
+                          **button_kwargs):
+    """Кнопка скачивания Excel (frame_download_button для xlsx, file_name с расширением)"""
+    frame_download_button(
+        df, sheet_name, label, os.path.splitext(file_name)[0], fmt='xlsx',
+        key=key, layout=layout, prepare=prepare, **button_kwargs
+    )
+
+
+def bundle_download_button(get_frames, fmt, file_stem, key, **button_kwargs):
+    """
+    Архив всех таблиц отчета одним файлом: собирается по нажатию во временный
+    ZIP на диске (по одной таблице), затем отдается на скачивание.
+    get_frames - функция без аргументов → {имя файла: DataFrame}
+    (таблицы читаются только после нажатия).
+    """
+    if not st.button("📦 Сформировать архив отчетов", key=f"{key}_prepare", **button_kwargs):
+        return
+    with st.spinner(f"Формирование архива ({FORMAT_LABELS[fmt]})..."):
+        handle, path = tempfile.mkstemp(suffix='.zip')
+        os.close(handle)
+        try:
+            written = write_bundle(get_frames(), fmt, path)
+            with open(path, 'rb') as f:
+                data = f.read()
+        finally:
+            os.remove(path)
+    if not written:
+        st.info("Нет таблиц для архива")
+        return
+    st.caption(f"В архиве: {', '.join(written)}")
+    st.download_button(
+        label="📦 Скачать архив отчетов",
+        data=data,
+        file_name=file_stem + '.zip',
+        mime="application/zip",
+        key=key,
+        **button_kwargs
+    )
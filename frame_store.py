@@ -0,0 +1,244 @@
+# frame_store.py
+# draft 4.1 - simplified
+"""
+Хранилище промежуточных таблиц сессии на локальном диске (Arrow IPC).
+Большие DataFrame из session_state (загруженные файлы, очищенные данные,
+отчет расчета) записываются в несжатые Arrow-файлы, в сессии остается
+только ленивая ссылка. Таблица читается через memory map, когда ее
+запрашивает вкладка, и держится в памяти в общем LRU с лимитом по размеру.
+
+Таблицы из хранилища только для чтения: чтобы изменить таблицу,
+нужно записать ее заново (frames[name] = df).
+"""
+import hashlib
+import os
+import shutil
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+import pandas as pd
+
+from config import config
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+FRAME_EXTENSION = '.arrow'
+
+
+class FrameHandle:
+    """Ленивая ссылка на таблицу в Arrow-файле (без чтения данных)"""
+
+    def __init__(self, path, rows, columns, nbytes):
+        self.path = path
+        self.rows = rows
+        self.columns = columns
+        self.nbytes = nbytes
+
+    def __len__(self):
+        return self.rows
+
+    def __repr__(self):
+        return f"FrameHandle({os.path.basename(self.path)}, {self.rows} строк, {self.nbytes / 1024 / 1024:.1f} МБ)"
+
+
+class FrameStore:
+    """
+    Arrow-файлы таблиц всех сессий + LRU прочитанных таблиц (общий для процесса).
+    Прочитанные таблицы вытесняются по суммарному размеру max_resident_bytes,
+    файл остается на диске до удаления ссылки.
+    """
+
+    def __init__(self, root_dir=None, max_resident_bytes=None, min_spill_bytes=None, ttl=None):
+        self.root_dir = root_dir or config.FRAME_STORE_DIR
+        self.max_resident_bytes = (
+            max_resident_bytes if max_resident_bytes is not None else config.FRAME_STORE_MB * 1024 * 1024
+        )
+        self.min_spill_bytes = min_spill_bytes if min_spill_bytes is not None else config.FRAME_SPILL_MIN_KB * 1024
+        self.ttl = ttl if ttl is not None else config.FRAME_STORE_TTL
+        self._resident = OrderedDict()
+        self._lock = threading.Lock()
+        self.resident_bytes = 0
+        self.loads = 0
+        self.hits = 0
+        self._cleanup_stale()
+
+    @property
+    def available(self):
+        return pa is not None
+
+    def namespace_dir(self, namespace):
+        return os.path.join(self.root_dir, namespace)
+
+    # === ЗАПИСЬ / ЧТЕНИЕ ===
+
+    def spill(self, namespace, name, df):
+        """
+        Записывает таблицу в Arrow-файл, возвращает FrameHandle.
+        None - таблица маленькая или не конвертируется в Arrow (остается в памяти).
+        """
+        if not self.available or not isinstance(df, pd.DataFrame):
+            return None
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=True)
+        except (pa.ArrowException, TypeError, ValueError):
+            # Смешанные типы в колонке - таблица остается в памяти как есть
+            return None
+        if table.nbytes < self.min_spill_bytes:
+            return None
+
+        namespace_dir = self.namespace_dir(namespace)
+        os.makedirs(namespace_dir, exist_ok=True)
+        name_hash = hashlib.sha1(str(name).encode('utf-8')).hexdigest()[:12]
+        # Новый файл на каждую запись: прочитанная ранее версия не подменяется
+        path = os.path.join(namespace_dir, f"{name_hash}_{uuid.uuid4().hex[:8]}{FRAME_EXTENSION}")
+        with pa.OSFile(path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        return FrameHandle(path, len(df), list(df.columns), table.nbytes)
+
+    def load(self, handle):
+        """Таблица по ссылке: из LRU или чтение Arrow-файла через memory map"""
+        with self._lock:
+            entry = self._resident.get(handle.path)
+            if entry is not None:
+                self._resident.move_to_end(handle.path)
+                self.hits += 1
+                return entry[0]
+
+        with pa.memory_map(handle.path, 'r') as source:
+            df = pa.ipc.open_file(source).read_all().to_pandas()
+
+        with self._lock:
+            self.loads += 1
+            if handle.path not in self._resident and handle.nbytes <= self.max_resident_bytes:
+                while self._resident and self.resident_bytes + handle.nbytes > self.max_resident_bytes:
+                    _, (_, evicted_bytes) = self._resident.popitem(last=False)
+                    self.resident_bytes -= evicted_bytes
+                self._resident[handle.path] = (df, handle.nbytes)
+                self.resident_bytes += handle.nbytes
+        return df
+
+    def discard(self, handle):
+        """Удаляет файл таблицы и ее копию в LRU"""
+        with self._lock:
+            entry = self._resident.pop(handle.path, None)
+            if entry is not None:
+                self.resident_bytes -= entry[1]
+        try:
+            os.remove(handle.path)
+        except OSError:
+            pass
+
+    def drop_namespace(self, namespace):
+        """Удаляет все файлы пространства имен (сессии)"""
+        shutil.rmtree(self.namespace_dir(namespace), ignore_errors=True)
+
+    # === ОБСЛУЖИВАНИЕ ===
+
+    def _cleanup_stale(self):
+        """Удаляет папки сессий, не менявшиеся дольше ttl (сессии после перезапуска сервера)"""
+        if not os.path.isdir(self.root_dir):
+            return
+        now = time.time()
+        for namespace in os.listdir(self.root_dir):
+            namespace_dir = self.namespace_dir(namespace)
+            try:
+                if now - os.path.getmtime(namespace_dir) > self.ttl:
+                    shutil.rmtree(namespace_dir, ignore_errors=True)
+            except OSError:
+                continue
+
+    def disk_bytes(self, namespace=None):
+        """Размер Arrow-файлов на диске (всех или одной сессии)"""
+        root = self.namespace_dir(namespace) if namespace else self.root_dir
+        total = 0
+        for dir_path, _, file_names in os.walk(root):
+            for file_name in file_names:
+                try:
+                    total += os.path.getsize(os.path.join(dir_path, file_name))
+                except OSError:
+                    continue
+        return total
+
+    def stats(self):
+        """Метрики хранилища для отладочной панели"""
+        with self._lock:
+            return {
+                'resident_frames': len(self._resident),
+                'resident_bytes': self.resident_bytes,
+                'max_resident_bytes': self.max_resident_bytes,
+                'loads': self.loads,
+                'hits': self.hits
+            }
+
+
+class FrameDict(MutableMapping):
+    """
+    Словарь сессии, выгружающий большие DataFrame в FrameStore.
+    Остальные значения (и таблицы, которые не удалось выгрузить) хранятся как есть.
+    Файлы удаляются при перезаписи ключа, удалении и сборке словаря мусорщиком.
+    """
+
+    def __init__(self, store, namespace=None, values=None):
+        self.store = store
+        self.namespace = namespace or uuid.uuid4().hex[:12]
+        self._data = {}
+        # Сессия Streamlit закрыта - словарь собран, файлы сессии удаляются
+        self._finalizer = weakref.finalize(self, store.drop_namespace, self.namespace)
+        if values:
+            self.update(values)
+
+    def __setitem__(self, key, value):
+        self._discard(key)
+        handle = self.store.spill(self.namespace, key, value) if isinstance(value, pd.DataFrame) else None
+        self._data[key] = handle if handle is not None else value
+
+    def __getitem__(self, key):
+        value = self._data[key]
+        if isinstance(value, FrameHandle):
+            return self.store.load(value)
+        return value
+
+    def __delitem__(self, key):
+        self._discard(key)
+        del self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def _discard(self, key):
+        value = self._data.get(key)
+        if isinstance(value, FrameHandle):
+            self.store.discard(value)
+
+    def handle(self, key):
+        """Ленивая ссылка на выгруженную таблицу (None - значение в памяти)"""
+        value = self._data.get(key)
+        return value if isinstance(value, FrameHandle) else None
+
+    def describe(self):
+        """Что где хранится: {ключ: 'диск, N строк, X МБ' / 'память'}"""
+        return {
+            key: (
+                f"диск, {value.rows:,} строк, {value.nbytes / 1024 / 1024:.1f} МБ"
+                if isinstance(value, FrameHandle) else 'память'
+            )
+            for key, value in self._data.items()
+        }
+
+
+# Глобальный экземпляр на процесс (общий LRU прочитанных таблиц для всех сессий)
+frame_store = FrameStore()
@@ -477,6 +477,7 @@ class PlanAdjustmentManager:
                 content = response.json()
                 file_content = base64.b64decode(content["content"]).decode("utf-8")
                 data = json.loads(file_content)
+                self.last_updated = data.get("last_updated")
                 return data.get("adjustments", [])
             return []
         except Exception as e:
@@ -643,6 +644,7 @@ class MultonPlanManager:
                 content = response.json()
                 file_content = base64.b64decode(content["content"]).decode("utf-8")
                 data = json.loads(file_content)
+                self.last_updated = data.get("last_updated")
                 records = data.get("data", [])
                 return pd.DataFrame(records)
             else:
@@ -785,6 +787,7 @@ class OptimaRSManager:
                 content = response.json()
                 file_content = base64.b64decode(content["content"]).decode("utf-8")
                 data = json.loads(file_content)
+                self.last_updated = data.get("last_updated")
                 return (
                     data.get("region_mapping", {}),
                     data.get("moscow_mapping", {}),
@@ -917,6 +920,7 @@ class MultibrandPlanManager:
                 content = response.json()
                 file_content = base64.b64decode(content["content"]).decode("utf-8")
                 data = json.loads(file_content)
+                self.last_updated = data.get('updated_at')
                 
                 dilers_df = pd.DataFrame(data.get('dilers', []))
                 pronto_df = pd.DataFrame(data.get('pronto', []))
@@ -1094,6 +1098,7 @@ class RegionCoefficientManager:
                 content = response.json()
                 file_content = base64.b64decode(content["content"]).decode("utf-8")
                 data = json.loads(file_content)
+                self.last_updated = data.get("last_updated")
                 return data.get("coefficients", {})
             else:
                 return {}
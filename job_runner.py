@@ -0,0 +1,225 @@
+# job_runner.py
+# draft 4.1 - simplified
+"""
+Фоновое выполнение расчета план/факт.
+Расчет идет в рабочем потоке, в session_state хранится только ID задачи,
+поэтому взаимодействие с виджетами (перезапуск скрипта) не прерывает расчет.
+Результат забирается при следующем перезапуске скрипта.
+"""
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from config import config
+
+# Статусы задачи
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_ERROR = 'error'
+JOB_CANCELLED = 'cancelled'
+
+FINISHED_STATUSES = (JOB_DONE, JOB_ERROR, JOB_CANCELLED)
+
+
+class JobCancelled(Exception):
+    """Задача отменена пользователем"""
+
+
+class ProgressTracker:
+    """
+    Прогресс задачи по этапам. Передается в вычислительное ядро (progress=...);
+    на каждом этапе проверяется отмена - расчет прерывается на границе этапа.
+    """
+
+    def __init__(self, total_stages=None):
+        self.total_stages = total_stages
+        self.stage_name = 'Ожидание'
+        self.stage_number = 0
+        self.rows = None
+        self.rows_done = None
+        self.started_at = None
+        self.stage_started_at = None
+        self.history = []
+        self._cancel_event = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.started_at = time.time()
+
+    def stage(self, name, rows=None):
+        """Начало этапа: name - название, rows - сколько строк обрабатывается"""
+        self.check_cancelled()
+        now = time.time()
+        with self._lock:
+            if self.stage_started_at is not None:
+                self.history.append((self.stage_name, self.rows, now - self.stage_started_at))
+            self.stage_name = name
+            self.stage_number += 1
+            self.rows = rows
+            self.rows_done = None
+            self.stage_started_at = now
+
+    def advance(self, rows_done, rows=None):
+        """Прогресс внутри длинного этапа (строк обработано)"""
+        self.check_cancelled()
+        with self._lock:
+            self.rows_done = rows_done
+            if rows is not None:
+                self.rows = rows
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def check_cancelled(self):
+        if self._cancel_event.is_set():
+            raise JobCancelled()
+
+    def snapshot(self):
+        """Состояние для отображения в UI"""
+        with self._lock:
+            now = time.time()
+            fraction = None
+            if self.total_stages:
+                fraction = min(self.stage_number / self.total_stages, 1.0)
+            return {
+                'stage': self.stage_name,
+                'stage_number': self.stage_number,
+                'total_stages': self.total_stages,
+                'fraction': fraction,
+                'rows': self.rows,
+                'rows_done': self.rows_done,
+                'elapsed': now - self.started_at if self.started_at else 0.0,
+                'stage_elapsed': now - self.stage_started_at if self.stage_started_at else 0.0,
+                'history': list(self.history)
+            }
+
+
+class CalculationJob:
+    """Одна фоновая задача"""
+
+    def __init__(self, job_id, total_stages=None, context=None, key=None):
+        self.id = job_id
+        self.key = key
+        self.subscribers = 1
+        self.status = JOB_QUEUED
+        self.progress = ProgressTracker(total_stages)
+        self.context = context or {}
+        self.result = None
+        self.error = None
+        self.traceback = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.future = None
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATUSES
+
+
+class JobManager:
+    """
+    Пул фоновых задач процесса (общий для всех сессий Streamlit).
+    Завершенные задачи хранятся JOB_TTL секунд, чтобы сессия успела забрать результат.
+    Задачи с одинаковым ключом не дублируются: сессии подписываются на уже идущую.
+    """
+
+    def __init__(self, max_workers=None, ttl=None):
+        self.max_workers = max_workers or config.JOB_WORKERS
+        self.ttl = ttl if ttl is not None else config.JOB_TTL
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='calc-job')
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, total_stages=None, context=None, key=None, **kwargs):
+        """
+        Запускает func(*args, progress=tracker, **kwargs) в рабочем потоке.
+        context - данные сессии, нужные при получении результата,
+        key - ключ входных данных: если такая задача уже идет, возвращается ее ID.
+        Возвращает ID задачи.
+        """
+        self._cleanup()
+        with self._lock:
+            if key is not None:
+                for running in self._jobs.values():
+                    if running.key == key and not running.finished and not running.progress.cancelled:
+                        running.subscribers += 1
+                        return running.id
+            job = CalculationJob(uuid.uuid4().hex[:12], total_stages, context, key)
+            self._jobs[job.id] = job
+        job.future = self._executor.submit(self._run, job, func, args, kwargs)
+        return job.id
+
+    def _run(self, job, func, args, kwargs):
+        if job.progress.cancelled:
+            job.status = JOB_CANCELLED
+            job.finished_at = time.time()
+            return
+        job.status = JOB_RUNNING
+        job.progress.start()
+        try:
+            job.result = func(*args, progress=job.progress, **kwargs)
+            job.status = JOB_DONE
+        except JobCancelled:
+            job.status = JOB_CANCELLED
+        except Exception as e:
+            job.error = str(e)
+            job.traceback = traceback.format_exc()
+            job.status = JOB_ERROR
+        finally:
+            job.finished_at = time.time()
+
+    def get(self, job_id):
+        """Задача по ID (None - не найдена или уже удалена)"""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """
+        Отказ сессии от задачи. Если задачу больше никто не ждет - запрос отмены:
+        она остановится на ближайшей границе этапа. True - задача отменяется.
+        """
+        job = self.get(job_id)
+        if job is None or job.finished:
+            return False
+        with self._lock:
+            job.subscribers -= 1
+            if job.subscribers > 0:
+                return False
+        job.progress.cancel()
+        if job.future is not None and job.future.cancel():
+            job.status = JOB_CANCELLED
+            job.finished_at = time.time()
+        return True
+
+    def release(self, job_id):
+        """Сессия забрала результат; задача удаляется, когда ее забрали все подписчики"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job.subscribers -= 1
+            if job.subscribers <= 0 and job.finished:
+                del self._jobs[job_id]
+
+    def _cleanup(self):
+        """Удаляет давно завершенные задачи, результат которых никто не забрал"""
+        now = time.time()
+        with self._lock:
+            expired = [
+                job_id for job_id, job in self._jobs.items()
+                if job.finished and job.finished_at and now - job.finished_at > self.ttl
+            ]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+
+# Глобальный экземпляр: модуль импортируется один раз на процесс,
+# поэтому задачи переживают перезапуски скрипта Streamlit
+job_manager = JobManager()
@@ -0,0 +1,623 @@
+# plan_engine.py
+# draft 4.1 - simplified
+"""
+Колоночный расчет плана на дату по иерархии (вместо построчного цикла
+VisitCalculator.calculate_hierarchical_plan_on_date).
+Коэффициент месяца, план по веткам (визиты / Мултон / Мультибренд / Мониторинги),
+веса RS и план на дату по этапам считаются операциями над колонками
+всей иерархии сразу. План по этапам - два шага над массивами дат datetime64:
+_stage_days (дни этапов и дни этапов в периоде, не зависят от весов) и
+_staged_sum (план на дату по весам этапов); StageGeometry хранит первый шаг
+для пересчета при смене весов. Величины, зависящие только от дат (коэффициент
+месяца, дни этапов), считаются один раз на уникальное сочетание дат
+и раздаются строкам RS. Результат совпадает с построчным расчетом:
+
+    python plan_engine.py --visits 20000 --seed 7
+
+строит иерархию на синтетических данных, считает план обоими движками
+и печатает расхождения (код выхода 1, если они есть).
+"""
+import argparse
+import sys
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from business_calendar import to_days
+from profiler import NULL_PROFILER
+
+PLAN_ENGINES = ('vectorized', 'legacy')
+
+# Ключ плана по визитам в иерархии (в визитах - visit_cube.PLAN_KEYS)
+HIERARCHY_PLAN_KEYS = ['Клиент', 'Проект', 'Волна', 'Регион']
+
+# Колонки результата в порядке построчного расчета
+PLAN_COLUMNS = [
+    'Проект', 'Клиент', 'Волна', 'Регион', 'DSM', 'ASM', 'RS', 'ПО', 'Уровень',
+    'План проекта, шт.', 'План на дату, шт.', 'Длительность', 'Дата старта', 'Дата финиша',
+    'Дата старта_гугл', 'Дата финиша_гугл', 'Коэффициент месяца', 'Метод подбора дат',
+    'Дней в периоде', 'Дневной план RS, шт.', 'skip_plan_correction'
+]
+
+STAGES = 4
+
+
+# ============================================
+# ВСПОМОГАТЕЛЬНЫЕ
+# ============================================
+
+def _round_python(values, digits):
+    """round() Python по каждому значению (как у плана из чисел Python в построчном расчете)"""
+    return np.array([round(value, digits) for value in np.asarray(values, dtype=float).tolist()], dtype=float)
+
+
+def _round(values, digits, python_mask):
+    """
+    Округление как в построчном расчете: строки, где план получен из чисел Python
+    (python_mask), - round() Python, остальные (числа NumPy из таблиц) - np.round.
+    Результаты различаются только на половинках в десятичной записи.
+    """
+    values = np.asarray(values, dtype=float)
+    result = np.round(values, digits)
+    if python_mask.any():
+        result[python_mask] = _round_python(values[python_mask], digits)
+    return result
+
+
+def _day_numbers(values):
+    """Даты → номер дня (datetime64[D] как float, NaT → NaN)"""
+    days = pd.to_datetime(values, errors='coerce').to_numpy(dtype='datetime64[ns]').astype('datetime64[D]')
+    numbers = days.astype('int64').astype(float)
+    numbers[np.isnat(days)] = np.nan
+    return numbers
+
+
+def _dates(day_numbers):
+    """Номера дней (без пустых) → datetime64[D]"""
+    return day_numbers.astype('int64').astype('datetime64[D]')
+
+
+def _day_number(value):
+    return float(np.datetime64(pd.Timestamp(value).date(), 'D').astype('int64'))
+
+
+def _working_days(start, end, business_calendar):
+    """Рабочие дни по производственному календарю в [start, end] по номерам дней; start > end → 0"""
+    return business_calendar.count(_dates(np.asarray(start)), _dates(np.asarray(end)))
+
+
+def _signatures(*columns):
+    """
+    Уникальные сочетания значений колонок (пустые - тоже значение).
+    Возвращает (номер сочетания каждой строки, позиции первых строк сочетаний).
+    """
+    frame = pd.DataFrame({i: column for i, column in enumerate(columns)})
+    codes = frame.groupby(list(frame.columns), dropna=False, sort=False).ngroup().to_numpy()
+    first_rows = pd.Series(np.arange(len(frame))).groupby(codes).min().to_numpy()
+    return codes, first_rows
+
+
+def _google_days(hierarchy_df, column, fallback):
+    """
+    Дата из Google (колонка может отсутствовать) с заменой пустых на дату иерархии.
+    Возвращает (значения для результата, номер дня для коэффициента месяца):
+    даты и datetime берутся без времени, прочие значения - день даты иерархии.
+    """
+    if column not in hierarchy_df.columns:
+        return fallback.to_numpy(dtype=object), _day_numbers(fallback)
+    values = hierarchy_df[column]
+    raw = values.where(values.notna(), fallback)
+
+    if pd.api.types.is_datetime64_any_dtype(raw):
+        return raw.to_numpy(dtype=object), _day_numbers(raw)
+
+    def to_day(value):
+        if hasattr(value, 'date'):
+            return pd.Timestamp(value.date())
+        if hasattr(value, 'year'):
+            return pd.Timestamp(value)
+        return pd.NaT
+
+    uniques = pd.unique(raw)
+    mapped = pd.Series([to_day(value) for value in uniques], index=range(len(uniques)), dtype='datetime64[ns]')
+    positions = pd.Index(uniques).get_indexer(raw)
+    days = _day_numbers(mapped.to_numpy()[positions])
+    fallback_days = _day_numbers(fallback)
+    return raw.to_numpy(dtype=object), np.where(np.isnan(days), fallback_days, days)
+
+
+# ============================================
+# ПЛАН НА ДАТУ ПО ЭТАПАМ
+# ============================================
+
+def _stage_days(duration, start, period_start, period_end):
+    """
+    Дни каждого этапа и дни этапа внутри периода - не зависят от весов этапов.
+    Длительность делится на этапы поровну (остаток - первым этапам).
+    Возвращает два списка из STAGES массивов формы входов.
+    """
+    stage_days = duration // STAGES
+    extra_days = duration % STAGES
+    current_day = np.zeros(duration.shape, dtype='int64')
+    days, days_in_period = [], []
+
+    for i in range(STAGES):
+        stage = stage_days + (extra_days > i)
+        stage_start = start + current_day.astype('timedelta64[D]')
+        stage_end = stage_start + (stage - 1).astype('timedelta64[D]')
+        intersect_start = np.maximum(period_start, stage_start)
+        intersect_end = np.minimum(period_end, stage_end)
+        overlaps = intersect_start <= intersect_end
+        days.append(stage)
+        days_in_period.append(np.where(overlaps, (intersect_end - intersect_start).astype('int64') + 1, 0))
+        current_day = current_day + stage
+    return days, days_in_period
+
+
+def _staged_sum(total_plan, coefficients, days, days_in_period):
+    """
+    План на дату по готовым дням этапов: план этапов 1-3 - total × коэффициент,
+    этап 4 - остаток; дневной план этапа × дни этапа в периоде.
+    """
+    plan_on_date = np.zeros(total_plan.shape)
+    plan_remaining = total_plan.copy()
+    for i in range(STAGES):
+        plan = total_plan * coefficients[i] if i < STAGES - 1 else plan_remaining
+        plan_remaining = plan_remaining - plan
+        daily_plan = np.divide(plan, days[i], out=np.zeros(total_plan.shape), where=days[i] > 0)
+        plan_on_date = plan_on_date + daily_plan * days_in_period[i]
+    return plan_on_date
+
+
+def _visit_plans(visit_cube, rows):
+    """Визитов по ключу (клиент, код, волна, регион) для строк иерархии"""
+    counts = visit_cube.plan_totals()
+    if counts.empty:
+        return np.zeros(len(rows))
+    target = pd.MultiIndex.from_arrays([rows[col] for col in HIERARCHY_PLAN_KEYS])
+    return counts.reindex(target).fillna(0).to_numpy(dtype=float)
+
+
+def _rs_weights(visit_cube, rows):
+    """Доля RS в визитах ключа плана (без удаленных визитов), 0 - RS нет в визитах"""
+    weights = visit_cube.rs_weights()
+    if weights.empty:
+        return np.zeros(len(rows))
+    target = pd.MultiIndex.from_arrays([rows[col] for col in HIERARCHY_PLAN_KEYS + ['RS']])
+    return weights.reindex(target).fillna(0).to_numpy(dtype=float)
+
+
+def _month_coefficients(google_start, google_finish, month_start, month_end, business_calendar):
+    """Коэффициент месяца по номерам дней старта и финиша Google (без пустых)"""
+    month_coefficient = np.ones(len(google_start))
+    continues_after_month = google_finish > month_end
+    # Сценарий 1: начался в месяце и продолжается после - знаменатель = весь проект
+    # Сценарий 2: начался до месяца и продолжается после - знаменатель до конца месяца
+    # Сценарий 3 и прочие: коэффициент 1
+    scenario_one = (google_start >= month_start) & continues_after_month
+    scenario_two = (google_start < month_start) & continues_after_month
+    if (scenario_one | scenario_two).any():
+        days_in_month = _working_days(
+            np.maximum(google_start, month_start), np.minimum(google_finish, month_end), business_calendar
+        )
+        denominator = np.where(
+            scenario_one,
+            _working_days(google_start, google_finish, business_calendar),
+            _working_days(google_start, np.full(len(google_start), month_end), business_calendar)
+        )
+        ratio = np.divide(days_in_month, denominator, out=np.ones(len(google_start)), where=denominator > 0)
+        month_coefficient = np.where(scenario_one | scenario_two, ratio, 1.0)
+    return month_coefficient
+
+
+def _plan_branches(rows):
+    """Ветки плана строк: (Мониторинги, Мултон, Мультибренд, визиты) - булевы массивы"""
+    po = rows['ПО']
+    client = rows['Клиент']
+    is_monitoring = (po == 'Мониторинги').to_numpy()
+    is_multon = ~is_monitoring & ((po == 'ПО клиента') & (client == 'Мултон')).to_numpy()
+    is_multibrand = ~is_monitoring & ~is_multon & ((client == 'Мультибренд 2024') & (po == 'CXWAY')).to_numpy()
+    is_visits = ~(is_monitoring | is_multon | is_multibrand)
+    return is_monitoring, is_multon, is_multibrand, is_visits
+
+
+# ============================================
+# РАСЧЕТ ПЛАНА
+# ============================================
+
+def plan_rows(hierarchy_df, visit_cube, calc_params, coefficients, plan_registry, prodata_quotas=None,
+              has_cxway=True, has_easymerch=True, profiler=None):
+    """
+    План на дату для всех строк иерархии (до корректировок плана).
+    Строки без дат, вне периода или с нулевым планом не попадают в результат,
+    порядок строк - как в иерархии. Колонки - PLAN_COLUMNS.
+    visit_cube - куб визитов расчета (visit_cube.VisitCube): визиты по ключу плана и доли RS,
+    plan_registry - индексы справочников расчета (план Мултон/Мультибренд, производственный календарь).
+    Коэффициент месяца и дни этапов зависят только от дат строки: считаются один раз
+    на уникальное сочетание дат (строки RS одного проекта и волны его разделяют)
+    и раздаются строкам. profiler - шаги 'строки → уникальные сочетания'.
+    """
+    profiler = profiler if profiler is not None else NULL_PROFILER
+    business_calendar = plan_registry.calendar
+    start_period = calc_params['start_date']
+    end_period = calc_params['end_date']
+    rows = hierarchy_df.reset_index(drop=True)
+    if rows.empty:
+        return pd.DataFrame(columns=PLAN_COLUMNS)
+
+    # === ДАТЫ И ПЕРИОД ===
+    start_day = _day_numbers(rows['Дата старта'])
+    finish_day = _day_numbers(rows['Дата финиша'])
+    duration = pd.to_numeric(rows['Длительность'], errors='coerce').to_numpy(dtype=float)
+    period_first = _day_number(start_period)
+    period_last = _day_number(end_period)
+
+    with np.errstate(invalid='ignore'):
+        valid = ~np.isnan(start_day) & ~np.isnan(finish_day) & (duration > 0)
+        valid &= ~((period_last < start_day) | (period_first > finish_day))
+    period_start = np.maximum(period_first, start_day)
+    period_end = np.minimum(period_last, finish_day)
+    days_in_period = period_end - period_start + 1
+
+    # === КОЭФФИЦИЕНТ МЕСЯЦА ===
+    start_google, start_google_day = _google_days(rows, 'Дата старта_гугл', rows['Дата старта'])
+    finish_google, finish_google_day = _google_days(rows, 'Дата финиша_гугл', rows['Дата финиша'])
+    month_start_ts = pd.Timestamp(calc_params['start_date'])
+    month_start = _day_number(month_start_ts)
+    month_end = _day_number(month_start_ts + pd.offsets.MonthEnd(1))
+
+    # Пустые даты не участвуют (такие строки отброшены проверкой valid)
+    google_start = np.nan_to_num(start_google_day, nan=month_start)
+    google_finish = np.nan_to_num(finish_google_day, nan=month_start)
+    step = profiler.begin('Коэффициент месяца: сочетания дат', rows_in=len(rows))
+    date_codes, date_rows = _signatures(google_start, google_finish)
+    month_coefficient = _month_coefficients(
+        google_start[date_rows], google_finish[date_rows], month_start, month_end, business_calendar
+    )[date_codes]
+    profiler.end(step, rows_out=len(date_rows))
+
+    # === ВЕТКИ ПЛАНА ===
+    is_monitoring, is_multon, is_multibrand, is_visits = _plan_branches(rows)
+
+    total_plan = np.zeros(len(rows))
+    # Строки, где план - числа Python (округление round()), остальные - числа NumPy
+    python_numbers = np.zeros(len(rows), dtype=bool)
+
+    # Мониторинги: квота ПроДата делится на регионы проекта, без этапов
+    if is_monitoring.any():
+        quotas = rows['Проект'].map(prodata_quotas or {}).fillna(0).to_numpy(dtype=float)
+        monitoring = rows.loc[is_monitoring, ['Проект', 'Регион']]
+        regions = monitoring.groupby('Проект')['Регион'].nunique(dropna=False)
+        region_counts = rows['Проект'].map(regions).fillna(0).to_numpy(dtype=float)
+        monitoring_plan = np.divide(quotas, region_counts, out=quotas.copy(), where=region_counts > 0)
+        total_plan = np.where(is_monitoring & (quotas > 0), monitoring_plan, total_plan)
+        python_numbers |= is_monitoring
+
+    # Мултон: план из JSON по (код, регион, ASM)
+    if is_multon.any() and has_easymerch:
+        multon = plan_registry.lookup('multon', [rows['Проект'], rows['Регион'], rows['ASM']])
+        total_plan = np.where(is_multon, np.nan_to_num(multon, nan=0.0), total_plan)
+
+    # Мультибренд: план по региону (Дилеры) или региону и типу волны (Пронто)
+    if is_multibrand.any() and has_cxway:
+        waves = rows['Волна'].astype(str).str.partition('_')
+        wave_type = waves[2].where(waves[1] != '', rows['Волна'].astype(str))
+        dilers = plan_registry.lookup('dilers', [rows['Регион']])
+        if plan_registry.pronto_by_wave:
+            pronto = plan_registry.lookup('pronto', [rows['Регион'], wave_type])
+        else:
+            pronto = plan_registry.lookup('pronto', [rows['Регион']])
+        multibrand = np.select(
+            [(wave_type == 'Дилеры').to_numpy(), wave_type.isin(['Пронто', 'Пронто М']).to_numpy()],
+            [dilers, pronto], default=0.0
+        )
+        total_plan = np.where(is_multibrand, np.nan_to_num(multibrand, nan=0.0), total_plan)
+
+    # Визиты: визиты ключа × коэффициент месяца, затем доля RS
+    if is_visits.any():
+        visits_plan = _visit_plans(visit_cube, rows)
+        weights = _rs_weights(visit_cube, rows)
+        month_plan = _round_python(visits_plan * month_coefficient, 1)
+        weighted = weights > 0
+        rs_plan = np.where(weighted, np.round(month_plan * weights, 1), month_plan)
+        total_plan = np.where(is_visits & (visits_plan > 0), rs_plan, total_plan)
+        python_numbers |= is_visits & ~weighted
+
+    keep = valid & (total_plan > 0)
+    keep &= ~(is_multon & (not has_easymerch)) & ~(is_multibrand & (not has_cxway))
+
+    # === ПЛАН НА ДАТУ ПО ЭТАПАМ ===
+    rows = rows[keep].reset_index(drop=True)
+    total_plan = total_plan[keep]
+    python_numbers = python_numbers[keep]
+    monitoring = is_monitoring[keep]
+    duration = duration[keep]
+    period_start = period_start[keep]
+    period_end = period_end[keep]
+
+    # Дни этапов - по уникальным сочетаниям (старт, финиш, длительность), план RS - по строкам
+    step = profiler.begin('План по этапам: сочетания дат', rows_in=len(rows))
+    stage_codes, stage_rows = _signatures(start_day[keep], finish_day[keep], duration)
+    days, days_in_stage_period = _stage_days(
+        duration[stage_rows].astype('int64'), _dates(start_day[keep][stage_rows]),
+        _dates(period_start[stage_rows]), _dates(period_end[stage_rows])
+    )
+    profiler.end(step, rows_out=len(stage_rows))
+    staged_on_date = _staged_sum(
+        total_plan, coefficients, [stage[stage_codes] for stage in days],
+        [stage[stage_codes] for stage in days_in_stage_period]
+    )
+    period_days = days_in_period[keep]
+    staged_daily = np.divide(staged_on_date, period_days, out=np.zeros(len(rows)), where=period_days > 0)
+    # Длительность короче суток (после отбрасывания дробной части - 0): плана на дату нет
+    no_stages = duration.astype('int64') == 0
+    staged_on_date = np.where(no_stages, 0.0, staged_on_date)
+    staged_daily = np.where(no_stages, 0.0, staged_daily)
+    plan_on_date = np.where(monitoring, total_plan, staged_on_date)
+    daily_plan = np.where(monitoring, total_plan, staged_daily)
+
+    result = pd.DataFrame({
+        'Проект': rows['Проект'],
+        'Клиент': rows['Клиент'],
+        'Волна': rows['Волна'],
+        'Регион': rows['Регион'],
+        'DSM': rows['DSM'],
+        'ASM': rows['ASM'],
+        'RS': rows['RS'],
+        'ПО': rows['ПО'],
+        'Уровень': 'RS',
+        'План проекта, шт.': total_plan,
+        'План на дату, шт.': _round(plan_on_date, 1, python_numbers),
+        'Длительность': duration.astype(int),
+        'Дата старта': rows['Дата старта'],
+        'Дата финиша': rows['Дата финиша'],
+        'Дата старта_гугл': start_google[keep],
+        'Дата финиша_гугл': finish_google[keep],
+        'Коэффициент месяца': month_coefficient[keep],
+        'Метод подбора дат': rows['Метод подбора дат'],
+        'Дней в периоде': days_in_period[keep].astype(int),
+        'Дневной план RS, шт.': _round(daily_plan, 2, python_numbers),
+        'skip_plan_correction': False
+    }, columns=PLAN_COLUMNS)
+    return result
+
+
+# ============================================
+# ПЕРЕСЧЕТ ПРИ ИЗМЕНЕНИИ ВЕСОВ ЭТАПОВ
+# ============================================
+
+class StageGeometry:
+    """
+    Все, что в плане на дату не зависит от весов этапов, по строкам плана
+    до корректировок: план проекта, дни этапов и дни этапов в периоде,
+    строки Мониторингов и правило округления. План на дату для новых весов -
+    суммирование готовых матриц (строки × этапы) теми же операциями,
+    что в plan_rows, поэтому результат совпадает с полным расчетом.
+    """
+
+    def __init__(self, plan_df, calc_params, visit_cube):
+        self.start_date = calc_params['start_date']
+        self.end_date = calc_params['end_date']
+        self.coefficients = list(calc_params.get('coefficients', [0.25, 0.25, 0.25, 0.25]))
+        self.index = plan_df.index
+        self.total_plan = plan_df['План проекта, шт.'].to_numpy(dtype=float)
+        duration = pd.to_numeric(plan_df['Длительность'], errors='coerce').fillna(0).to_numpy(dtype='int64')
+        start = to_days(plan_df['Дата старта'])
+        finish = to_days(plan_df['Дата финиша'])
+        # Дни этапов - по уникальным сочетаниям дат, как в plan_rows
+        codes, first_rows = _signatures(start, finish, duration)
+        start, finish = start[first_rows], finish[first_rows]
+        days, days_in_period = _stage_days(
+            duration[first_rows], start,
+            np.maximum(to_days(self.start_date), start), np.minimum(to_days(self.end_date), finish)
+        )
+        self.days = [stage[codes] for stage in days]
+        self.days_in_period = [stage[codes] for stage in days_in_period]
+        self.period_days = plan_df['Дней в периоде'].to_numpy(dtype=float)
+        self.empty = (self.total_plan == 0) | (duration == 0)
+
+        is_monitoring, _, _, is_visits = _plan_branches(plan_df)
+        self.monitoring = is_monitoring
+        self.python_numbers = is_monitoring | (is_visits & ~(_rs_weights(visit_cube, plan_df) > 0))
+
+    def __len__(self):
+        return len(self.total_plan)
+
+    def memory_bytes(self):
+        """Память массивов геометрии (строки × этапы) и индекса плана"""
+        arrays = [self.total_plan, self.period_days, self.empty, self.monitoring, self.python_numbers,
+                  *self.days, *self.days_in_period]
+        return int(sum(array.nbytes for array in arrays) + self.index.memory_usage(deep=True))
+
+    def same_period(self, calc_params):
+        """Геометрия построена для периода calc_params"""
+        return (pd.Timestamp(calc_params['start_date']) == pd.Timestamp(self.start_date) and
+                pd.Timestamp(calc_params['end_date']) == pd.Timestamp(self.end_date))
+
+    def plan_on_date(self, coefficients):
+        """(План на дату, дневной план RS) для весов этапов - Series с индексом плана"""
+        staged = _staged_sum(self.total_plan, coefficients, self.days, self.days_in_period)
+        daily = np.divide(staged, self.period_days, out=np.zeros(len(staged)), where=self.period_days > 0)
+        plan_on_date = np.where(self.monitoring, self.total_plan, np.where(self.empty, 0.0, staged))
+        daily_plan = np.where(self.monitoring, self.total_plan, np.where(self.empty, 0.0, daily))
+        return (pd.Series(_round(plan_on_date, 1, self.python_numbers), index=self.index),
+                pd.Series(_round(daily_plan, 2, self.python_numbers), index=self.index))
+
+
+# ============================================
+# КОРРЕКТИРОВКИ ПЛАНА
+# ============================================
+
+# Колонки плана, которые меняет корректировка
+ADJUSTED_COLUMNS = ['План проекта, шт.', 'План на дату, шт.', 'Дневной план RS, шт.', 'Оплата план']
+
+
+def project_keys(plan_df):
+    """Ключ корректировки строк плана: 'клиент|волна|код'"""
+    return (
+        plan_df['Клиент'].astype(str).str.strip() + '|' +
+        plan_df['Волна'].astype(str).str.strip() + '|' +
+        plan_df['Проект'].astype(str).str.strip()
+    )
+
+
+def apply_plan_adjustments(plan_df, adjustments, diag=None):
+    """
+    Корректировки {клиент|волна|код: сумма} к плану без корректировок → новая таблица.
+    План проекта меняется на сумму корректировки, строки проекта масштабируются
+    пропорционально (кроме skip_plan_correction). Корректировка, после которой план
+    отрицательный, не применяется (предупреждение в diag).
+    """
+    if not adjustments or plan_df is None or plan_df.empty:
+        return plan_df
+    keys = project_keys(plan_df)
+    totals = plan_df['План проекта, шт.'].groupby(keys, sort=False).sum()
+    adjustment = pd.Series(totals.index.map(adjustments), index=totals.index).fillna(0)
+    adjusted = totals + adjustment
+
+    negative = adjusted < 0
+    if diag is not None:
+        for key in totals.index[negative]:
+            value = adjustments[key]
+            diag.warning(f"⚠️ Корректировка {value} для проекта {key} делает план отрицательным "
+                         f"({totals[key]} + {value} = {totals[key] + value}). Корректировка НЕ применена.")
+    adjusted = adjusted.where(~negative, totals)
+    factors = (adjusted / totals).where(totals > 0, 1.0)
+
+    factor = keys.map(factors).to_numpy(dtype=float)
+    changed = factor != 1
+    if 'skip_plan_correction' in plan_df.columns:
+        changed &= ~plan_df['skip_plan_correction'].astype(bool).to_numpy()
+    if not changed.any():
+        return plan_df
+
+    result = plan_df.copy()
+    new_plan = result.loc[changed, 'План проекта, шт.'].to_numpy(dtype=float) * factor[changed]
+    new_plan_on_date = result.loc[changed, 'План на дату, шт.'].to_numpy(dtype=float) * factor[changed]
+    result['План проекта, шт.'] = result['План проекта, шт.'].astype(float)
+    result.loc[changed, 'План проекта, шт.'] = new_plan
+    result['План на дату, шт.'] = result['План на дату, шт.'].astype(float)
+    result.loc[changed, 'План на дату, шт.'] = _round_python(new_plan_on_date, 1)
+
+    if 'Дней в периоде' in result.columns:
+        days = result.loc[changed, 'Дней в периоде'].to_numpy(dtype=float)
+        with_days = days > 0
+        rows = result.index[changed][with_days]
+        result['Дневной план RS, шт.'] = result['Дневной план RS, шт.'].astype(float)
+        result.loc[rows, 'Дневной план RS, шт.'] = _round_python(new_plan_on_date[with_days] / days[with_days], 2)
+
+    # Плановая оплата считается от плана проекта
+    if 'plan_payment_per_visit' in result.columns:
+        result['Оплата план'] = (result['plan_payment_per_visit'] * result['План проекта, шт.']).round(2)
+    return result
+
+
+# ============================================
+# ПРОВЕРКА СОВПАДЕНИЯ С ПОСТРОЧНЫМ РАСЧЕТОМ
+# ============================================
+
+def compare_plans(legacy_df, vectorized_df, tolerance=1e-9):
+    """
+    Расхождения двух результатов плана: строки 'Строка', 'Колонка', 'Построчно', 'Колоночно'.
+    Пустая таблица - результаты совпадают (числа - с точностью tolerance).
+    """
+    columns = ['Строка', 'Колонка', 'Построчно', 'Колоночно']
+    if len(legacy_df) != len(vectorized_df):
+        return pd.DataFrame([{
+            'Строка': None, 'Колонка': 'число строк', 'Построчно': len(legacy_df), 'Колоночно': len(vectorized_df)
+        }], columns=columns)
+
+    legacy_df = legacy_df.reset_index(drop=True)
+    vectorized_df = vectorized_df.reset_index(drop=True)
+    mismatches = []
+    for col in sorted(set(legacy_df.columns) | set(vectorized_df.columns), key=str):
+        if col not in legacy_df.columns or col not in vectorized_df.columns:
+            mismatches.append({'Строка': None, 'Колонка': col,
+                               'Построчно': col in legacy_df.columns, 'Колоночно': col in vectorized_df.columns})
+            continue
+        left = legacy_df[col]
+        right = vectorized_df[col]
+        if pd.api.types.is_numeric_dtype(left) and pd.api.types.is_numeric_dtype(right) \
+                and not pd.api.types.is_bool_dtype(left):
+            differ = ~np.isclose(left.to_numpy(dtype=float), right.to_numpy(dtype=float),
+                                 rtol=0, atol=tolerance, equal_nan=True)
+        else:
+            differ = ~((left == right) | (left.isna() & right.isna())).to_numpy()
+        for position in np.flatnonzero(differ)[:20]:
+            mismatches.append({'Строка': int(position), 'Колонка': col,
+                               'Построчно': left.iloc[position], 'Колоночно': right.iloc[position]})
+    return pd.DataFrame(mismatches, columns=columns)
+
+
+def check_plan_parity(hierarchy_df, visits_df, calc_params, google_df=None, optima_df=None,
+                      plan_sources=None, loaded_sources=None, tolerance=1e-9):
+    """План обоими движками калькулятора → таблица расхождений (пустая - совпадают)"""
+    from visit_calculator import VisitCalculator
+
+    visit_calculator = VisitCalculator()
+    results = {}
+    for engine in PLAN_ENGINES:
+        results[engine] = visit_calculator.calculate_hierarchical_plan_on_date(
+            hierarchy_df, visits_df, calc_params, google_df=google_df, optima_df=optima_df,
+            plan_sources=plan_sources, loaded_sources=loaded_sources, engine=engine
+        )
+    return compare_plans(results['legacy'], results['vectorized'], tolerance)
+
+
+def _parse_date(value):
+    return date.fromisoformat(value)
+
+
+def main(argv=None):
+    from compute_core import (
+        normalize_source_frame, normalize_stage_weights, settings_to_sources, prepare_sources, calculate_plan_fact
+    )
+    from profiler import Profiler
+    from synthetic_data import generate_dataset
+
+    parser = argparse.ArgumentParser(description="Сверка колоночного и построчного расчета плана")
+    parser.add_argument('--visits', type=int, default=20000, help="Визитов в синтетическом наборе")
+    parser.add_argument('--seed', type=int, default=42, help="Seed синтетических данных")
+    parser.add_argument('--start', type=_parse_date, default=date(2026, 7, 1), help="Начало периода (YYYY-MM-DD)")
+    parser.add_argument('--end', type=_parse_date, default=date(2026, 7, 15), help="Конец периода (YYYY-MM-DD)")
+    parser.add_argument('--weights', nargs=4, type=float, default=[0.8, 1.2, 1.0, 0.9], help="Веса 4 этапов")
+    args = parser.parse_args(argv)
+
+    calc_params = {
+        'start_date': args.start,
+        'end_date': args.end,
+        'coefficients': normalize_stage_weights(args.weights)
+    }
+    frames, settings = generate_dataset(args.visits, args.start, args.end, args.seed)
+    # Как после загрузки файлов: все значения - строки (read_source_file)
+    frames = {source: normalize_source_frame(df.astype(str)) for source, df in frames.items()}
+    excluded_df, included_df, plan_sources = settings_to_sources(settings)
+
+    cleaned_data = {}
+    sources = prepare_sources(frames, calc_params, plan_sources, cleaned_data=cleaned_data,
+                              profiler=Profiler(enabled=False))
+    result = calculate_plan_fact(sources, calc_params, excluded_df, included_df, plan_sources,
+                                 loaded_sources=set(frames), cleaned_data=cleaned_data,
+                                 profiler=Profiler(enabled=False))
+    hierarchy_df = result['visit_report'].get('base_data')
+    if hierarchy_df is None or hierarchy_df.empty:
+        print("❌ Иерархия пустая - сверять нечего", file=sys.stderr)
+        return 1
+
+    mismatches = check_plan_parity(
+        hierarchy_df, cleaned_data['полевые_проекты'], calc_params, google_df=cleaned_data['сервизория'],
+        optima_df=cleaned_data.get('optima_processed'), plan_sources=plan_sources, loaded_sources=set(frames)
+    )
+    print(f"Строк иерархии: {len(hierarchy_df):,}")
+    if not mismatches.empty:
+        with pd.option_context('display.max_rows', None, 'display.width', 200):
+            print(mismatches.to_string(index=False))
+        print(f"❌ Расхождений: {len(mismatches)}")
+        return 1
+    print("✅ Колоночный расчет совпадает с построчным")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
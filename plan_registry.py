@@ -0,0 +1,202 @@
+# plan_registry.py
+# draft 4.1 - simplified
+"""
+Плановые справочники одного расчета в виде хэш-индексов.
+Справочники (план Мултон, план Мультибренд, RS Optima, коэффициенты
+регионов, корректировки, производственный календарь) загружаются один раз
+(load_plan_sources_from_managers или settings_to_sources), реестр строит
+по ним словари, и расчет плана делает только поиск по ключу:
+
+    (код проекта, регион, RS) → план Мултон
+    регион → план Мультибренд Дилеры, (регион, тип волны) → план Пронто
+
+status_frame() - какие справочники устарели или отсутствуют для расчета.
+"""
+import numpy as np
+import pandas as pd
+
+from business_calendar import get_calendar
+
+MULTON_KEYS = ['project_code', 'region', 'rs']
+DILERS_KEYS = ['region_short']
+PRONTO_KEYS = ['region_short', 'wave_type']
+
+# Справочник → (название, источник визитов, без которого справочник не нужен)
+SOURCE_INFO = {
+    'multon_plan': ('План Мултон', 'easymerch'),
+    'multibrand_plan': ('План Мультибренд', 'cxway'),
+    'optima_rs': ('RS Optima', 'optima'),
+    'region_coefficients': ('Коэффициенты регионов', 'bdr'),
+    'adjustments': ('Корректировки плана', None),
+    'production_calendar': ('Производственный календарь', None)
+}
+# Справочники с датой обновления в файле
+DATED_SOURCES = ('adjustments', 'multon_plan', 'multibrand_plan', 'optima_rs', 'region_coefficients')
+# Помесячные планы: устарели, если обновлены раньше начала месяца расчета
+MONTHLY_SOURCES = ('multon_plan', 'multibrand_plan')
+# Пустой справочник - нормальное состояние (не ошибка)
+OPTIONAL_SOURCES = ('adjustments',)
+
+STATUS_OK = 'ок'
+STATUS_MISSING = 'нет данных'
+STATUS_STALE = 'устарел'
+STATUS_UNUSED = 'не нужен'
+STATUS_COLUMNS = ['Справочник', 'Статус', 'Записей', 'Обновлен', 'Комментарий']
+
+
+def _index(table, keys, value_col):
+    """
+    Словарь {ключ: значение} по таблице: первое значение ключа (как .loc[mask].iloc[0]),
+    строки с пустым ключом пропускаются. Один ключ - скаляр, несколько - кортеж.
+    """
+    if table is None or table.empty or not all(col in table.columns for col in keys + [value_col]):
+        return {}
+    table = table.dropna(subset=keys).drop_duplicates(keys)
+    if len(keys) == 1:
+        return dict(zip(table[keys[0]], table[value_col]))
+    return dict(zip(zip(*(table[col] for col in keys)), table[value_col]))
+
+
+def _adjustment_totals(adjustments):
+    """Сумма корректировок по ключу 'клиент|волна|код'"""
+    totals = {}
+    for adj in adjustments or []:
+        key = f"{adj.get('project_name', '')}|{adj.get('wave_name', '')}|{adj.get('project_code', '')}"
+        totals[key] = totals.get(key, 0) + adj.get('adjustment_value', 0)
+    return totals
+
+
+class PlanSourceRegistry:
+    """Индексы плановых справочников одного расчета"""
+
+    def __init__(self, plan_sources, calc_params=None, loaded_sources=None):
+        plan_sources = plan_sources or {}
+        self.calc_params = calc_params or {}
+        self.loaded_sources = loaded_sources
+        self.updated = dict(plan_sources.get('updated') or {})
+
+        self.multon_df = plan_sources.get('multon_plan')
+        if self.multon_df is None:
+            self.multon_df = pd.DataFrame()
+        self.multon = _index(self.multon_df, MULTON_KEYS, 'plan')
+
+        dilers_df, pronto_df = plan_sources.get('multibrand_plan') or (pd.DataFrame(), pd.DataFrame())
+        if not self.is_needed('multibrand_plan'):
+            dilers_df, pronto_df = pd.DataFrame(), pd.DataFrame()
+        self.multibrand_rows = len(dilers_df) + len(pronto_df)
+        self.dilers = _index(dilers_df, DILERS_KEYS, 'plan')
+        # Старый формат Пронто - без типа волны, план только по региону
+        self.pronto_by_wave = 'wave_type' in pronto_df.columns
+        self.pronto = _index(pronto_df, PRONTO_KEYS if self.pronto_by_wave else DILERS_KEYS, 'plan')
+
+        self.optima_rs = plan_sources.get('optima_rs') or ({}, {}, {})
+        self.region_coefficients = plan_sources.get('region_coefficients') or {}
+        self.adjustment_list = plan_sources.get('adjustments') or []
+        self.adjustments = _adjustment_totals(self.adjustment_list)
+        self.calendar = get_calendar(plan_sources.get('production_calendar'))
+        self._series = {}
+
+    def is_needed(self, name):
+        """Справочник нужен, если загружен источник визитов, для которого он используется"""
+        required = SOURCE_INFO[name][1]
+        return required is None or self.loaded_sources is None or required in self.loaded_sources
+
+    # ============================================
+    # ПОИСК ПО КЛЮЧУ
+    # ============================================
+
+    def multon_plan(self, project_code, region, rs):
+        """План Мултон по (код проекта, регион, RS), 0 - нет в плане"""
+        return self.multon.get((project_code, region, rs), 0)
+
+    def multibrand_plan(self, region, wave_type):
+        """План Мультибренд по региону и типу волны ('Дилеры', 'Пронто', 'Пронто М'), 0 - нет в плане"""
+        if wave_type == 'Дилеры':
+            return self.dilers.get(region, 0)
+        if wave_type in ('Пронто', 'Пронто М'):
+            return self.pronto.get((region, wave_type) if self.pronto_by_wave else region, 0)
+        return 0
+
+    def lookup(self, name, key_columns):
+        """
+        Поиск сразу для массива ключей (колоночный расчет): name - 'multon', 'dilers' или 'pronto',
+        key_columns - список колонок ключа (Series/массивы). NaN - ключа нет в справочнике.
+        """
+        if name not in self._series:
+            index = getattr(self, name)
+            keys = list(index)
+            if keys and isinstance(keys[0], tuple):
+                keys = pd.MultiIndex.from_tuples(keys)
+            self._series[name] = pd.Series(pd.to_numeric(pd.Series(list(index.values()), dtype=object),
+                                                         errors='coerce').to_numpy(dtype=float), index=keys)
+        series = self._series[name]
+        if series.empty:
+            return np.full(len(key_columns[0]), np.nan)
+        if isinstance(series.index, pd.MultiIndex):
+            target = pd.MultiIndex.from_arrays(list(key_columns))
+        else:
+            target = pd.Index(key_columns[0])
+        return series.reindex(target).to_numpy(dtype=float)
+
+    # ============================================
+    # СОСТОЯНИЕ СПРАВОЧНИКОВ
+    # ============================================
+
+    def _records(self, name):
+        if name == 'multon_plan':
+            return len(self.multon_df)
+        if name == 'multibrand_plan':
+            return self.multibrand_rows
+        if name == 'optima_rs':
+            return sum(len(mapping) for mapping in self.optima_rs)
+        if name == 'region_coefficients':
+            return len(self.region_coefficients)
+        if name == 'adjustments':
+            return len(self.adjustment_list)
+        return len(self.calendar.holidays) + len(self.calendar.workdays)
+
+    def _status(self, name):
+        """(статус, комментарий) справочника для периода расчета"""
+        if not self.is_needed(name):
+            return STATUS_UNUSED, f"источник {SOURCE_INFO[name][1]} не загружен"
+        if self._records(name) == 0:
+            if name in OPTIONAL_SOURCES:
+                return STATUS_OK, 'пусто'
+            if name == 'production_calendar':
+                return STATUS_MISSING, 'праздники не заданы: рабочие дни только пн-пт'
+            return STATUS_MISSING, 'справочник пуст или не загружен'
+
+        start_date = self.calc_params.get('start_date')
+        if start_date is None:
+            return STATUS_OK, ''
+        month_start = pd.Timestamp(start_date).replace(day=1)
+        if name == 'production_calendar':
+            last_year = int(str(self.calendar.stop.astype('datetime64[Y]'))) - 1
+            if month_start.year > last_year:
+                return STATUS_STALE, f"праздники заданы до {last_year} года"
+        if name in MONTHLY_SOURCES:
+            updated = pd.to_datetime(self.updated.get(name), errors='coerce')
+            if pd.notna(updated) and updated.tz_localize(None) < month_start:
+                return STATUS_STALE, f"обновлен до начала месяца расчета ({month_start:%m.%Y})"
+        return STATUS_OK, ''
+
+    def status_frame(self):
+        """Состояние всех справочников: колонки STATUS_COLUMNS"""
+        rows = []
+        for name, (label, _) in SOURCE_INFO.items():
+            status, comment = self._status(name)
+            updated = self.updated.get(name)
+            rows.append({
+                'Справочник': label,
+                'Статус': status,
+                'Записей': self._records(name),
+                'Обновлен': str(updated)[:16].replace('T', ' ') if updated else '',
+                'Комментарий': comment
+            })
+        return pd.DataFrame(rows, columns=STATUS_COLUMNS)
+
+    def problems(self):
+        """Устаревшие и отсутствующие справочники: список строк для диагностики"""
+        frame = self.status_frame()
+        frame = frame[frame['Статус'].isin([STATUS_MISSING, STATUS_STALE])]
+        return [f"{row['Справочник']}: {row['Статус']} ({row['Комментарий']})" for _, row in frame.iterrows()]
@@ -0,0 +1,512 @@
+# profiler.py
+# draft 4.1 - simplified
+"""
+Профилировщик этапов расчета план/факт.
+Каждый этап (и вложенный шаг) записывает время, процессорное время потока,
+строки на входе/выходе, прирост пикового потребления памяти и попадания в кэш.
+Результат - таблица для UI, JSON для сравнения запусков и (по желанию)
+полный cProfile/pyinstrument одного запуска.
+
+Режим памяти (memory=True) дополнительно пишет для каждого этапа пик и прирост
+памяти Python (tracemalloc, все потоки процесса), текущий RSS и размер таблиц
+на входе/выходе (memory_usage(deep=True)). Режим заметно замедляет расчет.
+"""
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+from collections.abc import Mapping
+from contextlib import contextmanager
+from datetime import datetime
+
+import pandas as pd
+
+from config import config
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+CAPTURE_MODES = ('cprofile', 'pyinstrument')
+
+PROFILE_COLUMNS = [
+    'Этап', 'Уровень', 'Время, сек', 'CPU, сек', 'Строк на входе', 'Строк на выходе',
+    'Память +МБ', 'Попадания в кэш'
+]
+
+# Колонки режима памяти (добавляются к таблице этапов)
+MEMORY_COLUMNS = [
+    'Пик Python +МБ', 'Python +МБ', 'RSS, МБ', 'Таблицы на входе, МБ', 'Таблицы на выходе, МБ'
+]
+
+STATE_MEMORY_COLUMNS = ['Ключ', 'Тип', 'В памяти, МБ', 'На диске, МБ']
+
+MB = 1024 * 1024
+
+# Глубина обхода вложенных словарей и списков при подсчете памяти session_state
+STATE_MEMORY_DEPTH = 3
+
+
+def _peak_rss_mb():
+    """Пиковое потребление памяти процессом (МБ), None - недоступно"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux - КБ, macOS - байты
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def _current_rss_mb():
+    """Текущее потребление памяти процессом (МБ, Linux), None - недоступно"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / MB
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def frame_bytes(df):
+    """Память таблицы с учетом строк в object-колонках (memory_usage(deep=True))"""
+    if isinstance(df, pd.DataFrame):
+        return int(df.memory_usage(deep=True).sum())
+    if isinstance(df, pd.Series):
+        return int(df.memory_usage(deep=True))
+    return None
+
+
+def _frames_mb(frames):
+    """{имя: DataFrame} → {имя: МБ} (пропуски и не-таблицы не учитываются)"""
+    sizes = {}
+    for name, df in frames.items():
+        size = frame_bytes(df)
+        if size is not None:
+            sizes[str(name)] = round(size / MB, 3)
+    return sizes
+
+
+class StageHandle:
+    """Открытый этап: в него можно записать строки на выходе и попадания в кэш"""
+
+    def __init__(self, name, path, depth, rows_in=None, memory=False):
+        self.name = name
+        self.path = path
+        self.depth = depth
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.cache_hits = 0
+        self.memory = memory
+        self.frames_in_mb = None
+        self.frames_out_mb = None
+
+    def rows(self, rows_out):
+        self.rows_out = rows_out
+
+    def cache_hit(self, count=1):
+        self.cache_hits += count
+
+    def frames_in(self, frames):
+        """Таблицы на входе этапа {имя: DataFrame} - размер считается только в режиме памяти"""
+        if self.memory:
+            self.frames_in_mb = _frames_mb(frames)
+
+    def frames_out(self, frames):
+        """Таблицы на выходе этапа {имя: DataFrame} - размер считается только в режиме памяти"""
+        if self.memory:
+            self.frames_out_mb = _frames_mb(frames)
+
+
+class Profiler:
+    """
+    Профиль одного запуска. Этапы вкладываются:
+        with profiler.stage('План', rows_in=len(base_data)) as stage:
+            ...
+            stage.rows(len(plan_result))
+    """
+
+    def __init__(self, enabled=True, capture=None, memory=False):
+        self.enabled = enabled
+        self.memory = bool(memory) and enabled
+        self.capture = capture if capture in CAPTURE_MODES else None
+        self.capture_text = None
+        self.capture_stats = None
+        self.started_at = datetime.now().isoformat(timespec='seconds')
+        self.records = []
+        self.state_memory = None
+        self.saved_path = None
+        self._stack = []
+        self._origin = time.perf_counter()
+        self._capture_profiler = None
+        self._tracing = False
+
+    def begin(self, name, rows_in=None):
+        """Открывает этап (вложенный в текущий открытый); закрывается end()"""
+        if not self.enabled:
+            return StageHandle(name, name, 0, rows_in)
+        path = '/'.join([handle.name for handle in self._stack] + [name])
+        handle = StageHandle(name, path, len(self._stack), rows_in, self.memory)
+        if self.memory:
+            self._begin_memory(handle)
+        handle.start_offset = time.perf_counter() - self._origin
+        handle.wall_start = time.perf_counter()
+        handle.cpu_start = time.thread_time()
+        handle.peak_start = _peak_rss_mb()
+        self._stack.append(handle)
+        return handle
+
+    def end(self, handle, rows_out=None):
+        """Закрывает этап (и незакрытые вложенные, если этап прерван)"""
+        if not self.enabled or handle not in self._stack:
+            return
+        if rows_out is not None:
+            handle.rows_out = rows_out
+        while self._stack:
+            current = self._stack.pop()
+            peak_end = _peak_rss_mb()
+            record = {
+                'name': current.name,
+                'path': current.path,
+                'depth': current.depth,
+                'start': current.start_offset,
+                'wall': time.perf_counter() - current.wall_start,
+                'cpu': time.thread_time() - current.cpu_start,
+                'rows_in': current.rows_in,
+                'rows_out': current.rows_out,
+                'mem_delta_mb': peak_end - current.peak_start if current.peak_start is not None else None,
+                'cache_hits': current.cache_hits
+            }
+            if self.memory:
+                record.update(self._end_memory(current))
+            self.records.append(record)
+            if current is handle:
+                break
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        handle = self.begin(name, rows_in)
+        try:
+            yield handle
+        finally:
+            self.end(handle)
+
+    def cache_hit(self, name, rows=None):
+        """Этап, результат которого взят из кэша (без расчета)"""
+        with self.stage(name, rows_in=rows) as stage:
+            stage.rows(rows)
+            stage.cache_hit()
+
+    # === РЕЖИМ ПАМЯТИ ===
+
+    def _begin_memory(self, handle):
+        """
+        Отметка памяти в начале этапа. Пик tracemalloc сбрасывается на каждом этапе,
+        поэтому пик, набранный родителем до вложенного этапа, запоминается в родителе.
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        current, peak = tracemalloc.get_traced_memory()
+        if self._stack:
+            self._stack[-1].traced_peak = max(self._stack[-1].traced_peak, peak)
+        tracemalloc.reset_peak()
+        handle.traced_start = current
+        handle.traced_peak = current
+
+    def _end_memory(self, handle):
+        """Поля режима памяти для записи этапа"""
+        current, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+        stage_peak = max(handle.traced_peak, peak)
+        if self._stack:
+            self._stack[-1].traced_peak = max(self._stack[-1].traced_peak, stage_peak)
+        return {
+            'traced_peak_mb': (stage_peak - handle.traced_start) / MB,
+            'traced_delta_mb': (current - handle.traced_start) / MB,
+            'rss_mb': _current_rss_mb(),
+            'frames_in': handle.frames_in_mb,
+            'frames_out': handle.frames_out_mb
+        }
+
+    def stop_memory(self):
+        """Выключает tracemalloc, если его включил этот профилировщик"""
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    def record_state(self, state):
+        """Запоминает память ключей session_state (попадает в JSON профиля)"""
+        self.state_memory = state_memory(state).to_dict('records')
+
+    # === ПОЛНЫЙ ПРОФИЛЬ ЗАПУСКА ===
+
+    def start_capture(self):
+        """Включает cProfile/pyinstrument для текущего потока (если задан capture)"""
+        if self.capture == 'pyinstrument' and pyinstrument is not None:
+            self._capture_profiler = pyinstrument.Profiler()
+            self._capture_profiler.start()
+        elif self.capture is not None:
+            self._capture_profiler = cProfile.Profile()
+            self._capture_profiler.enable()
+
+    def stop_capture(self, limit=60):
+        """Останавливает захват (и tracemalloc режима памяти), текстовый отчет - в capture_text"""
+        self.stop_memory()
+        if self._capture_profiler is None:
+            return None
+        if isinstance(self._capture_profiler, cProfile.Profile):
+            self._capture_profiler.disable()
+            stream = io.StringIO()
+            pstats.Stats(self._capture_profiler, stream=stream).sort_stats('cumulative').print_stats(limit)
+            self.capture_text = stream.getvalue()
+            self.capture_stats = self._capture_profiler
+        else:
+            self._capture_profiler.stop()
+            self.capture_text = self._capture_profiler.output_text(unicode=True, color=False)
+        self._capture_profiler = None
+        return self.capture_text
+
+    def dump_capture(self, path):
+        """Сохраняет cProfile в .prof (для snakeviz/pstats) после stop_capture()"""
+        if self.capture_stats is not None:
+            self.capture_stats.dump_stats(path)
+
+    # === ВЫВОД ===
+
+    @property
+    def has_memory(self):
+        """В записях есть поля режима памяти (в том числе у загруженного профиля)"""
+        return any('traced_peak_mb' in record for record in self.records)
+
+    @property
+    def total_wall(self):
+        return sum(r['wall'] for r in self.records if r['depth'] == 0)
+
+    def sorted_records(self):
+        """Записи в порядке запуска этапов"""
+        return sorted(self.records, key=lambda r: (r['start'], r['depth']))
+
+    def to_frame(self):
+        """Таблица этапов для UI"""
+        memory = self.has_memory
+        rows = []
+        for record in self.sorted_records():
+            row = {
+                'Этап': record['path'],
+                'Уровень': record['depth'],
+                'Время, сек': round(record['wall'], 3),
+                'CPU, сек': round(record['cpu'], 3),
+                'Строк на входе': record['rows_in'],
+                'Строк на выходе': record['rows_out'],
+                'Память +МБ': round(record['mem_delta_mb'], 1) if record['mem_delta_mb'] is not None else None,
+                'Попадания в кэш': record['cache_hits']
+            }
+            if memory:
+                row.update({
+                    'Пик Python +МБ': _round_mb(record.get('traced_peak_mb')),
+                    'Python +МБ': _round_mb(record.get('traced_delta_mb')),
+                    'RSS, МБ': _round_mb(record.get('rss_mb')),
+                    'Таблицы на входе, МБ': _round_mb(sum((record.get('frames_in') or {}).values()) or None),
+                    'Таблицы на выходе, МБ': _round_mb(sum((record.get('frames_out') or {}).values()) or None)
+                })
+            rows.append(row)
+        return pd.DataFrame(rows, columns=PROFILE_COLUMNS + (MEMORY_COLUMNS if memory else []))
+
+    def memory_frame(self):
+        """Таблицы на входе/выходе этапов (режим памяти), крупные первыми"""
+        rows = []
+        for record in self.sorted_records():
+            for direction, key in (('вход', 'frames_in'), ('выход', 'frames_out')):
+                for name, size in (record.get(key) or {}).items():
+                    rows.append({'Этап': record['path'], 'Направление': direction, 'Таблица': name, 'МБ': size})
+        frame = pd.DataFrame(rows, columns=['Этап', 'Направление', 'Таблица', 'МБ'])
+        return frame.sort_values('МБ', ascending=False, ignore_index=True)
+
+    def to_flame_frame(self, root='Расчет'):
+        """
+        Дерево этапов для flame-диаграммы (plotly icicle): id, label, parent, wall.
+        Повторы одного пути суммируются.
+        """
+        if not self.records:
+            return pd.DataFrame(columns=['id', 'label', 'parent', 'wall'])
+        records = pd.DataFrame(self.records)
+        flame = records.groupby('path', as_index=False, sort=False).agg(
+            label=('name', 'first'), wall=('wall', 'sum')
+        ).rename(columns={'path': 'id'})
+        flame['parent'] = flame['id'].map(lambda path: root + '/' + path.rsplit('/', 1)[0] if '/' in path else root)
+        flame['id'] = root + '/' + flame['id']
+        total = max(self.total_wall, flame.loc[flame['parent'] == root, 'wall'].sum())
+        root_row = pd.DataFrame([{'id': root, 'label': root, 'parent': '', 'wall': total}])
+        return pd.concat([root_row, flame[['id', 'label', 'parent', 'wall']]], ignore_index=True)
+
+    def lines(self):
+        """Краткая сводка верхнего уровня (текст для CLI и сообщений)"""
+        lines = [
+            f"[PROFILE] {record['name']}: {record['wall']:.2f} сек"
+            + (" (из кэша)" if record['cache_hits'] else "")
+            for record in self.sorted_records() if record['depth'] == 0
+        ]
+        if self.has_memory:
+            peak = max((record.get('traced_peak_mb') or 0) for record in self.records)
+            lines.append(f"[PROFILE] Пик памяти Python за этап: +{peak:.1f} МБ")
+        lines.append(f"[PROFILE] ВСЕГО: {self.total_wall:.2f} сек")
+        return lines
+
+    def to_dict(self):
+        data = {
+            'started_at': self.started_at,
+            'total_wall': self.total_wall,
+            'records': self.sorted_records()
+        }
+        if self.state_memory is not None:
+            data['state_memory'] = self.state_memory
+        return data
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), ensure_ascii=False, indent=2, default=str)
+
+    def save(self, profile_dir=None, keep=None):
+        """Сохраняет профиль запуска в JSON-файл (старые сверх keep удаляются), возвращает путь"""
+        profile_dir = profile_dir or config.PROFILE_DIR
+        keep = keep if keep is not None else config.PROFILE_KEEP
+        os.makedirs(profile_dir, exist_ok=True)
+        file_name = f"profile_{self.started_at.replace(':', '').replace('-', '')}.json"
+        path = os.path.join(profile_dir, file_name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.to_json())
+        self.saved_path = path
+        for old_path in list_profiles(profile_dir)[keep:]:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+        return path
+
+    @classmethod
+    def from_dict(cls, data):
+        profiler = cls()
+        profiler.started_at = data.get('started_at', profiler.started_at)
+        profiler.records = list(data.get('records', []))
+        profiler.state_memory = data.get('state_memory')
+        return profiler
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            profiler = cls.from_dict(json.load(f))
+        profiler.saved_path = path
+        return profiler
+
+
+def _round_mb(value):
+    return round(value, 1) if value is not None else None
+
+
+def _object_bytes(value, seen, depth=0):
+    """
+    (байты в памяти, байты на диске) объекта: таблицы - memory_usage(deep=True),
+    словари и списки - сумма элементов. Объект, уже посчитанный в seen, не учитывается.
+    """
+    if id(value) in seen:
+        return 0, 0
+    seen.add(id(value))
+    size = frame_bytes(value)
+    if size is not None:
+        return size, 0
+    if depth >= STATE_MEMORY_DEPTH:
+        return sys.getsizeof(value), 0
+    if isinstance(value, Mapping):
+        memory, disk = 0, 0
+        for key in list(value.keys()):
+            item_memory, item_disk = _mapping_item_bytes(value, key, seen, depth + 1)
+            memory += item_memory
+            disk += item_disk
+        return memory, disk
+    if isinstance(value, (list, tuple, set)):
+        memory = 0
+        for item in value:
+            memory += _object_bytes(item, seen, depth + 1)[0]
+        return memory, 0
+    return sys.getsizeof(value), 0
+
+
+def _mapping_item_bytes(mapping, key, seen, depth):
+    """Элемент словаря; таблица, выгруженная на диск (frame_store), не читается"""
+    handle = mapping.handle(key) if hasattr(mapping, 'handle') else None
+    if handle is not None:
+        return 0, handle.nbytes
+    return _object_bytes(mapping[key], seen, depth)
+
+
+def state_memory(state):
+    """
+    Память ключей session_state (и ключей вложенных словарей) - крупные первыми.
+    Таблица, общая для нескольких ключей, считается один раз (у первого ключа).
+    Выгруженные на диск таблицы не читаются, их размер - в колонке «На диске».
+    """
+    seen = set()
+    rows = []
+    for key in list(state.keys()):
+        value = state[key]
+        memory, disk = _object_bytes(value, seen)
+        rows.append({
+            'Ключ': str(key),
+            'Тип': type(value).__name__,
+            'В памяти, МБ': round(memory / MB, 3),
+            'На диске, МБ': round(disk / MB, 3)
+        })
+        # Крупные словари раскрываются по ключам (cleaned_data/портал, visit_report/plan_result ...)
+        if isinstance(value, Mapping) and memory + disk >= MB:
+            item_seen = set()
+            for item_key in list(value.keys()):
+                item_memory, item_disk = _mapping_item_bytes(value, item_key, item_seen, 1)
+                rows.append({
+                    'Ключ': f"{key}/{item_key}",
+                    'Тип': type(value[item_key]).__name__ if item_disk == 0 else 'FrameHandle',
+                    'В памяти, МБ': round(item_memory / MB, 3),
+                    'На диске, МБ': round(item_disk / MB, 3)
+                })
+    frame = pd.DataFrame(rows, columns=STATE_MEMORY_COLUMNS)
+    return frame.sort_values(['В памяти, МБ', 'На диске, МБ'], ascending=False, ignore_index=True)
+
+
+def list_profiles(profile_dir=None):
+    """Сохраненные профили, новые первыми"""
+    profile_dir = profile_dir or config.PROFILE_DIR
+    if not os.path.isdir(profile_dir):
+        return []
+    files = [f for f in os.listdir(profile_dir) if f.startswith('profile_') and f.endswith('.json')]
+    return [os.path.join(profile_dir, f) for f in sorted(files, reverse=True)]
+
+
+def compare_profiles(current, baseline):
+    """Сравнение двух запусков по этапам: время и разница (сек, %)"""
+    def wall_by_path(profiler):
+        return {record['path']: record['wall'] for record in profiler.records}
+
+    current_wall = wall_by_path(current)
+    baseline_wall = wall_by_path(baseline)
+    rows = []
+    for path in sorted(set(current_wall) | set(baseline_wall)):
+        now = current_wall.get(path)
+        before = baseline_wall.get(path)
+        delta = now - before if now is not None and before is not None else None
+        rows.append({
+            'Этап': path,
+            'Было, сек': round(before, 3) if before is not None else None,
+            'Стало, сек': round(now, 3) if now is not None else None,
+            'Разница, сек': round(delta, 3) if delta is not None else None,
+            'Разница, %': round(delta / before * 100, 1) if delta is not None and before else None
+        })
+    return pd.DataFrame(rows)
+
+
+# Выключенный профилировщик по умолчанию (для вызовов вне пайплайна)
+NULL_PROFILER = Profiler(enabled=False)
@@ -0,0 +1,104 @@
+# result_cache.py
+# draft 4.1 - simplified
+"""
+Общий для всех сессий кэш результатов расчета план/факт.
+Ключ - отпечатки входных файлов + настроек/корректировок + период и коэффициенты,
+поэтому одинаковые загрузки разных пользователей считаются один раз.
+Таблицы результата общие для сессий и используются только для чтения.
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from config import config
+
+
+def estimate_bytes(obj, seen=None):
+    """
+    Оценка памяти результата: DataFrame/Series, массивы NumPy и объекты с memory_bytes()
+    (кубы, геометрия этапов) внутри словарей, списков и кортежей. Объект, на который
+    ссылаются несколько раз (источники и cleaned_data), считается один раз.
+    """
+    if seen is None:
+        seen = set()
+    if obj is None or id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(index=True, deep=True).sum())
+    if isinstance(obj, pd.Series):
+        return int(obj.memory_usage(index=True, deep=True))
+    if isinstance(obj, np.ndarray):
+        return int(obj.nbytes)
+    if hasattr(obj, 'memory_bytes'):
+        return int(obj.memory_bytes())
+    if isinstance(obj, dict):
+        return sum(estimate_bytes(value, seen) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(estimate_bytes(value, seen) for value in obj)
+    return 0
+
+
+class ResultCache:
+    """LRU-кэш с ограничением по памяти (байты) и счетчиками попаданий"""
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes if max_bytes is not None else config.RESULT_CACHE_MB * 1024 * 1024
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes_held = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Результат по ключу (None - нет в кэше)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, result):
+        """Кладет результат в кэш, вытесняя давно не используемые записи"""
+        size = estimate_bytes(result)
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            if key in self._entries:
+                self.bytes_held -= self._entries.pop(key)[1]
+            while self._entries and self.bytes_held + size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.bytes_held -= evicted_size
+                self.evictions += 1
+            self._entries[key] = (result, size)
+            self.bytes_held += size
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes_held = 0
+
+    def stats(self):
+        """Метрики кэша для сайдбара"""
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes_held': self.bytes_held,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0.0,
+                'evictions': self.evictions
+            }
+
+
+# Глобальный экземпляр на процесс (общий для всех сессий Streamlit)
+result_cache = ResultCache()
@@ -0,0 +1,164 @@
+# rollup_cube.py
+# draft 4.1 - simplified
+"""
+OLAP-куб отчетов план/факт по иерархии Проект→Клиент→Волна→Регион→DSM→ASM→RS (+ ПО).
+Строится один раз на расчет по calculated_data (compute_core.calculate_plan_fact).
+Аддитивные меры (план, факт, факт на дату, порученные, не порученные, оплаты)
+суммируются, атрибуты волны (даты, методы, Фокус) берутся первым значением,
+как в сводных таблицах вкладок. Средние и проценты считаются вкладками
+после чтения среза.
+
+Срез (набор уровней) считается один раз и хранится в кубе: повторная
+детализация вкладки - чтение готовой таблицы. Отчеты по умолчанию (только
+клиент, регион или DSM) готовы сразу после расчета. Куб сохраняется
+в снимок результата (to_frame / from_frame).
+"""
+import numpy as np
+import pandas as pd
+
+# Уровни куба (в этом порядке хранятся ключи срезов)
+DIMENSIONS = ['Проект', 'Клиент', 'Волна', 'Регион', 'Регион short', 'DSM', 'ASM', 'RS', 'ПО']
+# Первый уровень вкладок отчетов (ПФ проекты, Регионы, DSM) - готовы сразу
+DEFAULT_LEVELS = [['Клиент'], ['Регион'], ['DSM']]
+
+# Агрегация колонок в сводных таблицах вкладок: sum - меры, first - атрибуты
+AGGREGATIONS = {
+    'План проекта, шт.': 'sum',
+    'План на дату, шт.': 'sum',
+    'Факт проекта, шт.': 'sum',
+    'Факт на дату, шт.': 'sum',
+    'Длительность': 'first',
+    'Дата старта': 'first',
+    'Дата финиша': 'first',
+    'Дата старта_гугл': 'first',
+    'Дата финиша_гугл': 'first',
+    'Коэффициент месяца': 'first',
+    'Метод подбора дат': 'first',
+    'Дней до конца проекта': 'first',
+    'Прогноз, шт.': 'sum',
+    'Утилизация тайминга, %': 'first',
+    'Ср. план на день для 100% плана': 'sum',
+    'Фокус': 'first',
+    'Оплата план': 'sum',
+    'plan_payment_per_visit': 'first',
+    'Оплата факт': 'sum',
+    'Оплата_поручено': 'sum',
+    'Факт проекта_поручено, шт.': 'sum',
+    'Факт проекта_не_поручено, шт.': 'sum',
+    'Оплата план средн., руб.': 'first',
+    'Оплата факт средн., руб.': 'first',
+    'Оплата план-факт средн., руб.': 'first',
+    'Оплата факт/план средн., %': 'first',
+    'Оплата средн. в динамике, руб.': 'first',
+    'Оплата средн. прогноз, руб.': 'first',
+}
+
+# Ключ волны для Фокуса
+WAVE_KEYS = ['Проект', 'Клиент', 'Волна']
+TIMING_COL = 'Утилизация тайминга, %'
+# Колонка уровней среза в сохраненном кубе ('*' - исходные строки)
+LEVELS_COL = '_Уровни'
+BASE_LEVELS = '*'
+
+
+def wave_focus(data):
+    """
+    Фокус волны ('Да'/'Нет') для каждой строки: план/факт волны < 80%
+    и утилизация тайминга (первая строка волны) строго между 80 и 100.
+    """
+    grouped = data.groupby(WAVE_KEYS, sort=False)
+    plan = grouped['План проекта, шт.'].transform('sum')
+    fact = grouped['Факт проекта, шт.'].transform('sum')
+    plan_vs_fact = (fact / plan.where(plan > 0) * 100).fillna(0)
+
+    if TIMING_COL in data.columns:
+        group_ids = grouped.ngroup().to_numpy()
+        in_group = group_ids >= 0
+        first_rows = pd.Series(np.arange(len(data))[in_group]).groupby(group_ids[in_group]).min()
+        timing = np.full(len(data), np.nan)
+        timing[in_group] = data[TIMING_COL].to_numpy(dtype=float)[first_rows.to_numpy()][group_ids[in_group]]
+    else:
+        timing = np.zeros(len(data))
+
+    is_focus = (plan_vs_fact.to_numpy() < 80) & (timing > 80) & (timing < 100)
+    return pd.Series(np.where(is_focus, 'Да', 'Нет'), index=data.index)
+
+
+def aggregations(columns):
+    """AGGREGATIONS для колонок, которые есть в таблице"""
+    return {col: how for col, how in AGGREGATIONS.items() if col in columns}
+
+
+def rollup(data, levels):
+    """Сводная таблица вкладки: Фокус по волнам, затем группировка по levels"""
+    data = data.assign(**{'Фокус': wave_focus(data)})
+    return data.groupby(list(levels)).agg(aggregations(data.columns)).reset_index()
+
+
+class RollupCube:
+    """Срезы сводных таблиц отчетов по набору уровней"""
+
+    def __init__(self, data, materialize=True):
+        self.dimensions = [col for col in DIMENSIONS if col in data.columns]
+        columns = self.dimensions + [col for col in AGGREGATIONS if col in data.columns and col != 'Фокус']
+        self.base = data[columns].copy()
+        self.base['Фокус'] = wave_focus(self.base)
+        self.aggregations = aggregations(self.base.columns)
+        # frozenset(уровни) → срез с ключом в порядке DIMENSIONS
+        self.cuboids = {}
+        if materialize:
+            for levels in DEFAULT_LEVELS:
+                if all(level in self.dimensions for level in levels):
+                    self._cuboid(levels)
+
+    def __len__(self):
+        return len(self.base)
+
+    def memory_bytes(self):
+        """Память исходных строк и готовых срезов (memory_usage(deep=True))"""
+        frames = [self.base] + list(self.cuboids.values())
+        return int(sum(frame.memory_usage(index=True, deep=True).sum() for frame in frames))
+
+    def _canonical(self, levels):
+        return [col for col in self.dimensions if col in levels]
+
+    def _cuboid(self, levels):
+        key = frozenset(levels)
+        if key not in self.cuboids:
+            self.cuboids[key] = self.base.groupby(self._canonical(levels)).agg(self.aggregations)
+        return self.cuboids[key]
+
+    def slice(self, levels, data=None):
+        """
+        Сводная таблица по levels (порядок колонок и сортировка - как groupby(levels)).
+        data - отфильтрованные строки отчета: срез считается по ним и не сохраняется.
+        """
+        levels = list(levels)
+        if data is not None or not all(level in self.dimensions for level in levels):
+            return rollup(self.base if data is None else data, levels)
+        cuboid = self._cuboid(levels)
+        if len(levels) > 1:
+            cuboid = cuboid.reorder_levels(levels).sort_index()
+        return cuboid.reset_index()
+
+    # ============================================
+    # СОХРАНЕНИЕ
+    # ============================================
+
+    def to_frame(self):
+        """Куб одной таблицей: исходные строки и готовые срезы, колонка LEVELS_COL - уровни среза"""
+        parts = [self.base.assign(**{LEVELS_COL: BASE_LEVELS})]
+        for key, cuboid in self.cuboids.items():
+            levels = self._canonical(key)
+            parts.append(cuboid.reset_index().assign(**{LEVELS_COL: '|'.join(levels)}))
+        return pd.concat(parts, ignore_index=True)
+
+    @classmethod
+    def from_frame(cls, frame):
+        """Куб из таблицы to_frame (срезы не пересчитываются)"""
+        is_base = frame[LEVELS_COL] == BASE_LEVELS
+        cube = cls(frame.loc[is_base].drop(columns=LEVELS_COL).reset_index(drop=True), materialize=False)
+        for levels_key, part in frame.loc[~is_base].groupby(LEVELS_COL, sort=False):
+            levels = levels_key.split('|')
+            cube.cuboids[frozenset(levels)] = part[levels + list(cube.aggregations)].set_index(levels)
+        return cube
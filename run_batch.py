@@ -0,0 +1,197 @@
+# run_batch.py
+# draft 4.1 - simplified
+"""
+Пакетный расчет план/факт без веб-интерфейса (cron, воркер).
+
+Пример:
+    python run_batch.py ./input --start 2026-07-01 --end 2026-07-15 --output calculated_data.parquet
+    python run_batch.py ./input --start 2026-07-01 --end 2026-09-30 --split month --output quarter.parquet
+    python run_batch.py ./input --start 2026-07-01 --end 2026-07-31 --split week --check
+    python run_batch.py ./input --start 2026-07-01 --end 2026-07-15 --profile-json profile.json --cprofile run.prof
+    python run_batch.py ./input --start 2026-07-01 --end 2026-07-15 --profile-json profile.json --memory
+
+Файлы источников в папке распознаются по имени (сервизория/проекты, портал/массив,
+cxway, easymerch, optima, prodata, bdr). Настройки берутся из JSON-файлов
+в --settings-dir (по умолчанию - папка приложения).
+"""
+import argparse
+import os
+import sys
+from datetime import date
+
+from compute_core import (
+    load_source_folder, load_settings_from_folder, normalize_stage_weights, run_pipeline,
+    split_periods, calculate_periods, check_period_parity
+)
+from snapshot_store import SnapshotStore, input_fingerprints, settings_fingerprint
+from profiler import Profiler
+
+
+def _parse_date(value):
+    return date.fromisoformat(value)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Пакетный расчет план/факт полевых визитов")
+    parser.add_argument('input_dir', help="Папка с файлами источников")
+    parser.add_argument('--start', required=True, type=_parse_date, help="Дата начала периода (YYYY-MM-DD)")
+    parser.add_argument('--end', required=True, type=_parse_date, help="Дата окончания периода (YYYY-MM-DD)")
+    parser.add_argument('--weights', nargs=4, type=float, default=[0.8, 1.2, 1.0, 0.9],
+                        help="Веса 4 этапов (как ползунки в сайдбаре)")
+    parser.add_argument('--settings-dir', default=os.path.dirname(os.path.abspath(__file__)),
+                        help="Папка с JSON-настройками (projects_settings.json, multon_plan.json, ...)")
+    parser.add_argument('--output', default='calculated_data.parquet',
+                        help="Файл результата: .parquet или .xlsx")
+    parser.add_argument('--log', default=None, help="Файл для диагностики расчета")
+    parser.add_argument('--split', choices=['month', 'week'], default=None,
+                        help="Посчитать по периодам (месяцы/недели) за один запуск; колонка 'Период' в результате")
+    parser.add_argument('--check', action='store_true',
+                        help="Сверить пакетный расчет по периодам с обычным расчетом каждого периода (без сохранения)")
+    parser.add_argument('--snapshot', action='store_true',
+                        help="Сохранить снимок результата (его можно открыть в приложении)")
+    parser.add_argument('--profile-json', default=None,
+                        help="Файл для профиля этапов (JSON, для сравнения запусков)")
+    parser.add_argument('--cprofile', default=None,
+                        help="Полный cProfile запуска в файл .prof (snakeviz, pstats)")
+    parser.add_argument('--memory', action='store_true',
+                        help="Режим памяти: пик tracemalloc, RSS и размер таблиц по этапам (в --profile-json)")
+    return parser
+
+
+def report_profile(args, profiler):
+    """Время по этапам в консоль, профиль в JSON и cProfile (если заданы)"""
+    profiler.stop_capture()
+    for line in profiler.lines():
+        print(line)
+    if profiler.has_memory:
+        print(profiler.memory_frame().head(10).to_string(index=False))
+    if args.profile_json:
+        with open(args.profile_json, 'w', encoding='utf-8') as f:
+            f.write(profiler.to_json())
+    if args.cprofile:
+        profiler.dump_capture(args.cprofile)
+
+
+def save_result(df, path):
+    """Сохраняет calculated_data в Parquet или Excel (по расширению)"""
+    if path.lower().endswith('.xlsx'):
+        df.to_excel(path, sheet_name='calculated_data', index=False)
+    else:
+        df.to_parquet(path, index=False, compression='zstd')
+
+
+def run_periods(args, uploaded_files, excluded_df, included_df, plan_sources, profiler):
+    """Многопериодный расчет (--split): результат с колонкой 'Период'"""
+    periods = split_periods(args.start, args.end, args.split)
+    print(f"📅 Периодов: {len(periods)}")
+    
+    result = calculate_periods(
+        uploaded_files, periods, normalize_stage_weights(args.weights),
+        excluded_df, included_df, plan_sources, profiler=profiler
+    )
+    report_profile(args, profiler)
+    if result is None:
+        print("❌ Нужны файл Сервизории и хотя бы один источник визитов", file=sys.stderr)
+        return 1
+    
+    if args.log:
+        with open(args.log, 'w', encoding='utf-8') as f:
+            f.write(result['diagnostics'].to_text())
+    
+    calculated_data = result['calculated_data']
+    if calculated_data.empty:
+        print("❌ Расчет не дал результатов", file=sys.stderr)
+        return 1
+    
+    calculated_data = calculated_data.reset_index(level='Период').reset_index(drop=True)
+    save_result(calculated_data, args.output)
+    print(f"✅ Сохранено {len(calculated_data)} строк ({calculated_data['Период'].nunique()} периодов): {args.output}")
+    return 0
+
+
+def run_check(args, uploaded_files, excluded_df, included_df, plan_sources):
+    """Сверка (--check): периоды --split (или весь период) пакетом и по одному"""
+    periods = split_periods(args.start, args.end, args.split) if args.split else [(args.start, args.end)]
+    mismatches = check_period_parity(
+        uploaded_files, periods, normalize_stage_weights(args.weights), excluded_df, included_df, plan_sources
+    )
+    if not mismatches.empty:
+        print(mismatches.to_string(index=False))
+        print(f"❌ Расхождений: {len(mismatches)}")
+        return 1
+    print(f"✅ Пакетный расчет совпадает с обычным, периодов: {len(periods)}")
+    return 0
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    if args.end < args.start:
+        print("❌ Дата окончания раньше даты начала", file=sys.stderr)
+        return 2
+
+    if args.split is None and args.start.month != args.end.month:
+        print("❌ Период должен быть в пределах одного месяца", file=sys.stderr)
+        return 2
+
+    calc_params = {
+        'start_date': args.start,
+        'end_date': args.end,
+        'coefficients': normalize_stage_weights(args.weights)
+    }
+
+    uploaded_files, skipped = load_source_folder(args.input_dir)
+    for file_name in skipped:
+        print(f"⚠️ Пропущен файл: {file_name}")
+    print(f"📥 Источники: {', '.join(sorted(uploaded_files)) or 'нет'}")
+
+    excluded_df, included_df, plan_sources = load_settings_from_folder(args.settings_dir)
+    if args.check:
+        return run_check(args, uploaded_files, excluded_df, included_df, plan_sources)
+
+    profiler = Profiler(capture='cprofile' if args.cprofile else None, memory=args.memory)
+    profiler.start_capture()
+    if args.split:
+        return run_periods(args, uploaded_files, excluded_df, included_df, plan_sources, profiler)
+
+    result = run_pipeline(uploaded_files, calc_params, excluded_df, included_df, plan_sources, profiler=profiler)
+    report_profile(args, profiler)
+    if result is None:
+        print("❌ Нужны файл Сервизории и хотя бы один источник визитов", file=sys.stderr)
+        return 1
+
+    diagnostics = result['diagnostics']
+    if args.log:
+        with open(args.log, 'w', encoding='utf-8') as f:
+            f.write(diagnostics.to_text())
+
+    calculated_data = result['visit_report'].get('calculated_data')
+    if calculated_data is None or calculated_data.empty:
+        print("❌ Расчет не дал результатов", file=sys.stderr)
+        return 1
+
+    save_result(calculated_data, args.output)
+    print(f"✅ Сохранено {len(calculated_data)} строк: {args.output}")
+
+    if args.snapshot:
+        fingerprints = input_fingerprints(uploaded_files)
+        fingerprints['настройки'] = settings_fingerprint(excluded_df, included_df, plan_sources)
+        cleaned_data = result['cleaned_data']
+        frames = {
+            'base_data': result['visit_report'].get('base_data'),
+            'calculated_data': calculated_data,
+            'полевые_проекты': cleaned_data.get('полевые_проекты'),
+            'prodata_processed': cleaned_data.get('prodata_processed'),
+            'rollup_cube': result['visit_report']['rollup_cube'].to_frame()
+        }
+        meta = SnapshotStore().save(frames, fingerprints, calc_params, source='cli')
+        print(f"📂 Снимок: {meta['id']}")
+
+    not_found = result['not_found_projects']
+    if not_found is not None and not not_found.empty:
+        print(f"⚠️ Не найдено добавленных проектов: {len(not_found)}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
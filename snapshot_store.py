@@ -0,0 +1,201 @@
+# snapshot_store.py
+# draft 4.1 - simplified
+"""
+Снимки результатов расчета план/факт.
+Каждый снимок - папка со сжатыми Parquet-файлами и meta.json.
+Ключ снимка = (отпечатки входных файлов, период, коэффициенты этапов),
+поэтому одинаковый расчет не сохраняется дважды.
+"""
+import hashlib
+import json
+import os
+import shutil
+from datetime import date, datetime
+
+import pandas as pd
+
+from config import config
+
+# Таблицы снимка: имя файла → описание
+SNAPSHOT_FRAMES = {
+    'base_data': 'Иерархия',
+    'calculated_data': 'Итог план/факт',
+    'полевые_проекты': 'Визиты полевых проектов',
+    'prodata_processed': 'ПроДата',
+    'rollup_cube': 'OLAP-куб отчетов'
+}
+
+META_FILE = 'meta.json'
+
+
+# ============================================
+# ОТПЕЧАТКИ
+# ============================================
+
+def frame_fingerprint(df):
+    """Отпечаток содержимого DataFrame (значения + колонки)"""
+    if df is None:
+        return 'none'
+    digest = hashlib.sha1()
+    digest.update('|'.join(map(str, df.columns)).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+def input_fingerprints(uploaded_files):
+    """Отпечатки всех загруженных файлов {источник: отпечаток}"""
+    return {name: frame_fingerprint(df) for name, df in sorted(uploaded_files.items())}
+
+
+def settings_fingerprint(excluded_df, included_df, plan_sources):
+    """Отпечаток настроек проектов и плановых справочников (влияют на результат)"""
+    digest = hashlib.sha1()
+    for df in (excluded_df, included_df):
+        digest.update(frame_fingerprint(df).encode('utf-8'))
+    for name, value in sorted((plan_sources or {}).items()):
+        digest.update(name.encode('utf-8'))
+        parts = value if isinstance(value, tuple) else (value,)
+        for part in parts:
+            if isinstance(part, pd.DataFrame):
+                digest.update(frame_fingerprint(part).encode('utf-8'))
+            else:
+                digest.update(json.dumps(part, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def snapshot_key(fingerprints, calc_params):
+    """Ключ снимка по входным данным, периоду и коэффициентам этапов"""
+    payload = {
+        'inputs': fingerprints,
+        'start_date': str(calc_params.get('start_date')),
+        'end_date': str(calc_params.get('end_date')),
+        'coefficients': [round(c, 6) for c in calc_params.get('coefficients', [])]
+    }
+    return hashlib.sha1(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# ============================================
+# PARQUET
+# ============================================
+
+def _write_parquet(df, path):
+    """Parquet (zstd); смешанные типы в текстовых колонках приводятся к строкам"""
+    try:
+        df.to_parquet(path, index=False, compression='zstd')
+    except Exception:
+        df = df.copy()
+        for col in df.columns:
+            if df[col].dtype == 'object':
+                df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+        df.to_parquet(path, index=False, compression='zstd')
+
+
+class SnapshotStore:
+    """Хранилище снимков результатов в локальной папке"""
+
+    def __init__(self, root_dir=None, keep=None):
+        self.root_dir = root_dir or config.SNAPSHOT_DIR
+        self.keep = keep if keep is not None else config.SNAPSHOT_KEEP
+
+    def _snapshot_dir(self, snapshot_id):
+        return os.path.join(self.root_dir, snapshot_id)
+
+    def list_snapshots(self) -> list:
+        """Метаданные всех снимков, новые первыми"""
+        if not os.path.isdir(self.root_dir):
+            return []
+        snapshots = []
+        for snapshot_id in os.listdir(self.root_dir):
+            if snapshot_id.endswith('.tmp'):
+                continue
+            meta_path = os.path.join(self._snapshot_dir(snapshot_id), META_FILE)
+            if not os.path.exists(meta_path):
+                continue
+            try:
+                with open(meta_path, encoding='utf-8') as f:
+                    snapshots.append(json.load(f))
+            except Exception:
+                continue
+        return sorted(snapshots, key=lambda m: m.get('created_at', ''), reverse=True)
+
+    def find(self, key):
+        """Метаданные снимка по ключу (None - не найден)"""
+        for meta in self.list_snapshots():
+            if meta.get('key') == key:
+                return meta
+        return None
+
+    def save(self, frames, fingerprints, calc_params, source='app'):
+        """
+        Сохраняет таблицы снимка. Если снимок с таким ключом уже есть -
+        возвращает его без перезаписи.
+        """
+        key = snapshot_key(fingerprints, calc_params)
+        existing = self.find(key)
+        if existing is not None:
+            return existing
+
+        created_at = datetime.now()
+        snapshot_id = f"{created_at.strftime('%Y%m%d_%H%M%S')}_{key[:12]}"
+        tmp_dir = self._snapshot_dir(snapshot_id + '.tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        rows = {}
+        for name in SNAPSHOT_FRAMES:
+            df = frames.get(name)
+            if df is None or df.empty:
+                continue
+            _write_parquet(df, os.path.join(tmp_dir, f"{name}.parquet"))
+            rows[name] = len(df)
+
+        meta = {
+            'id': snapshot_id,
+            'key': key,
+            'created_at': created_at.isoformat(),
+            'source': source,
+            'start_date': str(calc_params.get('start_date')),
+            'end_date': str(calc_params.get('end_date')),
+            'coefficients': list(calc_params.get('coefficients', [])),
+            'inputs': fingerprints,
+            'rows': rows
+        }
+        with open(os.path.join(tmp_dir, META_FILE), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+
+        # Папка появляется целиком - незаконченный снимок не виден читателям
+        os.replace(tmp_dir, self._snapshot_dir(snapshot_id))
+        self._cleanup()
+        return meta
+
+    def load(self, snapshot_id):
+        """Загружает снимок: (таблицы, метаданные)"""
+        snapshot_dir = self._snapshot_dir(snapshot_id)
+        with open(os.path.join(snapshot_dir, META_FILE), encoding='utf-8') as f:
+            meta = json.load(f)
+        frames = {}
+        for name in meta.get('rows', {}):
+            path = os.path.join(snapshot_dir, f"{name}.parquet")
+            if os.path.exists(path):
+                frames[name] = pd.read_parquet(path)
+        return frames, meta
+
+    def load_latest(self):
+        """Последний снимок: (таблицы, метаданные) или (None, None)"""
+        snapshots = self.list_snapshots()
+        if not snapshots:
+            return None, None
+        return self.load(snapshots[0]['id'])
+
+    def _cleanup(self):
+        """Удаляет старые снимки сверх лимита"""
+        for meta in self.list_snapshots()[self.keep:]:
+            shutil.rmtree(self._snapshot_dir(meta['id']), ignore_errors=True)
+
+
+def snapshot_calc_params(meta):
+    """Параметры расчета из метаданных снимка"""
+    return {
+        'start_date': date.fromisoformat(meta['start_date']),
+        'end_date': date.fromisoformat(meta['end_date']),
+        'coefficients': meta.get('coefficients', [0.25, 0.25, 0.25, 0.25])
+    }
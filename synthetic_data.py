@@ -0,0 +1,619 @@
+# synthetic_data.py
+# draft 4.1 - simplified
+"""
+Генератор синтетических данных для расчета план/факт (без боевых файлов).
+Пишет Сервизорию, портал (Checker, колонки Total sum for payment*), CXWAY,
+Easymerch, Optima, ПроДата и БДР с согласованными кодами проектов (составные
+коды через '/', Семпл/Пилот/Мультикод), регионами, иерархией ЗОД → АСС → ЭМ
+и статусами - от 1 тыс. до 5 млн визитов, в xlsx, CSV или Parquet.
+В папку settings пишутся плановые справочники (Мултон, Мультибренд, RS Optima,
+корректировки, коэффициенты регионов, настройки проектов), поэтому полный
+расчет запускается без GitHub:
+
+    python synthetic_data.py ./data/synthetic --visits 100000 --format parquet --start 2026-07-01 --end 2026-07-15
+    python run_batch.py ./data/synthetic --start 2026-07-01 --end 2026-07-15 --settings-dir ./data/synthetic/settings
+
+Одинаковые параметры и seed дают одинаковые файлы.
+"""
+import argparse
+import csv
+import json
+import os
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from compute_core import SETTINGS_FILES
+from data_cleaner import REGION_MAPPING, ZOD_MAPPING
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+SYNTHETIC_FORMATS = ('xlsx', 'csv', 'parquet')
+
+# Строк на листе Excel (без заголовка)
+EXCEL_MAX_ROWS = 1048575
+
+# Доля визитов по источникам
+SOURCE_SHARES = {
+    'портал': 0.45,
+    'cxway': 0.25,
+    'easymerch': 0.10,
+    'optima': 0.12,
+    'prodata': 0.08
+}
+
+# Имена файлов (распознаются compute_core.detect_source_name)
+SOURCE_FILE_NAMES = {
+    'сервизория': 'servizoria',
+    'портал': 'checker',
+    'cxway': 'cxway',
+    'easymerch': 'easymerch',
+    'optima': 'optima',
+    'prodata': 'prodata',
+    'bdr': 'bdr'
+}
+
+# ПО проекта в Сервизории по источнику визитов
+GOOGLE_PORTALS = {
+    'портал': 'Чеккер',
+    'cxway': 'CXWAY',
+    'easymerch': 'Easymerch',
+    'optima': 'Оптима',
+    'prodata': 'Мониторинги'
+}
+
+# Статусы визитов по источникам: {статус: доля}
+STATUS_WEIGHTS = {
+    'портал': {'Выполнено': 0.45, 'Проверена': 0.15, 'Принята': 0.1, 'Поручено': 0.15, 'Не поручено': 0.1,
+               'Удалено': 0.05},
+    'cxway': {'Готово': 0.5, 'Завершено': 0.15, 'Поручено': 0.2, 'Не поручено': 0.1, 'Удалено': 0.05},
+    'easymerch': {'Выполнено': 0.6, 'Поручено': 0.25, 'Не поручено': 0.15},
+    'optima': {'Заполнена': 0.55, 'Проверена': 0.15, 'Поручено': 0.2, 'Не поручено': 0.1},
+    'prodata': {'Выполнено': 0.85, 'Поручено': 0.15}
+}
+
+# Неуникальные коды (один код у разных клиентов)
+NON_UNIQUE_CODES = ['Семпл', 'Пилот', 'Мультикод']
+
+# Веса регионов (остальные - 1)
+REGION_WEIGHTS = {'MC': 8, 'MS': 4, 'LN': 4, 'KD': 2, 'SV': 2, 'NZ': 2, 'TT': 2, 'RO': 2}
+
+RS_SURNAMES = [
+    'Иванова', 'Петрова', 'Смирнова', 'Кузнецова', 'Попова', 'Васильева', 'Соколова', 'Михайлова',
+    'Новикова', 'Федорова', 'Морозова', 'Волкова', 'Алексеева', 'Лебедева', 'Семенова', 'Егорова',
+    'Павлова', 'Козлова', 'Степанова', 'Николаева'
+]
+RS_NAMES = ['Анна', 'Мария', 'Елена', 'Ольга', 'Наталья', 'Ирина', 'Татьяна', 'Светлана', 'Юлия', 'Дарья']
+
+MONITORING_TYPES = ['Цены', 'Выкладка', 'Наличие', 'Промо']
+MULTIBRAND_WAVES = ['Дилеры', 'Пронто', 'Пронто М', 'Нерезультативные_Пронто_Дилеры']
+
+PAYMENT_RATES = [350.0, 450.0, 650.0, 800.0, 1200.0]
+
+
+# ============================================
+# ПРОЕКТЫ И ИЕРАРХИЯ
+# ============================================
+
+def _period(start, end):
+    """Период расчета (по умолчанию - текущий месяц)"""
+    today = date.today()
+    start = start or today.replace(day=1)
+    end = end or (pd.Timestamp(start) + pd.offsets.MonthEnd(0)).date()
+    return pd.Timestamp(start), pd.Timestamp(end)
+
+
+def build_staff(rng):
+    """Регионы → АСС (из ZOD_MAPPING, чтобы заполнялся ЗОД) и 1-3 ЭМ на регион"""
+    regions = sorted(REGION_MAPPING)
+    asms = list(ZOD_MAPPING)
+    rs_pool = [f"{surname} {name}" for surname in RS_SURNAMES for name in RS_NAMES]
+    rng.shuffle(rs_pool)
+
+    region_asm = {}
+    region_rs = {}
+    cursor = 0
+    for number, region in enumerate(regions):
+        region_asm[region] = asms[number % len(asms)]
+        count = int(rng.integers(1, 4))
+        region_rs[region] = [rs_pool[(cursor + k) % len(rs_pool)] for k in range(count)]
+        cursor += count
+    return regions, region_asm, region_rs
+
+
+def _project_code(number, rng, year):
+    """Полевой код проекта вида RU00.381.02.03SVZ26"""
+    country = int(rng.integers(0, 5))
+    direction = int(rng.integers(1, 3))
+    wave = int(rng.integers(1, 10))
+    return f"RU0{country}.{number + 100:03d}.0{direction}.0{wave}SVZ{year}"
+
+
+def build_projects(visits, period_start, rng, regions):
+    """
+    Проекты со всеми атрибутами: источник, клиент, волна, код, ПО в Сервизории,
+    даты, регионы, вес (доля визитов) и квота (для мониторингов).
+    """
+    n_projects = int(np.clip(visits // 150, 30, 30000))
+    n_clients = max(10, n_projects // 3)
+    month = period_start.strftime('%Y.%m')
+    year = period_start.strftime('%y')
+
+    region_weights = np.array([REGION_WEIGHTS.get(region, 1) for region in regions], dtype=float)
+    region_weights /= region_weights.sum()
+
+    sources = list(SOURCE_SHARES)
+    shares = np.array(list(SOURCE_SHARES.values()))
+    source_numbers = rng.choice(len(sources), size=n_projects, p=shares / shares.sum())
+
+    def project_dates():
+        start = period_start + timedelta(days=int(rng.integers(-60, 11)))
+        finish = max(start + timedelta(days=7), period_start + timedelta(days=int(rng.integers(10, 76))))
+        return start, finish
+
+    def project_regions(limit=12):
+        count = int(rng.integers(1, limit + 1))
+        return list(rng.choice(regions, size=count, replace=False, p=region_weights))
+
+    projects = []
+    for number in range(n_projects):
+        source = sources[source_numbers[number]]
+        code = _project_code(number, rng, year)
+        roll = rng.random()
+        if source in ('портал', 'cxway') and roll < 0.03:
+            code = NON_UNIQUE_CODES[number % len(NON_UNIQUE_CODES)]
+        elif roll < 0.08:
+            # Составной код: визиты и Сервизория с двумя кодами через '/'
+            code = f"{code}/{_project_code(number + n_projects, rng, year)}"
+
+        if source == 'prodata':
+            client = f"Мониторинг {number % n_clients + 1:04d}"
+            wave = 'Все волны'
+        else:
+            client = f"Клиент {number % n_clients + 1:04d}"
+            wave = month if rng.random() < 0.6 else f"{month}_{int(rng.integers(1, 4))}"
+
+        start, finish = project_dates()
+        files = [source]
+        google_portal = GOOGLE_PORTALS[source]
+        # Часть проектов CXWAY дублируется в портале (проект в Сервизории отмечен как Чеккер)
+        if source == 'cxway' and rng.random() < 0.03 and code not in NON_UNIQUE_CODES:
+            files.append('портал')
+            google_portal = 'Чеккер'
+
+        projects.append({
+            'source': source,
+            'files': files,
+            'client': client,
+            'wave': wave,
+            'code': code,
+            'portal': google_portal,
+            'start': start,
+            'finish': finish,
+            'regions': project_regions(),
+            'weight': float(rng.pareto(1.5) + 1),
+            'quota': float(rng.integers(50, 500)) if source == 'prodata' else None
+        })
+
+    # Мултон (Easymerch, план из JSON): волна пустая, ПО клиента
+    for number in range(3):
+        start, finish = project_dates()
+        projects.append({
+            'source': 'easymerch', 'files': ['easymerch'], 'client': 'Мултон', 'wave': '',
+            'code': _project_code(n_projects * 2 + number, rng, year), 'portal': 'ПО клиента',
+            'start': start, 'finish': finish, 'regions': project_regions(8),
+            'weight': 3.0, 'quota': None
+        })
+
+    # Мультибренд 2024 (CXWAY, план из JSON по типу волны)
+    multibrand_regions = project_regions(10)
+    for number, wave_type in enumerate(MULTIBRAND_WAVES):
+        start, finish = project_dates()
+        projects.append({
+            'source': 'cxway', 'files': ['cxway'], 'client': 'Мультибренд 2024', 'wave': f"{month}_{wave_type}",
+            'code': _project_code(n_projects * 2 + 10 + number, rng, year), 'portal': 'CXWAY',
+            'start': start, 'finish': finish, 'regions': multibrand_regions,
+            'weight': 2.0, 'quota': None
+        })
+
+    return projects
+
+
+# ============================================
+# ВИЗИТЫ
+# ============================================
+
+def sample_visits(projects, source, count, period_start, period_end, rng, region_rs):
+    """
+    Визиты источника (векторно): проект по весу, регион из регионов проекта,
+    ЭМ из ЭМ региона, дата около периода, статус по долям источника.
+    Возвращает словарь массивов (проект, регион, ЭМ, дата, статус).
+    """
+    candidates = [project for project in projects if source in project['files']]
+    if not candidates or count <= 0:
+        return None
+
+    weights = np.array([project['weight'] for project in candidates])
+    project_idx = rng.choice(len(candidates), size=count, p=weights / weights.sum())
+
+    # Регион: случайный из регионов проекта (плоский массив + смещения)
+    region_counts = np.array([len(project['regions']) for project in candidates])
+    region_offsets = np.concatenate([[0], np.cumsum(region_counts)[:-1]])
+    flat_regions = np.array([region for project in candidates for region in project['regions']], dtype=object)
+    region_pick = (rng.random(count) * region_counts[project_idx]).astype(int)
+    visit_regions = flat_regions[region_offsets[project_idx] + region_pick]
+
+    # ЭМ: случайный из ЭМ региона
+    region_names = sorted(region_rs)
+    region_index = {region: number for number, region in enumerate(region_names)}
+    rs_counts = np.array([len(region_rs[region]) for region in region_names])
+    rs_offsets = np.concatenate([[0], np.cumsum(rs_counts)[:-1]])
+    flat_rs = np.array([rs for region in region_names for rs in region_rs[region]], dtype=object)
+    visit_region_idx = pd.Series(visit_regions).map(region_index).to_numpy()
+    rs_pick = (rng.random(count) * rs_counts[visit_region_idx]).astype(int)
+    visit_rs = flat_rs[rs_offsets[visit_region_idx] + rs_pick]
+
+    # Дата: несколько дней до начала периода (отсекаются очисткой) и после конца
+    span = (period_end - period_start).days
+    offsets = rng.integers(-3, span + 4, size=count)
+    visit_dates = period_start.to_datetime64() + offsets.astype('timedelta64[D]')
+
+    statuses = list(STATUS_WEIGHTS[source])
+    status_weights = np.array(list(STATUS_WEIGHTS[source].values()))
+    visit_status = np.array(statuses, dtype=object)[
+        rng.choice(len(statuses), size=count, p=status_weights / status_weights.sum())
+    ]
+
+    def project_field(name):
+        return np.array([project[name] for project in candidates], dtype=object)[project_idx]
+
+    return {
+        'code': project_field('code'),
+        'client': project_field('client'),
+        'wave': project_field('wave'),
+        'region': visit_regions,
+        'rs': visit_rs,
+        'date': visit_dates,
+        'status': visit_status
+    }
+
+
+def _lookup(mapping, values):
+    """Значения словаря для массива ключей (векторно через pandas)"""
+    return pd.Series(values).map(mapping).fillna('').to_numpy(dtype=object)
+
+
+def build_portal(visits, region_asm, rng):
+    """Массив портала (Checker): колонки выгрузки и несколько Total sum for payment"""
+    count = len(visits['code'])
+    asm = _lookup(region_asm, visits['region'])
+    codes = visits['code'].copy()
+    # Часть визитов без кода анкеты - код восстанавливается из Сервизории по клиенту и волне
+    codes[rng.random(count) < 0.005] = ''
+    return pd.DataFrame({
+        'Код анкеты': codes,
+        'Имя клиента': visits['client'],
+        'Название проекта': visits['wave'],
+        'ЗОД': _lookup(ZOD_MAPPING, asm),
+        'АСС': asm,
+        'ЭМ рег': visits['rs'],
+        'Регион': visits['region'],
+        'Регион ': _lookup(REGION_MAPPING, visits['region']),
+        'Статус': visits['status'],
+        'Дата визита': visits['date'],
+        'Total sum for payment': rng.choice(PAYMENT_RATES, size=count),
+        'Total sum for payment.1': np.where(rng.random(count) < 0.2, 150.0, 0.0)
+    })
+
+
+def build_cxway(visits, region_asm, rng):
+    """Выгрузка CXWAY (английские заголовки, Оплата + Доп. оплата)"""
+    count = len(visits['code'])
+    return pd.DataFrame({
+        'Project Code': visits['code'],
+        'Client': visits['client'],
+        'Wave Name': visits['wave'],
+        'АСС': _lookup(region_asm, visits['region']),
+        'ЭМ рег': visits['rs'],
+        'Region short': pd.Series(visits['region']).str.lower().to_numpy(dtype=object),
+        'Status': visits['status'],
+        'Date of Visit': visits['date'],
+        'Оплата': rng.choice(PAYMENT_RATES, size=count),
+        'Доп. оплата': np.where(rng.random(count) < 0.1, 200.0, 0.0)
+    })
+
+
+def build_easymerch(visits, region_asm):
+    """Выгрузка Easymerch (регион 'MC Московская область' - берутся первые 2 символа)"""
+    regions = pd.Series(visits['region'])
+    return pd.DataFrame({
+        'код проекта': visits['code'],
+        'Имя клиента': visits['client'],
+        'Название волны': visits['wave'],
+        'АСМ': _lookup(region_asm, visits['region']),
+        'ЭМ': visits['rs'],
+        'Регион': (regions + ' ' + regions.map(REGION_MAPPING).fillna('')).to_numpy(dtype=object),
+        'Статус': visits['status'],
+        'Дата визита': visits['date']
+    })
+
+
+def build_optima(visits, region_asm, rng):
+    """Выгрузка Optima (код проекта с хвостом через '\\', длинное название региона)"""
+    count = len(visits['code'])
+    codes = pd.Series(visits['code'])
+    suffix_mask = rng.random(count) < 0.3
+    codes[suffix_mask] = codes[suffix_mask] + '\\' + pd.Series(rng.integers(1, 5, size=count)).astype(str)[suffix_mask]
+    regions = pd.Series(visits['region'])
+    long_regions = regions.map(REGION_MAPPING).fillna('')
+    long_regions[regions == 'MC'] = 'Москва'
+    return pd.DataFrame({
+        'Project Code': codes.to_numpy(dtype=object),
+        'Проект': visits['client'],
+        'Wave Name': visits['wave'],
+        'АСС': _lookup(region_asm, visits['region']),
+        'Координатор': visits['rs'],
+        'Регион Чекер': long_regions.to_numpy(dtype=object),
+        'Статус анкеты': visits['status'],
+        'Дата визита': visits['date']
+    })
+
+
+def build_prodata(visits, region_asm, rng):
+    """Выгрузка ПроДата (мониторинги): регион задается кластером 'Область_ГМ_N'"""
+    count = len(visits['code'])
+    regions = pd.Series(visits['region'])
+    clusters = regions.map(REGION_MAPPING).fillna('') + '_ГМ_' + pd.Series(rng.integers(1, 4, size=count)).astype(str)
+    return pd.DataFrame({
+        'Код проекта': visits['code'],
+        'Имя клиента': visits['client'],
+        'Направление': visits['wave'],
+        'Тип мониторинга': np.array(MONITORING_TYPES, dtype=object)[rng.integers(0, len(MONITORING_TYPES), size=count)],
+        'АСС': _lookup(region_asm, visits['region']),
+        'Кластер': clusters.to_numpy(dtype=object),
+        'Статус': visits['status'],
+        'Дата визита': visits['date']
+    })
+
+
+def build_servizoria(projects):
+    """Сервизория: одна строка на проект (даты, ПО, квота мониторингов)"""
+    return pd.DataFrame([
+        {
+            'Код проекта RU00.000.00.01SVZ24': project['code'],
+            'Проекты в  https://ru.checker-soft.com': project['client'],
+            'Название волны на Чекере/ином ПО': project['wave'],
+            'Название волны холостой': '',
+            'Портал на котором идет проект (для работы полевой команды)': project['portal'],
+            'Дата старта': project['start'],
+            'Дата финиша с продлением': project['finish'],
+            'Квота': str(int(project['quota'])) if project['quota'] is not None else ''
+        }
+        for project in projects
+    ])
+
+
+def build_bdr(projects, rng):
+    """БДР: плановая оплата за единицу по коду проекта (российский формат '650,00')"""
+    rows = []
+    seen = set()
+    for project in projects:
+        code = project['code']
+        if code in NON_UNIQUE_CODES or code in seen:
+            continue
+        seen.add(code)
+        rows.append({
+            'КОД': code,
+            'Проект': project['client'],
+            'Расходы на ТП/Респонденты, план на 1 ед': f"{float(rng.choice(PAYMENT_RATES)):.2f}".replace('.', ',')
+        })
+    return pd.DataFrame(rows)
+
+
+# ============================================
+# ПЛАНОВЫЕ СПРАВОЧНИКИ
+# ============================================
+
+def build_settings(projects, region_asm, region_rs, rng):
+    """
+    JSON-справочники в формате репозитория настроек: {ключ SETTINGS_FILES: данные}.
+    Планы Мултон/Мультибренд и RS Optima согласованы с регионами проектов.
+    """
+    now = datetime.now().isoformat()
+
+    multon_rows = []
+    for project in projects:
+        if project['client'] != 'Мултон':
+            continue
+        for region in project['regions']:
+            multon_rows.append({
+                'project_code': project['code'],
+                'region': region,
+                'rs': region_asm[region],
+                'plan': float(rng.integers(5, 120))
+            })
+
+    dilers, pronto = [], []
+    multibrand_regions = next(
+        (project['regions'] for project in projects if project['client'] == 'Мультибренд 2024'), []
+    )
+    for region in multibrand_regions:
+        base = {
+            'region_short': region,
+            'region_long': REGION_MAPPING.get(region, ''),
+            'asm': region_asm[region],
+            'rs': region_rs[region][0]
+        }
+        dilers.append({**base, 'plan': int(rng.integers(3, 30)), 'wave_type': 'Дилеры'})
+        for wave_type in ('Пронто', 'Пронто М'):
+            pronto.append({**base, 'plan': int(rng.integers(5, 60)), 'wave_type': wave_type})
+
+    optima_projects = [project for project in projects if project['source'] == 'optima']
+    optima_regions = sorted({region for project in optima_projects for region in project['regions']})
+    optima_clients = sorted({project['client'] for project in optima_projects})
+
+    field_projects = [
+        project for project in projects
+        if project['client'] not in ('Мултон', 'Мультибренд 2024') and project['code'] not in NON_UNIQUE_CODES
+    ]
+    picked = rng.choice(len(field_projects), size=min(4, len(field_projects)), replace=False)
+    adjusted = [field_projects[number] for number in picked[:3]]
+    excluded = [field_projects[number] for number in picked[3:]]
+
+    return {
+        'projects_settings': {
+            'excluded_projects': [
+                {
+                    'project_name': project['client'], 'wave_name': project['wave'],
+                    'project_code': project['code'], 'portal': project['portal'], 'fio_om': '',
+                    'added_at': now, 'added_by': 'synthetic'
+                }
+                for project in excluded
+            ],
+            'included_projects': [],
+            'history': [],
+            'last_updated': now,
+            'version': '1.0'
+        },
+        'adjustments': {
+            'adjustments': [
+                {
+                    'project_name': project['client'], 'wave_name': project['wave'],
+                    'project_code': project['code'], 'adjustment_value': int(rng.integers(-5, 30)),
+                    'created_at': now, 'created_by': 'synthetic'
+                }
+                for project in adjusted
+            ]
+        },
+        'multon_plan': {'last_updated': now, 'data': multon_rows},
+        'multibrand_plan': {'dilers': dilers, 'pronto': pronto, 'updated_at': now},
+        'optima_rs': {
+            'last_updated': now,
+            'region_mapping': {region: region_rs[region][0] for region in optima_regions},
+            'moscow_mapping': {client: region_rs['MC'][0] for client in optima_clients},
+            'spb_mapping': {client: region_rs['LN'][0] for client in optima_clients}
+        },
+        'region_coefficients': {
+            'last_updated': now,
+            'coefficients': {
+                region: float(rng.choice([0.9, 0.95, 1.0, 1.0, 1.1, 1.2])) for region in sorted(REGION_MAPPING)
+            }
+        }
+    }
+
+
+# ============================================
+# НАБОР ДАННЫХ
+# ============================================
+
+def source_counts(visits):
+    """Визитов по источникам для общего числа визитов"""
+    return {source: int(round(visits * share)) for source, share in SOURCE_SHARES.items()}
+
+
+def generate_dataset(visits=10000, start=None, end=None, seed=42):
+    """
+    Синтетический набор: ({источник: DataFrame исходного файла}, {ключ SETTINGS_FILES: JSON}).
+    Имена источников совпадают с compute_core ('сервизория', 'портал', 'cxway', ...).
+    """
+    rng = np.random.default_rng(seed)
+    period_start, period_end = _period(start, end)
+    regions, region_asm, region_rs = build_staff(rng)
+    projects = build_projects(visits, period_start, rng, regions)
+
+    builders = {
+        'портал': lambda v: build_portal(v, region_asm, rng),
+        'cxway': lambda v: build_cxway(v, region_asm, rng),
+        'easymerch': lambda v: build_easymerch(v, region_asm),
+        'optima': lambda v: build_optima(v, region_asm, rng),
+        'prodata': lambda v: build_prodata(v, region_asm, rng)
+    }
+
+    frames = {'сервизория': build_servizoria(projects)}
+    for source, count in source_counts(visits).items():
+        source_visits = sample_visits(projects, source, count, period_start, period_end, rng, region_rs)
+        if source_visits is not None:
+            frames[source] = builders[source](source_visits)
+    frames['bdr'] = build_bdr(projects, rng)
+
+    return frames, build_settings(projects, region_asm, region_rs, rng)
+
+
+def write_source(df, path, fmt):
+    """Файл источника: xlsx, CSV (';', UTF-8 с BOM, все поля в кавычках) или Parquet"""
+    if fmt == 'xlsx':
+        if len(df) > EXCEL_MAX_ROWS:
+            raise ValueError(f"{os.path.basename(path)}: {len(df):,} строк не помещаются на лист Excel")
+        df.to_excel(path, index=False, engine='xlsxwriter' if xlsxwriter is not None else None)
+    elif fmt == 'csv':
+        df.to_csv(path, sep=';', index=False, encoding='utf-8-sig', quoting=csv.QUOTE_ALL,
+                  date_format='%Y-%m-%d', chunksize=100000)
+    elif fmt == 'parquet':
+        df.to_parquet(path, index=False, compression='zstd')
+    else:
+        raise ValueError(f"Неизвестный формат: {fmt}")
+
+
+def write_dataset(out_dir, frames, settings, fmt='parquet'):
+    """
+    Пишет файлы источников в out_dir и справочники в out_dir/settings.
+    Возвращает {источник: путь к файлу}.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    paths = {}
+    for source, df in frames.items():
+        path = os.path.join(out_dir, f"{SOURCE_FILE_NAMES[source]}.{fmt}")
+        write_source(df, path, fmt)
+        paths[source] = path
+
+    settings_dir = os.path.join(out_dir, 'settings')
+    os.makedirs(settings_dir, exist_ok=True)
+    for key, data in settings.items():
+        with open(os.path.join(settings_dir, SETTINGS_FILES[key]), 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+    return paths
+
+
+# ============================================
+# CLI
+# ============================================
+
+def _parse_date(value):
+    return date.fromisoformat(value)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Синтетические файлы источников для расчета план/факт")
+    parser.add_argument('out_dir', nargs='?', default='./data/synthetic/', help="Папка для файлов")
+    parser.add_argument('--visits', type=int, default=10000, help="Всего визитов (1 тыс. - 5 млн)")
+    parser.add_argument('--format', choices=SYNTHETIC_FORMATS, default='parquet', help="Формат файлов источников")
+    parser.add_argument('--start', type=_parse_date, default=None, help="Начало периода (YYYY-MM-DD)")
+    parser.add_argument('--end', type=_parse_date, default=None, help="Конец периода (YYYY-MM-DD)")
+    parser.add_argument('--seed', type=int, default=42, help="Seed генератора (одинаковый seed - одинаковые файлы)")
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if args.visits <= 0:
+        parser.error("--visits должно быть больше нуля")
+    if args.format == 'xlsx' and max(source_counts(args.visits).values()) > EXCEL_MAX_ROWS:
+        parser.error(f"Для {args.visits:,} визитов нужен --format csv или parquet (лимит Excel {EXCEL_MAX_ROWS:,} строк)")
+
+    print(f"🧪 Генерация {args.visits:,} визитов...")
+    frames, settings = generate_dataset(args.visits, args.start, args.end, args.seed)
+    paths = write_dataset(args.out_dir, frames, settings, args.format)
+    for source, path in paths.items():
+        print(f"   {source}: {len(frames[source]):,} строк → {path}")
+    print(f"⚙️ Справочники: {os.path.join(args.out_dir, 'settings')}")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
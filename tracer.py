@@ -0,0 +1,67 @@
+# tracer.py
+# draft 4.1 - simplified
+"""
+Трассировка расчета план/факт для одного ключа (проект / регион / ASM).
+По умолчанию выключена: в циклах расчета проверяется только tracer.enabled,
+поэтому выключенный трассировщик ничего не стоит. Включенный записывает
+решения по веткам, входные данные плана и причины пропуска строк
+в структурированный журнал (таблица для отладочной панели).
+"""
+import pandas as pd
+
+
+class Tracer:
+    """Журнал решений расчета для выбранного ключа"""
+
+    def __init__(self, project=None, region=None, asm=None):
+        self.project = (project or '').strip() or None
+        self.region = (region or '').strip() or None
+        self.asm = (asm or '').strip() or None
+        self.enabled = self.project is not None
+        self.events = []
+
+    def matches(self, project_code, region=None, asm=None):
+        """Строка относится к трассируемому ключу (пустые части ключа - любые)"""
+        if not self.enabled or project_code != self.project:
+            return False
+        if self.region is not None and region != self.region:
+            return False
+        if self.asm is not None and asm != self.asm:
+            return False
+        return True
+
+    def record(self, stage, event, **data):
+        """Событие расчета: этап, что произошло, входные данные решения"""
+        if self.enabled:
+            self.events.append({'stage': stage, 'event': event, 'data': data})
+
+    def summary(self, stage, event, compute):
+        """
+        Сводка этапа (не по ключу). compute - функция без аргументов,
+        возвращающая dict; вызывается только при включенной трассировке.
+        """
+        if self.enabled:
+            self.record(stage, event, **compute())
+
+    @property
+    def key_label(self):
+        parts = [self.project, self.region, self.asm]
+        return ' / '.join(part or '*' for part in parts)
+
+    def to_frame(self):
+        """Журнал в виде таблицы: Этап, Событие, Данные"""
+        return pd.DataFrame([
+            {
+                'Этап': event['stage'],
+                'Событие': event['event'],
+                'Данные': ', '.join(f"{name}={value}" for name, value in event['data'].items())
+            }
+            for event in self.events
+        ], columns=['Этап', 'Событие', 'Данные'])
+
+    def clear(self):
+        self.events = []
+
+
+# Выключенный трассировщик по умолчанию
+NULL_TRACER = Tracer()
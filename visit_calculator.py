@@ -2,20 +2,144 @@
 # draft 4.1 - simplified
 import pandas as pd
 import numpy as np
-import streamlit as st
 from datetime import datetime, timedelta
 from typing import Optional, Dict, Tuple, List
 import io
 from io import BytesIO
 import calendar
-from github_settings import get_plan_adjustment_manager
-from github_settings import get_multon_plan_manager
-from github_settings import get_plan_adjustment_manager, get_multon_plan_manager, get_multibrand_plan_manager
 from data_cleaner import REGION_NAME_TO_CODE, ZOD_MAPPING
+from diagnostics import Diagnostics
+from tracer import NULL_TRACER
+from profiler import NULL_PROFILER
+from config import config
+from plan_engine import plan_rows, apply_plan_adjustments
+from business_calendar import get_calendar, load_calendar_settings
+from plan_registry import PlanSourceRegistry
+from visit_cube import VisitCube
+
+
+# ============================================
+# ИНДЕКСЫ ДАТ ПО КОДУ ПРОЕКТА
+# ============================================
+
+def _google_code_parts(google_df):
+    """
+    Строки таблицы проектов по частям составного кода ('A/B' → A и B): колонка code
+    плюс исходные колонки, индекс - номер строки таблицы (порядок сохраняется).
+    Строки без кода пропускаются.
+    """
+    google_df = google_df.reset_index(drop=True)
+    code_raw = google_df.get('Код проекта RU00.000.00.01SVZ24', pd.Series('', index=google_df.index))
+    code_raw = code_raw.astype(str).str.strip()
+    frame = google_df[~code_raw.isin(['nan', ''])].copy()
+    for col in ['Дата старта', 'Дата финиша с продлением', 'Название волны на Чекере/ином ПО', 'Название волны холостой']:
+        if col not in frame.columns:
+            frame[col] = None
+    frame['code'] = code_raw[frame.index].str.split('/')
+    frame = frame.explode('code')
+    frame['code'] = frame['code'].str.strip()
+    return frame[frame['code'] != '']
+
+
+def _code_index(google_codes, value_col, keep):
+    """Код → значение колонки (пустые пропускаются, keep - какая строка таблицы выигрывает)"""
+    values = google_codes.dropna(subset=[value_col]).drop_duplicates('code', keep=keep)
+    return pd.Series(values[value_col].to_numpy(), index=values['code'].to_numpy())
+
+
+def _code_parts(codes):
+    """
+    Части кодов проектов иерархии: DataFrame (row - позиция строки, order - номер части, part).
+    Код без '/' - одна часть как есть, составной - части без пробелов, пустые пропускаются.
+    """
+    codes = pd.Series(codes).astype(str).reset_index(drop=True)
+    compound = codes.str.contains('/', regex=False)
+    exploded = codes.str.split('/').explode()
+    parts = pd.DataFrame({'row': exploded.index.to_numpy(), 'part': exploded.to_numpy()})
+    parts['order'] = parts.groupby('row').cumcount()
+    parts['part'] = parts['part'].where(~compound.to_numpy()[parts['row']], parts['part'].str.strip())
+    return parts[parts['part'] != ''].reset_index(drop=True)
+
+
+def _first_part_match(parts, index, length):
+    """Значение index для первой найденной части кода каждой строки (не найдено - NaT)"""
+    matched = parts[parts['part'].isin(index.index)].drop_duplicates('row')
+    values = np.full(length, pd.NaT, dtype=object)
+    values[matched['row'].to_numpy()] = index.reindex(matched['part']).to_numpy(dtype=object)
+    return pd.Series(values).infer_objects()
+
+
+def load_plan_sources_from_managers(loaded_sources=None):
+    """
+    Загружает плановые справочники через менеджеры GitHub (режим приложения).
+    Возвращает словарь в формате, который принимают calculate_hierarchical_plan_on_date
+    и compute_core (корректировки, Мултон, Мультибренд, RS Optima, коэффициенты регионов,
+    производственный календарь - локальный файл config.CALENDAR_FILE).
+    loaded_sources - имена загруженных файлов: справочники для незагруженных
+    источников не запрашиваются (None - загружать все)
+    """
+    from github_settings import (
+        get_plan_adjustment_manager, get_multon_plan_manager, get_multibrand_plan_manager,
+        get_optima_rs_manager, get_region_coefficient_manager
+    )
+    
+    def is_loaded(name):
+        return loaded_sources is None or name in loaded_sources
+    
+    plan_sources = {
+        'adjustments': [],
+        'multon_plan': pd.DataFrame(),
+        'multibrand_plan': (pd.DataFrame(), pd.DataFrame()),
+        'optima_rs': ({}, {}, {}),
+        'region_coefficients': {},
+        'production_calendar': load_calendar_settings(),
+        'updated': {}
+    }
+    # Дата обновления справочника - из файла, прочитанного менеджером
+    def loaded(name, manager, value):
+        plan_sources[name] = value
+        plan_sources['updated'][name] = getattr(manager, 'last_updated', None)
+    
+    try:
+        manager = get_plan_adjustment_manager()
+        loaded('adjustments', manager, manager.get_adjustments())
+    except Exception:
+        pass
+    
+    manager = get_multon_plan_manager()
+    loaded('multon_plan', manager, manager.load_plan())
+    
+    # Мультибренд нужен только при загруженном CXWAY
+    if is_loaded('cxway'):
+        try:
+            manager = get_multibrand_plan_manager()
+            loaded('multibrand_plan', manager, manager.load_plan())
+        except Exception:
+            pass
+    
+    if is_loaded('optima'):
+        manager = get_optima_rs_manager()
+        loaded('optima_rs', manager, manager.load_distribution())
+    
+    # Коэффициенты регионов нужны только для плановой оплаты (БДР)
+    if is_loaded('bdr'):
+        manager = get_region_coefficient_manager()
+        loaded('region_coefficients', manager, manager.load_coefficients())
+    
+    return plan_sources
 
 
 class VisitCalculator:
     
+    def __init__(self, diag=None, profiler=None, tracer=None):
+        # Диагностика текущего расчета (выводится в UI или пишется в лог CLI)
+        self.diag = diag if diag is not None else Diagnostics()
+        # Трассировка одного ключа (выключена по умолчанию)
+        self.tracer = tracer if tracer is not None else NULL_TRACER
+        self.profiler = profiler if profiler is not None else NULL_PROFILER
+        # Производственный календарь для коэффициента месяца (задается на каждый расчет плана)
+        self.business_calendar = get_calendar()
+    
     def _calculate_rs_weights(self, visits_df, project_code, wave_name, region):
         """
         Доли RS = визиты RS в проекте+волне+регионе / все визиты проекта+волны+региона
@@ -60,21 +184,10 @@ class VisitCalculator:
     
 
     def _get_working_days_in_range(self, start_date, end_date):
-        """Возвращает количество рабочих дней (пн-пт) в диапазоне"""
+        """Возвращает количество рабочих дней в диапазоне по производственному календарю"""
         if pd.isna(start_date) or pd.isna(end_date):
             return 0
-        if hasattr(start_date, 'date'):
-            start_date = start_date.date()
-        if hasattr(end_date, 'date'):
-            end_date = end_date.date()
-        
-        days = 0
-        current = start_date
-        while current <= end_date:
-            if current.weekday() < 5:
-                days += 1
-            current += timedelta(days=1)
-        return days
+        return self.business_calendar.count(start_date, end_date)
         
     
     def calculate_plan_with_stages(self, total_plan, duration, coefficients, start_date, finish_date, period_start, period_end):
@@ -133,20 +246,27 @@ class VisitCalculator:
         
         return plan_on_date, daily_plan_avg
             
-    def extract_hierarchical_data(self, visits_df, google_df=None, google_df_original=None):
+    def _default_project_dates(self, calc_params=None):
+        """Даты по умолчанию для проектов без дат: от старта периода до конца месяца"""
+        if calc_params and calc_params.get('start_date') is not None:
+            first_day = pd.Timestamp(calc_params['start_date'])
+        else:
+            today = datetime.now()
+            first_day = pd.Timestamp(year=today.year, month=today.month, day=1)
+        last_day = first_day + pd.offsets.MonthEnd(1)
+        return first_day, last_day
+    
+    def extract_hierarchical_data(self, visits_df, google_df=None, google_df_original=None, calc_params=None):
         """
         Создаёт полную иерархию Проект→Клиент→Волна→Регион→DSM→ASM→RS
         с базовой информацией о проекте
         """
-        import time
-        start_total = time.time()
-        
         try:
             # 1. Определяем колонку региона
             region_col = 'Регион short'
             
             # Создаём иерархию из visits_df
-            start = time.time()
+            step = self.profiler.begin('Создание DataFrame', rows_in=len(visits_df))
             hierarchy = pd.DataFrame({
                 'Проект': visits_df['Код анкеты'].fillna('Не указано'),
                 'Клиент': visits_df['Имя клиента'].fillna('Не указано'),
@@ -158,52 +278,32 @@ class VisitCalculator:
                 'ПО': visits_df['ПО'].fillna('не определено'),
                 'Полевой': visits_df['Полевой']
             })
-            # st.write(f"[DETAIL] Создание DataFrame: {time.time() - start:.2f} сек")
+            self.profiler.end(step, rows_out=len(hierarchy))
 
-            # ============================================
-            # ✅ ДИАГНОСТИКА ПОСЛЕ СОЗДАНИЯ hierarchy
-            # ============================================
-            st.write(f"📊 extract_hierarchical_data (после создания hierarchy):")
-            st.write(f"  hierarchy строк: {len(hierarchy)}")
-            if not hierarchy.empty:
-                if 'ПО' in hierarchy.columns:
-                    st.write(f"  ПО: {hierarchy['ПО'].unique()}")
-                if 'Полевой' in hierarchy.columns:
-                    st.write(f"  Полевой == 1: {(hierarchy['Полевой'] == 1).sum()}")
-                    st.write(f"  Полевой == 0: {(hierarchy['Полевой'] == 0).sum()}")
-                    st.write(f"  Полевой isna: {hierarchy['Полевой'].isna().sum()}")
-            st.write("---")
-            # ============================================
+            self.tracer.summary('Иерархия', 'создана из визитов', lambda: {
+                'строк': len(hierarchy),
+                'ПО': sorted(hierarchy['ПО'].astype(str).unique()),
+                'Полевой == 1': int((hierarchy['Полевой'] == 1).sum()),
+                'Полевой == 0': int((hierarchy['Полевой'] == 0).sum()),
+                'Полевой пусто': int(hierarchy['Полевой'].isna().sum())
+            })
             
             # ТОЛЬКО ПОЛЕВЫЕ ПРОЕКТЫ
-            start = time.time()
+            step = self.profiler.begin('Фильтр полевых', rows_in=len(hierarchy))
             hierarchy = hierarchy[hierarchy['Полевой'] == 1]
             hierarchy = hierarchy.drop('Полевой', axis=1)
-            # st.write(f"[DETAIL] Фильтр полевых: {time.time() - start:.2f} сек")
+            self.profiler.end(step, rows_out=len(hierarchy))
 
-            # ============================================
-            # ✅ ДИАГНОСТИКА ПОСЛЕ ФИЛЬТРА
-            # ============================================
-            st.write(f"📊 extract_hierarchical_data (после фильтра Полевой == 1):")
-            st.write(f"  hierarchy строк: {len(hierarchy)}")
-            if not hierarchy.empty and 'ПО' in hierarchy.columns:
-                st.write(f"  ПО: {hierarchy['ПО'].unique()}")
-            st.write("---")
-            # ============================================
+            self.tracer.summary('Иерархия', 'фильтр Полевой == 1', lambda: {
+                'строк': len(hierarchy),
+                'ПО': sorted(hierarchy['ПО'].astype(str).unique())
+            })
             
             # Удаляем дубликаты
-            start = time.time()
+            step = self.profiler.begin('Удаление дубликатов', rows_in=len(hierarchy))
             hierarchy = hierarchy.drop_duplicates().reset_index(drop=True)
-            # st.write(f"[DETAIL] Удаление дубликатов: {time.time() - start:.2f} сек")
-            # ============================================
-            # ✅ ДИАГНОСТИКА ПОСЛЕ drop_duplicates
-            # ============================================
-            st.write(f"📊 extract_hierarchical_data (после drop_duplicates):")
-            st.write(f"  hierarchy строк: {len(hierarchy)}")
-            if not hierarchy.empty and 'ПО' in hierarchy.columns:
-                st.write(f"  ПО: {hierarchy['ПО'].unique()}")
-            st.write("---")
-            # ============================================
+            self.profiler.end(step, rows_out=len(hierarchy))
+            self.tracer.summary('Иерархия', 'удалены дубли', lambda: {'строк': len(hierarchy)})
             
             # Даты - по умолчанию пустые
             hierarchy['Дата старта'] = pd.NaT
@@ -214,72 +314,20 @@ class VisitCalculator:
             # 1. ОСНОВНЫЕ ДАТЫ (из очищенного google_df)
             # ============================================
             if google_df is not None and not google_df.empty:
-                start = time.time()
+                step = self.profiler.begin('Основные даты', rows_in=len(hierarchy))
                 try:
-                    start_mapping = {}
-                    finish_mapping = {}
-                    
-                    for idx, row in google_df.iterrows():
-                        code_raw = str(row.get('Код проекта RU00.000.00.01SVZ24', '')).strip()
-                        if code_raw and code_raw not in ['nan', '']:
-                            start_date = row.get('Дата старта')
-                            finish_date = row.get('Дата финиша с продлением')
-                            
-                            # Разделяем составной код по '/'
-                            codes = code_raw.split('/')
-                            for code in codes:
-                                code = code.strip()
-                                if not code:
-                                    continue
-                                if pd.notna(start_date):
-                                    start_mapping[code] = start_date
-                                if pd.notna(finish_date):
-                                    finish_mapping[code] = finish_date
+                    # Код (часть составного кода 'A/B') → дата: последняя непустая в таблице
+                    google_codes = _google_code_parts(google_df)
+                    start_index = _code_index(google_codes, 'Дата старта', keep='last')
+                    finish_index = _code_index(google_codes, 'Дата финиша с продлением', keep='last')
 
-                    # Функция для получения даты из start_mapping с учетом составных кодов
-                    def get_start_date(project_code):
-                        code_str = str(project_code)
-                        # Если нет слеша — ищем как есть
-                        if '/' not in code_str:
-                            return start_mapping.get(code_str, pd.NaT)
-                        
-                        # Разделяем на части и перебираем
-                        parts = code_str.split('/')
-                        for part in parts:
-                            part = part.strip()
-                            if not part:
-                                continue
-                            # Как только нашли часть в start_mapping — берем дату
-                            if part in start_mapping:
-                                return start_mapping[part]
-                        # Если ни одной части нет в mapping — возвращаем пустоту
-                        return pd.NaT
-                    
-                    def get_finish_date(project_code):
-                        code_str = str(project_code)
-                        if '/' not in code_str:
-                            return finish_mapping.get(code_str, pd.NaT)
-                        
-                        parts = code_str.split('/')
-                        for part in parts:
-                            part = part.strip()
-                            if not part:
-                                continue
-                            if part in finish_mapping:
-                                return finish_mapping[part]
-                        return pd.NaT
-                    
-                    hierarchy['Дата старта'] = hierarchy['Проект'].apply(get_start_date)
-                    hierarchy['Дата финиша'] = hierarchy['Проект'].apply(get_finish_date)
+                    # Составной код проекта - первая часть, для которой есть дата
+                    parts = _code_parts(hierarchy['Проект'])
+                    hierarchy['Дата старта'] = _first_part_match(parts, start_index, len(hierarchy))
+                    hierarchy['Дата финиша'] = _first_part_match(parts, finish_index, len(hierarchy))
                     
                     # Если дат нет, ставим первый и последний день месяца
-                    if 'plan_calc_params' in st.session_state:
-                        first_day = pd.Timestamp(st.session_state['plan_calc_params']['start_date'])
-                        last_day = first_day + pd.offsets.MonthEnd(1)
-                    else:
-                        today = datetime.now()
-                        first_day = pd.Timestamp(year=today.year, month=today.month, day=1)
-                        last_day = first_day + pd.offsets.MonthEnd(1)
+                    first_day, last_day = self._default_project_dates(calc_params)
                     
                     hierarchy['Дата старта'] = hierarchy['Дата старта'].fillna(first_day)
                     hierarchy['Дата финиша'] = hierarchy['Дата финиша'].fillna(last_day)
@@ -288,27 +336,15 @@ class VisitCalculator:
                     hierarchy['Дата старта'] = pd.NaT
                     hierarchy['Дата финиша'] = pd.NaT
                     
-                    if 'plan_calc_params' in st.session_state:
-                        first_day = pd.Timestamp(st.session_state['plan_calc_params']['start_date'])
-                        last_day = first_day + pd.offsets.MonthEnd(1)
-                    else:
-                        today = datetime.now()
-                        first_day = pd.Timestamp(year=today.year, month=today.month, day=1)
-                        last_day = first_day + pd.offsets.MonthEnd(1)
+                    first_day, last_day = self._default_project_dates(calc_params)
                     
                     hierarchy['Дата старта'] = hierarchy['Дата старта'].fillna(first_day)
                     hierarchy['Дата финиша'] = hierarchy['Дата финиша'].fillna(last_day)
                     pass
-                # st.write(f"[DETAIL] Основные даты: {time.time() - start:.2f} сек")
+                self.profiler.end(step, rows_out=len(hierarchy))
             else:
                 # Если google_df нет, ставим даты по умолчанию
-                if 'plan_calc_params' in st.session_state:
-                    first_day = pd.Timestamp(st.session_state['plan_calc_params']['start_date'])
-                    last_day = first_day + pd.offsets.MonthEnd(1)
-                else:
-                    today = datetime.now()
-                    first_day = pd.Timestamp(year=today.year, month=today.month, day=1)
-                    last_day = first_day + pd.offsets.MonthEnd(1)
+                first_day, last_day = self._default_project_dates(calc_params)
                 
                 hierarchy['Дата старта'] = first_day
                 hierarchy['Дата финиша'] = last_day
@@ -317,86 +353,47 @@ class VisitCalculator:
             # 2. ОРИГИНАЛЬНЫЕ ДАТЫ ИЗ GOOGLE (для информации и коэффициента)
             # ============================================
             if google_df_original is not None and not google_df_original.empty:
-                start = time.time()
+                step = self.profiler.begin('Оригинальные даты', rows_in=len(hierarchy))
                 try:
-                    # Словарь с приоритетом: (код, волна) → (старт, финиш, метод)
-                    date_mapping = {}
-                    
-                    for idx, row in google_df_original.iterrows():
-                        code_raw = str(row.get('Код проекта RU00.000.00.01SVZ24', '')).strip()
-                        
-                        if code_raw and code_raw not in ['nan', '']:
-                            start_date = row.get('Дата старта')
-                            finish_date = row.get('Дата финиша с продлением')
-                            
-                            if pd.notna(start_date) and pd.notna(finish_date):
-                                # Получаем волны
-                                wave_checker = str(row.get('Название волны на Чекере/ином ПО', '')).strip()
-                                wave_dummy = str(row.get('Название волны холостой', '')).strip()
-                                
-                                waves = []
-                                if wave_checker and wave_checker not in ['nan', '']:
-                                    waves.append(wave_checker)
-                                if wave_dummy and wave_dummy not in ['nan', '']:
-                                    waves.append(wave_dummy)
-                                
-                                # ✅ РАЗДЕЛЯЕМ СОСТАВНОЙ КОД ПО '/' 
-                                codes = code_raw.split('/')
-                                
-                                for single_code in codes:
-                                    single_code = single_code.strip()
-                                    if not single_code:
-                                        continue
-                                        
-                                    # Для каждой волны
-                                    for wave in waves:
-                                        key = (single_code, wave)
-                                        if key not in date_mapping:
-                                            date_mapping[key] = (start_date, finish_date, 'ВК')
-                                    
-                                    # Только по коду (без волны)
-                                    key = (single_code, None)
-                                    if key not in date_mapping:
-                                        date_mapping[key] = (start_date, finish_date, 'К')
-                    
-                    # Функция для получения дат по строке иерархии
-                    def get_dates(row):
-                        code = row['Проект']
-                        wave = row['Волна']
-                        
-                        # Точное совпадение по коду и волне
-                        if (code, wave) in date_mapping:
-                            start, finish, method = date_mapping[(code, wave)]
-                            return pd.Series([start, finish, method])
-                        
-                        # ✅ ЕСЛИ В КОДЕ ЕСТЬ '/', ПРОВЕРЯЕМ КАЖДУЮ ЧАСТЬ
-                        if '/' in code:
-                            parts = code.split('/')
-                            for part in parts:
-                                part = part.strip()
-                                if not part:
-                                    continue
-                                
-                                # Ищем совпадение по части кода и волне
-                                if (part, wave) in date_mapping:
-                                    start, finish, method = date_mapping[(part, wave)]
-                                    return pd.Series([start, finish, 'ВК'])
-                                
-                                # Ищем только по части кода (без волны)
-                                for (c, w), (start, finish, _) in date_mapping.items():
-                                    if c == part:
-                                        return pd.Series([start, finish, 'К'])
-                        
-                        # Код есть, но волна не совпала (или пустая)
-                        for (c, w), (start, finish, _) in date_mapping.items():
-                            if c == code:
-                                return pd.Series([start, finish, 'К'])
-                        
-                        # Код не найден
-                        return pd.Series([pd.NaT, pd.NaT, 'МП'])
-                    
-                    # Применяем маппинг
-                    hierarchy[['Дата старта_гугл', 'Дата финиша_гугл', 'Метод подбора дат']] = hierarchy.apply(get_dates, axis=1)
+                    # Индексы (первая строка таблицы с обеими датами):
+                    # (код, волна) → даты (метод 'ВК') и код → даты (метод 'К')
+                    google_codes = _google_code_parts(google_df_original)
+                    google_codes = google_codes[google_codes['Дата старта'].notna() &
+                                                google_codes['Дата финиша с продлением'].notna()]
+                    code_dates = google_codes.drop_duplicates('code')
+                    wave_dates = pd.concat([
+                        google_codes[['code', wave_col, 'Дата старта', 'Дата финиша с продлением']]
+                        .rename(columns={wave_col: 'wave'})
+                        for wave_col in ('Название волны на Чекере/ином ПО', 'Название волны холостой')
+                    ])
+                    wave_dates['wave'] = wave_dates['wave'].astype(str).str.strip()
+                    wave_dates = wave_dates[~wave_dates['wave'].isin(['nan', ''])]
+                    # Порядок строк таблицы важнее порядка колонок волн
+                    wave_dates = wave_dates.sort_index(kind='stable').drop_duplicates(['code', 'wave'])
+
+                    # Части кода строки иерархии по порядку: первая часть, известная по коду;
+                    # если для нее есть и волна строки - 'ВК', иначе 'К'. Не найдено - 'МП'
+                    parts = _code_parts(hierarchy['Проект'])
+                    parts['wave'] = hierarchy['Волна'].to_numpy()[parts['row']]
+                    parts = parts.merge(
+                        code_dates[['code', 'Дата старта', 'Дата финиша с продлением']],
+                        left_on='part', right_on='code', how='inner'
+                    ).merge(
+                        wave_dates.rename(columns={'Дата старта': 'start_wave', 'Дата финиша с продлением': 'finish_wave'}),
+                        left_on=['part', 'wave'], right_on=['code', 'wave'], how='left', suffixes=('', '_wave')
+                    ).sort_values(['row', 'order']).drop_duplicates('row')
+                    by_wave = parts['start_wave'].notna()
+
+                    rows = parts['row'].to_numpy()
+                    start = np.full(len(hierarchy), pd.NaT, dtype=object)
+                    finish = np.full(len(hierarchy), pd.NaT, dtype=object)
+                    method = np.full(len(hierarchy), 'МП', dtype=object)
+                    start[rows] = parts['start_wave'].where(by_wave, parts['Дата старта']).to_numpy(dtype=object)
+                    finish[rows] = parts['finish_wave'].where(by_wave, parts['Дата финиша с продлением']).to_numpy(dtype=object)
+                    method[rows] = np.where(by_wave, 'ВК', 'К')
+                    hierarchy['Дата старта_гугл'] = start
+                    hierarchy['Дата финиша_гугл'] = finish
+                    hierarchy['Метод подбора дат'] = method
                     
                     # Преобразуем в datetime
                     hierarchy['Дата старта_гугл'] = pd.to_datetime(hierarchy['Дата старта_гугл'], errors='coerce')
@@ -407,7 +404,7 @@ class VisitCalculator:
                     hierarchy['Дата финиша_гугл'] = pd.NaT
                     hierarchy['Метод подбора дат'] = 'МП'
                     pass
-                # st.write(f"[DETAIL] Оригинальные даты: {time.time() - start:.2f} сек")
+                self.profiler.end(step, rows_out=len(hierarchy))
             else:
                 hierarchy['Дата старта_гугл'] = pd.NaT
                 hierarchy['Дата финиша_гугл'] = pd.NaT
@@ -415,7 +412,7 @@ class VisitCalculator:
                 
             
             # Рассчитываем длительность
-            start = time.time()
+            step = self.profiler.begin('Расчет длительности', rows_in=len(hierarchy))
             hierarchy['Длительность'] = 0
             mask_valid_dates = hierarchy['Дата старта'].notna() & hierarchy['Дата финиша'].notna()
             
@@ -424,15 +421,13 @@ class VisitCalculator:
                     hierarchy.loc[mask_valid_dates, 'Дата финиша'] - 
                     hierarchy.loc[mask_valid_dates, 'Дата старта']
                 ).dt.days + 1
-            # st.write(f"[DETAIL] Расчет длительности: {time.time() - start:.2f} сек")
+            self.profiler.end(step, rows_out=len(hierarchy))
             
             # Сортируем
-            start = time.time()
+            step = self.profiler.begin('Сортировка', rows_in=len(hierarchy))
             hierarchy = hierarchy.sort_values(['Проект', 'Клиент', 'Волна', 'Регион', 'DSM', 'ASM', 'RS'])
             hierarchy = hierarchy[hierarchy['RS'] != 'Итого']
-            # st.write(f"[DETAIL] Сортировка: {time.time() - start:.2f} сек")
-            
-            # st.write(f"[DETAIL] ВСЕГО Иерархия: {time.time() - start_total:.2f} сек")
+            self.profiler.end(step, rows_out=len(hierarchy))
             
             return hierarchy
             
@@ -441,279 +436,79 @@ class VisitCalculator:
         except Exception as e:
             return pd.DataFrame()
     
-    def calculate_hierarchical_plan_on_date(self, hierarchy_df, visits_df, calc_params, google_df=None, optima_df=None):
-        
-        coefficients = calc_params.get('coefficients', [0.25, 0.25, 0.25, 0.25])
-    
-        # ============================================================
-        # 🔥 ДИАГНОСТИКА: поиск конкретного проекта
-        # ============================================================
-        
-        TARGET_PROJECT = "RU00.381.02.03SVZ25"
-        TARGET_REGION = "TT"
-        TARGET_ASM = "Воронин Евгений"
-        
-        st.write("=" * 80)
-        st.write("🔍 ДИАГНОСТИКА ПРОЕКТА:", TARGET_PROJECT)
-        st.write("=" * 80)
-        
-        # 1. Проверяем hierarchy_df
-        st.write("### 1. Иерархия (hierarchy_df)")
-        
-        # Ищем проект в иерархии
-        hierarchy_mask = (
-            (hierarchy_df['Проект'] == TARGET_PROJECT) &
-            (hierarchy_df['Регион'] == TARGET_REGION) &
-            (hierarchy_df['ASM'] == TARGET_ASM)
-        )
-        
+    def _trace_plan_inputs(self, hierarchy_df, visits_df, multon_plan_df):
+        """Трассировка: где трассируемый ключ есть во входных данных плана"""
+        tracer = self.tracer
+        
+        hierarchy_mask = hierarchy_df['Проект'] == tracer.project
+        if tracer.region is not None:
+            hierarchy_mask &= hierarchy_df['Регион'] == tracer.region
+        if tracer.asm is not None:
+            hierarchy_mask &= hierarchy_df['ASM'] == tracer.asm
         hierarchy_matches = hierarchy_df[hierarchy_mask]
-        st.write(f"Найдено в иерархии: {len(hierarchy_matches)} строк")
-        
-        if not hierarchy_matches.empty:
-            st.write("Первая строка:")
-            st.dataframe(hierarchy_matches.head(1))
-            
-            # Показываем все значения для первой строки
-            row = hierarchy_matches.iloc[0]
-            st.write("Детали:")
-            st.write(f"  - Проект: '{row['Проект']}'")
-            st.write(f"  - Клиент: '{row['Клиент']}'")
-            st.write(f"  - Волна: '{row['Волна']}'")
-            st.write(f"  - Регион: '{row['Регион']}'")
-            st.write(f"  - ASM: '{row['ASM']}'")
-            st.write(f"  - RS: '{row['RS']}'")
-            st.write(f"  - ПО: '{row['ПО']}'")
-            st.write(f"  - Дата старта: {row['Дата старта']}")
-            st.write(f"  - Дата финиша: {row['Дата финиша']}")
-            st.write(f"  - Длительность: {row['Длительность']}")
-        else:
-            st.error(f"❌ Проект {TARGET_PROJECT} с регионом {TARGET_REGION} и ASM {TARGET_ASM} НЕ НАЙДЕН в иерархии!")
-            st.write("Доступные проекты в иерархии:")
-            st.write(hierarchy_df[['Проект', 'Регион', 'ASM']].drop_duplicates().head(10))
-        
-        st.write("---")
-        
-        # 2. Проверяем visits_df (project_wave_region_plans)
-        st.write("### 2. Данные визитов (visits_df / project_wave_region_plans)")
-        
-        # Ищем в visits_df
-        visits_mask = (
-            (visits_df['Код анкеты'] == TARGET_PROJECT) &
-            (visits_df['Регион short'] == TARGET_REGION) &
-            (visits_df['АСС'] == TARGET_ASM)
-        )
-        
+        tracer.record('Входные данные', 'строк иерархии', найдено=len(hierarchy_matches),
+                      ПО=sorted(hierarchy_matches['ПО'].astype(str).unique()))
+        
+        visits_mask = visits_df['Код анкеты'] == tracer.project
+        if tracer.region is not None:
+            visits_mask &= visits_df['Регион short'] == tracer.region
+        if tracer.asm is not None:
+            visits_mask &= visits_df['АСС'] == tracer.asm
         visits_matches = visits_df[visits_mask]
-        st.write(f"Найдено в visits_df: {len(visits_matches)} строк")
-        
-        if not visits_matches.empty:
-            st.write("Первая строка:")
-            st.dataframe(visits_matches.head(1))
-            
-            row = visits_matches.iloc[0]
-            st.write("Детали:")
-            st.write(f"  - Код анкеты: '{row['Код анкеты']}'")
-            st.write(f"  - Имя клиента: '{row['Имя клиента']}'")
-            st.write(f"  - Название проекта: '{row['Название проекта']}'")
-            st.write(f"  - Регион short: '{row['Регион short']}'")
-            st.write(f"  - АСС: '{row['АСС']}'")
-            st.write(f"  - ЭМ: '{row['ЭМ']}'")
-            st.write(f"  - ПО: '{row['ПО']}'")
-            
-            # Строим ключ для project_wave_region_plans
-            plan_key = (row['Имя клиента'], row['Код анкеты'], row['Название проекта'], row['Регион short'])
-            st.write(f"  - Ключ для project_wave_region_plans: {plan_key}")
-            
-            # Проверяем project_wave_region_plans
-            # (этот словарь должен быть создан ДО основного цикла)
-            # Вставляем проверку здесь, но словарь создается позже,
-            # поэтому мы проверим его в основном цикле
-        else:
-            st.error(f"❌ Проект {TARGET_PROJECT} с регионом {TARGET_REGION} и ASM {TARGET_ASM} НЕ НАЙДЕН в visits_df!")
-            st.write("Доступные проекты в visits_df:")
-            st.write(visits_df[['Код анкеты', 'Регион short', 'АСС']].drop_duplicates().head(10))
-        
-        st.write("---")
-        
-        # 3. Проверяем JSON (Multon план)
-        st.write("### 3. JSON-файл (Multon план)")
-        
-        from github_settings import get_multon_plan_manager
-        multon_manager = get_multon_plan_manager()
-        plan_df = multon_manager.load_plan()
-        
-        st.write(f"JSON загружен: {not plan_df.empty}, строк: {len(plan_df)}")
-        
-        if not plan_df.empty:
-            # Ищем в JSON
-            json_mask = (
-                (plan_df['project_code'] == TARGET_PROJECT) &
-                (plan_df['region'] == TARGET_REGION) &
-                (plan_df['rs'] == TARGET_ASM)
-            )
-            json_matches = plan_df[json_mask]
-            st.write(f"Найдено в JSON: {len(json_matches)} строк")
-            
-            if not json_matches.empty:
-                st.write("Строка из JSON:")
-                st.dataframe(json_matches)
-                st.write(f"  - plan: {json_matches.iloc[0]['plan']}")
-            else:
-                st.error(f"❌ Проект {TARGET_PROJECT} с регионом {TARGET_REGION} и RS {TARGET_ASM} НЕ НАЙДЕН в JSON!")
-                st.write("Доступные проекты в JSON:")
-                st.write(plan_df[['project_code', 'region', 'rs']].drop_duplicates().head(10))
-        else:
-            st.error("❌ JSON пустой или не загрузился!")
-        
-        st.write("---")
-        
-        # 4. Проверяем project_wave_region_plans (создается в коде)
-        st.write("### 4. project_wave_region_plans (из visits_df)")
-        
-        # Этот словарь создается в коде ДО основного цикла.
-        # Мы не можем его получить здесь, поэтому создадим его заново для диагностики.
-        
-        # Определяем колонки для группировки (как в коде)
-        project_wave_region_plans = visits_df.groupby([
-            'Имя клиента',
-            'Код анкеты',
-            'Название проекта',
-            'Регион short'
-        ]).size().to_dict()
-        
-        st.write(f"Всего ключей в project_wave_region_plans: {len(project_wave_region_plans)}")
+        plan_keys = visits_matches.groupby(
+            ['Имя клиента', 'Код анкеты', 'Название проекта', 'Регион short']
+        ).size().to_dict() if not visits_matches.empty else {}
+        tracer.record('Входные данные', 'визитов', найдено=len(visits_matches), ключи_плана=plan_keys)
+        
+        if not multon_plan_df.empty:
+            json_mask = multon_plan_df['project_code'] == tracer.project
+            if tracer.region is not None:
+                json_mask &= multon_plan_df['region'] == tracer.region
+            if tracer.asm is not None:
+                json_mask &= multon_plan_df['rs'] == tracer.asm
+            tracer.record('Входные данные', 'план Мултон (JSON)', найдено=int(json_mask.sum()),
+                          план=multon_plan_df.loc[json_mask, 'plan'].tolist())
+    
+    def calculate_hierarchical_plan_on_date(self, hierarchy_df, visits_df, calc_params, google_df=None, optima_df=None,
+                                            plan_sources=None, loaded_sources=None, progress=None, engine=None,
+                                            plan_registry=None, visit_cube=None, adjust=True):
+        """
+        План на дату по иерархии.
+        plan_sources - плановые справочники (корректировки, Мултон, Мультибренд),
+        если не переданы - загружаются через менеджеры GitHub.
+        plan_registry - индексы справочников (plan_registry.PlanSourceRegistry) этого расчета,
+        None - строятся по plan_sources.
+        visit_cube - куб визитов расчета (visit_cube.VisitCube), None - строится по visits_df.
+        loaded_sources - имена загруженных файлов ('cxway', 'easymerch', ...),
+        None - ограничений нет.
+        progress - трекер фоновой задачи: прогресс по строкам иерархии и проверка отмены.
+        engine - 'vectorized' (колоночный plan_engine) или 'legacy' (построчный цикл),
+        None - config.PLAN_ENGINE. При трассировке всегда построчный (шаги каждой строки).
+        adjust=False - план без корректировок (корректировки применяются позже
+        plan_engine.apply_plan_adjustments, см. compute_core.preview_plan_adjustments).
+        """
         
-        # Ищем наш ключ
-        # Берем из visits_matches первую строку
-        if not visits_matches.empty:
-            row = visits_matches.iloc[0]
-            test_key = (row['Имя клиента'], row['Код анкеты'], row['Название проекта'], row['Регион short'])
-            st.write(f"Проверяем ключ: {test_key}")
-            
-            if test_key in project_wave_region_plans:
-                st.success(f"✅ Ключ НАЙДЕН в project_wave_region_plans! Значение: {project_wave_region_plans[test_key]}")
-            else:
-                st.error(f"❌ Ключ НЕ НАЙДЕН в project_wave_region_plans!")
-                
-                # Показываем похожие ключи
-                st.write("Похожие ключи (первые 5):")
-                similar_keys = [k for k in project_wave_region_plans.keys() if TARGET_PROJECT in k[1]]
-                for k in similar_keys[:5]:
-                    st.write(f"  - {k}: {project_wave_region_plans[k]}")
-        
-        st.write("=" * 80)
-        st.write("### 5. СИМУЛЯЦИЯ ОСНОВНОГО ЦИКЛА")
-        st.write("=" * 80)
-        
-        # ============================================================
-        # СИМУЛЯЦИЯ ОСНОВНОГО ЦИКЛА ДЛЯ КОНКРЕТНОГО ПРОЕКТА
-        # ============================================================
-        
-        # Находим строку в иерархии
-        if not hierarchy_matches.empty:
-            row = hierarchy_matches.iloc[0]
-            
-            st.write("### Шаг 5.1: Исходные данные из иерархии")
-            st.write(f"  - project_code: '{row['Проект']}'")
-            st.write(f"  - client: '{row['Клиент']}'")
-            st.write(f"  - wave_name: '{row['Волна']}'")
-            st.write(f"  - region: '{row['Регион']}'")
-            st.write(f"  - asm: '{row['ASM']}'")
-            st.write(f"  - rs: '{row['RS']}'")
-            st.write(f"  - po: '{row['ПО']}'")
-            
-            st.write("### Шаг 5.2: Определение источника (ПО)")
-            po = row['ПО']
-            client = row['Клиент']
-            project_code = row['Проект']
-            wave_name = row['Волна']
-            region = row['Регион']
-            asm = row['ASM']
-            
-            st.write(f"  - po == 'ПО клиента'? {po == 'ПО клиента'}")
-            st.write(f"  - client == 'Мултон'? {client == 'Мултон'}")
-            
-            if po == 'ПО клиента' and client == 'Мултон':
-                st.write("### Шаг 5.3: ВЕТКА JSON (Мултон)")
-                
-                # Загружаем JSON еще раз
-                plan_df = multon_manager.load_plan()
-                
-                if plan_df.empty:
-                    st.error("❌ JSON пустой! total_plan = 0")
-                    total_plan = 0
-                else:
-                    # Ищем в JSON
-                    json_mask = (plan_df['project_code'] == project_code) & \
-                                (plan_df['region'] == region) & \
-                                (plan_df['rs'] == asm)
-                    json_matches = plan_df[json_mask]
-                    
-                    st.write(f"  - Поиск в JSON по (project_code='{project_code}', region='{region}', rs='{asm}')")
-                    st.write(f"  - Найдено: {len(json_matches)} строк")
-                    
-                    if not json_matches.empty:
-                        total_plan = json_matches.iloc[0]['plan']
-                        st.success(f"✅ total_plan = {total_plan}")
-                    else:
-                        st.error("❌ Не найдено в JSON! total_plan = 0")
-                        total_plan = 0
-                        
-                        # Показываем, что есть в JSON для этого проекта
-                        st.write("Доступные записи в JSON для этого проекта:")
-                        project_json = plan_df[plan_df['project_code'] == project_code]
-                        if not project_json.empty:
-                            st.dataframe(project_json)
-                        else:
-                            st.write("Нет записей для этого проекта в JSON")
-            else:
-                st.write("### Шаг 5.3: ВЕТКА project_wave_region_plans (обычный расчет)")
-                
-                plan_key = (client, project_code, wave_name, region)
-                st.write(f"  - plan_key: {plan_key}")
-                
-                if plan_key in project_wave_region_plans:
-                    total_plan = project_wave_region_plans[plan_key]
-                    st.success(f"✅ total_plan = {total_plan}")
-                else:
-                    st.error(f"❌ Ключ не найден в project_wave_region_plans! total_plan = 0")
-                    
-                    # Показываем похожие ключи
-                    st.write("Похожие ключи:")
-                    similar = [k for k in project_wave_region_plans.keys() if k[0] == client]
-                    for k in similar[:5]:
-                        st.write(f"  - {k}: {project_wave_region_plans[k]}")
-            
-            st.write("---")
-            st.write(f"### Шаг 5.4: ИТОГОВЫЙ total_plan = {total_plan}")
-            
-            if total_plan > 0:
-                st.success("✅ Проект будет включен в план!")
-            else:
-                st.error("❌ total_plan = 0 → проект НЕ БУДЕТ включен в план!")
+        coefficients = calc_params.get('coefficients', [0.25, 0.25, 0.25, 0.25])
         
-        st.write("=" * 80)
-        st.write("🔍 ДИАГНОСТИКА ЗАВЕРШЕНА")
-        st.write("=" * 80)
+        has_cxway = loaded_sources is None or 'cxway' in loaded_sources
+        has_easymerch = loaded_sources is None or 'easymerch' in loaded_sources
         
-        # ============================================================
-        # КОНЕЦ ДИАГНОСТИКИ
-        # ============================================================
+        if plan_registry is None:
+            if plan_sources is None:
+                plan_sources = load_plan_sources_from_managers(loaded_sources)
+            plan_registry = PlanSourceRegistry(plan_sources, calc_params, loaded_sources)
+        multon_plan_df = plan_registry.multon_df
+        self.business_calendar = plan_registry.calendar
     
-
-        # ============================================
-        # ✅ ДИАГНОСТИКА
-        # ============================================
-        st.write(f"📊 calculate_hierarchical_plan_on_date:")
-        st.write(f"  hierarchy_df строк: {len(hierarchy_df)}")
-        st.write(f"  visits_df строк: {len(visits_df)}")
-        if not visits_df.empty and 'Источник' in visits_df.columns:
-            st.write(f"  Источники в visits_df: {visits_df['Источник'].unique()}")
-        if not hierarchy_df.empty and 'ПО' in hierarchy_df.columns:
-            st.write(f"  ПО в hierarchy_df: {hierarchy_df['ПО'].unique()}")
-        st.write("---")
-        # ============================================
+        tracer = self.tracer
+        tracer.summary('План', 'входные данные', lambda: {
+            'строк иерархии': len(hierarchy_df),
+            'строк визитов': len(visits_df),
+            'источники': sorted(visits_df['Источник'].astype(str).unique()) if 'Источник' in visits_df.columns else [],
+            'ПО': sorted(hierarchy_df['ПО'].astype(str).unique()) if 'ПО' in hierarchy_df.columns else []
+        })
+        if tracer.enabled:
+            self._trace_plan_inputs(hierarchy_df, visits_df, multon_plan_df)
         
         try:
             if hierarchy_df.empty or visits_df.empty:
@@ -760,174 +555,11 @@ class VisitCalculator:
                             except:
                                 pass
             
-            # Планы клиентов+проектов+волн+регионов
-            project_wave_region_plans = visits_df.groupby([
-                'Имя клиента',
-                'Код анкеты', 
-                'Название проекта',
-                'Регион short'
-            ]).size().to_dict()
-
-            # ============================================
-            # РАСЧЕТ ВЕСОВ RS ДЛЯ РАСПРЕДЕЛЕНИЯ ПЛАНА
-            # ============================================
-            rs_weights_for_plan = {}
-            
-            # Фильтруем только УДАЛЕННЫЕ записи (исключаем их)
-            status_col = None
-            for col in visits_df.columns:
-                if col.strip() == 'Статус':
-                    status_col = col
-                    break
-            
-            if status_col:
-                # Исключаем только 'Удалено'
-                not_deleted_mask = visits_df[status_col].astype(str).str.strip() != 'Удалено'
-                visits_for_weights = visits_df[not_deleted_mask].copy()
-            else:
-                visits_for_weights = visits_df.copy()
-            
-            # Группируем по (клиент, код, волна, регион, RS)
-            rs_counts = visits_for_weights.groupby([
-                'Имя клиента',
-                'Код анкеты',
-                'Название проекта',
-                'Регион short',
-                'ЭМ'  # RS
-            ]).size().reset_index(name='count')
-            
-            # Для каждой группы (клиент, код, волна, регион) считаем доли
-            if not rs_counts.empty:
-                for _, group in rs_counts.groupby(['Имя клиента', 'Код анкеты', 'Название проекта', 'Регион short']):
-                    key = (group['Имя клиента'].iloc[0], 
-                           group['Код анкеты'].iloc[0], 
-                           group['Название проекта'].iloc[0], 
-                           group['Регион short'].iloc[0])
-                    total = group['count'].sum()
-                    if total > 0:
-                        for _, row in group.iterrows():
-                            weight_key = key + (row['ЭМ'],)
-                            rs_weights_for_plan[weight_key] = row['count'] / total
-
-            # ============================================
-            # ЗАГРУЗКА КОРРЕКТИРОВОК ПЛАНА (ОДИН РАЗ)
-            # ============================================
-            plan_adjustments = {}
-            try:
-                adj_manager = get_plan_adjustment_manager()
-                all_adjustments = adj_manager.get_adjustments()
-                for adj in all_adjustments:
-                    key = f"{adj.get('project_name', '')}|{adj.get('wave_name', '')}|{adj.get('project_code', '')}"
-                    current = plan_adjustments.get(key, 0)
-                    plan_adjustments[key] = current + adj.get('adjustment_value', 0)
-            except Exception as e:
-                plan_adjustments = {}
-
-            # ============================================
-            # ЗАГРУЗКА РАСПРЕДЕЛЕНИЯ ДЛЯ МУЛЬТИБРЕНД 2024 (ОДИН РАЗ)
-            # ============================================
-            multibrand_dilers_df = pd.DataFrame()
-            multibrand_pronto_df = pd.DataFrame()
-            multibrand_loaded = False
-            
-            if 'cxway' in st.session_state.uploaded_files:
-                try:
-                    multibrand_manager = get_multibrand_plan_manager()
-                    multibrand_dilers_df, multibrand_pronto_df = multibrand_manager.load_plan()
-                    multibrand_loaded = not (multibrand_dilers_df.empty and multibrand_pronto_df.empty)
-                except:
-                    pass
+            # Корректировки плана {клиент|волна|код: сумма} - из реестра справочников
+            plan_adjustments = plan_registry.adjustments
         
-            # ============================================
-            # 2. ПРЕДВАРИТЕЛЬНЫЙ РАСЧЕТ ВЕСОВ RS
-            # ============================================
-            
-            # Создаем словарь весов RS: ключ = (проект, волна, регион)
-            rs_weights_cache = {}
-            
-            # Группируем все визиты по проекту, волне, региону и RS
-            visits_grouped = visits_df.groupby([
-                'Код анкеты', 
-                'Название проекта', 
-                'Регион short',
-                'ЭМ'  # RS колонка
-            ]).size().reset_index(name='count')
-            
-            # Для каждой комбинации считаем общее количество и долю
-            for _, group in visits_grouped.groupby(['Код анкеты', 'Название проекта', 'Регион short']):
-                key = (group['Код анкеты'].iloc[0], group['Название проекта'].iloc[0], group['Регион short'].iloc[0])
-                total = group['count'].sum()
-                if total > 0:
-                    rs_weights_cache[key] = {}
-                    for _, row in group.iterrows():
-                        rs_weights_cache[key][row['ЭМ']] = row['count'] / total
-            
-            # ============================================
-            # 3. ПРЕДВАРИТЕЛЬНЫЙ РАСЧЕТ РАСПРЕДЕЛЕНИЯ ПО РЕГИОНАМ
-            # ============================================
-            
-            # Для Мултон и ПроДата считаем количество регионов
-            multon_regions = {}
-            prodata_regions = {}
-            
-            for _, row in hierarchy_df.iterrows():
-                project_code = row['Проект']
-                po = row['ПО']
-                client = row['Клиент']
-                region = row['Регион']
-
-                # ============================================================
-                # ДИАГНОСТИКА: ВХОД В ЦИКЛ
-                # ============================================================
-                project_code = row['Проект']
-                po = row['ПО']
-                client = row['Клиент']
-                region = row['Регион']
-                asm = row['ASM']
-                start_date = row['Дата старта']
-                finish_date = row['Дата финиша']
-                duration = row['Длительность']
-                
-                is_target = (project_code == TARGET_PROJECT and 
-                             region == TARGET_REGION and 
-                             asm == TARGET_ASM)
-                
-                if is_target:
-                    st.write("=" * 80)
-                    st.write("🔍 ВХОД В ОСНОВНОЙ ЦИКЛ ДЛЯ ЦЕЛЕВОГО ПРОЕКТА!")
-                    st.write(f"  - project_code: '{project_code}'")
-                    st.write(f"  - region: '{region}'")
-                    st.write(f"  - asm: '{asm}'")
-                    st.write(f"  - po: '{po}'")
-                    st.write(f"  - client: '{client}'")
-                    st.write(f"  - start_date: {start_date}")
-                    st.write(f"  - finish_date: {finish_date}")
-                    st.write(f"  - duration: {duration}")
-                    st.write("=" * 80)
-                # ============================================================
-               
-                if po == 'ПО клиента' and client == 'Мултон':
-                    if project_code not in multon_regions:
-                        multon_regions[project_code] = set()
-                    multon_regions[project_code].add(region)
-                
-                if po == 'ПО клиента' and client == 'Мултон':
-                    if project_code not in multon_regions:
-                        multon_regions[project_code] = set()
-                    multon_regions[project_code].add(region)
-
-                elif po == 'Мониторинги':
-                    if project_code not in prodata_regions:
-                        prodata_regions[project_code] = set()
-                    prodata_regions[project_code].add(region)
-                    
-
             # === РАСШИРЕНИЕ ИЕРАРХИИ ДЛЯ МУЛТОН (добавляем проекты без визитов) ===
-            from github_settings import get_multon_plan_manager
-            multon_manager = get_multon_plan_manager()
-            plan_df = multon_manager.load_plan()
-            
-            if not plan_df.empty:
+            if plan_registry.multon:
                 # Получаем существующие комбинации из иерархии
                 existing_combinations = set(zip(
                     hierarchy_df[hierarchy_df['Клиент'] == 'Мултон']['Проект'],
@@ -935,8 +567,8 @@ class VisitCalculator:
                     hierarchy_df[hierarchy_df['Клиент'] == 'Мултон']['ASM']
                 ))
                 
-                # Получаем все комбинации из JSON
-                json_combinations = set(zip(plan_df['project_code'], plan_df['region'], plan_df['rs']))
+                # Все комбинации (код, регион, RS) плана
+                json_combinations = set(plan_registry.multon)
                 
                 # Находим недостающие комбинации
                 missing_combinations = json_combinations - existing_combinations
@@ -969,483 +601,432 @@ class VisitCalculator:
         
             
             # ============================================
-            # 4. ОСНОВНОЙ ЦИКЛ (ОПТИМИЗИРОВАННЫЙ)
+            # 4. РАСЧЕТ ПЛАНА ПО СТРОКАМ ИЕРАРХИИ
             # ============================================
             
-            results = []
-            
-            for _, row in hierarchy_df.iterrows():
-                region = row['Регион']
-                project_code = row['Проект']
-                wave_name = row['Волна']
-                po = row['ПО']
-                client = row['Клиент']
-                rs_name = row['RS']
+            # Визиты по ключу плана и доли RS - свертки куба визитов
+            if visit_cube is None:
+                visit_cube = VisitCube(visits_df, calc_params)
+            
+            engine = engine or config.PLAN_ENGINE
+            if engine == 'vectorized' and not tracer.enabled:
+                step = self.profiler.begin('Колоночный план', rows_in=len(hierarchy_df))
+                results_df = plan_rows(
+                    hierarchy_df, visit_cube, calc_params, coefficients, plan_registry,
+                    prodata_quotas=prodata_quotas,
+                    has_cxway=has_cxway,
+                    has_easymerch=has_easymerch,
+                    profiler=self.profiler
+                )
+                self.profiler.end(step, rows_out=len(results_df))
+                if progress is not None:
+                    progress.advance(len(hierarchy_df), len(hierarchy_df))
+            else:
+                step = self.profiler.begin('Построчный план', rows_in=len(hierarchy_df))
+                results_df = pd.DataFrame(self._plan_rows_legacy(
+                    hierarchy_df, calc_params, coefficients, prodata_quotas, plan_registry, visit_cube, has_cxway, has_easymerch, progress
+                ))
+                self.profiler.end(step, rows_out=len(results_df))
 
-                # ПРОВЕРКА ДАТ
-                start_date = row['Дата старта']
-                finish_date = row['Дата финиша']
-                duration = row['Длительность']
+            # ============================================
+            # ПРИМЕНЕНИЕ КОРРЕКТИРОВОК (ПОСЛЕ СБОРА ВСЕХ ДАННЫХ)
+            # ============================================
+            
+            if adjust:
+                results_df = apply_plan_adjustments(results_df, plan_adjustments, self.diag)
                 
+            if results_df.empty:
+                self.diag.warning("⚠️ calculate_hierarchical_plan_on_date: НЕТ РЕЗУЛЬТАТОВ!")
+                return pd.DataFrame()
+            return results_df
+        
+        except Exception as e:
+            print(f"Ошибка в calculate_hierarchical_plan_on_date: {e}")
+            import traceback
+            traceback.print_exc()
+            return pd.DataFrame()
+        
+    def _plan_rows_legacy(self, hierarchy_df, calc_params, coefficients, prodata_quotas,
+                          plan_registry, visit_cube, has_cxway, has_easymerch, progress=None):
+        """
+        Построчный расчет плана (цикл по иерархии) - эталон для plan_engine
+        и режим трассировки. Возвращает список строк плана до корректировок.
+        """
+        tracer = self.tracer
+        start_period = calc_params['start_date']
+        end_period = calc_params['end_date']
+        
+        # Планы клиентов+проектов+волн+регионов: визитов по ключу (все статусы)
+        project_wave_region_plans = visit_cube.plan_totals().to_dict()
 
-                if pd.isna(start_date) or pd.isna(finish_date) or duration <= 0:
-                    #ДИАГНОСТИКА
-                    if is_target:
-                        st.error("❌ ПРОПУСК #1: start_date isna, finish_date isna или duration <= 0")
-                        st.write(f"  - start_date isna: {pd.isna(start_date)}")
-                        st.write(f"  - finish_date isna: {pd.isna(finish_date)}")
-                        st.write(f"  - duration <= 0: {duration <= 0}")
-                        st.write("=" * 80)
-                     #ДИАГНОСТИКА   
-                    continue
-                
-                if end_period < start_date.date() or start_period > finish_date.date():
-                    #ДИАГНОСТИКА
-                    if is_target:
-                        st.error("❌ ПРОПУСК #2: Нет пересечения с отчетным периодом")
-                        st.write(f"  - end_period: {end_period}")
-                        st.write(f"  - start_date: {start_date.date()}")
-                        st.write(f"  - start_period: {start_period}")
-                        st.write(f"  - finish_date: {finish_date.date()}")
-                        st.write("=" * 80)
-                    #ДИАГНОСТИКА
-                    continue
-                
-                period_start = max(start_period, start_date.date())
-                period_end = min(end_period, finish_date.date())
-                days_in_period = max(0, (period_end - period_start).days + 1)
-                #ДИАГНОСТИКА
-                if days_in_period == 0:
-                    if is_target:
-                        st.error("❌ ПРОПУСК #3: days_in_period == 0")
-                        st.write(f"  - period_start: {period_start}")
-                        st.write(f"  - period_end: {period_end}")
-                        st.write(f"  - days_in_period: {days_in_period}")
-                        st.write("=" * 80)
-                    continue
-                
-                if is_target:
-                    st.success("✅ ПРОЕКТ ПРОШЕЛ ПРОВЕРКИ ДАТ! Дальше проверяем total_plan...")
-                    st.write(f"  - period_start: {period_start}")
-                    st.write(f"  - period_end: {period_end}")
-                    st.write(f"  - days_in_period: {days_in_period}")
-                #ДИАГНОСТИКА
+        # ============================================
+        # РАСЧЕТ ВЕСОВ RS ДЛЯ РАСПРЕДЕЛЕНИЯ ПЛАНА
+        # ============================================
+        # Доля RS в визитах (клиент, код, волна, регион) без удаленных визитов.
+        # Значения - np.float64 (не float из to_dict): round() ниже округляет как NumPy
+        rs_weights = visit_cube.rs_weights()
+        rs_weights_for_plan = dict(zip(rs_weights.index, rs_weights.to_numpy()))
+        
+        # ============================================
+        # 3. ПРЕДВАРИТЕЛЬНЫЙ РАСЧЕТ РАСПРЕДЕЛЕНИЯ ПО РЕГИОНАМ
+        # ============================================
+        
+        # Для Мултон и ПроДата считаем количество регионов
+        multon_regions = {}
+        prodata_regions = {}
+        
+        for _, row in hierarchy_df.iterrows():
+            project_code = row['Проект']
+            po = row['ПО']
+            client = row['Клиент']
+            region = row['Регион']
+           
+            if po == 'ПО клиента' and client == 'Мултон':
+                if project_code not in multon_regions:
+                    multon_regions[project_code] = set()
+                multon_regions[project_code].add(region)
+            
+            if po == 'ПО клиента' and client == 'Мултон':
+                if project_code not in multon_regions:
+                    multon_regions[project_code] = set()
+                multon_regions[project_code].add(region)
 
+            elif po == 'Мониторинги':
+                if project_code not in prodata_regions:
+                    prodata_regions[project_code] = set()
+                prodata_regions[project_code].add(region)
                 
-                # РАСЧЕТ КОЭФФИЦИЕНТА МЕСЯЦА (НОВАЯ ЛОГИКА)
-                # ============================================
-                start_date_google = row.get('Дата старта_гугл', None)
-                finish_date_google = row.get('Дата финиша_гугл', None)
-                
-                if pd.isna(start_date_google):
-                    start_date_google = start_date
-                if pd.isna(finish_date_google):
-                    finish_date_google = finish_date
-                
-                # Приводим все к Timestamp
-                if hasattr(start_date_google, 'date'):
-                    start_ts = pd.Timestamp(start_date_google.date())
-                elif hasattr(start_date_google, 'year'):
-                    start_ts = pd.Timestamp(start_date_google)
-                else:
-                    start_ts = pd.Timestamp(start_date.date())
+
+        # ============================================
+        # 4. ОСНОВНОЙ ЦИКЛ (ОПТИМИЗИРОВАННЫЙ)
+        # ============================================
+        
+        results = []
+        total_rows = len(hierarchy_df)
+        
+        for row_number, (_, row) in enumerate(hierarchy_df.iterrows()):
+            if progress is not None and row_number % 500 == 0:
+                progress.advance(row_number, total_rows)
+            region = row['Регион']
+            project_code = row['Проект']
+            wave_name = row['Волна']
+            po = row['ПО']
+            client = row['Клиент']
+            rs_name = row['RS']
+
+            # ПРОВЕРКА ДАТ
+            start_date = row['Дата старта']
+            finish_date = row['Дата финиша']
+            duration = row['Длительность']
+            
+            trace_row = tracer.enabled and tracer.matches(project_code, region, row['ASM'])
+            if trace_row:
+                tracer.record('План', 'строка иерархии', клиент=client, волна=wave_name, ПО=po,
+                              RS=rs_name, старт=start_date, финиш=finish_date, длительность=duration)
+
+            if pd.isna(start_date) or pd.isna(finish_date) or duration <= 0:
+                if trace_row:
+                    tracer.record('План', 'пропуск: нет дат или длительность <= 0',
+                                  старт=start_date, финиш=finish_date, длительность=duration)
+                continue
+            
+            if end_period < start_date.date() or start_period > finish_date.date():
+                if trace_row:
+                    tracer.record('План', 'пропуск: нет пересечения с периодом',
+                                  период=f"{start_period} — {end_period}",
+                                  проект=f"{start_date.date()} — {finish_date.date()}")
+                continue
+            
+            period_start = max(start_period, start_date.date())
+            period_end = min(end_period, finish_date.date())
+            days_in_period = max(0, (period_end - period_start).days + 1)
+            if days_in_period == 0:
+                if trace_row:
+                    tracer.record('План', 'пропуск: 0 дней в периоде',
+                                  начало=period_start, конец=period_end)
+                continue
+
+            
+            # РАСЧЕТ КОЭФФИЦИЕНТА МЕСЯЦА (НОВАЯ ЛОГИКА)
+            # ============================================
+            start_date_google = row.get('Дата старта_гугл', None)
+            finish_date_google = row.get('Дата финиша_гугл', None)
+            
+            if pd.isna(start_date_google):
+                start_date_google = start_date
+            if pd.isna(finish_date_google):
+                finish_date_google = finish_date
+            
+            # Приводим все к Timestamp
+            if hasattr(start_date_google, 'date'):
+                start_ts = pd.Timestamp(start_date_google.date())
+            elif hasattr(start_date_google, 'year'):
+                start_ts = pd.Timestamp(start_date_google)
+            else:
+                start_ts = pd.Timestamp(start_date.date())
+            
+            if hasattr(finish_date_google, 'date'):
+                finish_ts = pd.Timestamp(finish_date_google.date())
+            elif hasattr(finish_date_google, 'year'):
+                finish_ts = pd.Timestamp(finish_date_google)
+            else:
+                finish_ts = pd.Timestamp(finish_date.date())
+            
+            # Границы текущего месяца
+            month_start_ts = pd.Timestamp(calc_params['start_date'])
+            month_end_ts = month_start_ts + pd.offsets.MonthEnd(1)
+            
+            # ============================================
+            # ОПРЕДЕЛЯЕМ СЦЕНАРИЙ
+            # ============================================
+            
+            # Приводим к date для корректного сравнения (если нужно)
+            start_date_clean = start_ts.date() if hasattr(start_ts, 'date') else start_ts
+            finish_date_clean = finish_ts.date() if hasattr(finish_ts, 'date') else finish_ts
+            month_start_clean = month_start_ts.date() if hasattr(month_start_ts, 'date') else month_start_ts
+            month_end_clean = month_end_ts.date() if hasattr(month_end_ts, 'date') else month_end_ts
+            
+            # Флаги для определения сценария
+            project_starts_in_month = start_date_clean >= month_start_clean
+            project_ends_in_month = finish_date_clean <= month_end_clean
+            project_continues_after_month = finish_date_clean > month_end_clean
+            project_started_before_month = start_date_clean < month_start_clean
+            
+            # ============================================
+            # СЦЕНАРИЙ 1: Проект начался в этом месяце
+            # ============================================
+            if project_starts_in_month and project_continues_after_month:
+                # Текущая логика: знаменатель = весь проект
+                project_start_in_month = max(start_ts, month_start_ts)
+                project_end_in_month = min(finish_ts, month_end_ts)
+                working_days_in_month = self._get_working_days_in_range(
+                    project_start_in_month, 
+                    project_end_in_month
+                )
+                total_working_days = self._get_working_days_in_range(start_ts, finish_ts)
                 
-                if hasattr(finish_date_google, 'date'):
-                    finish_ts = pd.Timestamp(finish_date_google.date())
-                elif hasattr(finish_date_google, 'year'):
-                    finish_ts = pd.Timestamp(finish_date_google)
+                if total_working_days > 0:
+                    month_coefficient = working_days_in_month / total_working_days
                 else:
-                    finish_ts = pd.Timestamp(finish_date.date())
-                
-                # Границы текущего месяца
-                month_start_ts = pd.Timestamp(calc_params['start_date'])
-                month_end_ts = month_start_ts + pd.offsets.MonthEnd(1)
+                    month_coefficient = 1.0
+            
+            # ============================================
+            # СЦЕНАРИЙ 2: Проект начался ДО месяца и продолжается ПОСЛЕ месяца
+            # ============================================
+            elif project_started_before_month and project_continues_after_month:
+                # НОВАЯ ЛОГИКА: знаменатель = рабочие дни от начала проекта до конца месяца
+                project_start_in_month = max(start_ts, month_start_ts)
+                project_end_in_month = min(finish_ts, month_end_ts)
                 
-                # ============================================
-                # ОПРЕДЕЛЯЕМ СЦЕНАРИЙ
-                # ============================================
+                working_days_in_month = self._get_working_days_in_range(
+                    project_start_in_month, 
+                    project_end_in_month
+                )
                 
-                # Приводим к date для корректного сравнения (если нужно)
-                start_date_clean = start_ts.date() if hasattr(start_ts, 'date') else start_ts
-                finish_date_clean = finish_ts.date() if hasattr(finish_ts, 'date') else finish_ts
-                month_start_clean = month_start_ts.date() if hasattr(month_start_ts, 'date') else month_start_ts
-                month_end_clean = month_end_ts.date() if hasattr(month_end_ts, 'date') else month_end_ts
+                # 🔥 КЛЮЧЕВОЕ ОТЛИЧИЕ: знаменатель до конца месяца, а не до конца проекта
+                total_working_days = self._get_working_days_in_range(start_ts, month_end_ts)
                 
-                # Флаги для определения сценария
-                project_starts_in_month = start_date_clean >= month_start_clean
-                project_ends_in_month = finish_date_clean <= month_end_clean
-                project_continues_after_month = finish_date_clean > month_end_clean
-                project_started_before_month = start_date_clean < month_start_clean
+                if total_working_days > 0:
+                    month_coefficient = working_days_in_month / total_working_days
+                else:
+                    month_coefficient = 1.0
+            
+            # ============================================
+            # СЦЕНАРИЙ 3: Проект начался ДО месяца и заканчивается В месяце
+            # ============================================
+            elif project_started_before_month and project_ends_in_month:
+                # Коэффициент = 1 (весь план проекта должен быть выполнен в этом месяце)
+                month_coefficient = 1.0
+            
+            # ============================================
+            # DEFAULT: если ни одно условие не подошло
+            # ============================================
+            else:
+                month_coefficient = 1.0
+            # ============================================
+            
+            if trace_row:
+                tracer.record('План', 'коэффициент месяца', коэффициент=month_coefficient,
+                              старт_гугл=start_ts.date(), финиш_гугл=finish_ts.date(),
+                              дней_в_периоде=days_in_period)
+            
+            
+            if days_in_period == 0:
+                continue
+            
+            # Определяем total_plan и считаем план на дату
+            if po == 'Мониторинги':
+                total_plan = prodata_quotas.get(project_code, 0)
+                if total_plan <= 0:
+                    if trace_row:
+                        tracer.record('План', 'пропуск: нет квоты ПроДата', ветка='Мониторинги')
+                    continue
+                num_regions = len(prodata_regions.get(project_code, []))
+                if num_regions > 0:
+                    total_plan = total_plan / num_regions
+                # Мониторинги: старая логика, без этапов
+                rs_plan_on_date = total_plan
+                rs_daily_plan = total_plan
+                asm_from_plan = row['ASM'] 
+                rs_from_plan = row['RS']
+                skip_plan_correction = False
+            
+            else:
+                # Для всех остальных типов (Чеккер, CXWAY, Easymerch, Мултон, Оптима)
+                # Сначала рассчитываем total_plan (как раньше)
                 
-                # ============================================
-                # СЦЕНАРИЙ 1: Проект начался в этом месяце
-                # ============================================
-                if project_starts_in_month and project_continues_after_month:
-                    # Текущая логика: знаменатель = весь проект
-                    project_start_in_month = max(start_ts, month_start_ts)
-                    project_end_in_month = min(finish_ts, month_end_ts)
-                    working_days_in_month = self._get_working_days_in_range(
-                        project_start_in_month, 
-                        project_end_in_month
-                    )
-                    total_working_days = self._get_working_days_in_range(start_ts, finish_ts)
+                if po == 'ПО клиента' and client == 'Мултон':
+                    # Проверяем, загружен ли Easymerch
+                    if not has_easymerch:
+                        if trace_row:
+                            tracer.record('План', 'пропуск: Easymerch не загружен', ветка='Мултон')
+                        continue
+                        
+                    # Распределение плана из JSON (индекс реестра справочников)
+                    total_plan = plan_registry.multon_plan(project_code, region, row['ASM'])
                     
-                    if total_working_days > 0:
-                        month_coefficient = working_days_in_month / total_working_days
-                    else:
-                        month_coefficient = 1.0
-                
-                # ============================================
-                # СЦЕНАРИЙ 2: Проект начался ДО месяца и продолжается ПОСЛЕ месяца
-                # ============================================
-                elif project_started_before_month and project_continues_after_month:
-                    # НОВАЯ ЛОГИКА: знаменатель = рабочие дни от начала проекта до конца месяца
-                    project_start_in_month = max(start_ts, month_start_ts)
-                    project_end_in_month = min(finish_ts, month_end_ts)
+                    if trace_row:
+                        tracer.record('План', 'ветка Мултон (план из JSON)', строк_JSON=len(plan_registry.multon_df),
+                                      total_plan=total_plan)
                     
-                    working_days_in_month = self._get_working_days_in_range(
-                        project_start_in_month, 
-                        project_end_in_month
-                    )
+                    asm_from_plan = row['ASM']
+                    rs_from_plan = row['RS']
+                    skip_plan_correction = False
                     
-                    # 🔥 КЛЮЧЕВОЕ ОТЛИЧИЕ: знаменатель до конца месяца, а не до конца проекта
-                    total_working_days = self._get_working_days_in_range(start_ts, month_end_ts)
+                    if total_plan <= 0:
+                        if trace_row:
+                            tracer.record('План', 'пропуск: total_plan <= 0', ветка='Мултон')
+                        continue
                     
-                    if total_working_days > 0:
-                        month_coefficient = working_days_in_month / total_working_days
-                    else:
-                        month_coefficient = 1.0
-                
-                # ============================================
-                # СЦЕНАРИЙ 3: Проект начался ДО месяца и заканчивается В месяце
-                # ============================================
-                elif project_started_before_month and project_ends_in_month:
-                    # Коэффициент = 1 (весь план проекта должен быть выполнен в этом месяце)
-                    month_coefficient = 1.0
-                
-                # ============================================
-                # DEFAULT: если ни одно условие не подошло
-                # ============================================
-                else:
-                    month_coefficient = 1.0
-                # ============================================
-                
-                
-                if days_in_period == 0:
-                    continue
+                    # 🔥 РАСЧЕТ ПЛАНА НА ДАТУ ДЛЯ МУЛТОН
+                    rs_plan_on_date, rs_daily_plan = self.calculate_plan_with_stages(
+                        total_plan,
+                        duration,
+                        coefficients,
+                        start_date,
+                        finish_date,
+                        period_start,
+                        period_end
+                    )
                 
-                # Определяем total_plan и считаем план на дату
-                if po == 'Мониторинги':
-                    total_plan = prodata_quotas.get(project_code, 0)
-                    if total_plan <= 0:
+                elif client == 'Мультибренд 2024' and po == 'CXWAY':
+                    # Проверяем, загружен ли CXWAY
+                    if not has_cxway:
                         continue
-                    num_regions = len(prodata_regions.get(project_code, []))
-                    if num_regions > 0:
-                        total_plan = total_plan / num_regions
-                    # Мониторинги: старая логика, без этапов
-                    rs_plan_on_date = total_plan
-                    rs_daily_plan = total_plan
-                    asm_from_plan = row['ASM'] 
+                    
+                    # 1. Определяем тип волны по названию (после последнего '_')
+                    wave_parts = wave_name.split('_')
+                    if len(wave_parts) >= 2:
+                        wave_type = '_'.join(wave_parts[1:])
+                    else:
+                        wave_type = wave_name
+                    
+                    # 2. Определяем план в зависимости от типа волны
+                    asm_from_plan = row['ASM']
                     rs_from_plan = row['RS']
                     skip_plan_correction = False
-                
-                else:
-                    # Для всех остальных типов (Чеккер, CXWAY, Easymerch, Мултон, Оптима)
-                    # Сначала рассчитываем total_plan (как раньше)
                     
-                    if po == 'ПО клиента' and client == 'Мултон':
-                        # Проверяем, загружен ли Easymerch
-                        if 'easymerch' not in st.session_state.uploaded_files:
-                            if is_target:
-                                st.error("❌ ПРОПУСК #4a: Easymerch не загружен")
-                                st.write("=" * 80)
-                            continue
-                            
-                        # Загружаем распределение плана из JSON
-                        from github_settings import get_multon_plan_manager
-                        multon_manager = get_multon_plan_manager()
-                        plan_df = multon_manager.load_plan()
-                        
-                        if is_target:
-                            st.write(f"  - JSON загружен: {not plan_df.empty}, строк: {len(plan_df)}")
-                        
-                        if plan_df.empty:
-                            total_plan = 0
-                            if is_target:
-                                st.error("❌ JSON пустой!")
-                        else:
-                            mask = (plan_df['project_code'] == project_code) & \
-                                   (plan_df['region'] == region) & \
-                                   (plan_df['rs'] == row['ASM'])
-                            
-                            if is_target:
-                                st.write(f"  - Поиск в JSON: project_code='{project_code}', region='{region}', rs='{row['ASM']}'")
-                                st.write(f"  - Найдено: {mask.any()}")
-                            
-                            if mask.any():
-                                total_plan = plan_df.loc[mask, 'plan'].iloc[0]
-                                if is_target:
-                                    st.write(f"  - total_plan из JSON: {total_plan}")
-                            else:
-                                total_plan = 0
-                                if is_target:
-                                    st.warning("⚠️ Не найдено в JSON!")
-                        
-                        asm_from_plan = row['ASM']
-                        rs_from_plan = row['RS']
-                        skip_plan_correction = False
-                        
-                        if total_plan <= 0:
-                            if is_target:
-                                st.error("❌ ПРОПУСК #4: total_plan <= 0 (Мултон)")
-                                st.write("=" * 80)
-                            continue
+                    if wave_type == 'Нерезультативные_Пронто_Дилеры':
+                        total_plan = 0
+                        skip_plan_correction = True
+                        if trace_row:
+                            tracer.record('План', 'пропуск: нерезультативная волна', ветка='Мультибренд')
+                        continue
                         
-                        # 🔥 РАСЧЕТ ПЛАНА НА ДАТУ ДЛЯ МУЛТОН
-                        rs_plan_on_date, rs_daily_plan = self.calculate_plan_with_stages(
-                            total_plan,
-                            duration,
-                            coefficients,
-                            start_date,
-                            finish_date,
-                            period_start,
-                            period_end
-                        )
+                    else:
+                        # Дилеры - по короткому коду региона, Пронто - по региону и типу волны
+                        total_plan = plan_registry.multibrand_plan(region, wave_type)
                     
-                    elif client == 'Мультибренд 2024' and po == 'CXWAY':
-                        # Проверяем, загружен ли CXWAY
-                        if 'cxway' not in st.session_state.uploaded_files:
-                            continue
-                        
-                        # 1. Определяем тип волны по названию (после последнего '_')
-                        wave_parts = wave_name.split('_')
-                        if len(wave_parts) >= 2:
-                            wave_type = '_'.join(wave_parts[1:])
-                        else:
-                            wave_type = wave_name
-                        
-                        # 2. Определяем план в зависимости от типа волны
-                        asm_from_plan = row['ASM']
-                        rs_from_plan = row['RS']
-                        skip_plan_correction = False
-                        
-                        if wave_type == 'Нерезультативные_Пронто_Дилеры':
-                            total_plan = 0
-                            skip_plan_correction = True
-                            continue
-                            
-                        elif wave_type == 'Дилеры':
-                            # ИСПРАВЛЕНО: region_code → region_short
-                            plan_row = multibrand_dilers_df[multibrand_dilers_df['region_short'] == region]
-                            if not plan_row.empty:
-                                total_plan = plan_row.iloc[0]['plan']
-                            else:
-                                total_plan = 0
-                            
-                        elif wave_type == 'Пронто' or wave_type == 'Пронто М':
-                            # Поиск по короткому коду региона и типу волны
-                            if 'wave_type' in multibrand_pronto_df.columns:
-                                plan_row = multibrand_pronto_df[
-                                    (multibrand_pronto_df['region_short'] == region) &
-                                    (multibrand_pronto_df['wave_type'] == wave_type)
-                                ]
-                            else:
-                                plan_row = multibrand_pronto_df[multibrand_pronto_df['region_short'] == region]
-                            
-                            if not plan_row.empty:
-                                total_plan = plan_row.iloc[0]['plan']
-                            else:
-                                total_plan = 0
-                            
-                        else:
-                            total_plan = 0
-                        
-                        if total_plan <= 0 and not skip_plan_correction:
-                            continue
-                        
-                        # Рассчитываем план на дату с учетом этапов
-                        rs_plan_on_date, rs_daily_plan = self.calculate_plan_with_stages(
-                            total_plan,
-                            duration,
-                            coefficients,
-                            start_date,
-                            finish_date,
-                            period_start,
-                            period_end
-                        )
-    
-                    else:  # Чеккер, CXWAY (другие), Easymerch, Optima
-                        client_name = row['Клиент']
-                        plan_key = (client_name, project_code, wave_name, region)
-                        total_plan = project_wave_region_plans.get(plan_key, 0)
+                    if trace_row:
+                        tracer.record('План', 'ветка Мультибренд', тип_волны=wave_type, total_plan=total_plan)
                     
-                        asm_from_plan = row['ASM']
-                        rs_from_plan = rs_name
-                        skip_plan_correction = False
-                        
-                        if total_plan <= 0:
-                            continue
-                        
-                        # ПРИМЕНЯЕМ КОЭФФИЦИЕНТ МЕСЯЦА
-                        total_plan = round(total_plan * month_coefficient, 1)
-                        
-                        # Распределяем план по RS с помощью весов
-                        weight_key = (client_name, project_code, wave_name, region, rs_name)
-                        weight = rs_weights_for_plan.get(weight_key, 0)
-                        
-                        if weight > 0:
-                            total_plan = round(total_plan * weight, 1)
-                        
-                        # ✅ ДОБАВЛЯЕМ ПРОВЕРКУ!
-                        if total_plan <= 0:
-                            continue
-                        
-                        # Рассчитываем план на дату с учетом этапов
-                        rs_plan_on_date, rs_daily_plan = self.calculate_plan_with_stages(
-                            total_plan,
-                            duration,
-                            coefficients,
-                            start_date,
-                            finish_date,
-                            period_start,
-                            period_end
-                        )
-
-                # ============================================================
-                # 🔥 ДИАГНОСТИКА В ОСНОВНОМ ЦИКЛЕ (для целевого проекта)
-                # ============================================================
-                if project_code == TARGET_PROJECT and region == TARGET_REGION and asm == TARGET_ASM:
-                    st.write("=" * 80)
-                    st.write("🔍 ОСНОВНОЙ ЦИКЛ: ДОСТИГЛИ ЦЕЛЕВОГО ПРОЕКТА!")
-                    st.write(f"  - total_plan = {total_plan}")
-                    st.write(f"  - duration = {duration}")
-                    st.write(f"  - start_date = {start_date}")
-                    st.write(f"  - finish_date = {finish_date}")
-                    st.write(f"  - period_start = {period_start}")
-                    st.write(f"  - period_end = {period_end}")
-                    st.write(f"  - days_in_period = {days_in_period}")
-                    st.write(f"  - coefficients = {coefficients}")
+                    if total_plan <= 0 and not skip_plan_correction:
+                        continue
                     
-                    # Проверка calculate_plan_with_stages
+                    # Рассчитываем план на дату с учетом этапов
                     rs_plan_on_date, rs_daily_plan = self.calculate_plan_with_stages(
-                        total_plan, duration, coefficients, start_date, finish_date, period_start, period_end
+                        total_plan,
+                        duration,
+                        coefficients,
+                        start_date,
+                        finish_date,
+                        period_start,
+                        period_end
                     )
-                    st.write(f"  - rs_plan_on_date = {rs_plan_on_date}")
-                    st.write(f"  - rs_daily_plan = {rs_daily_plan}")
-                    
-                    if rs_plan_on_date <= 0:
-                        st.error("❌ rs_plan_on_date = 0! Проект НЕ БУДЕТ добавлен в results!")
-                    else:
-                        st.success("✅ rs_plan_on_date > 0! Проект будет добавлен в results!")
-                    st.write("=" * 80)
-                # ============================================================
-                
-                #ДИАГНОСТИКА
-                if is_target:
-                    st.success("✅ ПРОЕКТ ПРОШЕЛ ВСЕ ПРОВЕРКИ! Будет добавлен в results!")
-                    st.write("=" * 80)
-                #ДИАГНОСТИКА
-
-                results.append({
-                    'Проект': project_code,
-                    'Клиент': row['Клиент'],
-                    'Волна': wave_name,
-                    'Регион': region,
-                    'DSM': row['DSM'],
-                    'ASM': asm_from_plan,
-                    'RS': rs_from_plan,
-                    'ПО': po,
-                    'Уровень': 'RS',
-                    'План проекта, шт.': total_plan,
-                    'План на дату, шт.': round(rs_plan_on_date, 1),
-                    'Длительность': int(duration),
-                    'Дата старта': start_date,
-                    'Дата финиша': finish_date,
-                    'Дата старта_гугл': start_date_google,     
-                    'Дата финиша_гугл': finish_date_google,    
-                    'Коэффициент месяца': month_coefficient,
-                    'Метод подбора дат': row['Метод подбора дат'],
-                    'Дней в периоде': days_in_period,
-                    'Дневной план RS, шт.': round(rs_daily_plan, 2),
-                    'skip_plan_correction': skip_plan_correction
-                })
 
-
-            # ============================================
-            # ПРИМЕНЕНИЕ КОРРЕКТИРОВОК (ПОСЛЕ СБОРА ВСЕХ ДАННЫХ)
-            # ============================================        
-                    
-            if plan_adjustments and results:
-                # Преобразуем в DataFrame
-                results_df = pd.DataFrame(results)
-                
-                # Создаем ключ проекта (клиент + волна + код)
-                results_df['_project_key'] = (
-                    results_df['Клиент'].astype(str).str.strip() + '|' +
-                    results_df['Волна'].astype(str).str.strip() + '|' +
-                    results_df['Проект'].astype(str).str.strip()
-                )
+                else:  # Чеккер, CXWAY (другие), Easymerch, Optima
+                    client_name = row['Клиент']
+                    plan_key = (client_name, project_code, wave_name, region)
+                    total_plan = project_wave_region_plans.get(plan_key, 0)
                 
-                # 1. Считаем общий план проекта
-                project_totals = results_df.groupby('_project_key')['План проекта, шт.'].sum().to_dict()
-                
-                # 2. Применяем корректировки
-                adjusted_totals = {}
-                for key, total in project_totals.items():
-                    adjustment = plan_adjustments.get(key, 0)
-                    new_total = total + adjustment
-                    if new_total < 0:
-                        st.warning(f"⚠️ Корректировка {adjustment} для проекта {key} делает план отрицательным ({total} + {adjustment} = {new_total}). Корректировка НЕ применена.")
-                        adjusted_totals[key] = total
-                    else:
-                        adjusted_totals[key] = new_total
-                
-                # 3. Вычисляем коэффициенты корректировки
-                correction_factors = {}
-                for key in project_totals:
-                    if project_totals[key] > 0:
-                        correction_factors[key] = adjusted_totals[key] / project_totals[key]
-                    else:
-                        correction_factors[key] = 1
-                
-                # 4. Применяем коэффициенты к каждой строке
-                for idx, row in results_df.iterrows():
-                    # Пропускаем строки с флагом skip_plan_correction
-                    if row.get('skip_plan_correction', False):
+                    asm_from_plan = row['ASM']
+                    rs_from_plan = rs_name
+                    skip_plan_correction = False
+                    
+                    if total_plan <= 0:
+                        if trace_row:
+                            tracer.record('План', 'пропуск: нет визитов по ключу плана', ключ=plan_key)
                         continue
-                    key = row['_project_key']
-                    coeff = correction_factors.get(key, 1)
                     
-                    if coeff != 1:
-                        old_plan = row['План проекта, шт.']
-                        new_plan = old_plan * coeff
-                        
-                        old_plan_date = row['План на дату, шт.']
-                        new_plan_date = old_plan_date * coeff
-                        
-                        results_df.at[idx, 'План проекта, шт.'] = float(new_plan)
-                        results_df.at[idx, 'План на дату, шт.'] = round(new_plan_date, 1)
-                        
-                        if 'Дней в периоде' in results_df.columns:
-                            days = row['Дней в периоде']
-                            if days > 0:
-                                results_df.at[idx, 'Дневной план RS, шт.'] = round(new_plan_date / days, 2)
-                
-                # Удаляем временную колонку
-                results_df = results_df.drop('_project_key', axis=1)
-                
-                # Обновляем results
-                results = results_df.to_dict('records')
-            if not results:
-                st.warning("⚠️ calculate_hierarchical_plan_on_date: НЕТ РЕЗУЛЬТАТОВ!")
-                return pd.DataFrame()
-            return pd.DataFrame(results)
+                    # ПРИМЕНЯЕМ КОЭФФИЦИЕНТ МЕСЯЦА
+                    visits_plan = total_plan
+                    total_plan = round(total_plan * month_coefficient, 1)
+                    
+                    # Распределяем план по RS с помощью весов
+                    weight_key = (client_name, project_code, wave_name, region, rs_name)
+                    weight = rs_weights_for_plan.get(weight_key, 0)
+                    
+                    if weight > 0:
+                        total_plan = round(total_plan * weight, 1)
+                    
+                    if trace_row:
+                        tracer.record('План', 'ветка визитов', визитов=visits_plan,
+                                      коэффициент_месяца=month_coefficient, вес_RS=weight, total_plan=total_plan)
+                    
+                    # ✅ ДОБАВЛЯЕМ ПРОВЕРКУ!
+                    if total_plan <= 0:
+                        continue
+                    
+                    # Рассчитываем план на дату с учетом этапов
+                    rs_plan_on_date, rs_daily_plan = self.calculate_plan_with_stages(
+                        total_plan,
+                        duration,
+                        coefficients,
+                        start_date,
+                        finish_date,
+                        period_start,
+                        period_end
+                    )
+
+            if trace_row:
+                tracer.record('План', 'план на дату', total_plan=total_plan, коэффициенты=coefficients,
+                              план_на_дату=round(rs_plan_on_date, 1), дневной_план=round(rs_daily_plan, 2))
+
+            results.append({
+                'Проект': project_code,
+                'Клиент': row['Клиент'],
+                'Волна': wave_name,
+                'Регион': region,
+                'DSM': row['DSM'],
+                'ASM': asm_from_plan,
+                'RS': rs_from_plan,
+                'ПО': po,
+                'Уровень': 'RS',
+                'План проекта, шт.': total_plan,
+                'План на дату, шт.': round(rs_plan_on_date, 1),
+                'Длительность': int(duration),
+                'Дата старта': start_date,
+                'Дата финиша': finish_date,
+                'Дата старта_гугл': start_date_google,     
+                'Дата финиша_гугл': finish_date_google,    
+                'Коэффициент месяца': month_coefficient,
+                'Метод подбора дат': row['Метод подбора дат'],
+                'Дней в периоде': days_in_period,
+                'Дневной план RS, шт.': round(rs_daily_plan, 2),
+                'skip_plan_correction': skip_plan_correction
+            })
         
-        except Exception as e:
-            print(f"Ошибка в calculate_hierarchical_plan_on_date: {e}")
-            import traceback
-            traceback.print_exc()
-            return pd.DataFrame()
+        return results
         
     def calculate_dynamics_fact(self, visits_df, calc_params, group_cols):
         """
@@ -1517,146 +1098,59 @@ class VisitCalculator:
         
         return result
     
-    def calculate_hierarchical_fact_on_date(self, plan_df, visits_df, calc_params, status_filter='completed'):
+    def calculate_hierarchical_fact_on_date(self, plan_df, visits_df, calc_params, status_filter='completed',
+                                            visit_cube=None):
+        """
+        Факт по строкам RS плана для группы статусов: 'completed' (выполненные),
+        'assigned' (порученные), 'not_assigned' (не порученные).
+        visit_cube - куб визитов расчета (visit_cube.VisitCube), None - строится по visits_df.
+        """
         try:
             if plan_df.empty or visits_df.empty:
                 return pd.DataFrame()
             
             result_df = plan_df.copy()
-            region_col = 'Регион short'
-            
-            # Ищем колонку статуса
+            if visit_cube is None:
+                visit_cube = VisitCube(visits_df, calc_params)
             
-            status_col = None
-            for col in visits_df.columns:
-                col_clean = col.strip()
-                if col_clean == 'Статус':
-                    status_col = col
-                    break
-            
-            if not status_col:
+            # Нет колонки статуса или RS - факта нет
+            if not visit_cube.status_col or not visit_cube.rs_col:
                 result_df['Факт проекта, шт.'] = 0
                 result_df['Факт на дату, шт.'] = 0
                 return result_df
             
-            # Ищем колонку RS
-            rs_col = None
-            for col in visits_df.columns:
-                if any(name in str(col).lower() for name in ['эм', 'rs']):
-                    rs_col = col
-                    break
-            
-            if not rs_col:
-                result_df['Факт проекта, шт.'] = 0
-                result_df['Факт на дату, шт.'] = 0
-                return result_df
+            # Суффикс колонок по группе статусов
+            suffix = {'assigned': '_поручено', 'not_assigned': '_не_поручено'}.get(status_filter, '')
             
-            # ФИЛЬТРЫ
-            # КОНВЕРТИРУЕМ ДАТУ ВИЗИТА
-            if 'Дата визита' in visits_df.columns:
-                # ПРОСТО: pandas сам определит формат
-                visits_df['Дата визита'] = pd.to_datetime(
-                    visits_df['Дата визита'], 
-                    errors='coerce',
-                    dayfirst=True
-                )
-                
-                # Нормализуем к началу дня (00:00:00)
-                visits_df['Дата визита'] = visits_df['Дата визита'].dt.normalize()
-            
-            # ФИЛЬТРЫ - выбор статуса в зависимости от параметра
-            if status_filter == 'completed':
-                status_mask = visits_df[status_col].isin([
-                    'Выполнено', 'выполнен',
-                    'Заполнена', 'Проверена', 'Принята',
-                    'Завершено', 'Готово'
-                ])
-                suffix = ''
-            elif status_filter == 'assigned':
-                status_mask = visits_df[status_col].astype(str).str.strip() == 'Поручено'
-                suffix = '_поручено'
-            elif status_filter == 'not_assigned':
-                status_mask = visits_df[status_col].astype(str).str.strip() == 'Не поручено'
-                suffix = '_не_поручено'
-            else:
-                status_mask = None
-                suffix = ''
-                
-            start_date = pd.Timestamp(calc_params['start_date'])
-            end_date = pd.Timestamp(calc_params['end_date'])
-            period_mask = (
-                (visits_df['Дата визита'] >= start_date) &
-                (visits_df['Дата визита'] <= end_date)
-            )
-
-            # СЧИТАЕМ ФАКТЫ
-            filtered_df = visits_df[status_mask]
-            rs_facts_total = filtered_df.groupby([
-                'Имя клиента',
-                'Код анкеты',
-                'Название проекта',
-                region_col,
-                'АСС',
-                rs_col
-            ]).size().to_dict()
-
-            # Суммируем оплату по группам
-            payment_sum = filtered_df.groupby([
-                'Имя клиента',
-                'Код анкеты',
-                'Название проекта',
-                region_col,
-                'АСС',
-                rs_col
-            ])['Оплата факт'].sum().to_dict()
-            
-            # Если нет колонки "Дата визита" — факт на дату = факт проекта
-            if 'Дата визита' in visits_df.columns:
-                start_date = pd.Timestamp(calc_params['start_date'])
-                end_date = pd.Timestamp(calc_params['end_date'])
-                period_mask = (
-                    (visits_df['Дата визита'] >= start_date) &
-                    (visits_df['Дата визита'] <= end_date)
-                )
-                filtered_in_period = visits_df[status_mask & period_mask]
-                rs_facts_period = filtered_in_period.groupby([
-                    'Имя клиента',
-                    'Код анкеты',
-                    'Название проекта',
-                    region_col,
-                    'АСС',
-                    rs_col
-                ]).size().to_dict()
-            else:
-                # Для Optima и других без дат
-                rs_facts_period = rs_facts_total.copy()
+            # СЧИТАЕМ ФАКТЫ: свертка куба по (клиент, код, волна, регион, АСС, RS)
+            rs_facts_total, rs_facts_period, payment_sum = visit_cube.facts(status_filter)
     
             # ✅ СОЗДАЁМ КОЛОНКИ
             result_df[f'Факт проекта{suffix}, шт.'] = 0
             result_df[f'Факт на дату{suffix}, шт.'] = 0
             
-            # ✅ ЗАПОЛНЯЕМ
-            for idx in result_df[result_df['Уровень'] == 'RS'].index:
-                row = result_df.loc[idx]
-                project = str(row['Проект']).strip()
-                wave = str(row['Волна']).strip()
-                region = str(row['Регион']).strip()
-                rs = str(row['RS']).strip()
+            # ✅ ЗАПОЛНЯЕМ строки RS по ключу строки плана
+            rs_rows = (result_df['Уровень'] == 'RS').to_numpy()
+            if rs_rows.any():
+                keys = pd.MultiIndex.from_arrays([
+                    result_df.loc[rs_rows, col].astype(str).str.strip()
+                    for col in ['Клиент', 'Проект', 'Волна', 'Регион', 'ASM', 'RS']
+                ])
                 
-                client_name = str(row['Клиент']).strip()
-                asm = str(row['ASM']).strip()
-                key = (client_name, project, wave, region, asm, rs)
-                result_df.at[idx, f'Факт проекта{suffix}, шт.'] = rs_facts_total.get(key, 0)
-                result_df.at[idx, f'Факт на дату{suffix}, шт.'] = rs_facts_period.get(key, 0)
-                if suffix == '':
-                    result_df.at[idx, 'Оплата факт'] = payment_sum.get(key, 0)
-                else:
-                    result_df.at[idx, f'Оплата{suffix}'] = payment_sum.get(key, 0)
+                def values(series):
+                    if series.empty:
+                        return np.zeros(len(keys))
+                    return series.reindex(keys).fillna(0).to_numpy()
+                
+                result_df.loc[rs_rows, f'Факт проекта{suffix}, шт.'] = values(rs_facts_total).astype('int64')
+                result_df.loc[rs_rows, f'Факт на дату{suffix}, шт.'] = values(rs_facts_period).astype('int64')
+                payment_col = 'Оплата факт' if suffix == '' else f'Оплата{suffix}'
+                result_df.loc[rs_rows, payment_col] = values(payment_sum)
             
             return result_df
             
         except Exception as e:
-            st.error(f"❌ Ошибка: {e}")
+            self.diag.error(f"❌ Ошибка: {e}")
             return pd.DataFrame()
 
 
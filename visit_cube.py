@@ -0,0 +1,137 @@
+# visit_cube.py
+# draft 4.1 - simplified
+"""
+Куб визитов: одна группировка таблицы визитов на весь расчет.
+Визиты считаются по ключу (клиент, код, волна, регион, АСС, RS, группа
+статуса, визит в периоде) вместе с суммой оплаты. План по визитам,
+доли RS и все варианты факта (выполненные, порученные, не порученные;
+всего и на дату) получаются суммированием строк куба, без повторных
+проходов по визитам.
+"""
+import numpy as np
+import pandas as pd
+
+# Ключ плана по визитам
+PLAN_KEYS = ['Имя клиента', 'Код анкеты', 'Название проекта', 'Регион short']
+# Колонка RS для долей плана
+WEIGHT_RS_COL = 'ЭМ'
+
+# Группы статусов визита
+BUCKET_COMPLETED = 'completed'
+BUCKET_ASSIGNED = 'assigned'
+BUCKET_NOT_ASSIGNED = 'not_assigned'
+BUCKET_DELETED = 'deleted'
+BUCKET_OTHER = 'other'
+COMPLETED_STATUSES = ['Выполнено', 'выполнен', 'Заполнена', 'Проверена', 'Принята', 'Завершено', 'Готово']
+
+# Служебные колонки куба
+BUCKET_COL = '_Статус'
+PERIOD_COL = '_В периоде'
+
+
+def find_status_column(visits_df):
+    """Колонка статуса визита (имя может быть с пробелами), None - нет"""
+    return next((col for col in visits_df.columns if col.strip() == 'Статус'), None)
+
+
+def find_rs_column(visits_df):
+    """Колонка RS для факта: первая, в имени которой есть 'эм' или 'rs', None - нет"""
+    return next((col for col in visits_df.columns if any(name in str(col).lower() for name in ['эм', 'rs'])), None)
+
+
+def normalize_visit_dates(visits_df):
+    """Дата визита → datetime без времени (на месте, как ждут отчеты после расчета факта)"""
+    if 'Дата визита' in visits_df.columns:
+        visits_df['Дата визита'] = pd.to_datetime(visits_df['Дата визита'], errors='coerce', dayfirst=True)
+        visits_df['Дата визита'] = visits_df['Дата визита'].dt.normalize()
+
+
+class VisitCube:
+    """
+    Число визитов и сумма оплаты по ключу визита, группе статуса и признаку периода.
+    Строится один раз на расчет (compute_core.calculate_plan_fact) и передается
+    в расчет плана и факта.
+    """
+
+    def __init__(self, visits_df, calc_params):
+        self.status_col = find_status_column(visits_df)
+        self.rs_col = find_rs_column(visits_df)
+        self.has_dates = 'Дата визита' in visits_df.columns
+        normalize_visit_dates(visits_df)
+
+        rs_cols = [col for col in dict.fromkeys([WEIGHT_RS_COL, self.rs_col]) if col in visits_df.columns]
+        self.fact_keys = PLAN_KEYS + ['АСС'] + ([self.rs_col] if self.rs_col else [])
+        key_cols = [col for col in dict.fromkeys(PLAN_KEYS + ['АСС'] + rs_cols) if col in visits_df.columns]
+
+        frame = visits_df[key_cols].copy()
+        frame[BUCKET_COL] = self._buckets(visits_df)
+        if self.has_dates:
+            start_date = pd.Timestamp(calc_params['start_date'])
+            end_date = pd.Timestamp(calc_params['end_date'])
+            frame[PERIOD_COL] = ((visits_df['Дата визита'] >= start_date) &
+                                 (visits_df['Дата визита'] <= end_date)).to_numpy()
+        else:
+            # Без дат (Optima и др.) факт на дату = факт проекта
+            frame[PERIOD_COL] = True
+        frame['_Оплата'] = visits_df['Оплата факт'] if 'Оплата факт' in visits_df.columns else 0
+
+        # Пустые ключи остаются в кубе: каждая свертка отбрасывает их только по своим колонкам
+        self.cube = frame.groupby(key_cols + [BUCKET_COL, PERIOD_COL], dropna=False, sort=False, observed=True).agg(
+            visits=('_Оплата', 'size'), payment=('_Оплата', 'sum')
+        ).reset_index()
+        self.visits = len(visits_df)
+
+    def _buckets(self, visits_df):
+        if self.status_col is None:
+            return np.full(len(visits_df), BUCKET_OTHER)
+        status = visits_df[self.status_col]
+        stripped = status.astype(str).str.strip()
+        return np.select(
+            [status.isin(COMPLETED_STATUSES).to_numpy(), (stripped == 'Поручено').to_numpy(),
+             (stripped == 'Не поручено').to_numpy(), (stripped == 'Удалено').to_numpy()],
+            [BUCKET_COMPLETED, BUCKET_ASSIGNED, BUCKET_NOT_ASSIGNED, BUCKET_DELETED],
+            default=BUCKET_OTHER
+        )
+
+    def __len__(self):
+        return len(self.cube)
+
+    def memory_bytes(self):
+        """Память куба (memory_usage(deep=True))"""
+        return int(self.cube.memory_usage(index=True, deep=True).sum())
+
+    def rollup(self, keys, value='visits', mask=None):
+        """Сумма value по keys (строки с пустым ключом не учитываются, как в groupby)"""
+        cube = self.cube if mask is None else self.cube[mask]
+        return cube.groupby(keys, sort=False, observed=True)[value].sum()
+
+    # ============================================
+    # ПЛАН
+    # ============================================
+
+    def plan_totals(self):
+        """Визитов по ключу плана (клиент, код, волна, регион) - все статусы и даты"""
+        return self.rollup(PLAN_KEYS)
+
+    def rs_weights(self):
+        """Доля RS в визитах ключа плана без удаленных визитов: Series (ключ плана + RS) → доля"""
+        counts = self.rollup(PLAN_KEYS + [WEIGHT_RS_COL], mask=self.cube[BUCKET_COL] != BUCKET_DELETED)
+        if counts.empty:
+            return counts.astype(float)
+        totals = counts.groupby(level=list(range(len(PLAN_KEYS))), sort=False).transform('sum')
+        return counts / totals
+
+    # ============================================
+    # ФАКТ
+    # ============================================
+
+    def facts(self, status_bucket):
+        """
+        Факт по ключу (клиент, код, волна, регион, АСС, RS) для группы статуса:
+        (визитов всего, визитов в периоде, сумма оплаты) - Series с общим ключом.
+        """
+        mask = self.cube[BUCKET_COL] == status_bucket
+        total = self.rollup(self.fact_keys, mask=mask)
+        in_period = self.rollup(self.fact_keys, mask=mask & self.cube[PERIOD_COL])
+        payment = self.rollup(self.fact_keys, value='payment', mask=mask)
+        return total, in_period, payment